@@ -267,6 +267,21 @@ def tag(
         console.print(KishuCommand.delete_tag(notebook_path, delete_tag_name))
 
 
+@kishu_app.command()
+def gc(
+    notebook_path: Path = typer.Argument(..., help="Path to the target notebook.", show_default=False),
+    full_vacuum: bool = typer.Option(
+        False,
+        "--full",
+        help="Rewrite the whole database to reclaim space. Blocks the attached kernel's commits while running.",
+    ),
+) -> None:
+    """
+    Delete commits unreachable from any branch, tag or HEAD.
+    """
+    console.print(KishuCommand.gc(notebook_path, full_vacuum=full_vacuum))
+
+
 """
 Kishu Experimental Commands.
 """
@@ -23,11 +23,14 @@
 from kishu.jupyterint import JupyterCommandResult, JupyterConnection, KishuForJupyter, KishuSession
 from kishu.logging import logger
 from kishu.notebook_id import NotebookId
+from kishu.planning.ahg_cache import AHGCache
 from kishu.planning.planner import CheckpointRestorePlanner
 from kishu.storage.branch import BranchRow, HeadBranch, KishuBranch
 from kishu.storage.commit import CommitEntry, CommitEntryKind, FormattedCell, KishuCommit
 from kishu.storage.commit_graph import CommitNodeInfo, KishuCommitGraph
+from kishu.storage.gc import GarbageCollectionStats, KishuGarbageCollector
 from kishu.storage.path import KishuPath, NotebookPath
+from kishu.storage.snapshot_cache import SnapshotCache
 from kishu.storage.tag import KishuTag, TagRow
 from kishu.storage.variable_version import VariableVersion
 
@@ -266,6 +269,14 @@ class ListTagResult:
     tags: List[TagRow]
 
 
+@dataclass_json
+@dataclass
+class GCResult:
+    status: str
+    message: str
+    stats: Optional[GarbageCollectionStats] = None
+
+
 @dataclass
 class FECommit:
     oid: str
@@ -690,6 +701,23 @@ def list_tag(notebook_path: Path) -> ListTagResult:
         database_path = KishuPath.database_path(notebook_path)
         return ListTagResult(tags=KishuTag(database_path).list_tag())
 
+    @staticmethod
+    def gc(notebook_path: Path, full_vacuum: bool = False) -> GCResult:
+        NotebookPath.verify_valid_and_initialized(notebook_path)
+        database_path = KishuPath.database_path(notebook_path)
+        stats = KishuGarbageCollector(database_path).collect(full_vacuum=full_vacuum)
+        AHGCache.invalidate(database_path)
+        SnapshotCache.invalidate(database_path)
+        return GCResult(
+            status="ok",
+            message=(
+                f"Deleted {stats.num_deleted_commits} unreachable commits, reclaimed "
+                f"{stats.reclaimed_bytes + stats.deleted_buffer_bytes + stats.reclaimed_packfile_bytes} bytes"
+                f" in {stats.runtime_s:.3f}s."
+            ),
+            stats=stats,
+        )
+
     @staticmethod
     def fe_commit_graph(notebook_path: Path) -> FEInitializeResult:
         NotebookPath.verify_valid_and_initialized(notebook_path)
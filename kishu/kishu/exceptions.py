@@ -61,6 +61,11 @@ def __init__(self, commit_id: str):
         super().__init__(f"Commit ID '{commit_id}' does not exist.")
 
 
+class CheckpointPendingError(Exception):
+    def __init__(self, commit_id: str):
+        super().__init__(f"The checkpoint of commit ID '{commit_id}' is still being written.")
+
+
 """
 Raised by tag
 """
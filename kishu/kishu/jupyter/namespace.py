@@ -1,21 +1,109 @@
 from __future__ import annotations
 
-from typing import Any, Dict, List, Optional, Set, Tuple
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+LoadCallback = Callable[[Dict[str, Any]], None]
+
+
+class LazyVariable:
+    """
+    Placeholder for a checked out variable, replaced by its value in the namespace on first access.
+
+    @param name: name of the variable.
+    @param loader: returns the variables loaded together with this variable, e.g., all variables of its snapshot.
+    """
+
+    __slots__ = ("name", "loader")
+
+    def __init__(self, name: str, loader: Callable[[], Dict[str, Any]]) -> None:
+        self.name = name
+        self.loader = loader
+
+    def __repr__(self) -> str:
+        return f"<{self.name}: not loaded yet>"
 
 
 class TrackedNamespace(dict):
     """
     Wrapper class for monkey-patching Jupyter namespace to monitor variable accesses.
+
+    Reading variables through the namespace, e.g., globals()[name], globals().items(), dict(globals()) or %whos, loads
+    lazy variables first, so user code never sees their placeholders. Only raw_items and raw_values return the
+    placeholders, for Kishu to inspect lazy variables without loading them.
     """
 
     def __init__(self, *args, **kwargs) -> None:
         dict.__init__(self, *args, **kwargs)
         self._accessed_vars: Set[str] = set()
         self._assigned_vars: Set[str] = set()
+        self._load_callback: Optional[LoadCallback] = None
 
     def __getitem__(self, name: str) -> Any:
         self._accessed_vars.add(name)
-        return dict.__getitem__(self, name)
+        value = dict.__getitem__(self, name)
+        if type(value) is LazyVariable:
+            value = self._load(value)
+        return value
+
+    def get(self, name: str, default: Any = None) -> Any:
+        value = dict.get(self, name, default)
+        if type(value) is LazyVariable:
+            value = self._load(value)
+        return value
+
+    def pop(self, name: str, *args: Any) -> Any:
+        value = dict.get(self, name)
+        if type(value) is LazyVariable:
+            self._load(value)
+        return dict.pop(self, name, *args)
+
+    def items(self):
+        self._load_all()
+        return dict.items(self)
+
+    def values(self):
+        self._load_all()
+        return dict.values(self)
+
+    def raw_items(self):
+        """
+        Returns the items of the namespace without loading lazy variables, which are returned as placeholders.
+        """
+        return dict.items(self)
+
+    def raw_values(self):
+        """
+        Returns the values of the namespace without loading lazy variables, which are returned as placeholders.
+        """
+        return dict.values(self)
+
+    def __eq__(self, other: Any) -> bool:
+        self._load_all()
+        if isinstance(other, TrackedNamespace):
+            other._load_all()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other: Any) -> bool:
+        return not self == other
+
+    def _load_all(self) -> None:
+        lazy_variables = [value for value in dict.values(self) if type(value) is LazyVariable]
+        for lazy_variable in lazy_variables:
+            # Skip placeholders replaced by loading another variable of the same snapshot.
+            if dict.get(self, lazy_variable.name) is lazy_variable:
+                self._load(lazy_variable)
+
+    def _load(self, lazy_variable: LazyVariable) -> Any:
+        # Only replace the placeholders of the loaded variables; others may have been reassigned since.
+        loaded = {
+            name: value
+            for name, value in lazy_variable.loader().items()
+            if type(dict.get(self, name)) is LazyVariable and dict.__getitem__(self, name).loader is lazy_variable.loader
+        }
+        dict.update(self, loaded)
+        if self._load_callback is not None:
+            self._load_callback(loaded)
+        return dict.__getitem__(self, lazy_variable.name)
 
     def __setitem__(self, name: str, value: Any) -> None:
         self._assigned_vars.add(name)
@@ -37,6 +125,17 @@ def assigned_vars(self) -> Set[str]:
     def reset_assigned_vars(self) -> None:
         self._assigned_vars = set()
 
+    def lazy_vars(self) -> Set[str]:
+        return set(name for name, value in self.raw_items() if type(value) is LazyVariable)
+
+    def set_load_callback(self, callback: Optional[LoadCallback]) -> None:
+        self._load_callback = callback
+
+    def defer(self, names: Set[str]) -> None:
+        variables = {name: dict.__getitem__(self, name) for name in names}
+        loader = variables.copy
+        dict.update(self, {name: LazyVariable(name, loader) for name in names})
+
 
 class Namespace:
     """
@@ -66,20 +165,28 @@ def __setitem__(self, key, value) -> Any:
         self._tracked_namespace[key] = value
 
     def __eq__(self, other) -> bool:
-        return dict(self._tracked_namespace) == dict(self._tracked_namespace)
+        return isinstance(other, Namespace) and self._tracked_namespace == other._tracked_namespace
 
     def get_tracked_namespace(self) -> TrackedNamespace:
         return self._tracked_namespace
 
     def keyset(self) -> Set[str]:
-        return set(varname for varname, _ in filter(Namespace.no_ipython_var, self._tracked_namespace.items()))
+        # Listing variable names does not load lazy variables.
+        return set(varname for varname, _ in filter(Namespace.no_ipython_var, self._tracked_namespace.raw_items()))
 
     def to_dict(self) -> Dict[str, Any]:
         return {k: v for k, v in filter(Namespace.no_ipython_var, self._tracked_namespace.items())}
 
+    def to_raw_dict(self) -> Dict[str, Any]:
+        """
+        Same as to_dict, but keeps the placeholders of lazy variables instead of loading them, e.g., to move lazy
+        variables to another namespace.
+        """
+        return {k: v for k, v in filter(Namespace.no_ipython_var, self._tracked_namespace.raw_items())}
+
     def update(self, other: Namespace):
-        # Need to filter with other.to_dict() to not replace ipython variables.
-        self._tracked_namespace.update(other.to_dict())
+        # Need to filter with other.to_raw_dict() to not replace ipython variables.
+        self._tracked_namespace.update(other.to_raw_dict())
 
     def accessed_vars(self) -> Set[str]:
         return set(name for name in self._tracked_namespace.accessed_vars() if Namespace.no_ipython_var((name, None)))
@@ -93,6 +200,25 @@ def assigned_vars(self) -> Set[str]:
     def reset_assigned_vars(self) -> None:
         self._tracked_namespace.reset_assigned_vars()
 
+    def lazy_vars(self) -> Set[str]:
+        """
+        Returns the variables not loaded yet since a lazy checkout.
+        """
+        return self._tracked_namespace.lazy_vars()
+
+    def set_load_callback(self, callback: Optional[LoadCallback]) -> None:
+        """
+        Sets the function called with the variables loaded on first access to a lazy variable.
+        """
+        self._tracked_namespace.set_load_callback(callback)
+
+    def defer(self, names: Set[str]) -> None:
+        """
+        Replaces the variables with lazy variables loading them back together on first access to one of them, e.g.,
+        to process variables sharing objects once they are first accessed. The variables must not be lazy already.
+        """
+        self._tracked_namespace.defer(names)
+
     def ipython_in(self) -> Optional[List[str]]:
         return self._tracked_namespace["In"] if "In" in self._tracked_namespace else None
 
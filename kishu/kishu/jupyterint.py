@@ -49,7 +49,7 @@
 import uuid
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 import dill as pickle
 import ipylab
@@ -71,16 +71,25 @@
 from kishu.jupyter.namespace import Namespace
 from kishu.jupyter.runtime import JupyterRuntimeEnv
 from kishu.notebook_id import NotebookId
-from kishu.planning.plan import RestorePlan
+from kishu.planning.background import BackgroundCheckpointer
+from kishu.planning.plan import (
+    DEFAULT_RERUN_WORKERS,
+    DEFAULT_RESTORE_WORKERS,
+    DEFAULT_RESUME_LAZY_SIZE,
+    LazyVariablePrefetcher,
+    RestorePlan,
+)
 from kishu.planning.planner import ChangedVariables, CheckpointRestorePlanner
+from kishu.planning.undo import DEFAULT_UNDO_BUFFER_CELLS, DEFAULT_UNDO_BUFFER_SIZE, UndoBuffer
 from kishu.planning.variable_version_tracker import VariableVersionTracker
 from kishu.storage.branch import KishuBranch
-from kishu.storage.checkpoint import KishuCheckpoint
+from kishu.storage.checkpoint import DEFAULT_ASYNC_CHECKPOINT_TIMEOUT_S, KishuCheckpoint
 from kishu.storage.commit import CommitEntry, CommitEntryKind, FormattedCell, KishuCommit, NotebookCommitState
-from kishu.storage.commit_graph import KishuCommitGraph
+from kishu.storage.commit_graph import ABSOLUTE_PAST, KishuCommitGraph
 from kishu.storage.config import Config, PersistentConfig
 from kishu.storage.connection import KishuConnection
 from kishu.storage.disk_ahg import KishuDiskAHG
+from kishu.storage.gc import KishuGarbageCollector
 from kishu.storage.path import KishuPath
 from kishu.storage.tag import KishuTag
 from kishu.storage.variable_version import VariableVersion
@@ -259,6 +268,9 @@ def __init__(
     ) -> None:
         self._notebook_id = notebook_id
 
+        # Enable incremental vacuuming before any table is created.
+        KishuGarbageCollector.init_database(self.database_path())
+
         # Initialize persistent config.
         self._persistent_config = PersistentConfig(self.database_path())
         self._persistent_config.init_database()
@@ -274,6 +286,37 @@ def __init__(
         )
         self._incremental_cr = self._persistent_config.get("PLANNER", "incremental_store", True)
 
+        # Write checkpoints in forked processes. Only incremental checkpoints, whose restoration recomputes missing
+        # variable snapshots, may be skipped when the previous checkpoint is still being written. The prefetcher of
+        # lazy variables is stopped while forking, as the child would inherit the locks its thread holds.
+        self._background_checkpointer = BackgroundCheckpointer(
+            enabled=Config.get("PLANNER", "async_checkpoint", False),
+            coalesce=self._incremental_cr,
+            kishu_checkpoint=KishuCheckpoint(self.database_path(), self._incremental_cr),
+            timeout_s=Config.get("PLANNER", "async_checkpoint_timeout_s", DEFAULT_ASYNC_CHECKPOINT_TIMEOUT_S),
+            before_fork=lambda: self._lazy_variable_prefetcher.stop(),
+            after_fork=lambda: self._lazy_variable_prefetcher.start(self._user_ns),
+        )
+
+        # Check out variable snapshots as lazy variables, loaded on first access or by a background prefetcher.
+        self._lazy_checkout = Config.get("PLANNER", "lazy_checkout", False)
+        self._lazy_variable_prefetcher = LazyVariablePrefetcher()
+
+        # Load the variables to check out on a thread pool while checkout reruns cells.
+        self._restore_workers = Config.get("PLANNER", "restore_workers", DEFAULT_RESTORE_WORKERS)
+
+        # Rerun independent chains of cells in forked processes during checkout.
+        self._rerun_workers = Config.get("PLANNER", "rerun_workers", DEFAULT_RERUN_WORKERS)
+
+        # Resume variable snapshots at least this large as lazy variables.
+        self._resume_lazy_size = Config.get("PLANNER", "resume_lazy_size", DEFAULT_RESUME_LAZY_SIZE)
+
+        # Keep the variables changed by the last cells pickled in memory to check out their parents without storage.
+        self._undo_buffer = UndoBuffer(
+            max_cells=Config.get("PLANNER", "undo_buffer_cells", DEFAULT_UNDO_BUFFER_CELLS),
+            max_size=Config.get("PLANNER", "undo_buffer_size", DEFAULT_UNDO_BUFFER_SIZE),
+        )
+
         # Kishu info and storages.
         self._kishu_connection = KishuConnection(
             key=self._notebook_id.key(),
@@ -301,7 +344,8 @@ def __init__(
         self._kishu_variable_version.init_database()
         self._kishu_disk_ahg.init_database()
 
-        # Always reset head.
+        # Always reset head, keeping the previous head to resume after a kernel restart.
+        self._resumable_head = self._kishu_branch.get_head()
         self._kishu_branch.reset_head()
         self._kishu_graph.reset()
         self._kishu_nb_graph.reset()
@@ -373,6 +417,7 @@ def uninstall_kishu_hooks(self) -> None:
         except ValueError:
             pass
         del self._ip.user_ns[KISHU_INSTRUMENT]
+        self._background_checkpointer.wait()
 
     def enable_autosave_notebook(self) -> None:
         if self._test_mode:  # TODO: re-enable notebook saving during tests when possible/supported.
@@ -423,6 +468,10 @@ def checkout(self, branch_or_commit_id: str, skip_notebook: bool = False) -> Bar
         # Save notebook on checkout to avoid diverged notebook views between Jupyter Frontend and file system.
         self.save_notebook()
 
+        # Checkpoints being written in the background may be needed for restoration.
+        self._background_checkpointer.wait()
+        self._lazy_variable_prefetcher.stop()
+
         # By default, checkout at commit ID in detach mode.
         branch_name: Optional[str] = None
         commit_id = branch_or_commit_id
@@ -455,37 +504,31 @@ def checkout(self, branch_or_commit_id: str, skip_notebook: bool = False) -> Bar
             # Erase execution counts, assuming only checking out older execution.
             self._edit_execution_counts(commit_entry)
 
-        # Restore list of executed cells.
-        if commit_entry.executed_cells is not None:
-            current_executed_cells = self._user_ns.ipython_in()
-            if current_executed_cells is not None:
-                current_executed_cells[:] = commit_entry.executed_cells[:]
+        self._restore_executions(commit_entry)
 
-        # Restore IPython output maps.
-        # Currently, this restores string representation of the outputs.
-        # TODO: Restore the original object.
-        if commit_entry.executed_outputs is not None:
-            current_executed_outputs = self._user_ns.ipython_out()
-            if current_executed_outputs is not None:
-                current_executed_outputs.update(commit_entry.executed_outputs)
-                for key in current_executed_outputs.keys():
-                    if key not in commit_entry.executed_outputs:
-                        del current_executed_outputs[key]
-
-        # Restore execution count.
-        if commit_entry.execution_count is not None:
-            self._ip.execution_count = commit_entry.execution_count + 1  # _ip.execution_count is the next count.
-
-        # Use the (non-incremental) restore plan or a dynamically computed incremental restore plan depending on config.
-        if self._incremental_cr:
-            restore_plan = self._cr_planner.generate_incremental_restore_plan(self.database_path(), commit_id)
-        else:
-            restore_plan = commit_entry.restore_plan
-
-        commit_ns = restore_plan.run(database_path, commit_id)
-        self._checkout_namespace(self._user_ns, commit_ns)
+        # Undo the last cells from memory if possible. Otherwise, use the (non-incremental) restore plan or a
+        # dynamically computed incremental restore plan depending on config.
+        memoized_note = ""
+        if not self._undo_buffer.undo(self._kishu_graph.head(), commit_id, self._user_ns):
+            self._undo_buffer.clear()
+            if self._incremental_cr:
+                restore_plan = self._cr_planner.generate_incremental_restore_plan(self.database_path(), commit_id)
+            else:
+                restore_plan = commit_entry.restore_plan
+
+            commit_ns = restore_plan.run(
+                database_path,
+                commit_id,
+                lazy=self._lazy_checkout,
+                num_workers=self._restore_workers,
+                rerun_workers=self._rerun_workers,
+            )
+            self._checkout_namespace(self._user_ns, commit_ns, self._cr_planner.get_unchanged_variables(commit_id))
+            memoized_note = KishuForJupyter._memoized_note(restore_plan)
 
         self._cr_planner.replace_state(commit_id, self._user_ns)
+        if self._lazy_checkout:
+            self._lazy_variable_prefetcher.start(self._user_ns)
         self._variable_version_tracker.set_current(self._kishu_variable_version.get_variable_version_by_commit_id(commit_id))
 
         # Update Kishu heads.
@@ -502,11 +545,64 @@ def checkout(self, branch_or_commit_id: str, skip_notebook: bool = False) -> Bar
         # Create new commit when skip restoring notebook.
         if self._enable_auto_commit_when_skip_notebook and skip_notebook:
             new_commit = self.commit(f"Checked out vars from {commit_entry.message}")
-            return BareReprStr(f"Checkout {commit_id} only variables and commit {new_commit}.")
+            return BareReprStr(f"Checkout {commit_id} only variables and commit {new_commit}.{memoized_note}")
 
         if is_detach:
-            return BareReprStr(f"Checkout {commit_id} in detach mode.")
-        return BareReprStr(f"Checkout {branch_or_commit_id} ({commit_id}).")
+            return BareReprStr(f"Checkout {commit_id} in detach mode.{memoized_note}")
+        return BareReprStr(f"Checkout {branch_or_commit_id} ({commit_id}).{memoized_note}")
+
+    def resume(self) -> BareReprStr:
+        """
+        Restores the variable state of the head before this instance was attached, e.g., before the kernel restarted,
+        leaving the notebook as is. Unlike checkout, variable snapshots at least resume_lazy_size bytes large are
+        loaded on first access or by a background prefetcher, and the ID graphs of restored variables are built on
+        first access instead of before the next cell. This returns control sooner and spares cells not accessing those
+        variables, but the first cell accessing them pays for loading them and building their ID graphs instead.
+        """
+        commit_id = self._resumable_head.commit_id
+        if commit_id is None:
+            raise ValueError("No head to resume")
+        if self._kishu_graph.head() != ABSOLUTE_PAST:
+            raise ValueError("Cannot resume after cells have run or a commit was checked out")
+        commit_entry = self._kishu_commit.get_commit(commit_id)
+        if commit_entry.restore_plan is None:
+            raise ValueError("No restore plan found for commit_id = {}".format(commit_id))
+        self._restore_executions(commit_entry)
+
+        # Loading every stored variable snapshot reruns only the cells whose outputs could not be stored.
+        if self._incremental_cr:
+            restore_plan = self._cr_planner.generate_incremental_restore_plan(self.database_path(), commit_id)
+        else:
+            restore_plan = commit_entry.restore_plan
+        commit_ns = restore_plan.run(
+            self.database_path(),
+            commit_id,
+            lazy=True,
+            num_workers=self._restore_workers,
+            rerun_workers=self._rerun_workers,
+            lazy_min_size=self._resume_lazy_size,
+        )
+        self._checkout_namespace(self._user_ns, commit_ns, set())
+        self._cr_planner.replace_state(commit_id, self._user_ns, defer_id_graphs=True)
+        self._lazy_variable_prefetcher.start(self._user_ns)
+        self._variable_version_tracker.set_current(self._kishu_variable_version.get_variable_version_by_commit_id(commit_id))
+
+        # Update Kishu heads.
+        self._kishu_graph.jump(commit_id)
+        self._kishu_nb_graph.jump(commit_id)
+        self._kishu_branch.update_head(
+            branch_name=self._resumable_head.branch_name,
+            commit_id=commit_id,
+            is_detach=self._resumable_head.branch_name is None,
+        )
+        self._checkout_id += 1
+        return BareReprStr(f"Resumed {commit_id}.{KishuForJupyter._memoized_note(restore_plan)}")
+
+    def has_resumable_head(self) -> bool:
+        """
+        Returns whether there is a head from before this instance was attached to resume.
+        """
+        return self._resumable_head.commit_id is not None
 
     def pre_run_cell(self, info) -> None:
         """
@@ -521,6 +617,7 @@ def pre_run_cell(self, info) -> None:
         print(dir(info))
         """
         self._start_time = time.time()
+        self._background_checkpointer.start_pending()
         self._cr_planner.pre_run_cell_update()
 
     def post_run_cell(self, result) -> None:
@@ -626,32 +723,50 @@ def _commit_entry(self, entry: CommitEntry, changed_vars: Optional[ChangedVariab
         entry.commit_id = self._commit_id()
         entry.timestamp = time.time()
 
-        # Update optimization items.
-        changed_vars = self._cr_planner.post_run_cell_update(
-            entry.commit_id, entry.raw_cell, entry.end_time - entry.start_time if entry.end_time and entry.start_time else 1.0
-        )
-
-        # Observe all executed cells and outputs.
-        entry.executed_cells = self._user_ns.ipython_in()
-        executed_outputs = self._user_ns.ipython_out()
-        entry.executed_outputs = {k: str(v) for k, v in executed_outputs.items()} if executed_outputs is not None else None
-
-        # Readn and fill in notebook state.
-        self._read_and_fill_notebook_state(entry)
-        entry.nb_record_type = NotebookCommitState.with_commit
-
-        # Plan for checkpointing and restoration.
-        checkpoint_start_time = time.time()
-        entry.restore_plan, entry.varset_version = self._checkpoint(entry)
-
-        checkpoint_runtime_s = time.time() - checkpoint_start_time
-        entry.checkpoint_runtime_s = checkpoint_runtime_s
+        # Garbage collection keeps the commit while its rows are written before HEAD steps to it.
+        self._kishu_checkpoint.mark_pending(entry.commit_id, os.getpid())
+        try:
+            # Update optimization items.
+            changed_vars = self._cr_planner.post_run_cell_update(
+                entry.commit_id,
+                entry.raw_cell,
+                entry.end_time - entry.start_time if entry.end_time and entry.start_time else 1.0,
+            )
 
-        # Update other structures.
-        self._kishu_commit.store_commit(entry)
-        self._kishu_graph.step(entry.commit_id)
-        self._kishu_nb_graph.step(entry.commit_id)
-        self._step_branch(entry.commit_id)
+            # Observe all executed cells and outputs.
+            entry.executed_cells = self._user_ns.ipython_in()
+            executed_outputs = self._user_ns.ipython_out()
+            entry.executed_outputs = {k: str(v) for k, v in executed_outputs.items()} if executed_outputs is not None else None
+
+            # Readn and fill in notebook state.
+            self._read_and_fill_notebook_state(entry)
+            entry.nb_record_type = NotebookCommitState.with_commit
+
+            # Plan for checkpointing and restoration.
+            checkpoint_start_time = time.time()
+            entry.restore_plan, entry.varset_version = self._checkpoint(entry)
+
+            checkpoint_runtime_s = time.time() - checkpoint_start_time
+            entry.checkpoint_runtime_s = checkpoint_runtime_s
+
+            # Update other structures.
+            if self._undo_buffer.enabled():
+                parent_commit_id = self._kishu_graph.head()
+                self._undo_buffer.record(
+                    entry.commit_id,
+                    parent_commit_id,
+                    self._cr_planner.get_ahg().get_active_variable_snapshots(parent_commit_id),
+                    self._cr_planner.get_ahg().get_active_variable_snapshots(entry.commit_id),
+                    self._user_ns,
+                )
+            self._kishu_commit.store_commit(entry)
+            self._kishu_graph.step(entry.commit_id)
+            self._kishu_nb_graph.step(entry.commit_id)
+            self._step_branch(entry.commit_id)
+        finally:
+            # Otherwise, the background checkpointer unmarks the commit once its checkpoint is written.
+            if not self._background_checkpointer.is_writing(entry.commit_id):
+                self._kishu_checkpoint.unmark_pending(entry.commit_id)
 
         # Update variable version tracker.
         self._variable_version_tracker.update_variable_version(
@@ -693,8 +808,8 @@ def _checkpoint(self, cell_info: CommitEntry) -> Tuple[RestorePlan, int]:
             self.database_path(), cell_info.commit_id
         )
 
-        # Step 2: checkpoint
-        checkpoint_plan.run(self._user_ns)
+        # Step 2: checkpoint, possibly in the background.
+        self._background_checkpointer.submit(cell_info.commit_id, checkpoint_plan, self._user_ns)
 
         # Extra: generate variable version.
         data_version = hash(pickle.dumps(self._cr_planner.get_ahg().get_active_variable_snapshots(cell_info.commit_id)))
@@ -814,11 +929,50 @@ def _edit_execution_counts(self, entry: CommitEntry) -> None:
         # Reload frontend to reflect edited notebook. This may prompts a confirmation dialog.
         self.reload_jupyter_frontend()
 
-    def _checkout_namespace(self, user_ns: Namespace, target_ns: Namespace) -> None:
-        user_ns.update(target_ns)
+    def _restore_executions(self, commit_entry: CommitEntry) -> None:
+        """
+        Restores the executed cells, their outputs, and the execution count of commit_entry.
+        """
+        # Restore list of executed cells.
+        if commit_entry.executed_cells is not None:
+            current_executed_cells = self._user_ns.ipython_in()
+            if current_executed_cells is not None:
+                current_executed_cells[:] = commit_entry.executed_cells[:]
+
+        # Restore IPython output maps.
+        # Currently, this restores string representation of the outputs.
+        # TODO: Restore the original object.
+        if commit_entry.executed_outputs is not None:
+            current_executed_outputs = self._user_ns.ipython_out()
+            if current_executed_outputs is not None:
+                current_executed_outputs.update(commit_entry.executed_outputs)
+                for key in current_executed_outputs.keys():
+                    if key not in commit_entry.executed_outputs:
+                        del current_executed_outputs[key]
+
+        # Restore execution count.
+        if commit_entry.execution_count is not None:
+            self._ip.execution_count = commit_entry.execution_count + 1  # _ip.execution_count is the next count.
+
+    @staticmethod
+    def _memoized_note(restore_plan: RestorePlan) -> str:
+        if not restore_plan.memoized_actions:
+            return ""
+        return (
+            f" Skipped rerunning {len(restore_plan.memoized_actions)} cell(s) with stored outputs,"
+            f" saving {restore_plan.memoized_runtime_s():.2f}s."
+        )
+
+    def _checkout_namespace(self, user_ns: Namespace, target_ns: Namespace, unchanged_vars: Set[str]) -> None:
+        """
+        Replaces the variables of user_ns with those of target_ns, except for unchanged_vars, which stay in place.
+        """
         for key in list(user_ns.keyset()):
-            if key not in target_ns:
+            if key not in target_ns and key not in unchanged_vars:
                 del user_ns[key]
+        for key, value in target_ns.to_raw_dict().items():
+            if key not in unchanged_vars or key not in user_ns:
+                user_ns[key] = value
 
 
 def repr_if_not_none(obj: Any) -> Optional[str]:
@@ -832,7 +986,12 @@ def repr_if_not_none(obj: Any) -> Optional[str]:
 Namespace.register_kishu_vars(KISHU_VARS)
 
 
-def init_kishu(notebook_path: Optional[str] = None) -> None:
+def init_kishu(notebook_path: Optional[str] = None, resume: bool = False) -> None:
+    """
+    Attaches Kishu to the notebook's kernel.
+
+    @param resume: whether to restore the variable state of the notebook's last head, e.g., after a kernel restart.
+    """
     # Create notebook id.
     notebook_id = NotebookId.from_enclosing(None if notebook_path is None else Path(notebook_path))
 
@@ -853,6 +1012,11 @@ def init_kishu(notebook_path: Optional[str] = None) -> None:
 
     # Attach Kishu instrumentation.
     kishu.install_kishu_hooks()
+    if resume:
+        if kishu.has_resumable_head():
+            kishu.resume()
+        else:
+            print("WARNING: No earlier head to resume. Kishu starts from the current variable state.")
     kishu.reload_jupyter_frontend()
 
 
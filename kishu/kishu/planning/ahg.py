@@ -1,12 +1,13 @@
 from __future__ import annotations
 
-import functools
 from collections import defaultdict
 from dataclasses import dataclass, field
 from itertools import chain
 from typing import Dict, FrozenSet, List, Set, Tuple
 
 from kishu.jupyter.namespace import Namespace
+from kishu.planning.ahg_cache import AHGCache, AHGCacheStats
+from kishu.planning.ahg_snapshot import AHGSnapshot
 from kishu.storage.commit_graph import CommitId
 from kishu.storage.disk_ahg import (
     AHGUpdateResult,
@@ -54,7 +55,9 @@ class AHG:
     Variable Snapshots (VSs) and Cell Executions (CEs) are the nodes of the AHG.
     Edges represent dependencies between VSs and CEs.
 
-    This class is the cached in-memory of the KishuDiskAHG which handles optimization logic.
+    This class is the cached in-memory of the KishuDiskAHG which handles optimization logic. The adjacency of the graph
+    is loaded in bulk into an AHGSnapshot on first use and kept up to date on each update_graph. The snapshot and query
+    results are held in an AHGCache shared by all AHGs of the same database in the process.
     """
 
     def __init__(self, disk_ahg: KishuDiskAHG) -> None:
@@ -62,6 +65,7 @@ def __init__(self, disk_ahg: KishuDiskAHG) -> None:
         Create a new AHG. Called when Kishu is initialized for a notebook.
         """
         self._disk_ahg = disk_ahg
+        self._cache = AHGCache.for_database(disk_ahg.database_path)
 
         # Existing cells in the session prior to Kishu being attached.
         self._existing_cells: str = ""
@@ -139,49 +143,79 @@ def update_graph(self, update_info: AHGUpdateInfo) -> None:
         # Update set of active VSes (those still active from previous cell exec + created VSes + modified VSes).
         new_active_variables = unmodified_still_active_vss + output_vss_create + output_vss_modify
 
-        self._disk_ahg.store_update_results(
-            AHGUpdateResult(update_info.commit_id, accessed_vss, output_vss, newest_ce, new_active_variables)
+        update_result = AHGUpdateResult(
+            update_info.commit_id,
+            accessed_vss,
+            output_vss,
+            newest_ce,
+            new_active_variables,
+            update_info.parent_commit_id,
         )
+        snapshot = self.get_snapshot()
+        self._disk_ahg.store_update_results(update_result)
+        snapshot.update(update_result)
+        self._cache.note_append()
+
+    def get_snapshot(self) -> AHGSnapshot:
+        return self._cache.get_snapshot()
+
+    def get_cache_stats(self) -> AHGCacheStats:
+        return self._cache.stats
 
     def get_all_cell_executions(self) -> Set[CellExecution]:
-        return set(self._disk_ahg.get_all_cell_executions())
+        snapshot = self.get_snapshot()
+        return set(snapshot.get_ces(range(snapshot.num_ces())))
 
     def get_all_variable_snapshots(self) -> Set[VariableSnapshot]:
-        return set(self._disk_ahg.get_all_variable_snapshots())
+        return set(self.get_snapshot().vss)
 
-    @functools.lru_cache(maxsize=None)
     def get_active_variable_snapshots(self, commit_id: CommitId) -> Set[VariableSnapshot]:
-        return set(self._disk_ahg.get_active_vses(commit_id))
+        return self._cache.get(
+            ("active_variable_snapshots", commit_id),
+            lambda: self.get_vs_by_versioned_names(self._disk_ahg.get_active_versioned_names(commit_id)),
+        )
 
-    @functools.lru_cache(maxsize=None)
     def get_active_variable_names(self, commit_id: CommitId) -> Set[str]:
         # Return all variable KVs in components as a flattened set.
-        return set(chain.from_iterable([vs.name for vs in self.get_active_variable_snapshots(commit_id)]))
+        return self._cache.get(
+            ("active_variable_names", commit_id),
+            lambda: set(chain.from_iterable([vs.name for vs in self.get_active_variable_snapshots(commit_id)])),
+        )
 
-    @functools.lru_cache(maxsize=None)
     def get_vs_by_versioned_names(self, versioned_names: FrozenSet[str]) -> Set[VariableSnapshot]:
-        """
-        The conversion is for caching.
-        """
-        return set(self._disk_ahg.get_vs_by_versioned_names(list(versioned_names)))
+        snapshot = self.get_snapshot()
+        return {snapshot.vss[vs_idx] for vs_idx in snapshot.vs_indices(versioned_names)}
 
-    @functools.lru_cache(maxsize=None)
     def get_ce_by_cell_num(self, cell_num: CellExecutionNumber) -> CellExecution:
-        return self._disk_ahg.get_ce_by_cell_num(cell_num)
+        snapshot = self.get_snapshot()
+        return snapshot.get_ce(snapshot.ce_index_by_cell_num(cell_num))
 
-    @functools.lru_cache(maxsize=None)
     def get_vs_input_ce(self, vs: VariableSnapshot) -> CellExecution:
-        return self._disk_ahg.get_vs_input_ce(vs)
+        snapshot = self.get_snapshot()
+        vs_idx = snapshot.vs_index.get(vs.versioned_name())
+        if vs_idx is None:
+            raise ValueError(f"The (unique) CE creating VS with version = {vs.version} and name = {vs.name} not found")
+        return snapshot.get_ce(snapshot.input_ce_of(vs_idx))
 
-    @functools.lru_cache(maxsize=None)
     def get_ce_input_vses(self, ce: CellExecution) -> Set[VariableSnapshot]:
-        return set(self._disk_ahg.get_ce_input_vses(ce))
+        snapshot = self.get_snapshot()
+        return {snapshot.vss[vs_idx] for vs_idx in snapshot.input_vses_of(snapshot.ce_idx_of(ce))}
 
     def get_ce_output_vses(self, ce: CellExecution) -> Set[VariableSnapshot]:
+        snapshot = self.get_snapshot()
+        return {snapshot.vss[vs_idx] for vs_idx in snapshot.output_vses_of(snapshot.ce_idx_of(ce))}
+
+    def get_equivalent_ces(self, ce: CellExecution) -> List[CellExecution]:
         """
-        This is explicitly not cached as the VSes a CE contributes to is not immutable.
+        Returns the other CEs which ran the same (transformed) cell code as ce on the same input VSes, latest first.
+        Their outputs are those of ce if the cell is deterministic.
         """
-        return set(self._disk_ahg.get_ce_output_vses(ce))
+        snapshot = self.get_snapshot()
+        ce_idx = snapshot.ce_idx_of(ce)
+        candidates = [
+            idx for idx in snapshot.ces_by_inputs.get(frozenset(snapshot.input_vses_of(ce_idx)), []) if idx != ce_idx
+        ]
+        return [other_ce for other_ce in reversed(snapshot.get_ces(candidates)) if other_ce.cell == ce.cell]
 
     @staticmethod
     def union_find(variables: Set[str], linked_variables: List[Tuple[str, str]]) -> Set[VariableName]:
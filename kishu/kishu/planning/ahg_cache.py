@@ -0,0 +1,230 @@
+"""
+Process-wide caches of AHG query results, shared by all AHG instances reading the same database.
+"""
+
+from __future__ import annotations
+
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, ClassVar, Hashable, Iterator, Optional, Tuple, TypeVar
+
+from kishu.planning.ahg_snapshot import AHGSnapshot
+from kishu.storage.config import Config
+from kishu.storage.disk_ahg import (
+    AHG_ACTIVE_VSES_COMMIT_TABLE,
+    AHG_CELL_EXECUTION_TABLE,
+    AHG_GENERATION_TABLE,
+    KishuDiskAHG,
+)
+
+# Default maximum number of cached query results per database.
+DEFAULT_AHG_CACHE_SIZE = 1024
+
+# Maximum number of databases with caches kept alive in a process.
+MAX_CACHED_DATABASES = 16
+
+T = TypeVar("T")
+
+# (max rowid of the CE table, max rowid of the commit table, generation) of the AHG. Appends grow the max rowids by
+# one each, while other changes to existing nodes (e.g., garbage collection) bump the generation.
+AHGFingerprint = Tuple[int, int, int]
+
+READ_FINGERPRINT_SQL = f"""
+select
+    (select coalesce(max(rowid), 0) from {AHG_CELL_EXECUTION_TABLE}),
+    (select coalesce(max(rowid), 0) from {AHG_ACTIVE_VSES_COMMIT_TABLE}),
+    (select coalesce(max(generation), 0) from {AHG_GENERATION_TABLE})
+"""
+
+
+@dataclass
+class AHGCacheStats:
+    """
+    Counters of an AHGCache.
+
+    @param hits: number of lookups answered from the cache.
+    @param misses: number of lookups computed from the database.
+    @param evictions: number of entries evicted to stay within the size bound.
+    @param invalidations: number of times the cache was cleared due to changes made to the AHG by other connections.
+    """
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    invalidations: int = 0
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class AHGCache:
+    """
+    A size-bounded LRU cache of AHG query results (e.g., active VSes keyed by commit ID) and the AHG's in-memory
+    snapshot for a database.
+
+    Entries are valid for the database's data_version, which SQLite bumps whenever another connection commits to the
+    database. As most of these commits (checkpoints, commit entries, AHG appends) do not change existing AHG nodes, a
+    changed data_version only clears the cache if the AHG's fingerprint has also changed. The AHG's own appends are
+    applied to the snapshot in place and acknowledged with note_append. Each lookup validates the cache once, including
+    the lookups nested in computing an entry.
+    """
+
+    _caches: ClassVar[OrderedDict[str, AHGCache]] = OrderedDict()
+    _caches_lock: ClassVar[threading.Lock] = threading.Lock()
+
+    def __init__(self, database_path: Path, max_size: int = DEFAULT_AHG_CACHE_SIZE) -> None:
+        self.database_path = database_path
+        self.max_size = max_size
+        self.stats = AHGCacheStats()
+
+        self._lock = threading.RLock()
+        self._entries: OrderedDict[Hashable, object] = OrderedDict()
+        self._snapshot: Optional[AHGSnapshot] = None
+
+        # Persistent connection for reading the data_version, reopened in forked processes or if the database file is
+        # replaced.
+        self._monitor: Optional[sqlite3.Connection] = None
+        self._monitor_pid: Optional[int] = None
+        self._monitor_file_id: Optional[Tuple[int, int]] = None
+        self._data_version: Optional[int] = None
+        self._fingerprint: Optional[AHGFingerprint] = None
+        self._lookup_depth = 0
+
+    @staticmethod
+    def for_database(database_path: Path) -> AHGCache:
+        """
+        Returns the process-wide cache of the database, creating it if needed.
+        """
+        key = str(database_path)
+        with AHGCache._caches_lock:
+            cache = AHGCache._caches.get(key)
+            if cache is None:
+                cache = AHGCache(database_path, Config.get("PLANNER", "ahg_cache_size", DEFAULT_AHG_CACHE_SIZE))
+                AHGCache._caches[key] = cache
+                while len(AHGCache._caches) > MAX_CACHED_DATABASES:
+                    _, evicted_cache = AHGCache._caches.popitem(last=False)
+                    evicted_cache.close()
+            AHGCache._caches.move_to_end(key)
+            return cache
+
+    @staticmethod
+    def invalidate(database_path: Path) -> None:
+        """
+        Clears the process-wide cache of the database, if any. Called after destructive changes to the AHG.
+        """
+        with AHGCache._caches_lock:
+            cache = AHGCache._caches.get(str(database_path))
+        if cache is not None:
+            cache.clear()
+
+    def get(self, key: Hashable, compute: Callable[[], T]) -> T:
+        with self._lock, self._lookup():
+            if key in self._entries:
+                self.stats.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]  # type: ignore
+            self.stats.misses += 1
+            value = compute()
+            self._entries[key] = value
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.stats.evictions += 1
+            return value
+
+    def get_snapshot(self) -> AHGSnapshot:
+        with self._lock, self._lookup():
+            if self._snapshot is None:
+                self._snapshot = AHGSnapshot.from_db(KishuDiskAHG(self.database_path))
+            return self._snapshot
+
+    def note_append(self) -> None:
+        """
+        Acknowledges an append of one CE and one commit to the AHG made through this process (and already applied to
+        the snapshot), so that it does not invalidate the cache. The cache is cleared instead if the AHG has changed
+        otherwise since it was last validated, e.g., by another writer appending before or after this append.
+        """
+        with self._lock:
+            data_version = self._read_data_version()
+            fingerprint = self._read_fingerprint()
+            if self._fingerprint is None or fingerprint is None:
+                self.clear()
+                return
+            max_ce_rowid, max_commit_rowid, generation = self._fingerprint
+            if fingerprint != (max_ce_rowid + 1, max_commit_rowid + 1, generation):
+                if self._entries or self._snapshot is not None:
+                    self.stats.invalidations += 1
+                self.clear()
+                return
+            self._data_version = data_version
+            self._fingerprint = fingerprint
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._snapshot = None
+            self._data_version = None
+            self._fingerprint = None
+
+    def close(self) -> None:
+        with self._lock:
+            self.clear()
+            if self._monitor is not None and self._monitor_pid == os.getpid():
+                self._monitor.close()
+            self._monitor = None
+
+    @contextmanager
+    def _lookup(self) -> Iterator[None]:
+        if self._lookup_depth == 0:
+            self._validate()
+        self._lookup_depth += 1
+        try:
+            yield
+        finally:
+            self._lookup_depth -= 1
+
+    def _validate(self) -> None:
+        data_version = self._read_data_version()
+        if data_version is None:
+            # The database does not exist (yet).
+            self.clear()
+            return
+        if data_version == self._data_version:
+            return
+        fingerprint = self._read_fingerprint()
+        if fingerprint != self._fingerprint:
+            if self._entries or self._snapshot is not None:
+                self.stats.invalidations += 1
+            self._entries.clear()
+            self._snapshot = None
+        self._data_version = data_version
+        self._fingerprint = fingerprint
+
+    def _read_data_version(self) -> Optional[int]:
+        try:
+            stat = os.stat(self.database_path)
+        except FileNotFoundError:
+            return None
+        file_id = (stat.st_dev, stat.st_ino)
+        if self._monitor is None or self._monitor_pid != os.getpid() or self._monitor_file_id != file_id:
+            if self._monitor is not None and self._monitor_pid == os.getpid():
+                self._monitor.close()
+            self._monitor = sqlite3.connect(self.database_path, check_same_thread=False)
+            self._monitor_pid = os.getpid()
+            self._monitor_file_id = file_id
+            self.clear()
+        return self._monitor.execute("PRAGMA data_version").fetchone()[0]
+
+    def _read_fingerprint(self) -> Optional[AHGFingerprint]:
+        if self._monitor is None:
+            return None
+        try:
+            return self._monitor.execute(READ_FINGERPRINT_SQL).fetchone()
+        except sqlite3.OperationalError:
+            # The AHG tables have not been created yet.
+            return None
@@ -0,0 +1,167 @@
+"""
+In-memory snapshot of the AHG's adjacency for the planners.
+"""
+
+from __future__ import annotations
+
+from array import array
+from collections import defaultdict
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set
+
+from kishu.storage.disk_ahg import AHGUpdateResult, CellExecution, CellExecutionNumber, KishuDiskAHG, VariableSnapshot
+
+# Index of a node in the snapshot.
+VSIndex = int
+CEIndex = int
+
+# Placeholder for VSes without a (stored) CE creating them.
+NO_CE = -1
+
+
+class AHGSnapshot:
+    """
+    Adjacency of the AHG stored in compressed sparse row (CSR) form: VSes and CEs are numbered densely by insertion
+    order, and the input (output) VSes of the i-th CE are ce_input_vs[ce_input_offsets[i]:ce_input_offsets[i + 1]].
+    As the AHG grows by appending exactly one CE per cell execution, the CSR arrays are only ever appended to.
+
+    Cell code is not part of the snapshot; it is loaded in bulk from the database only for the CEs materialized as
+    CellExecution objects, i.e., those ending up in a plan.
+    """
+
+    def __init__(self, disk_ahg: KishuDiskAHG) -> None:
+        self._disk_ahg = disk_ahg
+
+        # VS nodes.
+        self.vss: List[VariableSnapshot] = []
+        self.vs_index: Dict[str, VSIndex] = {}
+        self.vs_input_ce: array = array("q")
+
+        # CE nodes.
+        self.ce_nums: array = array("q")
+        self.ce_runtimes: array = array("d")
+        self.ce_index: Dict[CellExecutionNumber, CEIndex] = {}
+
+        # CE to VS edges in CSR form.
+        self.ce_input_offsets: array = array("q", [0])
+        self.ce_input_vs: array = array("q")
+        self.ce_output_offsets: array = array("q", [0])
+        self.ce_output_vs: array = array("q")
+
+        # CEs by their input VSes, to find CEs which ran the same cell on the same inputs.
+        self.ces_by_inputs: Dict[FrozenSet[VSIndex], List[CEIndex]] = defaultdict(list)
+
+        # Lazily materialized CEs.
+        self._ces: Dict[CEIndex, CellExecution] = {}
+
+    @staticmethod
+    def from_db(disk_ahg: KishuDiskAHG) -> AHGSnapshot:
+        """
+        Loads the snapshot with a few bulk queries.
+        """
+        snapshot = AHGSnapshot(disk_ahg)
+        for vs in disk_ahg.get_all_variable_snapshots():
+            snapshot._add_vs(vs)
+
+        inputs_by_cell_num: Dict[CellExecutionNumber, List[str]] = defaultdict(list)
+        for cell_num, versioned_name in disk_ahg.get_all_ce_input_edges():
+            inputs_by_cell_num[cell_num].append(versioned_name)
+        outputs_by_cell_num: Dict[CellExecutionNumber, List[str]] = defaultdict(list)
+        for cell_num, versioned_name in disk_ahg.get_all_ce_output_edges():
+            outputs_by_cell_num[cell_num].append(versioned_name)
+
+        for cell_num, cell_runtime_s in disk_ahg.get_all_cell_execution_runtimes():
+            snapshot._add_ce(cell_num, cell_runtime_s, inputs_by_cell_num[cell_num], outputs_by_cell_num[cell_num])
+        return snapshot
+
+    def update(self, update_result: AHGUpdateResult) -> None:
+        """
+        Appends the new nodes and edges of a (persisted) AHG update.
+        """
+        for vs in update_result.output_vss:
+            self._add_vs(vs)
+        newest_ce = update_result.newest_ce
+        ce_idx = self._add_ce(
+            newest_ce.cell_num,
+            newest_ce.cell_runtime_s,
+            [vs.versioned_name() for vs in update_result.accessed_vss],
+            [vs.versioned_name() for vs in update_result.output_vss],
+        )
+        self._ces[ce_idx] = newest_ce
+
+    def _add_vs(self, vs: VariableSnapshot) -> VSIndex:
+        vs_idx = len(self.vss)
+        self.vss.append(vs)
+        self.vs_index[vs.versioned_name()] = vs_idx
+        self.vs_input_ce.append(NO_CE)
+        return vs_idx
+
+    def _add_ce(
+        self,
+        cell_num: CellExecutionNumber,
+        cell_runtime_s: float,
+        input_versioned_names: Iterable[str],
+        output_versioned_names: Iterable[str],
+    ) -> CEIndex:
+        ce_idx = len(self.ce_nums)
+        self.ce_nums.append(cell_num)
+        self.ce_runtimes.append(cell_runtime_s)
+        self.ce_index[cell_num] = ce_idx
+
+        # Edges to VSes missing from the database are dropped, same as when reading them with KishuDiskAHG.
+        input_vs_indices = self.vs_indices(input_versioned_names)
+        self.ce_input_vs.extend(input_vs_indices)
+        self.ce_input_offsets.append(len(self.ce_input_vs))
+        self.ces_by_inputs[frozenset(input_vs_indices)].append(ce_idx)
+        output_vs_indices = self.vs_indices(output_versioned_names)
+        self.ce_output_vs.extend(output_vs_indices)
+        self.ce_output_offsets.append(len(self.ce_output_vs))
+        for vs_idx in output_vs_indices:
+            self.vs_input_ce[vs_idx] = ce_idx
+        return ce_idx
+
+    def num_ces(self) -> int:
+        return len(self.ce_nums)
+
+    def vs_indices(self, versioned_names: Iterable[str]) -> List[VSIndex]:
+        return [self.vs_index[name] for name in versioned_names if name in self.vs_index]
+
+    def vs_indices_of(self, vss: Iterable[VariableSnapshot]) -> Set[VSIndex]:
+        return set(self.vs_indices(vs.versioned_name() for vs in vss))
+
+    def input_ce_of(self, vs_idx: VSIndex) -> CEIndex:
+        ce_idx = self.vs_input_ce[vs_idx]
+        if ce_idx == NO_CE:
+            vs = self.vss[vs_idx]
+            raise ValueError(f"The (unique) CE creating VS with version = {vs.version} and name = {vs.name} not found")
+        return ce_idx
+
+    def input_vses_of(self, ce_idx: CEIndex) -> array:
+        return self.ce_input_vs[self.ce_input_offsets[ce_idx] : self.ce_input_offsets[ce_idx + 1]]
+
+    def output_vses_of(self, ce_idx: CEIndex) -> array:
+        return self.ce_output_vs[self.ce_output_offsets[ce_idx] : self.ce_output_offsets[ce_idx + 1]]
+
+    def ce_idx_of(self, ce: CellExecution) -> CEIndex:
+        return self.ce_index_by_cell_num(ce.cell_num)
+
+    def ce_index_by_cell_num(self, cell_num: CellExecutionNumber) -> CEIndex:
+        ce_idx: Optional[CEIndex] = self.ce_index.get(cell_num)
+        if ce_idx is None:
+            raise ValueError(f"The CellExecution for cell number = {cell_num} was not found")
+        return ce_idx
+
+    def get_ces(self, ce_indices: Iterable[CEIndex]) -> List[CellExecution]:
+        """
+        Materializes CEs, loading the code of those not yet materialized in one query.
+        """
+        ce_indices = list(ce_indices)
+        missing_cell_nums = list({self.ce_nums[ce_idx] for ce_idx in ce_indices if ce_idx not in self._ces})
+        if missing_cell_nums:
+            cells = self._disk_ahg.get_cells_by_cell_nums(missing_cell_nums)
+            for cell_num in missing_cell_nums:
+                ce_idx = self.ce_index[cell_num]
+                self._ces[ce_idx] = CellExecution(cell_num, cells[cell_num], self.ce_runtimes[ce_idx])
+        return [self._ces[ce_idx] for ce_idx in ce_indices]
+
+    def get_ce(self, ce_idx: CEIndex) -> CellExecution:
+        return self.get_ces([ce_idx])[0]
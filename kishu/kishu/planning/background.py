@@ -0,0 +1,239 @@
+"""
+Runs checkpoint plans in forked child processes, off the critical path of cell executions.
+
+A forked child sees a copy-on-write image of the kernel's memory at the time of the fork, so it serializes the
+namespace exactly as it was when the cell finished while the kernel goes on running cells. Pages are only copied
+when the kernel modifies them before the child is done with them.
+
+Only the forking thread runs in the child. Locks other threads of the kernel held at the time of the fork stay held
+in the child, so Kishu's own threads are paused around forks, and children exceeding a timeout are killed. Checkpoints
+are marked pending in the database until written, so that readers in other processes wait for them. Children pickle
+checkpoints before taking the database's write lock, as the kernel writes its commits to the same database meanwhile.
+"""
+
+from __future__ import annotations
+
+import enum
+import math
+import os
+import signal
+import sys
+import traceback
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Optional, Union
+
+from kishu.jupyter.namespace import Namespace
+from kishu.planning.plan import CheckpointPlan, IncrementalCheckpointPlan
+from kishu.storage.checkpoint import DEFAULT_ASYNC_CHECKPOINT_TIMEOUT_S, KishuCheckpoint
+
+AnyCheckpointPlan = Union[CheckpointPlan, IncrementalCheckpointPlan]
+
+# Number of latest checkpoints whose statuses are kept. At most two checkpoints, the latest, are unfinished at a time.
+MAX_TRACKED_STATUSES = 100
+
+
+class BackgroundCheckpointStatus(str, enum.Enum):
+    pending = "pending"  # Waiting for the in-flight checkpoint to finish.
+    running = "running"
+    done = "done"
+    failed = "failed"
+    skipped = "skipped"  # Coalesced into a later checkpoint.
+
+
+@dataclass
+class InFlightCheckpoint:
+    """
+    @param commit_id: commit whose checkpoint plan the child process runs.
+    @param pid: process ID of the child.
+    """
+
+    commit_id: str
+    pid: int
+
+
+@dataclass
+class PendingCheckpoint:
+    commit_id: str
+    checkpoint_plan: AnyCheckpointPlan
+    user_ns: Namespace
+
+
+class BackgroundCheckpointer:
+    """
+    Runs at most one checkpoint plan at a time in a forked child process.
+
+    A checkpoint submitted while another is in flight becomes pending. It must start before the namespace changes,
+    i.e., before the next cell runs (see start_pending). If the in-flight checkpoint is still running by then, the
+    pending checkpoint is either skipped when coalescing, in which case the next commit stores the variable snapshots
+    it misses (incremental checkpointing only), or started after waiting for the in-flight checkpoint.
+
+    Without os.fork (e.g., on Windows) or when disabled, checkpoint plans run synchronously on submission.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        coalesce: bool = False,
+        kishu_checkpoint: Optional[KishuCheckpoint] = None,
+        timeout_s: float = DEFAULT_ASYNC_CHECKPOINT_TIMEOUT_S,
+        before_fork: Optional[Callable[[], None]] = None,
+        after_fork: Optional[Callable[[], None]] = None,
+    ) -> None:
+        """
+        @param enabled: whether to run checkpoint plans in the background.
+        @param coalesce: whether checkpoints may be skipped instead of waited for. Only safe with incremental
+            checkpointing, where restoring a commit falls back to recomputing the variables it misses.
+        @param kishu_checkpoint: checkpoint store in which to mark checkpoints pending until written, if any.
+        @param timeout_s: time after which a child still writing its checkpoint is killed, failing the checkpoint.
+        @param before_fork: called before each fork, e.g., to stop threads that may hold locks the child needs.
+        @param after_fork: called in the kernel after each fork, e.g., to restart those threads.
+        """
+        self.enabled = enabled and hasattr(os, "fork")
+        self.coalesce = coalesce
+        # Statuses of the latest MAX_TRACKED_STATUSES checkpoints, oldest first.
+        self.statuses: OrderedDict[str, BackgroundCheckpointStatus] = OrderedDict()
+        self._kishu_checkpoint = kishu_checkpoint
+        self._timeout_s = timeout_s
+        self._before_fork = before_fork
+        self._after_fork = after_fork
+        self._in_flight: Optional[InFlightCheckpoint] = None
+        self._pending: Optional[PendingCheckpoint] = None
+
+    def submit(self, commit_id: str, checkpoint_plan: AnyCheckpointPlan, user_ns: Namespace) -> None:
+        """
+        Checkpoints user_ns as of commit_id, returning as soon as the checkpoint is forked or made pending.
+        """
+        if not self.enabled:
+            checkpoint_plan.run(user_ns)
+            self._set_status(commit_id, BackgroundCheckpointStatus.done)
+            return
+
+        # A manual commit within a cell may leave a pending checkpoint whose namespace is gone by now.
+        self._skip_pending()
+        self.poll()
+        if self._kishu_checkpoint is not None:
+            self._kishu_checkpoint.mark_pending(commit_id, os.getpid())
+        if self._in_flight is None:
+            self._fork(commit_id, checkpoint_plan, user_ns)
+        elif self.coalesce:
+            self._pending = PendingCheckpoint(commit_id, checkpoint_plan, user_ns)
+            self._set_status(commit_id, BackgroundCheckpointStatus.pending)
+        else:
+            self._wait_in_flight()
+            self._fork(commit_id, checkpoint_plan, user_ns)
+
+    def start_pending(self) -> None:
+        """
+        Resolves the pending checkpoint, if any, while the namespace still matches its commit. Must be called before
+        the namespace changes.
+        """
+        if self._pending is None:
+            return
+        self.poll()
+        if self._in_flight is not None:
+            if self.coalesce:
+                self._skip_pending()
+                return
+            self._wait_in_flight()
+        self._fork_pending()
+
+    def is_writing(self, commit_id: str) -> bool:
+        """
+        Returns whether the checkpoint of commit_id is pending or running, i.e., marked pending until written.
+        """
+        return self.statuses.get(commit_id) in (BackgroundCheckpointStatus.pending, BackgroundCheckpointStatus.running)
+
+    def poll(self) -> None:
+        """
+        Reaps the in-flight checkpoint if it has finished.
+        """
+        if self._in_flight is None:
+            return
+        pid, wait_status = os.waitpid(self._in_flight.pid, os.WNOHANG)
+        if pid != 0:
+            self._finish(wait_status)
+
+    def wait(self) -> None:
+        """
+        Blocks until all submitted checkpoints are written, e.g., before reading them for checkout. Must be called
+        before the namespace changes if a checkpoint may be pending.
+        """
+        self._wait_in_flight()
+        if self._pending is not None:
+            self._fork_pending()
+            self._wait_in_flight()
+
+    def _fork(self, commit_id: str, checkpoint_plan: AnyCheckpointPlan, user_ns: Namespace) -> None:
+        if self._before_fork is not None:
+            self._before_fork()
+        try:
+            pid = os.fork()
+            if pid == 0:
+                self._run_child(commit_id, checkpoint_plan, user_ns)
+        finally:
+            if self._after_fork is not None:
+                self._after_fork()
+        self._in_flight = InFlightCheckpoint(commit_id, pid)
+        self._set_status(commit_id, BackgroundCheckpointStatus.running)
+
+    def _run_child(self, commit_id: str, checkpoint_plan: AnyCheckpointPlan, user_ns: Namespace) -> None:
+        # Child: write the checkpoint and exit without running the kernel's cleanup (e.g., atexit functions).
+        exit_code = 1
+        try:
+            # A child stuck, e.g., on a lock held by another thread of the kernel when forked, is killed by the alarm.
+            signal.signal(signal.SIGALRM, signal.SIG_DFL)
+            signal.alarm(max(1, math.ceil(self._timeout_s)))
+            # Interrupting the kernel signals its process group, which should not abort the checkpoint.
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            if self._kishu_checkpoint is not None:
+                self._kishu_checkpoint.mark_pending(commit_id, os.getpid())
+            # Hold the write lock only to insert the pickles, not while pickling, lest the kernel's writes time out.
+            KishuCheckpoint.pickle_before_write_lock = True
+            checkpoint_plan.run(user_ns)
+            exit_code = 0
+        except BaseException:
+            # The kernel's sys.stderr forwards to the frontend through threads that do not exist in the child.
+            traceback.print_exc(file=sys.__stderr__)
+        finally:
+            try:
+                # Restoring handles missing checkpoints once they are no longer pending.
+                if self._kishu_checkpoint is not None:
+                    self._kishu_checkpoint.unmark_pending(commit_id)
+            finally:
+                os._exit(exit_code)
+
+    def _fork_pending(self) -> None:
+        assert self._pending is not None
+        pending, self._pending = self._pending, None
+        self._fork(pending.commit_id, pending.checkpoint_plan, pending.user_ns)
+
+    def _skip_pending(self) -> None:
+        if self._pending is not None:
+            self._set_status(self._pending.commit_id, BackgroundCheckpointStatus.skipped)
+            if self._kishu_checkpoint is not None:
+                self._kishu_checkpoint.unmark_pending(self._pending.commit_id)
+            self._pending = None
+
+    def _wait_in_flight(self) -> None:
+        if self._in_flight is None:
+            return
+        _, wait_status = os.waitpid(self._in_flight.pid, 0)
+        self._finish(wait_status)
+
+    def _finish(self, wait_status: int) -> None:
+        assert self._in_flight is not None
+        succeeded = os.WIFEXITED(wait_status) and os.WEXITSTATUS(wait_status) == 0
+        self._set_status(
+            self._in_flight.commit_id, BackgroundCheckpointStatus.done if succeeded else BackgroundCheckpointStatus.failed
+        )
+        if not succeeded and self._kishu_checkpoint is not None:
+            # The child may have been killed before unmarking its checkpoint.
+            self._kishu_checkpoint.unmark_pending(self._in_flight.commit_id)
+        self._in_flight = None
+
+    def _set_status(self, commit_id: str, status: BackgroundCheckpointStatus) -> None:
+        self.statuses[commit_id] = status
+        self.statuses.move_to_end(commit_id)
+        while len(self.statuses) > MAX_TRACKED_STATUSES:
+            self.statuses.popitem(last=False)
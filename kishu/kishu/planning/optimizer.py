@@ -1,11 +1,12 @@
 from dataclasses import dataclass, field
-from typing import Any, Dict, Optional, Set, Tuple, Union
+from typing import Dict, List, Optional, Set, Tuple
 
 import networkx as nx
 import numpy as np
 from networkx.algorithms.flow import shortest_augmenting_path
 
 from kishu.planning.ahg import AHG
+from kishu.planning.ahg_snapshot import CEIndex, VSIndex
 from kishu.storage.config import Config
 from kishu.storage.disk_ahg import CellExecution, VariableSnapshot
 
@@ -84,41 +85,56 @@ def __init__(
         if self._optimizer_context.always_migrate and self._optimizer_context.always_recompute:
             raise ValueError("always_migrate and always_recompute cannot both be True.")
 
-    def dfs_helper(self, current: Any, visited: Set[Any], prerequisite_ces: Set[CellExecution]):
+        # The optimizer works on node indices of the in-memory AHG snapshot.
+        self._snapshot = ahg.get_snapshot()
+        self._active_vs_indices = self._snapshot.vs_indices_of(self.active_vss)
+        self._already_stored_vs_indices = self._snapshot.vs_indices_of(self.already_stored_vss)
+        self._req_func_mapping: Dict[CEIndex, Set[CEIndex]] = {}
+
+    def dfs_helper(self, ce_idx: CEIndex) -> Set[CEIndex]:
         """
-        Perform DFS on the Application History Graph for finding the CEs required to recompute a variable.
+        Perform DFS on the Application History Graph for finding the CEs required to recompute the outputs of a CE.
 
-        @param current: Name of current nodeset.
-        @param visited: Visited nodesets.
-        @param prerequisite_ces: Set of CEs needing re-execution to recompute the current nodeset.
+        @param ce_idx: Index of the CE to recompute.
         """
-        if isinstance(current, CellExecution):
-            if current in self.req_func_mapping:
-                # Use memoized results if we already know prerequisite CEs of current CE.
-                prerequisite_ces.update(self.req_func_mapping[current])
-            else:
-                # Else, recurse into input variables of the CE.
-                prerequisite_ces.add(current)
-                for vs in self.ahg.get_ce_input_vses(current):
-                    if vs not in self.active_vss and vs not in self.already_stored_vss and vs not in visited:
-                        self.dfs_helper(vs, visited, prerequisite_ces)
-
-        elif isinstance(current, VariableSnapshot):
-            visited.add(current)
-            upstream_ce = self.ahg.get_vs_input_ce(current)
-            if upstream_ce not in prerequisite_ces:
-                self.dfs_helper(upstream_ce, visited, prerequisite_ces)
+        prerequisite_ces: Set[CEIndex] = {ce_idx}
+        visited: Set[VSIndex] = set()
+        stack: List[CEIndex] = [ce_idx]
+        while stack:
+            current = stack.pop()
+            for vs_idx in self._snapshot.input_vses_of(current):
+                if vs_idx in self._active_vs_indices or vs_idx in self._already_stored_vs_indices or vs_idx in visited:
+                    continue
+                visited.add(vs_idx)
+                upstream_ce = self._snapshot.input_ce_of(vs_idx)
+                if upstream_ce in prerequisite_ces:
+                    continue
+                if upstream_ce in self._req_func_mapping:
+                    # Use memoized results if we already know prerequisite CEs of the upstream CE.
+                    prerequisite_ces.update(self._req_func_mapping[upstream_ce])
+                else:
+                    prerequisite_ces.add(upstream_ce)
+                    stack.append(upstream_ce)
+        return prerequisite_ces
 
     def find_prerequisites(self):
         """
         Find the necessary (prerequisite) cell executions to rerun a cell execution.
         """
-        for ce in self.ahg.get_all_cell_executions():
+        for ce_idx in range(self._snapshot.num_ces()):
             # Find prerequisites only if the CE has at least 1 active output.
-            if set(self.ahg.get_ce_output_vses(ce)).intersection(self.active_vss):
-                prerequisite_ces = set()
-                self.dfs_helper(ce, set(), prerequisite_ces)
-                self.req_func_mapping[ce] = prerequisite_ces
+            if not self._active_vs_indices.isdisjoint(self._snapshot.output_vses_of(ce_idx)):
+                self._req_func_mapping[ce_idx] = self.dfs_helper(ce_idx)
+
+        # Materialize the prerequisite CEs for building the restore plan.
+        ces = dict(
+            zip(
+                self._req_func_mapping.keys(),
+                self._snapshot.get_ces(self._req_func_mapping.keys()),
+            )
+        )
+        for ce_idx, prerequisite_ces in self._req_func_mapping.items():
+            self.req_func_mapping[ces[ce_idx]] = set(self._snapshot.get_ces(prerequisite_ces))
 
     def compute_plan(self) -> Tuple[Set[VariableSnapshot], Set[CellExecution]]:
         """
@@ -136,9 +152,9 @@ def compute_plan(self) -> Tuple[Set[VariableSnapshot], Set[CellExecution]]:
             return self.active_vss, set()
 
         if self._optimizer_context.always_recompute:
-            return set(), set(self.ahg.get_all_cell_executions())
+            return set(), set(self._snapshot.get_ces(range(self._snapshot.num_ces())))
 
-        # Construct flow graph for computing mincut.
+        # Construct flow graph for computing mincut. VSes are represented by their objects and CEs by their indices.
         flow_graph = nx.DiGraph()
 
         # Add source and sink to flow graph.
@@ -155,19 +171,20 @@ def compute_plan(self) -> Tuple[Set[VariableSnapshot], Set[CellExecution]]:
             )
 
         # Add all CEs as nodes, connect them with the sink with edge capacity equal to recomputation cost.
-        for ce in self.ahg.get_all_cell_executions():
-            flow_graph.add_node(ce)
-            flow_graph.add_edge(ce, FLOW_GRAPH_SINK, capacity=ce.cell_runtime_s)
+        for ce_idx in range(self._snapshot.num_ces()):
+            flow_graph.add_node(ce_idx)
+            flow_graph.add_edge(ce_idx, FLOW_GRAPH_SINK, capacity=self._snapshot.ce_runtimes[ce_idx])
 
         # Connect each CE with its output variables and its prerequisite CEs.
         for active_vs in self.active_vss:
-            for ce in self.req_func_mapping[self.ahg.get_vs_input_ce(active_vs)]:
-                flow_graph.add_edge(active_vs, ce, capacity=np.inf)
+            vs_idx = self._snapshot.vs_index[active_vs.versioned_name()]
+            for ce_idx in self._req_func_mapping[self._snapshot.input_ce_of(vs_idx)]:
+                flow_graph.add_edge(active_vs, ce_idx, capacity=np.inf)
 
         # Prune CEs which produce no active variables to speedup computation.
-        for ce in self.ahg.get_all_cell_executions():
-            if flow_graph.in_degree(ce) == 0:
-                flow_graph.remove_node(ce)
+        for ce_idx in range(self._snapshot.num_ces()):
+            if flow_graph.in_degree(ce_idx) == 0:
+                flow_graph.remove_node(ce_idx)
 
         # Solve min-cut with Ford-Fulkerson.
         cut_value, partition = nx.minimum_cut(
@@ -176,7 +193,7 @@ def compute_plan(self) -> Tuple[Set[VariableSnapshot], Set[CellExecution]]:
 
         # Determine the replication plan from the partition.
         vss_to_migrate = set(partition[1]).intersection(self.active_vss)
-        ces_to_recompute = set(partition[0]).intersection(set(self.ahg.get_all_cell_executions()))
+        ces_to_recompute = set(self._snapshot.get_ces(node for node in partition[0] if isinstance(node, CEIndex)))
 
         return vss_to_migrate, ces_to_recompute
 
@@ -209,43 +226,51 @@ def __init__(
         self.useful_active_vses = useful_active_vses
         self.useful_stored_vses = useful_stored_vses
 
+        # The optimizer works on node indices of the in-memory AHG snapshot.
+        self._snapshot = ahg.get_snapshot()
+        self._target_active_vs_indices = self._snapshot.vs_indices_of(target_active_vss)
+        self._useful_active_vs_indices = self._snapshot.vs_indices_of(useful_active_vses)
+        self._useful_stored_vs_indices = self._snapshot.vs_indices_of(useful_stored_vses)
+
     def dfs_helper(
         self,
-        current: Union[CellExecution, VariableSnapshot],
-        visited: Set[VariableSnapshot],
-        prerequisite_ces: Set[CellExecution],
-        opt_result: IncrementalLoadOptimizationResult,
+        vs_idx: VSIndex,
+        prerequisite_ces: Set[CEIndex],
+        vss_to_move: Set[VSIndex],
+        vss_to_load: Set[VSIndex],
         computing_fallback=False,
     ):
         """
         Perform DFS on the Application History Graph for finding the CEs required to recompute a variable.
 
-        @param current: Name of current nodeset.
-        @param visited: Visited nodesets.
-        @param prerequisite_ces: Set of CEs needing re-execution to recompute the current nodeset.
+        @param vs_idx: Index of the VS to restore.
+        @param prerequisite_ces: Set of CEs needing re-execution to recompute the VS.
+        @param vss_to_move: VSes to move from the current namespace found by the DFS.
+        @param vss_to_load: VSes to load from the database found by the DFS.
         @param computing_fallback: whether this DFS run is for finding fallback recomputation. If yes, skip using
             any VSes stored in the DB (as they are the main point of failure).
         """
-        if isinstance(current, CellExecution):
-            prerequisite_ces.add(current)
-            for vs in self.ahg.get_ce_input_vses(current):
-                if vs not in self.target_active_vss and vs not in visited:
-                    self.dfs_helper(vs, visited, prerequisite_ces, opt_result, computing_fallback)
-
-        elif isinstance(current, VariableSnapshot):
-            visited.add(current)
+        visited: Set[VSIndex] = {vs_idx}
+        stack: List[VSIndex] = [vs_idx]
+        while stack:
+            current = stack.pop()
 
             # Current VS is in the namespace.
-            if current in self.useful_active_vses:
-                opt_result.vss_to_move.add(current)
+            if current in self._useful_active_vs_indices:
+                vss_to_move.add(current)
 
             # Current VS is stored in the DB.
-            elif not computing_fallback and current in self.useful_stored_vses:
-                opt_result.vss_to_load.add(current)
+            elif not computing_fallback and current in self._useful_stored_vs_indices:
+                vss_to_load.add(current)
 
             # Else, continue checking the dependencies required to compute this VS.
             else:
-                self.dfs_helper(self.ahg.get_vs_input_ce(current), visited, prerequisite_ces, opt_result, computing_fallback)
+                ce_idx = self._snapshot.input_ce_of(current)
+                prerequisite_ces.add(ce_idx)
+                for input_vs_idx in self._snapshot.input_vses_of(ce_idx):
+                    if input_vs_idx not in self._target_active_vs_indices and input_vs_idx not in visited:
+                        visited.add(input_vs_idx)
+                        stack.append(input_vs_idx)
 
     def compute_plan(self) -> IncrementalLoadOptimizationResult:
         """
@@ -256,18 +281,25 @@ def compute_plan(self) -> IncrementalLoadOptimizationResult:
         @param always_migrate: migrate all variables.
         @param always_recompute: rerun all cells.
         """
-        opt_result = IncrementalLoadOptimizationResult()
+        prerequisite_ces: Set[CEIndex] = set()
+        vss_to_move: Set[VSIndex] = set()
+        vss_to_load: Set[VSIndex] = set()
 
         # Greedily find the cells to rerun, VSes to move and VSes to load for each active VS in the target state.
-        for vs in self.target_active_vss:
-            prerequisite_ces: Set[CellExecution] = set()
-            self.dfs_helper(vs, set(), prerequisite_ces, opt_result)
-            opt_result.ces_to_rerun |= prerequisite_ces
+        for vs_idx in self._target_active_vs_indices:
+            self.dfs_helper(vs_idx, prerequisite_ces, vss_to_move, vss_to_load)
+
+        opt_result = IncrementalLoadOptimizationResult(
+            vss_to_move={self._snapshot.vss[vs_idx] for vs_idx in vss_to_move},
+            vss_to_load={self._snapshot.vss[vs_idx] for vs_idx in vss_to_load},
+            ces_to_rerun=set(self._snapshot.get_ces(prerequisite_ces)),
+        )
 
         # For the VSes to load, find their fallback recomputations.
-        for vs in opt_result.vss_to_load:
-            fallback_ces: Set[CellExecution] = set()
-            self.dfs_helper(vs, set(), fallback_ces, opt_result, computing_fallback=True)
-            opt_result.fallback_recomputation[vs] = fallback_ces
+        for vs_idx in vss_to_load:
+            fallback_ces: Set[CEIndex] = set()
+            self.dfs_helper(vs_idx, fallback_ces, vss_to_move, set(), computing_fallback=True)
+            opt_result.fallback_recomputation[self._snapshot.vss[vs_idx]] = set(self._snapshot.get_ces(fallback_ces))
+        opt_result.vss_to_move = {self._snapshot.vss[vs_idx] for vs_idx in vss_to_move}
 
         return opt_result
@@ -2,20 +2,64 @@
 
 import atexit
 import enum
+import math
+import multiprocessing
+import signal
+import sys
+import threading
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 from dataclasses import dataclass, field
 from pathlib import Path
 from queue import LifoQueue
-from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from typing import Any, Callable, Dict, FrozenSet, Iterator, List, Optional, Set, Tuple
 
 import dill
 from IPython.core.interactiveshell import InteractiveShell
 from traitlets.config import Config
 
 from kishu.exceptions import CommitIdNotExistError
-from kishu.jupyter.namespace import Namespace
+from kishu.jupyter.namespace import LazyVariable, Namespace
 from kishu.storage.checkpoint import KishuCheckpoint
 from kishu.storage.disk_ahg import VariableSnapshot
 
+DEFAULT_RESTORE_WORKERS = 4
+DEFAULT_RERUN_WORKERS = 1
+DEFAULT_RESUME_LAZY_SIZE = 1 << 20
+
+# A forked worker rerunning a chain of cells is presumed stuck, e.g., on a lock held by another thread of the kernel when
+# forked, once it runs this much longer than the cells took originally. Its cells are then rerun in the shell instead.
+RERUN_TIMEOUT_GRACE_S = 60.0
+RERUN_TIMEOUT_FACTOR = 4.0
+
+# Cells containing this comment have side effects, e.g., writing files, and are never rerun in forked workers nor
+# skipped by reusing their stored outputs.
+SIDE_EFFECT_MARKER = "# kishu: side effects"
+
+# Cells containing this comment are nondeterministic, e.g., sampling random numbers, and are never skipped by reusing
+# the stored outputs of their earlier executions.
+NONDETERMINISTIC_MARKER = "# kishu: nondeterministic"
+
+# Previous binding of variables which were not bound.
+UNBOUND = object()
+
+# Shell and chains of cells to rerun by forked workers, which inherit them.
+_fork_inherited_reruns: Optional[Tuple[RestoreActionContext, List[List[RerunCellRestoreAction]]]] = None
+
+
+def _rerun_fork_inherited(i: int) -> bytes:
+    assert _fork_inherited_reruns is not None
+    ctx, chains = _fork_inherited_reruns
+    # The kernel's streams forward to the frontend through threads that do not exist in the worker.
+    sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+    # A worker stuck past the chain's timeout is killed by the alarm, breaking the pool so the kernel reruns the chains.
+    signal.signal(signal.SIGALRM, signal.SIG_DFL)
+    signal.alarm(max(1, math.ceil(ParallelReruns.timeout_s(chains[i]))))
+    try:
+        return ParallelReruns.rerun_chain(ctx, chains[i])
+    finally:
+        signal.alarm(0)
+
 
 def no_history_interactive_shell():
     """
@@ -28,6 +72,85 @@ def no_history_interactive_shell():
     return InteractiveShell(config=config)
 
 
+class InteractiveShellPool:
+    """
+    Keeps InteractiveShells for running RestorePlans. Shells are recycled by clearing their namespaces, which is much
+    cheaper than tearing down a shell, whose exit collects garbage across the whole process, and spawning another.
+
+    @param max_size: the maximum number of idle shells to keep.
+    """
+
+    def __init__(self, max_size: int = 2) -> None:
+        self._max_size = max_size
+        self._shells: List[InteractiveShell] = []
+        self._lock = threading.Lock()
+
+    def get(self) -> InteractiveShell:
+        with self._lock:
+            if self._shells:
+                return self._shells.pop()
+        return no_history_interactive_shell()
+
+    def put(self, shell: InteractiveShell) -> None:
+        # Same as InteractiveShell.reset except the garbage collection when flushing the output cache.
+        displayhook = shell.displayhook
+        do_full_cache, displayhook.do_full_cache = displayhook.do_full_cache, False
+        try:
+            shell.reset(new_session=False)
+        finally:
+            displayhook.do_full_cache = do_full_cache
+        for name in ("_", "__", "___"):
+            setattr(displayhook, name, "")
+        with self._lock:
+            if len(self._shells) < self._max_size:
+                self._shells.append(shell)
+
+
+RESTORE_SHELL_POOL = InteractiveShellPool()
+
+
+class PausableThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    Thread pool whose tasks can be paused, e.g., so that none of them holds a lock, such as of the allocator or of a
+    module being imported, while the process forks. Forked children would wait on such locks forever.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None) -> None:
+        super().__init__(max_workers)
+        self._condition = threading.Condition()
+        self._paused = False
+        self._running = 0
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        return super().submit(self._run_unpaused, fn, *args, **kwargs)
+
+    @contextmanager
+    def paused(self) -> Iterator[None]:
+        """
+        Waits for the running tasks to finish, keeping other tasks from starting until the context exits.
+        """
+        with self._condition:
+            self._paused = True
+            self._condition.wait_for(lambda: self._running == 0)
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._paused = False
+                self._condition.notify_all()
+
+    def _run_unpaused(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        with self._condition:
+            self._condition.wait_for(lambda: not self._paused)
+            self._running += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._condition:
+                self._running -= 1
+                self._condition.notify_all()
+
+
 class RestoreActionOrder(str, enum.Enum):
     """
     Order for performing restore actions; lower means higher priority within the cell execution.
@@ -65,9 +188,53 @@ def new_move_variable(cell_num):
 
 @dataclass
 class RestoreActionContext:
+    """
+    @param lazy: whether to load variable snapshots on first access to their variables instead of right away.
+    @param lazy_min_size: estimated size in bytes of the smallest variable snapshot loaded on first access, if lazy.
+    @param prefetched: loads started ahead by each action, whose results it installs when it runs.
+    @param checkpoint_loads: the load of the checkpoint shared by each action loading from it.
+    @param checkpoint_load: the load of the checkpoint shared by the next actions loading from it, if any.
+    @param memoized: cells to rerun which were skipped by loading their memoized outputs instead.
+    """
+
     shell: InteractiveShell
     database_path: Path
     exec_id: str
+    lazy: bool = False
+    lazy_min_size: float = 0.0
+    prefetched: Dict[StepOrder, List[Future]] = field(default_factory=dict)
+    checkpoint_loads: Dict[StepOrder, CheckpointLoad] = field(default_factory=dict)
+    checkpoint_load: Optional[CheckpointLoad] = None
+    memoized: List[RerunCellRestoreAction] = field(default_factory=list)
+
+
+class CheckpointLoad:
+    """
+    Loads variables from the checkpoint of a commit once for all actions sharing the load, either ahead on an executor
+    or on first use.
+    """
+
+    def __init__(self, database_path: Path, exec_id: str) -> None:
+        self.database_path = database_path
+        self.exec_id = exec_id
+        self.variable_names: Set[str] = set()
+        self._future: Optional[Future] = None
+
+    def start(self, executor: Executor) -> None:
+        if self._future is None:
+            self._future = executor.submit(self._load)
+
+    def result(self) -> Dict[str, Any]:
+        if self._future is None:
+            self._future = Future()
+            try:
+                self._future.set_result(self._load())
+            except Exception as e:
+                self._future.set_exception(e)
+        return self._future.result()
+
+    def _load(self) -> Dict[str, Any]:
+        return KishuCheckpoint(Path(self.database_path)).load_checkpoint(self.exec_id, self.variable_names)
 
 
 @dataclass
@@ -76,14 +243,14 @@ class VarNamesToObjects:
     Convenient wrapper for serializing variables.
     """
 
-    object_dict: Dict[str, Any] = field(default_factory=lambda: {})
+    object_dict: Dict[str, Any] = field(default_factory=dict)
 
-    def dumps(self) -> bytes:
-        return dill.dumps(self.object_dict)
+    def dumps(self, checkpoint: KishuCheckpoint) -> bytes:
+        return checkpoint.dumps(self.object_dict)
 
     @staticmethod
-    def loads(data: bytes) -> VarNamesToObjects:
-        object_dict = dill.loads(data)
+    def loads(data: bytes, checkpoint: KishuCheckpoint) -> VarNamesToObjects:
+        object_dict = checkpoint.loads(data)
         res = VarNamesToObjects()
         for key, obj in object_dict.items():
             res[key] = obj
@@ -125,7 +292,7 @@ def run(self, user_ns: Namespace):
         namespace: VarNamesToObjects = VarNamesToObjects()
         for name in self.variable_names:
             namespace[name] = user_ns[name]
-        KishuCheckpoint(self.database_path).store_checkpoint(self.exec_id, namespace.dumps())
+        KishuCheckpoint(self.database_path).dump_checkpoint(self.exec_id, namespace.object_dict)
 
 
 class IncrementalWriteCheckpointAction(CheckpointAction):
@@ -262,6 +429,24 @@ def run(self, ctx: RestoreActionContext):
         """
         raise NotImplementedError("This base class must be extended.")
 
+    def prepare(self, ctx: RestoreActionContext) -> None:
+        """
+        Prepares this action before any action runs, e.g., sharing work with other actions.
+        """
+        pass
+
+    def prefetch(self, ctx: RestoreActionContext, executor: Executor) -> None:
+        """
+        Starts the work of this action not depending on earlier actions, e.g., loading variables, on executor.
+        """
+        pass
+
+    def bound_names(self) -> Optional[Set[str]]:
+        """
+        Returns the variables this action binds, or None if unknown.
+        """
+        return None
+
 
 @dataclass
 class LoadVariableRestoreAction(RestoreAction):
@@ -283,13 +468,37 @@ def run(self, ctx: RestoreActionContext):
         """
         @param user_ns  A target space where restored variables will be set.
         """
-        data: bytes = KishuCheckpoint(Path(ctx.database_path)).get_checkpoint(ctx.exec_id)
-        namespace: VarNamesToObjects = VarNamesToObjects.loads(data)
+        checkpoint = KishuCheckpoint(Path(ctx.database_path))
+        checkpoint_load = ctx.checkpoint_loads.get(self.step_order)
+        if checkpoint_load is None:
+            namespace: Dict[str, Any] = checkpoint.load_checkpoint(ctx.exec_id, self.variable_names)
+        else:
+            try:
+                namespace = checkpoint_load.result()
+            except Exception:
+                # Variables loaded together with this action's may have failed to load; load only this action's.
+                if checkpoint_load.variable_names == self.variable_names:
+                    raise
+                namespace = checkpoint.load_checkpoint(ctx.exec_id, self.variable_names)
         for key, obj in namespace.items():
             # if self.variable_names is set, limit the restoration only to those variables.
             if key in self.variable_names:
                 ctx.shell.user_ns[key] = obj
 
+    def prepare(self, ctx: RestoreActionContext) -> None:
+        # Actions with no cells rerun between them load the checkpoint once, e.g., keeping the objects their variables
+        # share shared. Cells rerun after a load may modify its objects, so later actions load them again.
+        if ctx.checkpoint_load is None:
+            ctx.checkpoint_load = CheckpointLoad(ctx.database_path, ctx.exec_id)
+        ctx.checkpoint_load.variable_names.update(self.variable_names)
+        ctx.checkpoint_loads[self.step_order] = ctx.checkpoint_load
+
+    def prefetch(self, ctx: RestoreActionContext, executor: Executor) -> None:
+        ctx.checkpoint_loads[self.step_order].start(executor)
+
+    def bound_names(self) -> Optional[Set[str]]:
+        return set(self.variable_names)
+
 
 @dataclass
 class IncrementalLoadRestoreAction(RestoreAction):
@@ -311,15 +520,104 @@ def run(self, ctx: RestoreActionContext):
         """
         @param user_ns  A target space where restored variables will be set.
         """
+        lazy_vses = self._lazy_variable_snapshots(ctx)
+        for vs in lazy_vses:
+            loader = LazyVariableSnapshot(ctx.database_path, vs)
+            for name in vs.name:
+                ctx.shell.user_ns[name] = LazyVariable(name, loader)
+        if len(lazy_vses) == len(self.variable_snapshots):
+            return
+
         # Each dictionary contains the data for a VS in the form of its variable name-to-data mappings.
-        snapshots: List[bytes] = KishuCheckpoint(ctx.database_path).get_variable_snapshots(self.variable_snapshots)
-        for snapshot in snapshots:
-            vs_dict = dill.loads(snapshot)
+        futures = ctx.prefetched.pop(self.step_order, None)
+        if futures is not None:
+            vs_dicts = [future.result() for future in futures]
+        else:
+            vs_dicts = KishuCheckpoint(ctx.database_path).load_variable_snapshots(set(self.variable_snapshots) - lazy_vses)
+        for vs_dict in vs_dicts:
             if not isinstance(vs_dict, dict):
                 raise ValueError(f"loaded snapshot is of type {type(vs_dict)}, expected type dict")
             for k, v in vs_dict.items():
                 ctx.shell.user_ns[k] = v
 
+    def prefetch(self, ctx: RestoreActionContext, executor: Executor) -> None:
+        # Variable snapshots are loaded independently, e.g., reading and decoding their chunks in parallel.
+        checkpoint = KishuCheckpoint(ctx.database_path)
+        ctx.prefetched[self.step_order] = [
+            executor.submit(lambda vs: checkpoint.load_variable_snapshots({vs})[0], vs)
+            for vs in set(self.variable_snapshots) - self._lazy_variable_snapshots(ctx)
+        ]
+
+    def bound_names(self) -> Optional[Set[str]]:
+        return {name for vs in self.variable_snapshots for name in vs.name}
+
+    def _lazy_variable_snapshots(self, ctx: RestoreActionContext) -> Set[VariableSnapshot]:
+        if not ctx.lazy:
+            return set()
+        return {vs for vs in self.variable_snapshots if vs.size >= ctx.lazy_min_size}
+
+
+class LazyVariableSnapshot:
+    """
+    Loads a variable snapshot once, on first access to one of its lazy variables or when prefetched.
+    """
+
+    def __init__(self, database_path: Path, variable_snapshot: VariableSnapshot) -> None:
+        self.database_path = database_path
+        self.variable_snapshot = variable_snapshot
+        self._lock = threading.Lock()
+        self._variables: Optional[Dict[str, Any]] = None
+
+    def __call__(self) -> Dict[str, Any]:
+        with self._lock:
+            if self._variables is None:
+                (vs_dict,) = KishuCheckpoint(self.database_path).load_variable_snapshots({self.variable_snapshot})
+                if not isinstance(vs_dict, dict):
+                    raise ValueError(f"loaded snapshot is of type {type(vs_dict)}, expected type dict")
+                self._variables = vs_dict
+            return self._variables
+
+
+class LazyVariablePrefetcher:
+    """
+    Loads the variable snapshots of lazy variables in a background thread, so that first accesses to them need not
+    wait for storage. Loaded snapshots are only installed into the namespace on first access, by the kernel's thread.
+    """
+
+    def __init__(self) -> None:
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def start(self, user_ns: Namespace) -> None:
+        self.stop()
+        loaders: Dict[int, Callable[[], Dict[str, Any]]] = {}
+        for value in user_ns.get_tracked_namespace().raw_values():
+            if type(value) is LazyVariable:
+                loaders.setdefault(id(value.loader), value.loader)
+        if not loaders:
+            return
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._prefetch, args=(list(loaders.values()), self._stopped), daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stops prefetching after the variable snapshot being loaded, if any.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @staticmethod
+    def _prefetch(loaders: List[Callable[[], Dict[str, Any]]], stopped: threading.Event) -> None:
+        while loaders and not stopped.is_set():
+            try:
+                loaders.pop(0)()
+            except Exception:
+                # Failures are raised again on first access to the variables.
+                pass
+
 
 @dataclass
 class MoveVariableRestoreAction(RestoreAction):
@@ -340,6 +638,9 @@ def run(self, ctx: RestoreActionContext):
         for k, v in self.vars_to_move.to_dict().items():
             ctx.shell.user_ns[k] = v
 
+    def bound_names(self) -> Optional[Set[str]]:
+        return self.vars_to_move.keyset()
+
 
 @dataclass
 class RerunCellRestoreAction(RestoreAction):
@@ -348,21 +649,231 @@ class RerunCellRestoreAction(RestoreAction):
 
     @param step_order: the order (i.e., when to run) of this restore action.
     @param cell_code: Cell code to rerun.
+    @param input_names: Variables the cell reads, or None if unknown.
+    @param output_names: Variables the cell writes, or None if unknown.
+    @param memoized_outputs: Stored output VSes of an earlier execution of the same cell on the same inputs, loaded
+        instead of rerunning the cell. The cell is rerun if they fail to load.
+    @param cell_runtime_s: Runtime of the cell, saved by loading its memoized outputs.
     """
 
     step_order: StepOrder
     cell_code: str
+    input_names: Optional[FrozenSet[str]] = None
+    output_names: Optional[FrozenSet[str]] = None
+    memoized_outputs: Optional[Set[VariableSnapshot]] = None
+    cell_runtime_s: float = 0.0
 
     def run(self, ctx: RestoreActionContext):
         """
         @param user_ns  A target space where restored variables will be set.
         """
+        if self.memoized_outputs is not None:
+            try:
+                futures = ctx.prefetched.pop(self.step_order, None)
+                if futures is not None:
+                    vs_dicts = [future.result() for future in futures]
+                else:
+                    vs_dicts = KishuCheckpoint(ctx.database_path).load_variable_snapshots(self.memoized_outputs)
+                if all(isinstance(vs_dict, dict) for vs_dict in vs_dicts):
+                    for vs_dict in vs_dicts:
+                        ctx.shell.user_ns.update(vs_dict)
+                    ctx.memoized.append(self)
+                    return
+            except Exception:
+                # Rerun the cell instead.
+                pass
+
         try:
             ctx.shell.run_cell(self.cell_code)
         except Exception:
             # We don't want to raise exceptions during code rerunning as the code can contain errors.
             pass
 
+    def prepare(self, ctx: RestoreActionContext) -> None:
+        ctx.checkpoint_load = None
+
+    def prefetch(self, ctx: RestoreActionContext, executor: Executor) -> None:
+        if self.memoized_outputs is not None:
+            checkpoint = KishuCheckpoint(ctx.database_path)
+            ctx.prefetched[self.step_order] = [
+                executor.submit(lambda vs: checkpoint.load_variable_snapshots({vs})[0], vs) for vs in self.memoized_outputs
+            ]
+
+    def bound_names(self) -> Optional[Set[str]]:
+        return None if self.output_names is None else set(self.output_names)
+
+    def has_side_effects(self) -> bool:
+        return SIDE_EFFECT_MARKER in self.cell_code
+
+    @staticmethod
+    def is_memoizable(cell_code: str) -> bool:
+        """
+        Returns whether rerunning the cell may be skipped by loading the stored outputs of an earlier execution.
+        """
+        return NONDETERMINISTIC_MARKER not in cell_code and SIDE_EFFECT_MARKER not in cell_code
+
+
+class ParallelReruns:
+    """
+    Reruns independent chains of cells of a restore plan in forked worker processes, which start with the restore
+    shell's namespace as of the first cell to rerun. The variables a chain writes are shipped back pickled and installed
+    in the shell at the step of its last cell, as if its cells had been rerun in the shell.
+
+    @param chains: chains of cells, in order, which neither read nor write variables written by other chains or by
+        other actions up to their last cells.
+    """
+
+    def __init__(self, chains: List[List[RerunCellRestoreAction]]) -> None:
+        self.chains = chains
+        self.fork_at = min(chain[0].step_order for chain in chains)
+        self._steps = {action.step_order for chain in chains for action in chain}
+        self._last_steps = {chain[-1].step_order: i for i, chain in enumerate(chains)}
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._futures: List[Future] = []
+
+    @staticmethod
+    def plan(actions: Dict[StepOrder, RestoreAction], max_chains: int) -> Optional[ParallelReruns]:
+        """
+        Partitions the cells to rerun into chains, linking each cell with the earlier ones writing variables it reads
+        or writes, or reading variables it writes. Returns the chains which may be rerun by workers from the first cell
+        to rerun, or None if rerunning them in parallel does not pay off or is unsafe, e.g., with cells marked as having
+        side effects.
+        """
+        if max_chains <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+            return None
+        # Cells skipped by loading their memoized outputs are not worth forking.
+        reruns = [
+            action
+            for _, action in sorted(actions.items())
+            if isinstance(action, RerunCellRestoreAction) and action.memoized_outputs is None
+        ]
+        if len(reruns) < 2:
+            return None
+        if any(action.input_names is None or action.output_names is None or action.has_side_effects() for action in reruns):
+            return None
+
+        chain_of = list(range(len(reruns)))
+
+        def find(i: int) -> int:
+            while chain_of[i] != i:
+                chain_of[i] = chain_of[chain_of[i]]
+                i = chain_of[i]
+            return i
+
+        for j, later in enumerate(reruns):
+            for i, earlier in enumerate(reruns[:j]):
+                assert earlier.input_names is not None and earlier.output_names is not None
+                assert later.input_names is not None and later.output_names is not None
+                if not earlier.output_names.isdisjoint(later.input_names | later.output_names) or not (
+                    earlier.input_names.isdisjoint(later.output_names)
+                ):
+                    chain_of[find(j)] = find(i)
+        chains: Dict[int, List[RerunCellRestoreAction]] = {}
+        for i, action in enumerate(reruns):
+            chains.setdefault(find(i), []).append(action)
+        if len(chains) < 2:
+            return None
+
+        # Workers start from the namespace as of the first cell to rerun, so other actions until a chain's last cell
+        # must not bind its variables.
+        fork_at = reruns[0].step_order
+        parallel_chains = []
+        for chain in chains.values():
+            chain_names = set().union(*(action.input_names | action.output_names for action in chain))  # type: ignore
+            chain_steps = {action.step_order for action in chain}
+            if all(
+                step_order in chain_steps
+                or not fork_at <= step_order <= chain[-1].step_order
+                or ((bound_names := action.bound_names()) is not None and bound_names.isdisjoint(chain_names))
+                for step_order, action in actions.items()
+            ):
+                parallel_chains.append(chain)
+        if not parallel_chains:
+            return None
+        return ParallelReruns(parallel_chains[:max_chains])
+
+    def start(self, ctx: RestoreActionContext, prefetcher: Optional[PausableThreadPoolExecutor] = None) -> None:
+        """
+        Forks the workers, which inherit the shell as is.
+
+        @param prefetcher: threads loading variables, paused while forking.
+        """
+        global _fork_inherited_reruns
+        _fork_inherited_reruns = (ctx, self.chains)
+        self._executor = ProcessPoolExecutor(len(self.chains), mp_context=multiprocessing.get_context("fork"))
+        # With the fork start method, the pool forks all of its workers on the first submission.
+        with prefetcher.paused() if prefetcher is not None else nullcontext():
+            self._futures = [self._executor.submit(_rerun_fork_inherited, i) for i in range(len(self.chains))]
+
+    def covers(self, step_order: StepOrder) -> bool:
+        return step_order in self._steps
+
+    def pending_names(self, step_order: StepOrder) -> Set[str]:
+        """
+        Returns the variables read or written by the chains being rerun by workers which are installed after step_order.
+        """
+        if self._executor is None:
+            return set()
+        return {
+            name
+            for chain in self.chains
+            if chain[-1].step_order > step_order
+            for action in chain
+            for name in (action.input_names or frozenset()) | (action.output_names or frozenset())
+        }
+
+    def run(self, ctx: RestoreActionContext, step_order: StepOrder) -> None:
+        """
+        Installs the variables of the chain ending at step_order, if any, rerunning its cells in the shell instead if
+        its worker failed.
+        """
+        i = self._last_steps.get(step_order)
+        if i is None:
+            return
+        try:
+            assigned, deleted = dill.loads(self._futures[i].result(timeout=ParallelReruns.timeout_s(self.chains[i])))
+        except Exception:
+            for action in self.chains[i]:
+                action.run(ctx)
+            return
+        for name in deleted:
+            ctx.shell.user_ns.pop(name, None)
+        ctx.shell.user_ns.update(assigned)
+
+    def close(self) -> None:
+        global _fork_inherited_reruns
+        for future in self._futures:
+            future.cancel()
+        if self._executor is not None:
+            # Workers still running rerun chains whose cells were rerun in the shell instead, until their alarms.
+            self._executor.shutdown(wait=False)
+        _fork_inherited_reruns = None
+
+    @staticmethod
+    def timeout_s(chain: List[RerunCellRestoreAction]) -> float:
+        """
+        Returns the time after which the worker rerunning chain is presumed stuck.
+        """
+        return RERUN_TIMEOUT_GRACE_S + RERUN_TIMEOUT_FACTOR * sum(action.cell_runtime_s or 0.0 for action in chain)
+
+    @staticmethod
+    def rerun_chain(ctx: RestoreActionContext, chain: List[RerunCellRestoreAction]) -> bytes:
+        """
+        Reruns the cells of chain, returning the pickled variables they wrote and the names of those they deleted.
+        """
+        before = dict(ctx.shell.user_ns)
+        for action in chain:
+            action.run(ctx)
+        after = ctx.shell.user_ns
+        output_names = set().union(*(action.output_names or frozenset() for action in chain))
+        assigned = {
+            name: value
+            for name, value in after.items()
+            if Namespace.no_ipython_var((name, value)) and (name in output_names or before.get(name, UNBOUND) is not value)
+        }
+        deleted = [name for name in before if name not in after]
+        return dill.dumps((assigned, deleted))
+
 
 # Idea from https://stackoverflow.com/questions/57633815/atexit-how-does-one-trigger-it-manually
 class AtExitContext:
@@ -405,27 +916,58 @@ class RestorePlan:
     @param actions  A series of actions for restoring a state.
     """
 
-    actions: Dict[StepOrder, RestoreAction] = field(default_factory=lambda: {})
+    actions: Dict[StepOrder, RestoreAction] = field(default_factory=dict)
 
     # TODO: add the undeserializable variables which caused fallback computation to config list.
     fallbacked_actions: List[LoadVariableRestoreAction] = field(default_factory=lambda: [])
 
-    def add_rerun_cell_restore_action(self, cell_num: int, cell_code: str):
+    # Cells to rerun skipped by the last run by loading their memoized outputs.
+    memoized_actions: List[RerunCellRestoreAction] = field(default_factory=lambda: [])
+
+    def memoized_runtime_s(self) -> float:
+        """
+        Returns the runtime of the cells the last run skipped rerunning by loading their memoized outputs.
+        """
+        return sum(action.cell_runtime_s for action in self.memoized_actions)
+
+    def add_rerun_cell_restore_action(
+        self,
+        cell_num: int,
+        cell_code: str,
+        input_names: Optional[FrozenSet[str]] = None,
+        output_names: Optional[FrozenSet[str]] = None,
+        memoized_outputs: Optional[Set[VariableSnapshot]] = None,
+        cell_runtime_s: float = 0.0,
+    ):
         step_order = StepOrder.new_rerun_cell(cell_num)
         assert step_order not in self.actions
 
-        self.actions[step_order] = RerunCellRestoreAction(step_order, cell_code)
+        self.actions[step_order] = RerunCellRestoreAction(
+            step_order, cell_code, input_names, output_names, memoized_outputs, cell_runtime_s
+        )
 
     def add_load_variable_restore_action(
-        self, cell_num: int, variable_names: List[str], fallback_recomputation: List[Tuple[int, str]]
+        self,
+        cell_num: int,
+        variable_names: List[str],
+        fallback_recomputation: List[Tuple[int, str]],
+        fallback_names: Optional[Dict[int, Tuple[FrozenSet[str], FrozenSet[str]]]] = None,
     ):
+        """
+        @param fallback_names: the variables read and written by each cell of fallback_recomputation, by cell number,
+            if known. Without them, failed loads may restart the plan instead of rerunning the cells right away.
+        """
         step_order = StepOrder.new_load_variable(cell_num)
         assert step_order not in self.actions
 
+        fallback_names = fallback_names or {}
         self.actions[step_order] = LoadVariableRestoreAction(
             step_order,
             set(variable_names),
-            [RerunCellRestoreAction(StepOrder.new_rerun_cell(cell_num), code) for cell_num, code in fallback_recomputation],
+            [
+                RerunCellRestoreAction(StepOrder.new_rerun_cell(cell_num), code, *fallback_names.get(cell_num, (None, None)))
+                for cell_num, code in fallback_recomputation
+            ],
         )
 
     def add_incremental_load_restore_action(
@@ -446,33 +988,172 @@ def add_move_variable_restore_action(self, cell_num: int, vars_to_move: Namespac
 
         self.actions[step_order] = MoveVariableRestoreAction(step_order, vars_to_move)
 
-    def run(self, database_path: Path, exec_id: str) -> Namespace:
+    def run(
+        self,
+        database_path: Path,
+        exec_id: str,
+        lazy: bool = False,
+        num_workers: int = DEFAULT_RESTORE_WORKERS,
+        rerun_workers: int = DEFAULT_RERUN_WORKERS,
+        lazy_min_size: float = 0.0,
+    ) -> Namespace:
         """
         Performs a series of actions as specified in self.actions.
 
         @param user_ns  A target space where restored variables will be set.
         @param database_path  The file where information is stored.
+        @param lazy  Whether to restore variable snapshots as lazy variables, loaded on first access. Variable
+            snapshots that cells rerun later in the plan may access are loaded right away.
+        @param num_workers  Number of threads loading variables ahead of the actions installing them, e.g., while
+            earlier cells are rerun. With one, actions load their variables when they run.
+        @param rerun_workers  Number of forked processes rerunning independent chains of cells, alongside the actions
+            run in order. With one, all cells are rerun in order.
+        @param lazy_min_size  Estimated size in bytes of the smallest variable snapshot restored lazily, if lazy. Smaller
+            variable snapshots are loaded right away, alongside the other loads.
         """
+        # The commit's checkpoint may still be written in the background, e.g., by a forked process of its kernel.
+        KishuCheckpoint(database_path).wait_until_written(exec_id)
+
+        executor = PausableThreadPoolExecutor(num_workers) if num_workers > 1 else None
+        try:
+            return self._run(database_path, exec_id, lazy, executor, rerun_workers, lazy_min_size)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def _run(
+        self,
+        database_path: Path,
+        exec_id: str,
+        lazy: bool,
+        executor: Optional[PausableThreadPoolExecutor],
+        rerun_workers: int,
+        lazy_min_size: float,
+    ) -> Namespace:
         while True:
-            with AtExitContext():  # Intercept and trigger all atexit functions.
-                ctx = RestoreActionContext(no_history_interactive_shell(), database_path, exec_id)
-
-                # Run restore actions sorted by cell number, then rerun cells before loading variables.
-                for _, action in sorted(self.actions.items(), key=lambda k: k[0]):
-                    try:
-                        action.run(ctx)
-                    except CommitIdNotExistError as e:
-                        # Problem was caused by Kishu itself (specifically, missing file for commit ID).
-                        raise e
-                    except Exception as e:
-                        if not isinstance(action, LoadVariableRestoreAction):
+            shell = RESTORE_SHELL_POOL.get()
+            parallel_reruns = ParallelReruns.plan(self.actions, rerun_workers)
+            try:
+                with AtExitContext():  # Intercept and trigger all atexit functions.
+                    ctx = RestoreActionContext(shell, database_path, exec_id, lazy_min_size=lazy_min_size)
+                    last_rerun = max(
+                        (
+                            step_order
+                            for step_order, action in self.actions.items()
+                            if isinstance(action, RerunCellRestoreAction)
+                        ),
+                        default=None,
+                    )
+
+                    def is_lazy(step_order: StepOrder) -> bool:
+                        return lazy and (last_rerun is None or step_order > last_rerun)
+
+                    # Loading variables depends on no other action, so all loads start upfront. Actions still install
+                    # the loaded variables, rerun cells, and move variables in order.
+                    for step_order, action in sorted(self.actions.items(), key=lambda k: k[0]):
+                        action.prepare(ctx)
+                    if executor is not None:
+                        for step_order, action in sorted(self.actions.items(), key=lambda k: k[0]):
+                            ctx.lazy = is_lazy(step_order)
+                            action.prefetch(ctx, executor)
+
+                    # Run restore actions sorted by cell number, then rerun cells before loading variables.
+                    ran: Dict[StepOrder, RestoreAction] = {}
+                    for step_order, action in sorted(self.actions.items(), key=lambda k: k[0]):
+                        ctx.lazy = is_lazy(step_order)
+                        if parallel_reruns is not None and step_order == parallel_reruns.fork_at:
+                            parallel_reruns.start(ctx, executor)
+                        try:
+                            if parallel_reruns is not None and parallel_reruns.covers(step_order):
+                                parallel_reruns.run(ctx, step_order)
+                            else:
+                                action.run(ctx)
+                        except CommitIdNotExistError as e:
+                            # Problem was caused by Kishu itself (specifically, missing file for commit ID).
                             raise e
+                        except Exception as e:
+                            if not isinstance(action, LoadVariableRestoreAction):
+                                raise e
+
+                            # If action is load variable, replace action with fallback recomputation plan
+                            self.fallbacked_actions.append(action)
+                            del self.actions[action.step_order]
+                            for rerun_cell_action in action.fallback_recomputation:
+                                self.actions[rerun_cell_action.step_order] = rerun_cell_action
+                            if not RestorePlan._run_fallback_recomputation(ctx, action, ran, parallel_reruns):
+                                break
+                            ran.update((rerun.step_order, rerun) for rerun in action.fallback_recomputation)
+                        else:
+                            ran[step_order] = action
+                    else:
+                        self.memoized_actions = ctx.memoized
+                        return Namespace(ctx.shell.user_ns.copy())
+
+                    # Restart the plan, now with the fallback cells in place, in a fresh namespace.
+                    for futures in ctx.prefetched.values():
+                        for future in futures:
+                            future.cancel()
+            finally:
+                if parallel_reruns is not None:
+                    parallel_reruns.close()
+                RESTORE_SHELL_POOL.put(shell)
 
-                        # If action is load variable, replace action with fallback recomputation plan
-                        self.fallbacked_actions.append(action)
-                        del self.actions[action.step_order]
-                        for rerun_cell_action in action.fallback_recomputation:
-                            self.actions[rerun_cell_action.step_order] = rerun_cell_action
-                        break
+    @staticmethod
+    def _run_fallback_recomputation(
+        ctx: RestoreActionContext,
+        action: LoadVariableRestoreAction,
+        ran: Dict[StepOrder, RestoreAction],
+        parallel_reruns: Optional[ParallelReruns],
+    ) -> bool:
+        """
+        Reruns the fallback cells of a failed load right away in the same shell, if that restores the same variables as
+        restarting the plan with them in place. It does not if actions already run after the first fallback cell may
+        access the variables those cells read, or read the variables they write: those actions may have modified the
+        objects the cells read in place, or read variables before the cells wrote them. The same goes for chains of
+        cells being rerun by workers. Variables the cells write but later actions already bound are reverted, as those
+        actions would have overwritten them when run after the cells.
+
+        @return  Whether the fallback cells were rerun, or the plan must be restarted instead.
+        """
+        reruns = sorted(action.fallback_recomputation, key=lambda rerun: rerun.step_order)
+        if not reruns:
+            return True
+        first_rerun = reruns[0].step_order
+        later = {step_order: ran_action for step_order, ran_action in ran.items() if step_order > first_rerun}
+        pending_names = set() if parallel_reruns is None else parallel_reruns.pending_names(action.step_order)
+        names_known = all(rerun.input_names is not None and rerun.output_names is not None for rerun in reruns)
+        if not names_known and (later or pending_names):
+            return False
+        read_names = set().union(*(rerun.input_names or frozenset() for rerun in reruns))
+        written_names = set().union(*(rerun.output_names or frozenset() for rerun in reruns))
+        if not pending_names.isdisjoint(read_names | written_names):
+            return False
+        bound_at: Dict[str, StepOrder] = {}
+        for step_order, ran_action in later.items():
+            bound_names = ran_action.bound_names()
+            input_names = ran_action.input_names if isinstance(ran_action, RerunCellRestoreAction) else frozenset()
+            if bound_names is None or input_names is None:
+                return False
+            if not read_names.isdisjoint(bound_names | input_names) or not written_names.isdisjoint(input_names):
+                return False
+            for name in bound_names:
+                bound_at[name] = max(bound_at.get(name, first_rerun), step_order)
+
+        # Cells rerun from here may access lazy variables installed before.
+        for name, value in list(ctx.shell.user_ns.items()):
+            if type(value) is LazyVariable and (name in read_names or not names_known):
+                ctx.shell.user_ns[name] = value.loader()[name]
+
+        for rerun in reruns:
+            previous = {
+                name: ctx.shell.user_ns.get(name, UNBOUND)
+                for name in rerun.output_names or frozenset()
+                if bound_at.get(name, first_rerun) > rerun.step_order
+            }
+            rerun.run(ctx)
+            for name, value in previous.items():
+                if value is UNBOUND:
+                    ctx.shell.user_ns.pop(name, None)
                 else:
-                    return Namespace(ctx.shell.user_ns.copy())
+                    ctx.shell.user_ns[name] = value
+        return True
@@ -5,7 +5,7 @@
 from dataclasses import dataclass
 from itertools import chain, combinations
 from pathlib import Path
-from typing import Dict, List, Optional, Set, Tuple
+from typing import Any, Dict, FrozenSet, List, Optional, Set, Tuple
 
 import pandas
 from IPython.core.inputtransformer2 import TransformerManager
@@ -15,7 +15,7 @@
 from kishu.planning.ahg import AHG, AHGUpdateInfo
 from kishu.planning.idgraph import IdGraph
 from kishu.planning.optimizer import IncrementalLoadOptimizer, Optimizer
-from kishu.planning.plan import CheckpointPlan, IncrementalCheckpointPlan, RestorePlan
+from kishu.planning.plan import CheckpointPlan, IncrementalCheckpointPlan, RerunCellRestoreAction, RestorePlan
 from kishu.storage.checkpoint import KishuCheckpoint
 from kishu.storage.commit_graph import CommitId, KishuCommitGraph
 from kishu.storage.config import Config, PersistentConfig
@@ -71,6 +71,7 @@ def __init__(
         """
         self._ahg = ahg if ahg else AHG(kishu_disk_ahg)
         self._user_ns = user_ns
+        self._user_ns.set_load_callback(self._update_loaded_id_graphs)
         self._id_graph_map: Dict[str, IdGraph] = {}
         self._pre_run_cell_vars: Set[str] = set()
 
@@ -132,9 +133,10 @@ def pre_run_cell_update(self) -> None:
         # Record variables in the user name prior to running cell if we are not in a new session.
         self._pre_run_cell_vars = self._user_ns.keyset() if self._kishu_graph.head() else set()
 
-        # Populate missing ID graph entries.
+        # Populate missing ID graph entries. Those of lazy variables are populated once they are loaded.
+        lazy_vars = self._user_ns.lazy_vars()
         for var in self._user_ns.keyset():
-            if var not in self._id_graph_map:
+            if var not in self._id_graph_map and var not in lazy_vars:
                 self._id_graph_map[var] = IdGraph.from_object(self._user_ns[var])
 
         # Clear patched namespace trackers.
@@ -177,9 +179,11 @@ def post_run_cell_update(
         for k in filter(self._user_ns.__contains__, modified_vars_candidates):
             new_idgraph = IdGraph.from_object(self._user_ns[k])
 
-            if not self._id_graph_map[k] == new_idgraph:
+            # Lazy variables reassigned before being loaded have no ID graphs.
+            id_graph = self._id_graph_map.get(k)
+            if id_graph is None or not id_graph == new_idgraph:
                 # Non-overwrite modification requires also accessing the variable.
-                if self._id_graph_map[k].is_root_id_and_type_equals(new_idgraph):
+                if id_graph is not None and id_graph.is_root_id_and_type_equals(new_idgraph):
                     accessed_vars.add(k)
                 self._id_graph_map[k] = new_idgraph
                 modified_vars.add(k)
@@ -246,10 +250,11 @@ def _generate_checkpoint_restore_plans(
         # Retrieve active VSs from the graph. Active VSs are correspond to the latest instances/versions of each variable.
         active_vss = self._ahg.get_active_variable_snapshots(commit_id)
 
+        lazy_vars = self._user_ns.lazy_vars()
         for varname in self._user_ns.keyset():
             """If manual commit made before init, pre-run cell update doesn't happen for new variables
             so we need to add them to self._id_graph_map"""
-            if varname not in self._id_graph_map:
+            if varname not in self._id_graph_map and varname not in lazy_vars:
                 self._id_graph_map[varname] = IdGraph.from_object(self._user_ns[varname])
 
         # If incremental storage is enabled, retrieve list of currently stored VSes and compute VSes to
@@ -307,10 +312,11 @@ def _generate_restore_plan(
         """
         restore_plan = RestorePlan()
 
-        for ce in self._ahg.get_all_cell_executions():
+        # Only CEs to rerun or with variables to load appear in the plan.
+        for ce in ces_to_recompute.union(ce_to_vs_map.keys()):
             # Add a rerun cell restore action if the cell needs to be rerun
             if ce in ces_to_recompute:
-                restore_plan.add_rerun_cell_restore_action(ce.cell_num, ce.cell)
+                self._add_rerun_cell_restore_action(restore_plan, ce)
 
             # Add a load variable restore action if there are variables from the cell that needs to be stored
             if len(ce_to_vs_map[ce]) > 0:
@@ -318,6 +324,7 @@ def _generate_restore_plan(
                     ce.cell_num,
                     list(chain.from_iterable(ce_to_vs_map[ce])),
                     [(req_ce.cell_num, req_ce.cell) for req_ce in req_func_mapping[ce]],
+                    fallback_names={req_ce.cell_num: self._ce_names(req_ce) for req_ce in req_func_mapping[ce]},
                 )
         return restore_plan
 
@@ -342,6 +349,49 @@ def generate_incremental_restore_plan(
             self._kishu_graph.list_ancestor_commit_ids(target_commit_id),
         )
 
+    def _add_rerun_cell_restore_action(
+        self, restore_plan: RestorePlan, ce: CellExecution, database_path: Optional[Path] = None
+    ) -> None:
+        """
+        Adds a rerun of ce to restore_plan, with the variables it reads and writes for rerunning independent cells in
+        parallel. If database_path is given, the rerun loads the stored outputs of an equivalent CE instead, if any.
+        """
+        input_names, output_names = self._ce_names(ce)
+        restore_plan.add_rerun_cell_restore_action(
+            ce.cell_num,
+            ce.cell,
+            input_names=input_names,
+            output_names=output_names,
+            memoized_outputs=self._find_memoized_outputs(ce, database_path) if database_path is not None else None,
+            cell_runtime_s=ce.cell_runtime_s,
+        )
+
+    def _ce_names(self, ce: CellExecution) -> Tuple[FrozenSet[str], FrozenSet[str]]:
+        """
+        Returns the variables ce reads and writes.
+        """
+        return (
+            frozenset(name for vs in self._ahg.get_ce_input_vses(ce) for name in vs.name),
+            frozenset(name for vs in self._ahg.get_ce_output_vses(ce) for name in vs.name),
+        )
+
+    def _find_memoized_outputs(self, ce: CellExecution, database_path: Path) -> Optional[Set[VariableSnapshot]]:
+        """
+        Returns the stored output VSes of the latest other CE which ran the same cell code as ce on the same input
+        VSes and wrote the same variables, if any.
+        """
+        if not Config.get("PLANNER", "cell_memoization", True) or not RerunCellRestoreAction.is_memoizable(ce.cell):
+            return None
+        output_names = {vs.name for vs in self._ahg.get_ce_output_vses(ce)}
+        for equivalent_ce in self._ahg.get_equivalent_ces(ce):
+            memoized_outputs = self._ahg.get_ce_output_vses(equivalent_ce)
+            if {vs.name for vs in memoized_outputs} != output_names or any(vs.deleted for vs in memoized_outputs):
+                continue
+            versioned_names = [vs.versioned_name() for vs in memoized_outputs]
+            if KishuCheckpoint(database_path).filter_stored_versioned_names(versioned_names) == set(versioned_names):
+                return memoized_outputs
+        return None
+
     def _generate_incremental_restore_plan(
         self,
         database_path: Path,
@@ -351,6 +401,8 @@ def _generate_incremental_restore_plan(
     ) -> RestorePlan:
         """
         Dynamically generates an incremental restore plan. To be called at checkout time if incremental CR is enabled.
+        The plan leaves out the currently active VSes that are also active in the target state, which stay in place in
+        the user namespace, unless cells to rerun may read them.
         """
         # Find currently active VSes and stored VSes that can help restoration.
         useful_vses = self._find_useful_vses(lca_active_vses, database_path, target_parent_commit_ids)
@@ -362,9 +414,18 @@ def _generate_incremental_restore_plan(
             useful_vses.useful_active_vses,
             useful_vses.useful_stored_vses,
         ).compute_plan()
+
+        # Only move the unchanged VSes that cells to rerun, including fallback recomputations, may read into the
+        # restore shell.
+        rerun_ces = opt_result.ces_to_rerun.union(*opt_result.fallback_recomputation.values())
+        rerun_input_names = {name for ce in rerun_ces for vs in self._ahg.get_ce_input_vses(ce) for name in vs.name}
+        vss_to_move = {
+            vs for vs in opt_result.vss_to_move if vs not in target_active_vses or not vs.name.isdisjoint(rerun_input_names)
+        }
+
         # Sort the VSes to load and move by cell execution number.
         move_ce_to_vs_map: Dict[CellExecution, Set[VariableSnapshot]] = defaultdict(set)
-        for vs in opt_result.vss_to_move:
+        for vs in vss_to_move:
             move_ce_to_vs_map[self._ahg.get_vs_input_ce(vs)].add(vs)
 
         load_ce_to_vs_map: Dict[CellExecution, Set[VariableSnapshot]] = defaultdict(set)
@@ -374,10 +435,11 @@ def _generate_incremental_restore_plan(
         # Compute the incremental restore plan.
         restore_plan = RestorePlan()
 
-        for ce in self._ahg.get_all_cell_executions():
+        # Only CEs to rerun or with variables to move or load appear in the plan.
+        for ce in opt_result.ces_to_rerun.union(move_ce_to_vs_map.keys(), load_ce_to_vs_map.keys()):
             # Add a rerun cell restore action if the cell needs to be rerun.
             if ce in opt_result.ces_to_rerun:
-                restore_plan.add_rerun_cell_restore_action(ce.cell_num, ce.cell)
+                self._add_rerun_cell_restore_action(restore_plan, ce, database_path)
 
             # Add a move variable action if variables need to be moved.
             if len(move_ce_to_vs_map[ce]) > 0:
@@ -416,6 +478,14 @@ def _find_useful_vses(
 
         return UsefulVses(useful_active_vses, useful_stored_vses)
 
+    def get_unchanged_variables(self, target_commit_id: CommitId) -> Set[str]:
+        """
+        Returns the variables of the VSes active both currently and in the target state, which checkout leaves in place.
+        """
+        current_active_vses = self._ahg.get_active_variable_snapshots(self._kishu_graph.head())
+        target_active_vses = self._ahg.get_active_variable_snapshots(target_commit_id)
+        return {name for vs in current_active_vses.intersection(target_active_vses) for name in vs.name}
+
     def get_ahg(self) -> AHG:
         return self._ahg
 
@@ -425,30 +495,57 @@ def get_id_graph_map(self) -> Dict[str, IdGraph]:
         """
         return self._id_graph_map
 
-    def replace_state(self, target_commit_id: CommitId, new_user_ns: Namespace) -> None:
+    def replace_state(self, target_commit_id: CommitId, new_user_ns: Namespace, defer_id_graphs: bool = False) -> None:
         """
         Replace user namespace with new_user_ns.
         Called when a checkout is performed.
+
+        @param defer_id_graphs: whether to build the ID graphs of differing variables once they are first accessed,
+            turning them into lazy variables, instead of right away.
         """
         # Get target AHG.
         target_active_vses = self._ahg.get_active_variable_snapshots(target_commit_id)
 
-        self._replace_state(target_active_vses, new_user_ns)
+        self._replace_state(target_active_vses, new_user_ns, defer_id_graphs)
 
-    def _replace_state(self, new_active_vses: Set[VariableSnapshot], new_user_ns: Namespace) -> None:
+    def _replace_state(
+        self, new_active_vses: Set[VariableSnapshot], new_user_ns: Namespace, defer_id_graphs: bool = False
+    ) -> None:
         """
         Replace the current AHG's active VSes with new_active_vses and user namespace with new_user_ns.
         Called when a checkout is performed.
         """
         self._user_ns = new_user_ns
-
-        # Update ID graphs for differing active variables.
-        for varname in self._get_differing_vars_post_checkout(new_active_vses):
-            self._id_graph_map[varname] = IdGraph.from_object(self._user_ns[varname])
+        self._user_ns.set_load_callback(self._update_loaded_id_graphs)
+        differing_vars = self._get_differing_vars_post_checkout(new_active_vses)
+
+        # Variables sharing objects are in the same VS, so cells cannot modify the objects of a VS before accessing one
+        # of its variables, which then loads all of them.
+        if defer_id_graphs:
+            lazy_vars = self._user_ns.lazy_vars()
+            for vs in new_active_vses:
+                names = {name for name in vs.name if name in differing_vars and name in self._user_ns}
+                if names and not names & lazy_vars:
+                    self._user_ns.defer(names)
+
+        # Update ID graphs for differing active variables. Those of lazy variables are updated once they are loaded.
+        lazy_vars = self._user_ns.lazy_vars()
+        for varname in differing_vars:
+            if varname in lazy_vars:
+                self._id_graph_map.pop(varname, None)
+            else:
+                self._id_graph_map[varname] = IdGraph.from_object(self._user_ns[varname])
 
         # Clear pre-run cell info.
         self._pre_run_cell_vars = set()
 
+    def _update_loaded_id_graphs(self, variables: Dict[str, Any]) -> None:
+        """
+        Records the ID graphs of lazy variables as loaded, before cells may modify them.
+        """
+        for varname, obj in variables.items():
+            self._id_graph_map[varname] = IdGraph.from_object(obj)
+
     def _get_differing_vars_post_checkout(self, new_active_vses: Set[VariableSnapshot]) -> Set[str]:
         """
         Finds all differing active variables between the pre and post-checkout states.
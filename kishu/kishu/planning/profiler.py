@@ -1,5 +1,4 @@
 import inspect
-import pickle
 import sys
 import types
 from typing import Any, Optional
@@ -15,6 +14,9 @@ def _get_object_class(obj: Any) -> Optional[str]:
 
 
 def _add_to_unserializable_list(obj: Any) -> None:
+    # Whether a container pickles depends on its items, e.g., the list of a variable snapshot's variables.
+    if type(obj) in (list, tuple, set, frozenset, dict):
+        return
     if _get_object_class(obj):
         unserializable_class_list = Config.get("PROFILER", "excluded_classes", [])
         unserializable_class_list.append(_get_object_class(obj))
@@ -40,10 +42,10 @@ def _is_picklable(obj: Any) -> bool:
     except Exception:
         pass
 
-    # Double check with pickle library, which is slower but more robust.
-    # TODO: remove this in the future, returning false when Dill fails.
+    # Double check by pickling, which is slower but more robust, e.g., to objects failing dill's equality check after
+    # unpickling them. Checkpoints are pickled with dill, which also pickles modules and functions, unlike pickle.
     try:
-        pickle.dumps(obj)
+        dill.dumps(obj)
     except Exception:
         # Add the unpicklable object to the config file.
         if Config.get("PROFILER", "auto_add_unpicklable_object", True):
@@ -0,0 +1,162 @@
+"""
+Undoes the last cells by swapping back the variables they changed, kept pickled in memory, instead of checking out
+their parent commit from storage.
+
+Each cell replaces some active variable snapshots (VSes) of its parent commit with new ones. The buffer keeps the
+pickle of every active VS as of when it became active, and moves the pickles of the VSes a cell replaces into that
+cell's undo entry. Undoing the cell deletes the variables of its new VSes and unpickles the replaced VSes, which are
+whole groups of variables sharing objects.
+"""
+
+from __future__ import annotations
+
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, List, Optional, Set
+
+import dill
+
+from kishu.jupyter.namespace import Namespace
+from kishu.storage.disk_ahg import VariableSnapshot
+
+DEFAULT_UNDO_BUFFER_CELLS = 0
+DEFAULT_UNDO_BUFFER_SIZE = 1 << 28
+
+
+@dataclass
+class UndoEntry:
+    """
+    @param commit_id: commit of the cell.
+    @param parent_commit_id: commit before the cell.
+    @param added_vses: VSes the cell made active.
+    @param replaced_vses: pickles of the VSes the cell replaced, or None for those not kept.
+    """
+
+    commit_id: str
+    parent_commit_id: Optional[str]
+    added_vses: Set[VariableSnapshot]
+    replaced_vses: Dict[VariableSnapshot, Optional[bytes]]
+
+    def complete(self) -> bool:
+        return all(data is not None for data in self.replaced_vses.values())
+
+
+class UndoBuffer:
+    """
+    Ring buffer of the undo entries of the last cells, bounded by the number of cells and the total size of the kept
+    pickles. Evicting starts from the oldest entries, then the pickles of the least recently added active VSes.
+    """
+
+    def __init__(self, max_cells: int = DEFAULT_UNDO_BUFFER_CELLS, max_size: int = DEFAULT_UNDO_BUFFER_SIZE) -> None:
+        """
+        @param max_cells: number of last cells that can be undone. 0 disables the buffer.
+        @param max_size: size in bytes of the pickles to keep.
+        """
+        self.max_cells = max_cells
+        self.max_size = max_size
+        self._entries: Deque[UndoEntry] = deque()
+        self._active_vses: OrderedDict[VariableSnapshot, bytes] = OrderedDict()
+        self._size = 0
+
+    def enabled(self) -> bool:
+        return self.max_cells > 0
+
+    def size(self) -> int:
+        return self._size
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._active_vses.clear()
+        self._size = 0
+
+    def record(
+        self,
+        commit_id: str,
+        parent_commit_id: Optional[str],
+        parent_vses: Set[VariableSnapshot],
+        vses: Set[VariableSnapshot],
+        user_ns: Namespace,
+    ) -> None:
+        """
+        Records the cell of commit_id, which changed the active VSes from parent_vses to vses in user_ns.
+        """
+        if not self.enabled():
+            return
+        added_vses = vses - parent_vses
+        replaced_vses = {vs: self._active_vses.pop(vs, None) for vs in parent_vses - vses}
+        tracked_ns = user_ns.get_tracked_namespace()  # Pickling is not an access by the user.
+        for vs in added_vses:
+            data = UndoBuffer._dumps_or_none({name: tracked_ns.get(name) for name in vs.name if name in tracked_ns})
+            if data is not None and len(data) <= self.max_size:
+                self._active_vses[vs] = data
+                self._size += len(data)
+        self._entries.append(UndoEntry(commit_id, parent_commit_id, added_vses, replaced_vses))
+        self._evict()
+
+    def undo(self, commit_id: str, target_commit_id: str, user_ns: Namespace) -> bool:
+        """
+        Restores the variables of target_commit_id, an ancestor of commit_id, the current commit, in user_ns if the
+        entries of the cells between them are kept. Returns whether it did; otherwise, user_ns is unchanged.
+        """
+        chain: List[UndoEntry] = []
+        current: Optional[str] = commit_id
+        for entry in reversed(self._entries):
+            if current == target_commit_id or entry.commit_id != current or not entry.complete():
+                break
+            chain.append(entry)
+            current = entry.parent_commit_id
+        if not chain or current != target_commit_id:
+            return False
+
+        # Undo the cells from the latest; VSes added by a cell and replaced by a later one are never restored.
+        restored_vses: Dict[VariableSnapshot, bytes] = {}
+        deleted_names: Set[str] = set()
+        for entry in chain:
+            for vs in entry.added_vses:
+                if restored_vses.pop(vs, None) is None:
+                    deleted_names.update(vs.name)
+            restored_vses.update((vs, data) for vs, data in entry.replaced_vses.items() if data is not None)
+        try:
+            restored = {vs: dill.loads(data) for vs, data in restored_vses.items()}
+        except Exception:
+            return False
+
+        for name in deleted_names:
+            if name in user_ns:
+                del user_ns[name]
+        for variables in restored.values():
+            for name, value in variables.items():
+                user_ns[name] = value
+
+        # The restored VSes are active again.
+        for entry in chain:
+            self._entries.pop()
+            for vs in entry.added_vses:
+                self._active_vses.pop(vs, None)
+        self._active_vses.update(restored_vses)
+        self._size = sum(len(data) for data in self._active_vses.values()) + sum(
+            len(data) for entry in self._entries for data in entry.replaced_vses.values() if data is not None
+        )
+        return True
+
+    def _evict(self) -> None:
+        while len(self._entries) > self.max_cells:
+            self._drop_oldest_entry()
+        while self._size > self.max_size and self._entries:
+            self._drop_oldest_entry()
+        while self._size > self.max_size and self._active_vses:
+            _, data = self._active_vses.popitem(last=False)
+            self._size -= len(data)
+
+    def _drop_oldest_entry(self) -> None:
+        entry = self._entries.popleft()
+        for data in entry.replaced_vses.values():
+            if data is not None:
+                self._size -= len(data)
+
+    @staticmethod
+    def _dumps_or_none(variables: Dict[str, Any]) -> Optional[bytes]:
+        try:
+            return dill.dumps(variables)
+        except Exception:
+            return None
@@ -0,0 +1,247 @@
+"""
+Backends storing the data of deduplicated chunks: inline in SQLite or in append-only packfiles.
+"""
+
+from __future__ import annotations
+
+import os
+import shutil
+import sqlite3
+from collections import defaultdict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Collection, Dict, List, Sequence, Tuple
+
+from kishu.storage.config import Config
+
+CHUNK_TABLE = "blob_chunk"
+PACK_INDEX_TABLE = "blob_pack_index"
+
+DEFAULT_BLOB_BACKEND = "sqlite"
+DEFAULT_PACKFILE_MAX_SIZE = 1 << 30
+
+# Packfiles with less live data than this fraction of their size are rewritten by repacking.
+DEFAULT_REPACK_MIN_LIVE_RATIO = 0.5
+
+PACKFILE_PREFIX = "pack-"
+PACKFILE_SUFFIX = ".pack"
+
+# Maximum number of digests to look up per query, below SQLite's limit on the number of query parameters.
+SQLITE_MAX_PARAMS = 500
+
+Digest = bytes
+
+
+@dataclass
+class RepackStats:
+    """
+    @param num_deleted_packfiles: number of packfiles deleted, after moving their live chunks if any.
+    @param moved_bytes: total size of the live chunks moved to the active packfile.
+    @param reclaimed_bytes: number of bytes by which the packfiles shrank.
+    """
+
+    num_deleted_packfiles: int = 0
+    moved_bytes: int = 0
+    reclaimed_bytes: int = 0
+
+
+class BlobBackend:
+    """
+    Stores the data of chunks, keyed by their digest, for KishuChunkStore, which keeps their reference counts in
+    CHUNK_TABLE. Methods operate on a caller's cursor so that they join the caller's transaction.
+    """
+
+    def init_database(self, cur: sqlite3.Cursor) -> None:
+        pass
+
+    def drop_database(self, cur: sqlite3.Cursor) -> None:
+        pass
+
+    def insert(self, cur: sqlite3.Cursor, chunks: Sequence[Tuple[Digest, int, bytes]]) -> None:
+        """
+        Stores new chunks given as (digest, reference count, data).
+        """
+        raise NotImplementedError("Must be extended by inherited classes.")
+
+    def load(self, cur: sqlite3.Cursor, digests: Collection[Digest]) -> Dict[Digest, bytes]:
+        """
+        Returns the data of the chunks among digests stored by this backend.
+        """
+        raise NotImplementedError("Must be extended by inherited classes.")
+
+
+class SqliteBlobBackend(BlobBackend):
+    """
+    Stores chunk data inline in CHUNK_TABLE.
+    """
+
+    def insert(self, cur: sqlite3.Cursor, chunks: Sequence[Tuple[Digest, int, bytes]]) -> None:
+        cur.executemany(f"insert into {CHUNK_TABLE} values (?, ?, ?)", chunks)
+
+    def load(self, cur: sqlite3.Cursor, digests: Collection[Digest]) -> Dict[Digest, bytes]:
+        chunks: Dict[Digest, bytes] = {}
+        for batch in _batches(list(digests)):
+            cur.execute(
+                f"select digest, data from {CHUNK_TABLE} where data is not null and digest in (%s)"
+                % ",".join("?" * len(batch)),
+                batch,
+            )
+            chunks.update(cur.fetchall())
+        return chunks
+
+
+class PackfileBlobBackend(BlobBackend):
+    """
+    Appends chunk data to packfiles in a directory next to the database, keeping the database small. PACK_INDEX_TABLE
+    locates each chunk by packfile and offset; CHUNK_TABLE rows keep their reference counts with null data.
+
+    Chunks stored by a call are appended with one sequential write to the newest (active) packfile, until it exceeds
+    the maximum packfile size. Packfiles are never modified otherwise; repacking moves the live chunks of mostly dead
+    packfiles to the active packfile and deletes them.
+    """
+
+    def __init__(self, database_path: Path, max_packfile_size: int = DEFAULT_PACKFILE_MAX_SIZE) -> None:
+        """
+        @param database_path: database storing the packfile index. Packfiles are stored in a directory next to it.
+        @param max_packfile_size: size in bytes after which appends go to a new packfile.
+        """
+        self.directory = PackfileBlobBackend.packfile_directory(database_path)
+        self.max_packfile_size = max_packfile_size
+
+    @staticmethod
+    def packfile_directory(database_path: Path) -> Path:
+        return database_path.with_name(f"{database_path.name}.packs")
+
+    def init_database(self, cur: sqlite3.Cursor) -> None:
+        cur.execute(
+            f"create table if not exists {PACK_INDEX_TABLE} " "(digest blob primary key, pack_id int, offset int, size int)"
+        )
+
+    def drop_database(self, cur: sqlite3.Cursor) -> None:
+        cur.execute(f"drop table if exists {PACK_INDEX_TABLE}")
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def insert(self, cur: sqlite3.Cursor, chunks: Sequence[Tuple[Digest, int, bytes]]) -> None:
+        if not chunks:
+            return
+        # Writing to the database first takes its write lock, serializing appends with repacking.
+        cur.executemany(
+            f"insert into {CHUNK_TABLE} values (?, ?, null)", [(digest, refcount) for digest, refcount, _ in chunks]
+        )
+        locations = self._append([data for _, _, data in chunks])
+        cur.executemany(
+            f"insert into {PACK_INDEX_TABLE} values (?, ?, ?, ?)",
+            [(digest, *location) for (digest, _, _), location in zip(chunks, locations)],
+        )
+
+    def load(self, cur: sqlite3.Cursor, digests: Collection[Digest]) -> Dict[Digest, bytes]:
+        locations: Dict[int, List[Tuple[Digest, int, int]]] = defaultdict(list)
+        for batch in _batches(list(digests)):
+            cur.execute(
+                f"select digest, pack_id, offset, size from {PACK_INDEX_TABLE} where digest in (%s)"
+                % ",".join("?" * len(batch)),
+                batch,
+            )
+            for digest, pack_id, offset, size in cur.fetchall():
+                locations[pack_id].append((digest, offset, size))
+
+        chunks: Dict[Digest, bytes] = {}
+        for pack_id, pack_locations in locations.items():
+            fd = os.open(self._packfile_path(pack_id), os.O_RDONLY)
+            try:
+                # Read in file order.
+                for digest, offset, size in sorted(pack_locations, key=lambda location: location[1]):
+                    chunks[digest] = os.pread(fd, size, offset)
+            finally:
+                os.close(fd)
+        return chunks
+
+    def repack(
+        self, cur: sqlite3.Cursor, min_live_ratio: float = DEFAULT_REPACK_MIN_LIVE_RATIO
+    ) -> Tuple[RepackStats, List[Path]]:
+        """
+        Moves the live chunks of packfiles with less than min_live_ratio live data to the active packfile. Returns the
+        packfiles to delete once the caller's transaction commits, as the index refers to them until then.
+        """
+        stats = RepackStats()
+        pack_ids = self._pack_ids()
+        if not pack_ids:
+            return stats, []
+
+        # Forget chunks released since the last repack.
+        cur.execute(f"delete from {PACK_INDEX_TABLE} where digest not in (select digest from {CHUNK_TABLE})")
+        live_bytes = dict(cur.execute(f"select pack_id, sum(size) from {PACK_INDEX_TABLE} group by pack_id").fetchall())
+
+        # Never repack the active packfile, which the kernel may be appending to.
+        packfiles_to_delete = []
+        for pack_id in pack_ids[:-1]:
+            path = self._packfile_path(pack_id)
+            packfile_size = path.stat().st_size
+            if live_bytes.get(pack_id, 0) >= min_live_ratio * packfile_size:
+                continue
+            digests = [row[0] for row in cur.execute(f"select digest from {PACK_INDEX_TABLE} where pack_id = ?", (pack_id,))]
+            chunks = self.load(cur, digests)
+            locations = self._append([chunks[digest] for digest in digests])
+            cur.executemany(
+                f"update {PACK_INDEX_TABLE} set pack_id = ?, offset = ?, size = ? where digest = ?",
+                [(*location, digest) for digest, location in zip(digests, locations)],
+            )
+            moved_bytes = sum(len(data) for data in chunks.values())
+            packfiles_to_delete.append(path)
+            stats.num_deleted_packfiles += 1
+            stats.moved_bytes += moved_bytes
+            stats.reclaimed_bytes += packfile_size - moved_bytes
+        return stats, packfiles_to_delete
+
+    def _pack_ids(self) -> List[int]:
+        if not self.directory.exists():
+            return []
+        return sorted(
+            int(path.name[len(PACKFILE_PREFIX) : -len(PACKFILE_SUFFIX)])
+            for path in self.directory.glob(f"{PACKFILE_PREFIX}*{PACKFILE_SUFFIX}")
+        )
+
+    def _packfile_path(self, pack_id: int) -> Path:
+        return self.directory / f"{PACKFILE_PREFIX}{pack_id:08d}{PACKFILE_SUFFIX}"
+
+    def _append(self, blobs: List[bytes]) -> List[Tuple[int, int, int]]:
+        """
+        Appends blobs to the active packfile, returning their (pack ID, offset, size).
+        """
+        if not blobs:
+            return []
+        self.directory.mkdir(parents=True, exist_ok=True)
+        pack_ids = self._pack_ids()
+        pack_id = pack_ids[-1] if pack_ids else 0
+        path = self._packfile_path(pack_id)
+        if path.exists() and path.stat().st_size >= self.max_packfile_size:
+            pack_id += 1
+            path = self._packfile_path(pack_id)
+
+        locations = []
+        with open(path, "ab") as f:
+            offset = f.seek(0, os.SEEK_END)
+            for blob in blobs:
+                locations.append((pack_id, offset, len(blob)))
+                offset += len(blob)
+            f.writelines(blobs)
+        return locations
+
+
+def blob_backends_from_config(database_path: Path) -> List[BlobBackend]:
+    """
+    Returns the configured backend, which stores new chunks, followed by the other backends, which still serve the
+    chunks stored before the configuration changed.
+    """
+    backends: Dict[str, BlobBackend] = {
+        "sqlite": SqliteBlobBackend(),
+        "packfile": PackfileBlobBackend(database_path, Config.get("PLANNER", "packfile_max_size", DEFAULT_PACKFILE_MAX_SIZE)),
+    }
+    name = Config.get("PLANNER", "blob_backend", DEFAULT_BLOB_BACKEND)
+    if name not in backends:
+        raise ValueError(f"Blob backend {name} is unknown, available: {list(backends)}")
+    return [backends[name]] + [backend for backend_name, backend in backends.items() if backend_name != name]
+
+
+def _batches(digests: List[Digest]) -> List[List[Digest]]:
+    return [digests[i : i + SQLITE_MAX_PARAMS] for i in range(0, len(digests), SQLITE_MAX_PARAMS)]
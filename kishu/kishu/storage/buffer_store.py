@@ -0,0 +1,902 @@
+"""
+Out-of-band storage of the large buffers of pickled checkpoints, e.g., numpy arrays, as memory-mapped files.
+
+DataFrames are pickled column by column, so that each numeric column is a buffer of its own and unchanged columns
+are stored once across versions.
+
+Parameters of models, i.e., the fitted arrays of sklearn estimators and torch tensors, are stored out of band down to
+a smaller size, so that versions of a model share their unchanged parameters.
+
+A large buffer modified in a few places, e.g., a few rows of an array, is stored as a delta: the fixed-size blocks
+differing from a previous version of the buffer and a reference to it.
+
+Variables sharing objects can be pickled as parts: one per variable and one per object reached from more than one
+part. Each part has its own memo, so unchanged parts pickle to the same bytes, which chunk deduplication stores once.
+A subset of the variables is loaded by unpickling only their parts and the parts they reference.
+"""
+
+from __future__ import annotations
+
+import gc
+import io
+import mmap
+import os
+import pickle
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import types
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, List, Optional, Sequence, Set, Tuple, Union
+
+import dill
+import numpy as np
+import pandas as pd
+
+from kishu.storage.chunk_store import Digest, digest_of
+from kishu.storage.schema import drop_schema_version, get_schema_version, set_schema_version, table_columns
+
+BUFFER_REF_TABLE = "blob_buffer_ref"
+BUFFER_REF_TABLE_NAMES_IDX = "blob_buffer_ref_names_idx"
+BUFFER_REF_TABLE_BLOB_IDX = "blob_buffer_ref_blob_idx"
+
+# Layout versions of the buffer reference table:
+#   0: (commit_id, blob_key, digest) rows.
+#   1: rows also store the variable names part of the blob key, indexed to find the latest blob of the same variables.
+BUFFER_SCHEMA_COMPONENT = "buffer_store"
+BUFFER_SCHEMA_VERSION = 1
+
+# Pickles with out-of-band buffers start with the magic, the number of buffers and their digests. Pickles never start
+# with a null byte; hence pickles without the magic are loaded as is.
+BUFFER_MAGIC = b"\x00KB"
+BUFFER_COUNT_FORMAT = "<I"
+BUFFER_DIGEST_SIZE = 16
+BUFFER_FILE_SUFFIX = ".buf"
+
+# A delta file starts with the magic, its header and the indices of its blocks, followed by the blocks' data. Each
+# buffer stored as a delta or with at least two blocks has a sidecar file listing the digests of its blocks.
+DELTA_FILE_SUFFIX = ".delta"
+BLOCKS_FILE_SUFFIX = ".blocks"
+DELTA_MAGIC = b"KBD1"
+DELTA_HEADER_FORMAT = "<16sQQII"  # Base digest, size, block size, depth in the delta chain, number of blocks.
+DELTA_INDEX_FORMAT = "<Q"
+BLOCKS_HEADER_FORMAT = "<Q"  # Block size.
+
+DEFAULT_DELTA_BLOCK_SIZE = 1 << 20
+DEFAULT_DELTA_KEYFRAME_INTERVAL = 8
+
+# Buffers differing from their base in more than this fraction of blocks are stored whole.
+DELTA_MAX_CHANGED_FRACTION = 0.5
+
+# Pickles streamed to storage cannot start with their buffers' digests; they reference buffers by persistent IDs.
+BUFFER_PERSISTENT_ID = "kishu.buffer"
+
+# Pickles split into parts start with the magic and a manifest pickle, followed by the parts' pickles. Parts reference
+# other parts by their indices as persistent IDs. Splitting gives up on objects needing too many rounds or parts. The
+# manifest lists the size of each part and the parts it references, so that loading some variables skips other parts.
+SHARED_MAGIC = b"\x00KS"
+SHARED_MAX_ROUNDS = 16
+SHARED_MAX_PARTS = 1000
+
+# Objects whose identity need not be preserved or which are pickled by reference are never parts of their own.
+UNSHARED_TYPES = frozenset(
+    [
+        type(None),
+        bool,
+        int,
+        float,
+        complex,
+        str,
+        bytes,
+        tuple,
+        frozenset,
+        type,
+        types.FunctionType,
+        types.BuiltinFunctionType,
+        types.ModuleType,
+        pickle.PickleBuffer,
+    ]
+)
+
+DEFAULT_OUT_OF_BAND_MIN_SIZE = 1 << 20
+DEFAULT_MODEL_PARAM_MIN_SIZE = 1 << 16
+
+# Buffer files are written before the checkpoints referencing them are committed. Unreferenced files younger than this
+# may belong to a checkpoint being stored, so sweeping keeps them.
+BUFFER_SWEEP_GRACE_PERIOD_S = 3600.0
+
+
+def _rebuild_dataframe(values: List[Any], columns: pd.Index, index: pd.Index, attrs: Dict[Any, Any]) -> pd.DataFrame:
+    """
+    Reassembles a DataFrame pickled column by column around its unpickled columns, without copying them.
+    """
+    df = pd.DataFrame(dict(enumerate(values)), index=index, copy=False)
+    df.columns = columns
+    df.attrs = attrs
+    return df
+
+
+def _rebuild_tensor(array: np.ndarray, dtype: str, requires_grad: bool) -> Any:
+    """
+    Rebuilds a CPU tensor around its unpickled data, without copying it.
+    """
+    import torch
+
+    tensor = torch.from_numpy(array)
+    if str(tensor.dtype) != dtype:
+        # Dtypes numpy lacks, e.g., bfloat16, are pickled as integers of the same size.
+        tensor = tensor.view(getattr(torch, dtype.split(".", 1)[1]))
+    return tensor.requires_grad_(requires_grad)
+
+
+def _rebuild_parameter(tensor: Any, requires_grad: bool) -> Any:
+    import torch
+
+    return torch.nn.Parameter(tensor, requires_grad)
+
+
+class OutOfBandPickler(dill.Pickler):
+    """
+    dill pickler passing numpy arrays' data to the buffer callback.
+    """
+
+    def __init__(self, *args: Any, split_dataframes: bool = True, **kwargs: Any) -> None:
+        """
+        @param split_dataframes: whether to pickle DataFrames column by column instead of by their consolidated blocks.
+        """
+        super().__init__(*args, **kwargs)
+        self.split_dataframes = split_dataframes
+
+        # Objects can only be models of libraries already imported; importing them here would slow every checkpoint.
+        self._torch: Any = sys.modules.get("torch")
+        self._sklearn_base: Any = sys.modules.get("sklearn.base")
+
+        # Arrays holding model parameters and their buffers passed to the callback. The objects are kept alive so that
+        # their IDs are not reused while pickling.
+        self._param_arrays: Dict[int, Any] = {}
+        self._param_buffers: Dict[int, pickle.PickleBuffer] = {}
+
+    def is_model_param(self, buffer: pickle.PickleBuffer) -> bool:
+        """
+        Returns whether the buffer passed to the callback holds a parameter of a model.
+        """
+        return id(buffer) in self._param_buffers
+
+    def reducer_override(self, obj: Any) -> Any:
+        # pickle memoizes the copies of in-band buffers, but the copies of all empty buffers are the same object.
+        if type(obj) is pickle.PickleBuffer:
+            view = memoryview(obj)
+            if view.nbytes == 0:
+                return (bytes, ()) if view.readonly else (bytearray, ())
+            return NotImplemented
+        # dill reduces arrays with __reduce__, which copies their data into the pickle regardless of the protocol.
+        if type(obj) is np.ndarray and not obj.dtype.hasobject:
+            reduced = obj.__reduce_ex__(self.proto)
+            if id(obj) in self._param_arrays:
+                for arg in reduced[1]:
+                    if isinstance(arg, pickle.PickleBuffer):
+                        self._param_buffers[id(arg)] = arg
+            return reduced
+        if self._torch is not None and type(obj) in (self._torch.Tensor, self._torch.nn.Parameter):
+            return self._reduce_tensor(obj)
+        if self._sklearn_base is not None and isinstance(obj, self._sklearn_base.BaseEstimator):
+            # Fitted attributes, e.g., coef_ or coefs_, end with an underscore.
+            for name, value in vars(obj).items():
+                if name.endswith("_") and not name.startswith("_"):
+                    for array in value if isinstance(value, (list, tuple)) else [value]:
+                        if type(array) is np.ndarray:
+                            self._param_arrays[id(array)] = array
+            return NotImplemented
+        # A DataFrame's block holds all of its columns of a dtype, so modifying or adding one column changes the whole
+        # block. Numeric columns are contiguous rows of their blocks, passed to the buffer callback on their own;
+        # object and extension columns are pickled as usual.
+        if self.split_dataframes and type(obj) is pd.DataFrame and obj.flags.allows_duplicate_labels:
+            values = [obj.iloc[:, i]._values for i in range(obj.shape[1])]
+            return _rebuild_dataframe, (values, obj.columns, obj.index, obj.attrs)
+        return NotImplemented
+
+    def _reduce_tensor(self, tensor: Any) -> Any:
+        """
+        Reduces a dense CPU tensor to a numpy array sharing its data, which is then pickled as a model parameter.
+        Other tensors, e.g., on GPUs, are pickled by torch.
+        """
+        torch = self._torch
+        if not (
+            tensor.layout == torch.strided
+            and tensor.device.type == "cpu"
+            and tensor.grad_fn is None
+            and not tensor.is_quantized
+            and not tensor.is_nested
+            and not tensor.is_conj()
+            and not tensor.is_neg()
+            and not tensor.has_names()
+        ):
+            return NotImplemented
+        if type(tensor) is torch.nn.Parameter:
+            data = tensor.detach()
+            self._param_arrays[id(data)] = data
+            return _rebuild_parameter, (data, tensor.requires_grad)
+
+        data = tensor.detach().contiguous()
+        try:
+            array = data.numpy()
+        except TypeError:
+            array = data.view({1: torch.uint8, 2: torch.int16, 4: torch.int32, 8: torch.int64}[data.element_size()]).numpy()
+        self._param_arrays[id(array)] = array
+        return _rebuild_tensor, (array, str(tensor.dtype), tensor.requires_grad)
+
+
+class PersistentBufferPickler(OutOfBandPickler):
+    """
+    OutOfBandPickler referencing the buffers written by the buffer store by persistent IDs.
+    """
+
+    def __init__(
+        self,
+        file: Union[io.RawIOBase, io.BufferedIOBase],
+        buffer_store: KishuBufferStore,
+        base_digests: Sequence[Digest] = (),
+    ) -> None:
+        super().__init__(file, 5, split_dataframes=buffer_store.split_dataframes)
+        self._buffer_store = buffer_store
+        self._base_digests = base_digests
+        self.digests: List[Digest] = []
+
+    def persistent_id(self, obj: Any) -> Any:
+        if type(obj) is not pickle.PickleBuffer:
+            return None
+        digest = self._buffer_store._write_large_buffer(obj, self._base_digests, self.is_model_param(obj))
+        if digest is None:
+            return None
+        self.digests.append(digest)
+        return (BUFFER_PERSISTENT_ID, digest)
+
+
+class SharedObjectTracker:
+    """
+    Tracks the part first reaching each object while pickling parts. An object reached by a second part becomes a part
+    of its own, and the part that pickled it inline becomes stale. Each round pickles the stale and new parts again,
+    keeping the pickles of other parts, until a round finds no new shared objects.
+
+    Objects that the garbage collector finds reachable from more than one root start as parts, so that the first round
+    usually finds every shared object without pickling a large part twice.
+    """
+
+    def __init__(self, roots: List[Any]) -> None:
+        # Parts, starting with the roots, are kept alive so that their IDs are not reused while pickling.
+        self.parts: List[Any] = []
+        self.part_indices: Dict[int, int] = {}
+        for root in roots:
+            if id(root) not in self.part_indices:
+                self.part_indices[id(root)] = len(self.parts)
+                self.parts.append(root)
+        self._seed_parts()
+        self.references: List[Set[int]] = [set() for _ in self.parts]
+        self._owners: Dict[int, Tuple[int, Any]] = {}
+        self._owned: List[List[int]] = [[] for _ in self.parts]
+        self._stale: Set[int] = set(range(len(self.parts)))
+
+    def _seed_parts(self) -> None:
+        owners: Dict[int, int] = {}
+        for root in range(len(self.parts)):
+            stack = gc.get_referents(self.parts[root])
+            while stack:
+                obj = stack.pop()
+                obj_type = type(obj)
+                container = obj_type is tuple or obj_type is frozenset
+                if (not container and (obj_type in UNSHARED_TYPES or isinstance(obj, np.dtype))) or id(
+                    obj
+                ) in self.part_indices:
+                    continue
+                owner = owners.get(id(obj))
+                if owner == root:
+                    continue
+                if owner is not None and not container:
+                    if len(self.parts) >= SHARED_MAX_PARTS:
+                        return
+                    self.part_indices[id(obj)] = len(self.parts)
+                    self.parts.append(obj)
+                    continue
+                # Immutable containers are never parts, so their items are reached from each root reaching them.
+                owners[id(obj)] = root
+                stack.extend(gc.get_referents(obj))
+
+    def start_round(self) -> List[int]:
+        """
+        Forgets the objects reached by stale parts, returning the parts to pickle in this round.
+        """
+        stale = sorted(self._stale)
+        for part in stale:
+            for obj_id in self._owned[part]:
+                del self._owners[obj_id]
+            self._owned[part] = []
+            self.references[part] = set()
+        self._stale = set()
+        return stale
+
+    def referenced_part(self, part: int, obj: Any) -> Optional[int]:
+        """
+        Returns the part to reference instead of pickling obj, which is not of an unshared type, in part, if any.
+        """
+        if isinstance(obj, np.dtype) or obj is self.parts[part]:
+            return None
+        referenced = self.part_indices.get(id(obj))
+        if referenced is None:
+            owner = self._owners.get(id(obj))
+            if owner is None:
+                self._owners[id(obj)] = (part, obj)
+                self._owned[part].append(id(obj))
+                return None
+            if owner[0] == part:
+                return None
+            referenced = self.part_indices[id(obj)] = len(self.parts)
+            self.parts.append(obj)
+            self.references.append(set())
+            self._owned.append([])
+            self._stale.update((owner[0], referenced))
+        self.references[part].add(referenced)
+        return referenced
+
+    def load_order(self) -> Optional[List[int]]:
+        """
+        Returns the parts ordered after the parts they reference, or None if parts reference each other in a cycle.
+        """
+        order: List[int] = []
+        state: Dict[int, bool] = {}  # False while visiting, True once ordered.
+        for start in range(len(self.parts)):
+            if start in state:
+                continue
+            stack = [(start, iter(sorted(self.references[start])))]
+            state[start] = False
+            while stack:
+                part, referenced_parts = stack[-1]
+                referenced = next(referenced_parts, None)
+                if referenced is None:
+                    stack.pop()
+                    state[part] = True
+                    order.append(part)
+                elif referenced not in state:
+                    state[referenced] = False
+                    stack.append((referenced, iter(sorted(self.references[referenced]))))
+                elif not state[referenced]:
+                    return None
+        return order
+
+
+class SharedObjectPickler(PersistentBufferPickler):
+    """
+    PersistentBufferPickler pickling a part, referencing objects pickled in other parts by persistent IDs.
+    """
+
+    def __init__(
+        self,
+        file: Union[io.RawIOBase, io.BufferedIOBase],
+        buffer_store: KishuBufferStore,
+        base_digests: Sequence[Digest],
+        tracker: SharedObjectTracker,
+        part: int,
+    ) -> None:
+        super().__init__(file, buffer_store, base_digests)
+        self._tracker = tracker
+        self._part = part
+
+    def persistent_id(self, obj: Any) -> Any:
+        obj_type = type(obj)
+        if obj_type in UNSHARED_TYPES:
+            return super().persistent_id(obj) if obj_type is pickle.PickleBuffer else None
+        if id(obj) in self.memo:
+            return None
+        return self._tracker.referenced_part(self._part, obj)
+
+    def reducer_override(self, obj: Any) -> Any:
+        # Builtin dtypes, e.g., of arrays in different parts, are restored as the same objects by name.
+        if isinstance(obj, np.dtype) and obj.isbuiltin == 1 and np.dtype(obj.str) is obj:
+            return (np.dtype, (obj.str,))
+        return super().reducer_override(obj)
+
+    def save_pers(self, pid: Any) -> None:
+        super().save_pers(pid)
+        # Memoize referenced parts so that later references to them are plain memo lookups.
+        if type(pid) is int:
+            self.memoize(self._tracker.parts[pid])
+
+
+class PersistentBufferUnpickler(dill.Unpickler):
+    def __init__(self, file: BinaryIO, buffer_store: KishuBufferStore, parts: Optional[Dict[int, Any]] = None) -> None:
+        """
+        @param parts: parts loaded so far, if unpickling a part.
+        """
+        super().__init__(file)
+        self._buffer_store = buffer_store
+        self._parts = parts
+
+    def persistent_load(self, pid: Any) -> Any:
+        if isinstance(pid, tuple) and len(pid) == 2 and pid[0] == BUFFER_PERSISTENT_ID:
+            return self._buffer_store._map_buffer(pid[1])
+        if type(pid) is int and self._parts is not None:
+            return self._parts[pid]
+        raise pickle.UnpicklingError(f"Unsupported persistent ID {pid}")
+
+
+class KishuBufferStore:
+    """
+    Pickles objects with protocol 5, writing each buffer of at least min_size bytes (e.g., the data of a numpy array or
+    a pandas block) to its own file instead of into the pickle. Buffer files are named by their xxh3 digest, so
+    unchanged buffers are written once across checkpoints.
+
+    Loading memory-maps the buffer files copy-on-write: restored arrays page in lazily on access, and modifying them
+    does not modify the stored checkpoint.
+
+    Given base buffers, e.g., those of the variable's previous version, a new buffer sharing most of its blocks with
+    one of them is stored as a delta instead. Every keyframe_interval-th version in a chain of deltas is stored whole,
+    bounding the number of deltas applied to restore a buffer.
+    """
+
+    def __init__(
+        self,
+        database_path: Path,
+        min_size: int = DEFAULT_OUT_OF_BAND_MIN_SIZE,
+        delta_block_size: Optional[int] = DEFAULT_DELTA_BLOCK_SIZE,
+        keyframe_interval: int = DEFAULT_DELTA_KEYFRAME_INTERVAL,
+        split_dataframes: bool = True,
+        model_param_min_size: int = DEFAULT_MODEL_PARAM_MIN_SIZE,
+    ) -> None:
+        """
+        @param database_path: database storing the checkpoints. Buffer files are stored in a directory next to it.
+        @param min_size: size in bytes of the smallest buffer to store out of band; smaller buffers stay in the pickle.
+        @param delta_block_size: size in bytes of the blocks compared between versions of a buffer, or None to store
+            buffers whole.
+        @param keyframe_interval: maximum length of a chain of buffers stored as deltas, including its whole base.
+        @param split_dataframes: whether to store the columns of DataFrames as buffers of their own.
+        @param model_param_min_size: size in bytes of the smallest parameter of a model to store out of band.
+        """
+        self.directory = KishuBufferStore.buffer_directory(database_path)
+        self.min_size = min_size
+        self.delta_block_size = delta_block_size
+        self.keyframe_interval = keyframe_interval
+        self.split_dataframes = split_dataframes
+        self.model_param_min_size = model_param_min_size
+
+    @staticmethod
+    def buffer_directory(database_path: Path) -> Path:
+        return database_path.with_name(f"{database_path.name}.buffers")
+
+    @staticmethod
+    def init_database(cur: sqlite3.Cursor) -> None:
+        columns = table_columns(cur, BUFFER_REF_TABLE)
+        if get_schema_version(cur, BUFFER_SCHEMA_COMPONENT) is None and columns is not None and "names" not in columns:
+            cur.execute(f"alter table {BUFFER_REF_TABLE} add column names text")
+            cur.execute(f"update {BUFFER_REF_TABLE} set names = substr(blob_key, instr(blob_key, ',') + 1)")
+        cur.execute(f"create table if not exists {BUFFER_REF_TABLE} (commit_id text, blob_key text, digest blob, names text)")
+        # Index entries end with the rowid, so the latest blob of the same variables is the last entry of its names.
+        cur.execute(f"create index if not exists {BUFFER_REF_TABLE_NAMES_IDX} on {BUFFER_REF_TABLE} (names)")
+        cur.execute(f"create index if not exists {BUFFER_REF_TABLE_BLOB_IDX} on {BUFFER_REF_TABLE} (commit_id, blob_key)")
+        set_schema_version(cur, BUFFER_SCHEMA_COMPONENT, BUFFER_SCHEMA_VERSION)
+
+    @staticmethod
+    def drop_database(cur: sqlite3.Cursor) -> None:
+        cur.execute(f"drop table if exists {BUFFER_REF_TABLE}")
+        drop_schema_version(cur, BUFFER_SCHEMA_COMPONENT)
+
+    def dumps(self, obj: Any, base_digests: Sequence[Digest] = (), split_shared: bool = False) -> bytes:
+        """
+        Pickles obj, writing its large buffers to buffer files, as deltas from base_digests where they differ little.
+        Pickles without such buffers are plain dill pickles.
+
+        @param split_shared: whether to pickle a dict of variables as parts, as dump does.
+        """
+        if split_shared and isinstance(obj, dict) and len(obj) > 1:
+            f = io.BytesIO()
+            shared_digests = self._dump_shared(obj, f, base_digests)
+            if shared_digests is not None:
+                return KishuBufferStore._with_header(shared_digests, f.getbuffer())
+
+        digests: List[Digest] = []
+
+        def buffer_callback(buffer: pickle.PickleBuffer) -> bool:
+            digest = self._write_large_buffer(buffer, base_digests, pickler.is_model_param(buffer))
+            if digest is None:
+                return True
+            digests.append(digest)
+            return False
+
+        f = io.BytesIO()
+        pickler = OutOfBandPickler(f, 5, buffer_callback=buffer_callback, split_dataframes=self.split_dataframes)
+        pickler.dump(obj)
+        return KishuBufferStore._with_header(digests, f.getbuffer())
+
+    @staticmethod
+    def _with_header(digests: List[Digest], data: memoryview) -> bytes:
+        if not digests:
+            return bytes(data)
+        return b"".join([BUFFER_MAGIC, struct.pack(BUFFER_COUNT_FORMAT, len(digests))] + digests + [data])
+
+    def dump(
+        self, obj: Any, file: io.RawIOBase, base_digests: Sequence[Digest] = (), split_shared: bool = False
+    ) -> List[Digest]:
+        """
+        Pickles obj into file, e.g., streaming it to storage, writing its large buffers to buffer files as dumps does.
+        Returns the digests of the buffers.
+
+        @param split_shared: whether to pickle a dict of variables as parts: one per variable and one per object reached
+            from more than one part, unless parts reference each other in a cycle. The pickle is then held in memory
+            until all parts are found.
+        """
+        if split_shared and isinstance(obj, dict) and len(obj) > 1:
+            digests = self._dump_shared(obj, file, base_digests)
+            if digests is not None:
+                return digests
+        pickler = PersistentBufferPickler(file, self, base_digests)
+        pickler.dump(obj)
+        return pickler.digests
+
+    def _dump_shared(
+        self, variables: Dict[Any, Any], file: Union[io.RawIOBase, io.BufferedIOBase], base_digests: Sequence[Digest]
+    ) -> Optional[List[Digest]]:
+        """
+        Pickles the variables as parts into file, returning the digests of their buffers, or None if they cannot be
+        split into parts.
+        """
+        if len(variables) > SHARED_MAX_PARTS:
+            return None
+        tracker = SharedObjectTracker(list(variables.values()))
+        parts: Dict[int, bytes] = {}
+        part_digests: Dict[int, List[Digest]] = {}
+        for _ in range(SHARED_MAX_ROUNDS):
+            stale = tracker.start_round()
+            if not stale:
+                break
+            if len(tracker.parts) > SHARED_MAX_PARTS:
+                return None
+            for part in stale:
+                f = io.BytesIO()
+                pickler = SharedObjectPickler(f, self, base_digests, tracker, part)
+                pickler.dump(tracker.parts[part])
+                parts[part] = f.getvalue()
+                part_digests[part] = pickler.digests
+        else:
+            return None
+
+        order = tracker.load_order()
+        if order is None:
+            return None
+        manifest = (
+            list(variables.keys()),
+            [tracker.part_indices[id(value)] for value in variables.values()],
+            order,
+            [len(parts[part]) for part in order],
+            [sorted(tracker.references[part]) for part in order],
+        )
+        file.write(SHARED_MAGIC)
+        dill.dump(manifest, file)
+        for part in order:
+            file.write(parts[part])
+        return [digest for part in order for digest in part_digests[part]]
+
+    def loads(self, data: bytes, names: Optional[Set[str]] = None) -> Any:
+        """
+        @param names: if the pickle is of a dict of variables, the variables to load. Pickles split into parts load only
+            the parts of these variables; others are loaded whole and then filtered.
+        """
+        digests, offset = KishuBufferStore.parse_header(data)
+        if data[offset : offset + len(SHARED_MAGIC)] == SHARED_MAGIC:
+            return self.load(io.BufferedReader(io.BytesIO(memoryview(data)[offset:])), names)
+        if offset == 0:
+            return KishuBufferStore._select(PersistentBufferUnpickler(io.BytesIO(data), self).load(), names)
+        return KishuBufferStore._select(
+            dill.loads(data[offset:], buffers=[self._map_buffer(digest) for digest in digests]), names
+        )
+
+    def load(self, file: io.BufferedReader, names: Optional[Set[str]] = None) -> Any:
+        """
+        Unpickles the pickle read from file, either dumped or streamed.
+
+        @param names: if the pickle is of a dict of variables, the variables to load, as in loads.
+        """
+        if file.peek(len(BUFFER_MAGIC))[: len(BUFFER_MAGIC)] == BUFFER_MAGIC:
+            header = file.read(len(BUFFER_MAGIC) + struct.calcsize(BUFFER_COUNT_FORMAT))
+            (num_buffers,) = struct.unpack_from(BUFFER_COUNT_FORMAT, header, len(BUFFER_MAGIC))
+            header += file.read(num_buffers * BUFFER_DIGEST_SIZE)
+            digests, _ = KishuBufferStore.parse_header(header)
+            if file.peek(len(SHARED_MAGIC))[: len(SHARED_MAGIC)] != SHARED_MAGIC:
+                return KishuBufferStore._select(
+                    dill.Unpickler(file, buffers=[self._map_buffer(digest) for digest in digests]).load(), names
+                )
+        if file.peek(len(SHARED_MAGIC))[: len(SHARED_MAGIC)] != SHARED_MAGIC:
+            return KishuBufferStore._select(PersistentBufferUnpickler(file, self).load(), names)
+
+        # Load the parts in order, each after the parts it references. Manifests without the sizes and references of
+        # parts load all parts.
+        file.read(len(SHARED_MAGIC))
+        variable_names, name_parts, order, *table = dill.Unpickler(file).load()
+        needed: Optional[Set[int]] = None
+        if names is not None and table:
+            sizes, references = table
+            part_references = dict(zip(order, references))
+            stack = [part for name, part in zip(variable_names, name_parts) if name in names]
+            needed = set()
+            while stack:
+                part = stack.pop()
+                if part not in needed:
+                    needed.add(part)
+                    stack.extend(part_references[part])
+        parts: Dict[int, Any] = {}
+        for i, part in enumerate(order):
+            if needed is None or part in needed:
+                parts[part] = PersistentBufferUnpickler(file, self, parts).load()
+                if needed is not None and len(parts) == len(needed):
+                    break
+            else:
+                file.read(sizes[i])
+        return KishuBufferStore._select(
+            {name: parts[part] for name, part in zip(variable_names, name_parts) if part in parts}, names
+        )
+
+    @staticmethod
+    def _select(variables: Any, names: Optional[Set[str]]) -> Any:
+        if names is None or not isinstance(variables, dict):
+            return variables
+        return {name: value for name, value in variables.items() if name in names}
+
+    @staticmethod
+    def parse_header(data: Union[bytes, memoryview]) -> Tuple[List[Digest], int]:
+        """
+        Returns the digests of the pickle's out-of-band buffers and the offset at which the pickle starts.
+        """
+        if bytes(data[: len(BUFFER_MAGIC)]) != BUFFER_MAGIC:
+            return [], 0
+        offset = len(BUFFER_MAGIC)
+        (num_buffers,) = struct.unpack_from(BUFFER_COUNT_FORMAT, data, offset)
+        offset += struct.calcsize(BUFFER_COUNT_FORMAT)
+        digests = [
+            bytes(data[offset + i * BUFFER_DIGEST_SIZE : offset + (i + 1) * BUFFER_DIGEST_SIZE]) for i in range(num_buffers)
+        ]
+        return digests, offset + num_buffers * BUFFER_DIGEST_SIZE
+
+    @staticmethod
+    def store_refs(cur: sqlite3.Cursor, commit_id: str, blob_key: str, data: Union[bytes, memoryview]) -> None:
+        """
+        Records that the stored blob (commit_id, blob_key) references the out-of-band buffers of the pickle data.
+        """
+        KishuBufferStore.store_digest_refs(cur, commit_id, blob_key, KishuBufferStore.parse_header(data)[0])
+
+    @staticmethod
+    def store_digest_refs(cur: sqlite3.Cursor, commit_id: str, blob_key: str, digests: List[Digest]) -> None:
+        """
+        Records that the stored blob (commit_id, blob_key) references the out-of-band buffers with the digests.
+        """
+        if not digests:
+            # Even an empty executemany opens a transaction, after which reads hold locks that may deadlock writes.
+            return
+        names = KishuBufferStore.blob_key_names(blob_key)
+        cur.executemany(
+            f"insert into {BUFFER_REF_TABLE} values (?, ?, ?, ?)",
+            [(commit_id, blob_key, digest, names) for digest in set(digests)],
+        )
+
+    @staticmethod
+    def latest_digests(cur: sqlite3.Cursor, blob_key: str) -> List[Digest]:
+        """
+        Returns the digests of the out-of-band buffers of the latest stored blob of the same variables as blob_key.
+        """
+        res = cur.execute(
+            f"select commit_id, blob_key from {BUFFER_REF_TABLE} where names = ? order by rowid desc limit 1",
+            (KishuBufferStore.blob_key_names(blob_key),),
+        ).fetchone()
+        if res is None:
+            return []
+        return [
+            row[0] for row in cur.execute(f"select digest from {BUFFER_REF_TABLE} where commit_id = ? and blob_key = ?", res)
+        ]
+
+    @staticmethod
+    def blob_key_names(blob_key: str) -> str:
+        # Blobs of variable snapshots are keyed by their versioned names, "<version>,<names>"; the checkpoint's key is
+        # empty.
+        return blob_key.split(",", 1)[-1]
+
+    def sweep(self, cur: sqlite3.Cursor, grace_period_s: float = BUFFER_SWEEP_GRACE_PERIOD_S) -> Tuple[int, int]:
+        """
+        Deletes the buffer files no stored blob references. Returns the number of deleted files and their total size.
+        """
+        if not self.directory.exists():
+            return 0, 0
+        referenced_digests = {row[0] for row in cur.execute(f"select distinct digest from {BUFFER_REF_TABLE}")}
+        # Deltas need their bases.
+        for digest in list(referenced_digests):
+            referenced_digests.update(self._delta_chain(digest))
+
+        num_deleted, deleted_bytes = 0, 0
+        now = time.time()
+        for path in self.directory.iterdir():
+            stem, _, suffix = path.name.partition(".")
+            if f".{suffix}" in (BUFFER_FILE_SUFFIX, DELTA_FILE_SUFFIX, BLOCKS_FILE_SUFFIX):
+                if bytes.fromhex(stem) in referenced_digests:
+                    continue
+            stat = path.stat()
+            if now - stat.st_mtime < grace_period_s:
+                continue
+            path.unlink()
+            if f".{suffix}" != BLOCKS_FILE_SUFFIX:
+                num_deleted += 1
+            deleted_bytes += stat.st_size
+        return num_deleted, deleted_bytes
+
+    def _buffer_path(self, digest: Digest) -> Path:
+        return self.directory / f"{digest.hex()}{BUFFER_FILE_SUFFIX}"
+
+    def _delta_path(self, digest: Digest) -> Path:
+        return self.directory / f"{digest.hex()}{DELTA_FILE_SUFFIX}"
+
+    def _blocks_path(self, digest: Digest) -> Path:
+        return self.directory / f"{digest.hex()}{BLOCKS_FILE_SUFFIX}"
+
+    def _write_large_buffer(
+        self, buffer: pickle.PickleBuffer, base_digests: Sequence[Digest] = (), is_model_param: bool = False
+    ) -> Optional[Digest]:
+        """
+        Writes the buffer if it is large enough to store out of band, returning its digest.
+        """
+        try:
+            raw = buffer.raw()
+        except BufferError:
+            # Non-contiguous buffers cannot be written as is.
+            return None
+        if raw.nbytes < (min(self.min_size, self.model_param_min_size) if is_model_param else self.min_size):
+            return None
+        return self._write_buffer(raw, base_digests)
+
+    def _write_buffer(self, raw: memoryview, base_digests: Sequence[Digest] = ()) -> Digest:
+        digest = digest_of(raw)
+        for path in (self._buffer_path(digest), self._delta_path(digest)):
+            if path.exists():
+                # Renew the grace period of the file and its bases until the checkpoint referencing it is committed.
+                for chain_digest in self._delta_chain(digest):
+                    self._touch(chain_digest)
+                return digest
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        if self.delta_block_size is None or raw.nbytes < 2 * self.delta_block_size:
+            self._write_file(self._buffer_path(digest), [raw])
+            return digest
+
+        block_size = self.delta_block_size
+        block_digests = [digest_of(raw[i : i + block_size]) for i in range(0, raw.nbytes, block_size)]
+        self._write_file(self._blocks_path(digest), [struct.pack(BLOCKS_HEADER_FORMAT, block_size)] + block_digests)
+        base = self._find_base(block_digests, base_digests)
+        if base is None:
+            self._write_file(self._buffer_path(digest), [raw])
+            return digest
+
+        # Store the blocks differing from the base's blocks at the same offsets, including those past its end.
+        base_digest, base_depth, base_block_digests = base
+        indices = [
+            i
+            for i, block_digest in enumerate(block_digests)
+            if i >= len(base_block_digests) or block_digest != base_block_digests[i]
+        ]
+        header = struct.pack(DELTA_HEADER_FORMAT, base_digest, raw.nbytes, block_size, base_depth + 1, len(indices))
+        self._write_file(
+            self._delta_path(digest),
+            [DELTA_MAGIC, header]
+            + [struct.pack(DELTA_INDEX_FORMAT, i) for i in indices]
+            + [raw[i * block_size : (i + 1) * block_size] for i in indices],
+        )
+        for chain_digest in self._delta_chain(base_digest):
+            self._touch(chain_digest)
+        return digest
+
+    def _find_base(
+        self, block_digests: List[Digest], base_digests: Sequence[Digest]
+    ) -> Optional[Tuple[Digest, int, List[Digest]]]:
+        """
+        Returns the base buffer sharing the most blocks with the new buffer, its depth in its delta chain and its block
+        digests, or None if the new buffer is better stored whole.
+        """
+        best_base, max_shared = None, 0
+        for base_digest in set(base_digests):
+            base_block_digests = self._read_block_digests(base_digest)
+            if base_block_digests is None:
+                continue
+            num_shared = sum(1 for new, old in zip(block_digests, base_block_digests) if new == old)
+            if num_shared > max_shared:
+                best_base, max_shared = (base_digest, base_block_digests), num_shared
+        if best_base is None or len(block_digests) - max_shared > DELTA_MAX_CHANGED_FRACTION * len(block_digests):
+            return None
+        base_digest, base_block_digests = best_base
+        base_depth = self._delta_depth(base_digest)
+        if base_depth is None or base_depth + 1 >= self.keyframe_interval:
+            return None
+        return base_digest, base_depth, base_block_digests
+
+    def _read_block_digests(self, digest: Digest) -> Optional[List[Digest]]:
+        try:
+            data = self._blocks_path(digest).read_bytes()
+        except FileNotFoundError:
+            return None
+        (block_size,) = struct.unpack_from(BLOCKS_HEADER_FORMAT, data)
+        if block_size != self.delta_block_size:
+            return None
+        offset = struct.calcsize(BLOCKS_HEADER_FORMAT)
+        return [data[i : i + BUFFER_DIGEST_SIZE] for i in range(offset, len(data), BUFFER_DIGEST_SIZE)]
+
+    def _read_delta_header(self, digest: Digest) -> Optional[Tuple[Digest, int, int, int, int]]:
+        """
+        Returns the base digest, size, block size, depth and number of blocks of a buffer stored as a delta, or None if
+        it is not.
+        """
+        try:
+            with open(self._delta_path(digest), "rb") as f:
+                data = f.read(len(DELTA_MAGIC) + struct.calcsize(DELTA_HEADER_FORMAT))
+        except FileNotFoundError:
+            return None
+        return struct.unpack_from(DELTA_HEADER_FORMAT, data, len(DELTA_MAGIC))
+
+    def _delta_depth(self, digest: Digest) -> Optional[int]:
+        """
+        Returns the number of deltas applied to restore the buffer, or None if it is not stored.
+        """
+        header = self._read_delta_header(digest)
+        if header is not None:
+            return header[3]
+        return 0 if self._buffer_path(digest).exists() else None
+
+    def _delta_chain(self, digest: Digest) -> Set[Digest]:
+        """
+        Returns the digest and those of the bases from which the buffer is restored.
+        """
+        chain = {digest}
+        header = self._read_delta_header(digest)
+        while header is not None and header[0] not in chain:
+            chain.add(header[0])
+            header = self._read_delta_header(header[0])
+        return chain
+
+    def _touch(self, digest: Digest) -> None:
+        for path in (self._buffer_path(digest), self._delta_path(digest), self._blocks_path(digest)):
+            if path.exists():
+                os.utime(path)
+
+    def _write_file(self, path: Path, parts: Sequence[Union[bytes, memoryview]]) -> None:
+        # Write to a temporary file first so that a buffer file, once present, is complete.
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "wb") as f:
+            for part in parts:
+                f.write(part)
+        os.replace(tmp_path, path)
+
+    def _map_buffer(self, digest: Digest) -> Union[bytes, mmap.mmap]:
+        if not self._buffer_path(digest).exists() and self._delta_path(digest).exists():
+            return self._apply_delta(digest)
+        with open(self._buffer_path(digest), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b""
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    def _apply_delta(self, digest: Digest) -> mmap.mmap:
+        """
+        Restores a buffer stored as a delta by writing its blocks over its restored base. Blocks shared with a base of
+        the same size still page in lazily.
+        """
+        with open(self._delta_path(digest), "rb") as f:
+            header_size = len(DELTA_MAGIC) + struct.calcsize(DELTA_HEADER_FORMAT)
+            base_digest, size, block_size, _, num_blocks = struct.unpack_from(
+                DELTA_HEADER_FORMAT, f.read(header_size), len(DELTA_MAGIC)
+            )
+            base = self._map_buffer(base_digest)
+            if isinstance(base, mmap.mmap) and len(base) == size:
+                buffer = base
+            else:
+                buffer = mmap.mmap(-1, size)
+                buffer[: min(len(base), size)] = base[: min(len(base), size)]
+
+            index_size = struct.calcsize(DELTA_INDEX_FORMAT)
+            indices_data = f.read(num_blocks * index_size)
+            view = memoryview(buffer)
+            for j in range(num_blocks):
+                (i,) = struct.unpack_from(DELTA_INDEX_FORMAT, indices_data, j * index_size)
+                f.readinto(view[i * block_size : min((i + 1) * block_size, size)])
+            view.release()
+        return buffer
@@ -2,80 +2,298 @@
 Sqlite interface for storing checkpoints.
 """
 
+from __future__ import annotations
+
+import io
+import multiprocessing
+import os
 import sqlite3
+import time
 from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from pathlib import Path
-from typing import Dict, List, Set
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
 
 import dill as pickle
 
-from kishu.exceptions import CommitIdNotExistError
+from kishu.exceptions import CheckpointPendingError, CommitIdNotExistError
 from kishu.jupyter.namespace import Namespace
+from kishu.storage.blob_backend import blob_backends_from_config
+from kishu.storage.buffer_store import (
+    DEFAULT_DELTA_BLOCK_SIZE,
+    DEFAULT_DELTA_KEYFRAME_INTERVAL,
+    DEFAULT_MODEL_PARAM_MIN_SIZE,
+    DEFAULT_OUT_OF_BAND_MIN_SIZE,
+    KishuBufferStore,
+)
+from kishu.storage.chunk_store import CHECKPOINT_BLOB_KEY, DEFAULT_CHUNK_AVG_SIZE, ChunkReader, KishuChunkStore
+from kishu.storage.codec import BlobCodec
+from kishu.storage.config import Config
 from kishu.storage.disk_ahg import VariableSnapshot
+from kishu.storage.snapshot_cache import CachingReader, CachingWriter, SnapshotCache, SnapshotCacheStats
 
 CHECKPOINT_TABLE = "checkpoint"
 VARIABLE_SNAPSHOT_TABLE = "variable_snapshot"
+PENDING_CHECKPOINT_TABLE = "pending_checkpoint"
 SQLITE3_DEFAULT_MAX_BLOB_SIZE = (
     500_000_000  # Compile-time maximum is 1GB, however, inserting exactly 1GB will raise the error.
 )
 
+# Longest time a checkpoint may take to be written in the background, after which its writer is killed.
+DEFAULT_ASYNC_CHECKPOINT_TIMEOUT_S = 1800.0
+PENDING_CHECKPOINT_POLL_INTERVAL_S = 0.05
+
+DEFAULT_SERIALIZATION_WORKERS = 1
+DEFAULT_SERIALIZATION_EXECUTOR = "process"
+SERIALIZATION_EXECUTORS = ["process", "thread"]
+
+# Variables to serialize by forked workers, which inherit them, and the base buffers of each, instead of receiving them
+# pickled.
+_fork_inherited_variables: Optional[Tuple[KishuCheckpoint, List[Dict[str, Any]], List[List[bytes]]]] = None
+
+
+def _dumps_fork_inherited(i: int) -> Optional[bytes]:
+    assert _fork_inherited_variables is not None
+    checkpoint, variables, base_digests = _fork_inherited_variables
+    return checkpoint._dumps_or_none(variables[i], base_digests[i])
+
 
 class KishuCheckpoint:
+    # Whether to pickle the blobs of a checkpoint before taking the database's write lock to insert them, instead of
+    # streaming them into the database as they are pickled. Set in forked background writers, whose kernel keeps
+    # writing commits to the same database meanwhile.
+    pickle_before_write_lock = False
+
     def __init__(self, database_path: Path, incremental_cr: bool = False):
         self.database_path = database_path
         self._incremental_cr = incremental_cr
         self._max_blob_size = SQLITE3_DEFAULT_MAX_BLOB_SIZE
+        self._codec = BlobCodec.from_config()
+
+        # Deduplicate new blobs by content-defined chunks. Blobs stored either way remain readable.
+        self._chunk_dedup = Config.get("PLANNER", "chunk_dedup", True)
+        self._chunk_store = KishuChunkStore(
+            Config.get("PLANNER", "chunk_avg_size", DEFAULT_CHUNK_AVG_SIZE),
+            self._codec,
+            blob_backends_from_config(database_path),
+        )
+
+        # Store large buffers, e.g., of numpy arrays, in memory-mapped files instead of in pickles.
+        self._out_of_band_buffers = Config.get("PLANNER", "out_of_band_buffers", True)
+        # Store those buffers as deltas from the buffers of the variables' previous versions where they differ little.
+        self._delta_buffers = Config.get("PLANNER", "delta_buffers", True)
+        self._buffer_store = KishuBufferStore(
+            database_path,
+            Config.get("PLANNER", "out_of_band_min_size", DEFAULT_OUT_OF_BAND_MIN_SIZE),
+            Config.get("PLANNER", "delta_block_size", DEFAULT_DELTA_BLOCK_SIZE) if self._delta_buffers else None,
+            Config.get("PLANNER", "delta_keyframe_interval", DEFAULT_DELTA_KEYFRAME_INTERVAL),
+            Config.get("PLANNER", "split_dataframes", True),
+            Config.get("PLANNER", "model_param_min_size", DEFAULT_MODEL_PARAM_MIN_SIZE),
+        )
+        # Pickle the variables of a variable snapshot or checkpoint as parts, storing the objects they share as parts of
+        # their own, and loading some of the variables of a checkpoint by their parts.
+        self._split_shared_objects = Config.get("PLANNER", "split_shared_objects", True)
+
+        # Keep the pickles of recently written and read variable snapshots in memory, e.g., to switch between branches
+        # without reading their variables from the database.
+        self._snapshot_cache = SnapshotCache.for_database(database_path)
+
+        # Serialize variable snapshots in parallel by forked processes or, e.g., for buffer-heavy variables whose
+        # serialization mostly writes buffer files without holding the GIL, by threads.
+        self._serialization_workers = Config.get("PLANNER", "serialization_workers", DEFAULT_SERIALIZATION_WORKERS)
+        self._serialization_executor = Config.get("PLANNER", "serialization_executor", DEFAULT_SERIALIZATION_EXECUTOR)
+        if self._serialization_executor not in SERIALIZATION_EXECUTORS:
+            raise ValueError(
+                f"Serialization executor {self._serialization_executor} is unknown, available: {SERIALIZATION_EXECUTORS}"
+            )
 
     def init_database(self):
         con = sqlite3.connect(self.database_path)
         cur = con.cursor()
-        cur.execute(
-            f"create table if not exists {CHECKPOINT_TABLE} "
-            f"(commit_id text, chunk_id int, data blob, primary key (commit_id, chunk_id))"
-        )
-
-        # Create incremental checkpointing related tables only if incremental store is enabled.
-        if self._incremental_cr:
+        try:
             cur.execute(
-                f"create table if not exists {VARIABLE_SNAPSHOT_TABLE} "
-                f"(versioned_name text, commit_id text, chunk_id int, data blob, "
-                f"primary key (versioned_name, commit_id, chunk_id))"
+                f"create table if not exists {CHECKPOINT_TABLE} "
+                f"(commit_id text, chunk_id int, data blob, primary key (commit_id, chunk_id))"
             )
-        con.commit()
+            cur.execute(f"create table if not exists {PENDING_CHECKPOINT_TABLE} (commit_id text primary key, pid int)")
+            self._chunk_store.init_database(cur)
+            KishuBufferStore.init_database(cur)
+
+            # Create incremental checkpointing related tables only if incremental store is enabled.
+            if self._incremental_cr:
+                cur.execute(
+                    f"create table if not exists {VARIABLE_SNAPSHOT_TABLE} "
+                    f"(versioned_name text, commit_id text, chunk_id int, data blob, "
+                    f"primary key (versioned_name, commit_id, chunk_id))"
+                )
+            con.commit()
+        finally:
+            con.close()
 
     def drop_database(self):
         con = sqlite3.connect(self.database_path)
         cur = con.cursor()
-        cur.execute(f"drop table if exists {CHECKPOINT_TABLE}")
-        cur.execute(f"drop table if exists {VARIABLE_SNAPSHOT_TABLE}")
-        con.commit()
+        try:
+            cur.execute(f"drop table if exists {CHECKPOINT_TABLE}")
+            cur.execute(f"drop table if exists {VARIABLE_SNAPSHOT_TABLE}")
+            cur.execute(f"drop table if exists {PENDING_CHECKPOINT_TABLE}")
+            self._chunk_store.drop_database(cur)
+            KishuBufferStore.drop_database(cur)
+            con.commit()
+            SnapshotCache.invalidate(self.database_path)
+        finally:
+            con.close()
+
+    def dumps(self, obj: Any, base_digests: Sequence[bytes] = (), split_shared: bool = False) -> bytes:
+        """
+        Pickles an object to store as a checkpoint or variable snapshot.
+
+        @param base_digests: out-of-band buffers from which to store the object's buffers as deltas.
+        @param split_shared: whether to pickle a dict of variables as parts, storing their shared objects once.
+        """
+        if self._out_of_band_buffers:
+            return self._buffer_store.dumps(obj, base_digests, split_shared)
+        return pickle.dumps(obj)
+
+    def loads(self, data: bytes, variable_names: Optional[Set[str]] = None) -> Any:
+        """
+        Unpickles a checkpoint or variable snapshot, memory-mapping its out-of-band buffers.
+
+        @param variable_names: the variables to load from a checkpoint, or None to load all of them.
+        """
+        return self._buffer_store.loads(data, variable_names)
+
+    def dump_checkpoint(self, commit_id: str, obj: Any) -> None:
+        """
+        Pickles obj as the checkpoint of commit_id. With chunk deduplication, the pickle is streamed into chunks as it
+        is written instead of being held in memory, unless its variables are pickled as parts or pickle_before_write_lock
+        is set.
+        """
+        if not self._chunk_dedup or self.pickle_before_write_lock:
+            self.store_checkpoint(commit_id, self.dumps(obj, split_shared=self._split_shared_objects))
+            return
+        con = sqlite3.connect(self.database_path)
+        try:
+            self._stream(con, commit_id, CHECKPOINT_BLOB_KEY, obj, self._split_shared_objects)
+            con.commit()
+        finally:
+            con.close()
+
+    def load_checkpoint(self, commit_id: str, variable_names: Optional[Set[str]] = None) -> Any:
+        """
+        Unpickles the checkpoint of commit_id, streaming it from its chunks if it is stored as such.
+
+        @param variable_names: the variables to load, or None to load all of them. Checkpoints pickled as parts skip
+            unpickling the parts of other variables.
+        """
+        con = sqlite3.connect(self.database_path)
+        try:
+            reader = self._chunk_store.reader(con.cursor(), commit_id, CHECKPOINT_BLOB_KEY)
+            if reader is None:
+                return self.loads(self.get_checkpoint(commit_id), variable_names)
+            return self._load(reader, variable_names)
+        finally:
+            con.close()
+
+    def mark_pending(self, commit_id: str, pid: int) -> None:
+        """
+        Records that process pid is writing the checkpoint of commit_id, until unmark_pending.
+        """
+        con = sqlite3.connect(self.database_path)
+        try:
+            con.execute(f"insert or replace into {PENDING_CHECKPOINT_TABLE} values (?, ?)", (commit_id, pid))
+            con.commit()
+        finally:
+            con.close()
+
+    def unmark_pending(self, commit_id: str) -> None:
+        con = sqlite3.connect(self.database_path)
+        try:
+            con.execute(f"delete from {PENDING_CHECKPOINT_TABLE} where commit_id = ?", (commit_id,))
+            con.commit()
+        finally:
+            con.close()
+
+    def wait_until_written(self, commit_id: str) -> None:
+        """
+        Blocks while the checkpoint of commit_id is being written, e.g., by a forked process of the kernel. Raises
+        CheckpointPendingError if it is not written within the checkpoint timeout.
+        """
+        timeout_s = Config.get("PLANNER", "async_checkpoint_timeout_s", DEFAULT_ASYNC_CHECKPOINT_TIMEOUT_S)
+        deadline = time.monotonic() + timeout_s
+        while True:
+            con = sqlite3.connect(self.database_path)
+            try:
+                res: Optional[tuple] = con.execute(
+                    f"select pid from {PENDING_CHECKPOINT_TABLE} where commit_id = ?", (commit_id,)
+                ).fetchone()
+            except sqlite3.OperationalError:
+                # Databases from before checkpoints were written in the background.
+                return
+            finally:
+                con.close()
+            if res is None:
+                return
+            if not KishuCheckpoint._is_alive(res[0]):
+                # The writer died, e.g., with its kernel, leaving the checkpoint partly written at most. Restoring
+                # handles missing checkpoints and variable snapshots.
+                self.unmark_pending(commit_id)
+                return
+            if time.monotonic() > deadline:
+                raise CheckpointPendingError(commit_id)
+            time.sleep(PENDING_CHECKPOINT_POLL_INTERVAL_S)
+
+    @staticmethod
+    def _is_alive(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
 
     def get_checkpoint(self, commit_id: str) -> bytes:
         con = sqlite3.connect(self.database_path)
         cur = con.cursor()
-        cur.execute(f"select data from {CHECKPOINT_TABLE} where commit_id = ? ORDER BY chunk_id", (commit_id,))
-        res: List = cur.fetchall()
-        if not res:
-            raise CommitIdNotExistError(commit_id)
+        try:
+            data = self._chunk_store.load(cur, commit_id, CHECKPOINT_BLOB_KEY)
+            if data is not None:
+                return data
+
+            cur.execute(f"select data from {CHECKPOINT_TABLE} where commit_id = ? ORDER BY chunk_id", (commit_id,))
+            res: List = cur.fetchall()
+            if not res:
+                raise CommitIdNotExistError(commit_id)
 
-        con.commit()
-        return b"".join([i[0] for i in res])
+            con.commit()
+            return BlobCodec.decode(b"".join([i[0] for i in res]))
+        finally:
+            con.close()
 
     def store_checkpoint(self, commit_id: str, data: bytes) -> None:
         con = sqlite3.connect(self.database_path)
         cur = con.cursor()
+        try:
+            KishuBufferStore.store_refs(cur, commit_id, CHECKPOINT_BLOB_KEY, data)
+            if self._chunk_dedup:
+                self._chunk_store.store(cur, commit_id, CHECKPOINT_BLOB_KEY, data)
+                con.commit()
+                return
 
-        # Break the blob into chunks and insert each chunk
-        data_view = memoryview(data)
-        for i in range(0, len(data_view), self._max_blob_size):
-            chunk = data_view[i : i + self._max_blob_size]
-            cur.execute(
-                f"""
-            INSERT INTO {CHECKPOINT_TABLE} values (?, ?, ?)
-            """,
-                (commit_id, i // self._max_blob_size, chunk),
-            )
-        con.commit()
+            # Break the blob into chunks and insert each chunk
+            data_view = memoryview(self._codec.encode(data))
+            for i in range(0, len(data_view), self._max_blob_size):
+                chunk = data_view[i : i + self._max_blob_size]
+                cur.execute(
+                    f"""
+                INSERT INTO {CHECKPOINT_TABLE} values (?, ?, ?)
+                """,
+                    (commit_id, i // self._max_blob_size, chunk),
+                )
+            con.commit()
+        finally:
+            con.close()
 
     def get_variable_snapshots(self, variable_snapshots: Set[VariableSnapshot]) -> List[bytes]:
         """
@@ -85,59 +303,293 @@ def get_variable_snapshots(self, variable_snapshots: Set[VariableSnapshot]) -> L
         """
         con = sqlite3.connect(self.database_path)
         cur = con.cursor()
-        param_list = [vs.versioned_name() for vs in variable_snapshots]
+        try:
+            param_list = [vs.versioned_name() for vs in variable_snapshots]
+            data_dict = self._get_cached_variable_snapshots(param_list)
+            uncached_list = [name for name in param_list if name not in data_dict]
+            uncached_data_dict = KishuCheckpoint._get_table_variable_snapshots(cur, uncached_list)
+            uncached_data_dict.update(self._chunk_store.load_by_blob_keys(cur, uncached_list))
+            for name, data in uncached_data_dict.items():
+                self._snapshot_cache.put(name, data)
+            data_dict.update(uncached_data_dict)
+
+            if len(data_dict) != len(variable_snapshots):
+                raise ValueError(f"length of results {len(data_dict)} not equal to queries {len(variable_snapshots)}:")
+            return [data_dict[vs.versioned_name()] for vs in variable_snapshots]
+        finally:
+            con.close()
+
+    def load_variable_snapshots(self, variable_snapshots: Set[VariableSnapshot]) -> List[Any]:
+        """
+        Unpickles variable snapshots, streaming those stored as chunks one at a time. Returns them in the same order.
+        """
+        con = sqlite3.connect(self.database_path)
+        cur = con.cursor()
+        try:
+            param_list = [vs.versioned_name() for vs in variable_snapshots]
+            data_dict = self._get_cached_variable_snapshots(param_list)
+            uncached_list = [name for name in param_list if name not in data_dict]
+            readers = self._chunk_store.readers_by_blob_keys(cur, uncached_list)
+            uncached_data_dict = KishuCheckpoint._get_table_variable_snapshots(
+                cur, [name for name in uncached_list if name not in readers]
+            )
+            for name, data in uncached_data_dict.items():
+                self._snapshot_cache.put(name, data)
+            data_dict.update(uncached_data_dict)
+
+            if len(readers) + len(data_dict) != len(variable_snapshots):
+                raise ValueError(
+                    f"length of results {len(readers) + len(data_dict)} not equal to queries {len(variable_snapshots)}:"
+                )
+            return [
+                self._load_cached(name, readers[name]) if name in readers else self.loads(data_dict[name])
+                for name in param_list
+            ]
+        finally:
+            con.close()
+
+    def get_snapshot_cache_stats(self) -> SnapshotCacheStats:
+        """
+        Returns the hits and misses of variable snapshot reads on the in-memory cache shared by checkpoints of this
+        database in the process.
+        """
+        return self._snapshot_cache.stats
+
+    def _get_cached_variable_snapshots(self, versioned_names: List[str]) -> Dict[str, bytes]:
+        if not self._snapshot_cache.enabled():
+            return {}
+        data_dict = {}
+        for versioned_name in versioned_names:
+            data = self._snapshot_cache.get(versioned_name)
+            if data is not None:
+                data_dict[versioned_name] = data
+        return data_dict
+
+    def _load_cached(self, versioned_name: str, reader: ChunkReader) -> Any:
+        """
+        Unpickles a variable snapshot streamed from reader, caching its pickle as it is read.
+        """
+        if not self._snapshot_cache.enabled():
+            return self._load(reader)
+        caching_reader = CachingReader(reader, self._snapshot_cache.max_size)
+        obj = self._load(caching_reader)
+        data = caching_reader.data()
+        if data is not None:
+            self._snapshot_cache.put(versioned_name, data)
+        return obj
+
+    @staticmethod
+    def _get_table_variable_snapshots(cur: sqlite3.Cursor, versioned_names: List[str]) -> Dict[str, bytes]:
+        """
+        Returns the data of the variable snapshots stored in VARIABLE_SNAPSHOT_TABLE, i.e., without chunk dedup.
+        """
+        if not versioned_names:
+            return {}
         cur.execute(
-            f"select versioned_name, data from {VARIABLE_SNAPSHOT_TABLE} WHERE versioned_name IN (%s) ORDER BY chunk_id"
-            % ",".join("?" * len(param_list)),
-            param_list,
+            f"select versioned_name, commit_id, data from {VARIABLE_SNAPSHOT_TABLE} WHERE versioned_name IN (%s) "
+            "ORDER BY commit_id, chunk_id" % ",".join("?" * len(versioned_names)),
+            versioned_names,
         )
 
         res: List = cur.fetchall()
 
-        # Concatenate chunks
+        # Concatenate chunks, reading one copy of variable snapshots stored by more than one commit.
         chunk_dict: Dict[str, List[bytes]] = defaultdict(list)
-        for versioned_name, data in res:
-            chunk_dict[versioned_name].append(data)
-
-        if len(chunk_dict) != len(variable_snapshots):
-            raise ValueError(f"length of results {len(chunk_dict)} not equal to queries {len(variable_snapshots)}:")
-        return [b"".join(chunk_dict[vs.versioned_name()]) for vs in variable_snapshots]
+        commit_id_dict: Dict[str, str] = {}
+        for versioned_name, commit_id, data in res:
+            if commit_id_dict.setdefault(versioned_name, commit_id) == commit_id:
+                chunk_dict[versioned_name].append(data)
+        return {versioned_name: BlobCodec.decode(b"".join(chunks)) for versioned_name, chunks in chunk_dict.items()}
 
     def get_stored_versioned_names(self, commit_ids: List[str]) -> Set[str]:
         con = sqlite3.connect(self.database_path)
         cur = con.cursor()
+        try:
+            # Get all namespaces
+            cur.execute(
+                f"select versioned_name from {VARIABLE_SNAPSHOT_TABLE} WHERE commit_id IN (%s)"
+                % ",".join("?" * len(commit_ids)),
+                commit_ids,
+            )
+            res: List = cur.fetchall()
+            return set([i[0] for i in res]).union(KishuChunkStore.stored_blob_keys(cur, commit_ids) - {CHECKPOINT_BLOB_KEY})
+        finally:
+            con.close()
 
-        # Get all namespaces
-        cur.execute(
-            f"select versioned_name from {VARIABLE_SNAPSHOT_TABLE} WHERE commit_id IN (%s)" % ",".join("?" * len(commit_ids)),
-            commit_ids,
-        )
-        res: List = cur.fetchall()
-        return set([i[0] for i in res])
+    def filter_stored_versioned_names(self, versioned_names: List[str]) -> Set[str]:
+        """
+        Returns the versioned names stored by any commit among versioned_names.
+        """
+        if not versioned_names:
+            return set()
+        con = sqlite3.connect(self.database_path)
+        cur = con.cursor()
+        try:
+            cur.execute(
+                f"select distinct versioned_name from {VARIABLE_SNAPSHOT_TABLE} WHERE versioned_name IN (%s)"
+                % ",".join("?" * len(versioned_names)),
+                versioned_names,
+            )
+            res: List = cur.fetchall()
+            return set([i[0] for i in res]).union(KishuChunkStore.existing_blob_keys(cur, versioned_names))
+        finally:
+            con.close()
 
     def store_variable_snapshots(self, commit_id: str, vses_to_store: List[VariableSnapshot], user_ns: Namespace) -> None:
         con = sqlite3.connect(self.database_path)
         cur = con.cursor()
+        try:
+            # Create a namespace containing only variables from each component. Components are disjoint, so they are
+            # serialized independently, possibly in parallel, while this thread inserts those serialized so far.
+            variables = [user_ns.subset(set(vs.name)).to_dict() for vs in vses_to_store]
+            if (
+                self._chunk_dedup
+                and not self.pickle_before_write_lock
+                and min(self._serialization_workers, len(variables)) <= 1
+            ):
+                # Serializing on this thread, stream each pickle into chunks instead of holding it in memory.
+                for vs, variable_dict in zip(vses_to_store, variables):
+                    try:
+                        data = self._stream(
+                            con, commit_id, vs.versioned_name(), variable_dict, self._split_shared_objects, cache=True
+                        )
+                    except (pickle.PickleError, ValueError, AttributeError, TypeError):
+                        # If the VS fails to pickle, skip it as it would be reconstructed on (incremental) checkout.
+                        continue
+                    con.commit()
+                    if data is not None:
+                        self._snapshot_cache.put(vs.versioned_name(), data)
+                return
 
-        # Store each variable snapshot.
-        for vs in vses_to_store:
-            # Create a namespace containing only variables from the component
-            ns_subset = user_ns.subset(set(vs.name))
+            base_digests = [self._base_buffer_digests(cur, vs.versioned_name()) for vs in vses_to_store]
+            batches: Iterable[List[Tuple[int, Optional[bytes]]]] = self._serialize(variables, base_digests)
+            if self.pickle_before_write_lock:
+                # Inserting takes the write lock until the commit, so insert all pickles at once.
+                batches = [[pickled for batch in batches for pickled in batch]]
+            for batch in batches:
+                stored = []
+                for i, data_dump in batch:
+                    if data_dump is None:
+                        # If the VS fails to pickle, skip it as it would be reconstructed on (incremental) checkout.
+                        continue
+                    vs = vses_to_store[i]
+                    stored.append((vs.versioned_name(), data_dump))
+                    KishuBufferStore.store_refs(cur, commit_id, vs.versioned_name(), data_dump)
+                    if self._chunk_dedup:
+                        self._chunk_store.store(cur, commit_id, vs.versioned_name(), data_dump)
+                        continue
 
-            try:
-                data_dump = pickle.dumps(ns_subset.to_dict())
-            except (pickle.PickleError, ValueError, AttributeError, TypeError):
-                # If the VS fails to pickle, skip it as it would be reconstructed on (incremental) checkout.
-                continue
+                    # Break the blob into chunks and insert each chunk
+                    data_view = memoryview(self._codec.encode(data_dump))
+                    for j in range(0, len(data_view), self._max_blob_size):
+                        chunk = data_view[j : j + self._max_blob_size]
+                        cur.execute(
+                            f"""
+                            INSERT INTO {VARIABLE_SNAPSHOT_TABLE} values (?, ?, ?, ?)
+                            """,
+                            (vs.versioned_name(), commit_id, j // self._max_blob_size, chunk),
+                        )
+                con.commit()
+                for versioned_name, data_dump in stored:
+                    self._snapshot_cache.put(versioned_name, data_dump)
+        finally:
+            con.close()
 
-            # Break the blob into chunks and insert each chunk
-            data_view = memoryview(data_dump)
-            for i in range(0, len(data_view), self._max_blob_size):
-                chunk = data_view[i : i + self._max_blob_size]
-                cur.execute(
-                    f"""
-                    INSERT INTO {VARIABLE_SNAPSHOT_TABLE} values (?, ?, ?, ?)
-                    """,
-                    (vs.versioned_name(), commit_id, i // self._max_blob_size, chunk),
-                )
-            con.commit()
+    def _serialize(
+        self, variables: List[Dict[str, Any]], base_digests: List[List[bytes]]
+    ) -> Iterator[List[Tuple[int, Optional[bytes]]]]:
+        """
+        Serializes each of the variable dictionaries, yielding batches of (index, pickle or None if unpicklable) in
+        the order they finish.
+        """
+        num_workers = min(self._serialization_workers, len(variables))
+        if num_workers <= 1:
+            for i, variable_dict in enumerate(variables):
+                yield [(i, self._dumps_or_none(variable_dict, base_digests[i]))]
+            return
+
+        global _fork_inherited_variables
+        executor: Executor
+        if self._serialization_executor == "process" and "fork" in multiprocessing.get_all_start_methods():
+            # Workers are forked on the first submission, after which they have the variables.
+            _fork_inherited_variables = (self, variables, base_digests)
+            executor = ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context("fork"))
+            futures = {executor.submit(_dumps_fork_inherited, i): i for i in range(len(variables))}
+        else:
+            executor = ThreadPoolExecutor(num_workers)
+            futures = {
+                executor.submit(self._dumps_or_none, variable_dict, base_digests[i]): i
+                for i, variable_dict in enumerate(variables)
+            }
+        try:
+            not_done: Set[Future] = set(futures)
+            while not_done:
+                done, not_done = wait(not_done, return_when=FIRST_COMPLETED)
+                yield [(futures[future], future.result()) for future in done]
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown()
+            _fork_inherited_variables = None
+
+    def _stream(
+        self,
+        con: sqlite3.Connection,
+        commit_id: str,
+        blob_key: str,
+        obj: Any,
+        split_shared: bool = False,
+        cache: bool = False,
+    ) -> Optional[bytes]:
+        """
+        Pickles obj into the chunks of the blob (commit_id, blob_key) in a transaction left for the caller to commit.
+        On failure, the transaction is rolled back.
+
+        @param cache: whether to return the pickle to cache, unless it is larger than the snapshot cache.
+        """
+        cur = con.cursor()
+        # Take the write lock upfront: reading before writing in a deferred transaction may fail to upgrade its lock.
+        cur.execute("begin immediate")
+        base_digests = self._base_buffer_digests(cur, blob_key)
+        writer = self._chunk_store.writer(cur, commit_id, blob_key)
+        file: io.RawIOBase = writer
+        if cache and self._snapshot_cache.enabled():
+            file = CachingWriter(writer, self._snapshot_cache.max_size)
+        try:
+            digests = self._dump(obj, file, base_digests, split_shared)
+            writer.close()
+        except BaseException:
+            writer.abort()
+            con.rollback()
+            raise
+        KishuBufferStore.store_digest_refs(cur, commit_id, blob_key, digests)
+        return file.data() if isinstance(file, CachingWriter) else None
+
+    def _base_buffer_digests(self, cur: sqlite3.Cursor, blob_key: str) -> List[bytes]:
+        """
+        Returns the out-of-band buffers of the latest stored blob of the same variables, from which to store the new
+        blob's buffers as deltas.
+        """
+        if not self._out_of_band_buffers or not self._delta_buffers:
+            return []
+        return KishuBufferStore.latest_digests(cur, blob_key)
+
+    def _dump(
+        self, obj: Any, file: io.RawIOBase, base_digests: Sequence[bytes] = (), split_shared: bool = False
+    ) -> List[bytes]:
+        """
+        Pickles obj into file, returning the digests of its out-of-band buffers.
+        """
+        if self._out_of_band_buffers:
+            return self._buffer_store.dump(obj, file, base_digests, split_shared)
+        pickle.dump(obj, file)
+        return []
+
+    def _load(self, reader: io.RawIOBase, variable_names: Optional[Set[str]] = None) -> Any:
+        return self._buffer_store.load(io.BufferedReader(reader), variable_names)
+
+    def _dumps_or_none(self, variable_dict: Dict[str, Any], base_digests: Sequence[bytes] = ()) -> Optional[bytes]:
+        try:
+            return self.dumps(variable_dict, base_digests, self._split_shared_objects)
+        except (pickle.PickleError, ValueError, AttributeError, TypeError):
+            return None
@@ -0,0 +1,414 @@
+"""
+Content-defined chunking and deduplicated storage of checkpoint blobs.
+"""
+
+from __future__ import annotations
+
+import io
+import sqlite3
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple, Union
+
+import numpy as np
+import xxhash
+
+from kishu.storage.blob_backend import CHUNK_TABLE, SQLITE_MAX_PARAMS, BlobBackend, Digest, SqliteBlobBackend
+from kishu.storage.codec import NO_CODEC, BlobCodec
+
+CHUNK_REF_TABLE = "blob_chunk_ref"
+CHUNK_REF_BLOB_KEY_IDX = "blob_chunk_ref_blob_key_idx"
+
+# Blob key of a commit's full checkpoint; variable snapshots use their versioned names.
+CHECKPOINT_BLOB_KEY = ""
+
+DEFAULT_CHUNK_AVG_SIZE = 16384
+
+# Number of bytes hashed at once, bounding the memory of chunking large blobs.
+ROLLING_HASH_SEGMENT_SIZE = 1 << 22
+
+# Number of trailing bytes the rolling hash at a byte depends on.
+ROLLING_HASH_WINDOW_SIZE = 48
+
+# Number of bytes a ChunkWriter buffers before storing the chunks it has determined.
+STREAM_WRITE_BUFFER_SIZE = 1 << 22
+
+# Number of chunks a ChunkReader loads at once.
+STREAM_READ_BATCH_SIZE = 256
+
+# Random gear values, derived deterministically so that chunk boundaries (and deduplication) are stable across runs.
+GEAR = np.array([xxhash.xxh32_intdigest(bytes([i])) for i in range(256)], dtype=np.uint32)
+
+
+def digest_of(chunk: Union[bytes, memoryview]) -> Digest:
+    return xxhash.xxh3_128_digest(chunk)
+
+
+class FastCDCChunker:
+    """
+    Content-defined chunker following FastCDC (Xia et al., USENIX ATC '16): a chunk ends at a byte whose rolling hash
+    is below a threshold, so boundaries only depend on nearby content and an insertion only changes the chunks around
+    it. Normalized chunking uses a stricter threshold before the average chunk size and a looser one after it, which
+    narrows the chunk size distribution.
+
+    Instead of FastCDC's gear hash, whose recurrence is sequential, the rolling hash is the windowed sum of gear
+    values, i.e., the difference of two prefix sums, which numpy computes over whole blobs at once.
+    """
+
+    def __init__(self, avg_size: int = DEFAULT_CHUNK_AVG_SIZE) -> None:
+        """
+        @param avg_size: targeted average chunk size in bytes. Chunks are between a quarter and eight times as large.
+        """
+        if avg_size < ROLLING_HASH_WINDOW_SIZE * 4:
+            raise ValueError(f"Average chunk size must be at least {ROLLING_HASH_WINDOW_SIZE * 4} bytes, got {avg_size}")
+        self.avg_size = avg_size
+        self.min_size = avg_size // 4
+        self.max_size = avg_size * 8
+        bits = avg_size.bit_length() - 1
+        self._threshold_small = np.uint32(1 << (32 - bits - 2))
+        self._threshold_large = np.uint32(1 << (32 - bits + 2))
+
+    def chunk_boundaries(self, data: Union[bytes, bytearray, memoryview]) -> List[int]:
+        """
+        Returns the end offsets of the chunks of data.
+        """
+        size = len(data)
+        if size <= self.min_size:
+            return [size] if size > 0 else []
+
+        # Positions after which a chunk may end, for each threshold.
+        candidates_small, candidates_large = self._find_candidates(np.frombuffer(data, dtype=np.uint8))
+
+        boundaries = []
+        start = 0
+        while size - start > self.min_size:
+            end = self._first_candidate(candidates_small, start + self.min_size, start + self.avg_size)
+            if end is None:
+                end = self._first_candidate(candidates_large, start + self.avg_size, start + self.max_size)
+            if end is None:
+                end = min(start + self.max_size, size)
+            boundaries.append(end)
+            start = end
+        if start < size:
+            boundaries.append(size)
+        return boundaries
+
+    def split(self, data: Union[bytes, memoryview]) -> List[memoryview]:
+        data_view = memoryview(data).cast("B")
+        chunks = []
+        start = 0
+        for end in self.chunk_boundaries(data_view):
+            chunks.append(data_view[start:end])
+            start = end
+        return chunks
+
+    def _find_candidates(self, data: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        candidates_small, candidates_large = [], []
+        for segment_start in range(0, len(data), ROLLING_HASH_SEGMENT_SIZE):
+            # Include the preceding window so that hashes do not depend on segmenting.
+            context_start = max(0, segment_start - ROLLING_HASH_WINDOW_SIZE)
+            hashes = FastCDCChunker._rolling_hashes(data[context_start : segment_start + ROLLING_HASH_SEGMENT_SIZE])
+            hashes = hashes[segment_start - context_start :]
+            candidates_large_segment = np.flatnonzero(hashes < self._threshold_large)
+            candidates_small_segment = candidates_large_segment[hashes[candidates_large_segment] < self._threshold_small]
+            # A chunk ends after the candidate byte.
+            candidates_small.append(candidates_small_segment + (segment_start + 1))
+            candidates_large.append(candidates_large_segment + (segment_start + 1))
+        return np.concatenate(candidates_small), np.concatenate(candidates_large)
+
+    @staticmethod
+    def _rolling_hashes(data: np.ndarray) -> np.ndarray:
+        hashes = np.cumsum(GEAR[data], dtype=np.uint32)
+        hashes[ROLLING_HASH_WINDOW_SIZE:] -= hashes[:-ROLLING_HASH_WINDOW_SIZE].copy()
+        return hashes
+
+    @staticmethod
+    def _first_candidate(candidates: np.ndarray, low: int, high: int) -> Optional[int]:
+        i = np.searchsorted(candidates, low)
+        if i < len(candidates) and candidates[i] < high:
+            return int(candidates[i])
+        return None
+
+
+class KishuChunkStore:
+    """
+    Stores blobs as lists of content-defined chunks. Each distinct chunk is stored once, keyed by its xxh3 digest, and
+    reference counted by the blobs containing it.
+
+    Blobs are identified by (commit_id, blob_key), e.g., a commit's checkpoint or one of its variable snapshots.
+    Methods operate on a caller's cursor so that they join the caller's transaction.
+    """
+
+    def __init__(
+        self,
+        avg_chunk_size: int = DEFAULT_CHUNK_AVG_SIZE,
+        codec: Optional[BlobCodec] = None,
+        backends: Optional[Sequence[BlobBackend]] = None,
+    ) -> None:
+        """
+        @param avg_chunk_size: targeted average chunk size in bytes.
+        @param codec: codec compressing newly stored chunks. Chunks are digested before compression.
+        @param backends: backends storing chunk data. The first one stores new chunks; chunks are read from any.
+        """
+        self._chunker = FastCDCChunker(avg_chunk_size)
+        self._codec = codec if codec is not None else BlobCodec(NO_CODEC, 0)
+        self._backends = list(backends) if backends is not None else [SqliteBlobBackend()]
+
+    def init_database(self, cur: sqlite3.Cursor) -> None:
+        cur.execute(f"create table if not exists {CHUNK_TABLE} (digest blob primary key, refcount int, data blob)")
+        cur.execute(
+            f"create table if not exists {CHUNK_REF_TABLE} "
+            "(commit_id text, blob_key text, seq int, digest blob, primary key (commit_id, blob_key, seq))"
+        )
+        cur.execute(f"create index if not exists {CHUNK_REF_BLOB_KEY_IDX} on {CHUNK_REF_TABLE} (blob_key)")
+        for backend in self._backends:
+            backend.init_database(cur)
+
+    def drop_database(self, cur: sqlite3.Cursor) -> None:
+        cur.execute(f"drop table if exists {CHUNK_TABLE}")
+        cur.execute(f"drop table if exists {CHUNK_REF_TABLE}")
+        for backend in self._backends:
+            backend.drop_database(cur)
+
+    def store(self, cur: sqlite3.Cursor, commit_id: str, blob_key: str, data: Union[bytes, memoryview]) -> None:
+        self._store_chunks(cur, commit_id, blob_key, 0, self._chunker.split(data))
+
+    def writer(self, cur: sqlite3.Cursor, commit_id: str, blob_key: str) -> ChunkWriter:
+        """
+        Returns a file-like object storing the blob written to it, chunked as by store, once closed.
+        """
+        return ChunkWriter(self, cur, commit_id, blob_key)
+
+    def _store_chunks(
+        self, cur: sqlite3.Cursor, commit_id: str, blob_key: str, first_seq: int, chunks: Sequence[Union[bytes, memoryview]]
+    ) -> None:
+        """
+        Stores chunks of the blob (commit_id, blob_key), starting from its first_seq-th chunk.
+        """
+        digests = [digest_of(chunk) for chunk in chunks]
+
+        # Only compress and insert chunks not stored yet.
+        counts = Counter(digests)
+        unique_digests = list(counts)
+        stored_digests: Set[Digest] = set()
+        for i in range(0, len(unique_digests), SQLITE_MAX_PARAMS):
+            batch = unique_digests[i : i + SQLITE_MAX_PARAMS]
+            cur.execute(f"select digest from {CHUNK_TABLE} where digest in (%s)" % ",".join("?" * len(batch)), batch)
+            stored_digests.update(row[0] for row in cur.fetchall())
+
+        # Compress before the first write, which holds the database's write lock until the caller commits.
+        new_chunks = {}
+        for digest, chunk in zip(digests, chunks):
+            if digest not in stored_digests and digest not in new_chunks:
+                new_chunks[digest] = self._codec.encode(chunk)
+        if stored_digests:
+            cur.executemany(
+                f"update {CHUNK_TABLE} set refcount = refcount + ? where digest = ?",
+                [(counts[digest], digest) for digest in stored_digests],
+            )
+        self._backends[0].insert(cur, [(digest, counts[digest], data) for digest, data in new_chunks.items()])
+        cur.executemany(
+            f"insert into {CHUNK_REF_TABLE} values (?, ?, ?, ?)",
+            [(commit_id, blob_key, first_seq + seq, digest) for seq, digest in enumerate(digests)],
+        )
+
+    def load(self, cur: sqlite3.Cursor, commit_id: str, blob_key: str) -> Optional[bytes]:
+        """
+        Returns the blob, or None if it is not stored.
+        """
+        cur.execute(
+            f"select digest from {CHUNK_REF_TABLE} where commit_id = ? and blob_key = ? order by seq", (commit_id, blob_key)
+        )
+        digests = [row[0] for row in cur.fetchall()]
+        if not digests:
+            return None
+        return self._join(digests, self._load_chunks(cur, digests))
+
+    def reader(self, cur: sqlite3.Cursor, commit_id: str, blob_key: str) -> Optional[ChunkReader]:
+        """
+        Returns a file-like object reading the blob a few chunks at a time, or None if it is not stored.
+        """
+        cur.execute(
+            f"select digest from {CHUNK_REF_TABLE} where commit_id = ? and blob_key = ? order by seq", (commit_id, blob_key)
+        )
+        digests = [row[0] for row in cur.fetchall()]
+        if not digests:
+            return None
+        return ChunkReader(self, cur, digests)
+
+    def load_by_blob_keys(self, cur: sqlite3.Cursor, blob_keys: Sequence[str]) -> Dict[str, bytes]:
+        """
+        Returns the blobs with the given keys regardless of their commits, for blob keys naming the same blob in every
+        commit storing it.
+        """
+        digests_by_key = KishuChunkStore._digests_by_blob_keys(cur, blob_keys)
+        chunks = self._load_chunks(cur, {digest for digests in digests_by_key.values() for digest in digests})
+        return {blob_key: self._join(digests, chunks) for blob_key, digests in digests_by_key.items()}
+
+    def readers_by_blob_keys(self, cur: sqlite3.Cursor, blob_keys: Sequence[str]) -> Dict[str, ChunkReader]:
+        """
+        Like load_by_blob_keys, but returns file-like objects reading the blobs a few chunks at a time.
+        """
+        return {
+            blob_key: ChunkReader(self, cur, digests)
+            for blob_key, digests in KishuChunkStore._digests_by_blob_keys(cur, blob_keys).items()
+        }
+
+    @staticmethod
+    def stored_blob_keys(cur: sqlite3.Cursor, commit_ids: Sequence[str]) -> Set[str]:
+        cur.execute(
+            f"select distinct blob_key from {CHUNK_REF_TABLE} where commit_id in (%s)" % ",".join("?" * len(commit_ids)),
+            list(commit_ids),
+        )
+        return {row[0] for row in cur.fetchall()}
+
+    @staticmethod
+    def existing_blob_keys(cur: sqlite3.Cursor, blob_keys: Sequence[str]) -> Set[str]:
+        """
+        Returns the blob keys stored by any commit among blob_keys.
+        """
+        cur.execute(
+            f"select distinct blob_key from {CHUNK_REF_TABLE} where blob_key in (%s)" % ",".join("?" * len(blob_keys)),
+            list(blob_keys),
+        )
+        return {row[0] for row in cur.fetchall()}
+
+    @staticmethod
+    def release(cur: sqlite3.Cursor, digests: Iterable[Digest]) -> None:
+        """
+        Drops one reference to each of the digests (counting repeats), deleting chunks no longer referenced.
+        """
+        counts = Counter(digests)
+        cur.executemany(
+            f"update {CHUNK_TABLE} set refcount = refcount - ? where digest = ?",
+            [(count, digest) for digest, count in counts.items()],
+        )
+        cur.execute(f"delete from {CHUNK_TABLE} where refcount <= 0")
+
+    @staticmethod
+    def _digests_by_blob_keys(cur: sqlite3.Cursor, blob_keys: Sequence[str]) -> Dict[str, List[Digest]]:
+        cur.execute(
+            f"select blob_key, commit_id, digest from {CHUNK_REF_TABLE} where blob_key in (%s) "
+            "order by blob_key, commit_id, seq" % ",".join("?" * len(blob_keys)),
+            list(blob_keys),
+        )
+        # A blob may be stored by more than one commit, e.g., when a background checkpoint stores it again while an
+        # earlier one is still in flight; read one copy.
+        digests_by_key: Dict[str, List[Digest]] = {}
+        commit_id_by_key: Dict[str, str] = {}
+        for blob_key, commit_id, digest in cur.fetchall():
+            if commit_id_by_key.setdefault(blob_key, commit_id) == commit_id:
+                digests_by_key.setdefault(blob_key, []).append(digest)
+        return digests_by_key
+
+    def _load_chunks(self, cur: sqlite3.Cursor, digests: Iterable[Digest]) -> Dict[Digest, bytes]:
+        missing_digests = set(digests)
+        chunks: Dict[Digest, bytes] = {}
+        for backend in self._backends:
+            if not missing_digests:
+                break
+            backend_chunks = backend.load(cur, missing_digests)
+            chunks.update(backend_chunks)
+            missing_digests.difference_update(backend_chunks)
+        return chunks
+
+    @staticmethod
+    def _join(digests: List[Digest], chunks: Dict[Digest, bytes]) -> bytes:
+        for digest in digests:
+            if digest not in chunks:
+                raise ValueError(f"Chunk {digest.hex()} is missing from the chunk store")
+        return b"".join(BlobCodec.decode(chunks[digest]) for digest in digests)
+
+
+class ChunkWriter(io.RawIOBase):
+    """
+    Stores the blob written to it as KishuChunkStore.store would, without holding all of it in memory: once enough
+    bytes are buffered, chunks whose boundaries cannot depend on later bytes are stored. Closing stores the rest.
+    """
+
+    def __init__(self, chunk_store: KishuChunkStore, cur: sqlite3.Cursor, commit_id: str, blob_key: str) -> None:
+        super().__init__()
+        self._chunk_store = chunk_store
+        self._cur = cur
+        self._commit_id = commit_id
+        self._blob_key = blob_key
+        self._buffer = bytearray()
+        self._num_chunks = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:  # type: ignore
+        num_bytes = memoryview(data).nbytes
+        self._buffer += data
+        if len(self._buffer) >= STREAM_WRITE_BUFFER_SIZE:
+            self._store(final=False)
+        return num_bytes
+
+    def close(self) -> None:
+        if not self.closed:
+            self._store(final=True)
+        super().close()
+
+    def abort(self) -> None:
+        """
+        Closes without storing the buffered bytes, e.g., when writing the blob failed. Chunks stored so far remain in
+        the caller's transaction, which the caller should roll back.
+        """
+        self._buffer.clear()
+        super().close()
+
+    def _store(self, final: bool) -> None:
+        # The buffer starts at a chunk boundary. A chunk's end is determined by at most max_size bytes from its start,
+        # as the rolling hash never looks behind it beyond the minimum chunk size.
+        chunker = self._chunk_store._chunker
+        chunks: List[bytes] = []
+        start = 0
+        for end in chunker.chunk_boundaries(self._buffer):
+            if not final and start + chunker.max_size > len(self._buffer):
+                break
+            chunks.append(bytes(self._buffer[start:end]))
+            start = end
+        self._chunk_store._store_chunks(self._cur, self._commit_id, self._blob_key, self._num_chunks, chunks)
+        self._num_chunks += len(chunks)
+        del self._buffer[:start]
+
+
+class ChunkReader(io.RawIOBase):
+    """
+    Reads a blob stored as the given chunks, loading a batch of chunks at a time.
+    """
+
+    def __init__(self, chunk_store: KishuChunkStore, cur: sqlite3.Cursor, digests: List[Digest]) -> None:
+        super().__init__()
+        self._chunk_store = chunk_store
+        self._cur = cur
+        self._digests = digests
+        self._next_digest = 0
+        self._chunks: List[bytes] = []
+        self._chunk = memoryview(b"")
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:  # type: ignore
+        while not self._chunk:
+            if not self._chunks:
+                if self._next_digest == len(self._digests):
+                    return 0
+                self._load_batch()
+            self._chunk = memoryview(BlobCodec.decode(self._chunks.pop()))
+        view = memoryview(buffer).cast("B")
+        num_bytes = min(len(view), len(self._chunk))
+        view[:num_bytes] = self._chunk[:num_bytes]
+        self._chunk = self._chunk[num_bytes:]
+        return num_bytes
+
+    def _load_batch(self) -> None:
+        digests = self._digests[self._next_digest : self._next_digest + STREAM_READ_BATCH_SIZE]
+        self._next_digest += len(digests)
+        chunks = self._chunk_store._load_chunks(self._cur, digests)
+        for digest in digests:
+            if digest not in chunks:
+                raise ValueError(f"Chunk {digest.hex()} is missing from the chunk store")
+        # Popped from the end and decoded when read, e.g., not at all if the reader stops before them.
+        self._chunks = [chunks[digest] for digest in reversed(digests)]
@@ -0,0 +1,167 @@
+"""
+Compression of stored blobs with a per-blob header recording the codec.
+"""
+
+from __future__ import annotations
+
+import lzma
+import zlib
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Union
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from kishu.storage.config import Config
+
+# Encoded blobs start with the magic followed by the codec ID. Pickles, which blobs were stored as before, never start
+# with a null byte; hence blobs without the magic are read as is.
+CODEC_MAGIC = b"\x00KZ"
+CODEC_HEADER_SIZE = len(CODEC_MAGIC) + 1
+
+DEFAULT_CODEC = "auto"
+DEFAULT_COMPRESSION_MAX_RATIO = 0.9
+DEFAULT_COMPRESSION_SAMPLE_SIZE = 1 << 20
+
+Blob = Union[bytes, bytearray, memoryview]
+
+
+@dataclass(frozen=True)
+class Codec:
+    """
+    @param codec_id: ID recorded in the blob header. Must never change once blobs are stored with it.
+    @param name: name of the codec in the config, e.g., PLANNER.compression_codec=zlib.
+    @param compress: compresses a blob at a compression level.
+    @param decompress: decompresses a blob.
+    @param default_level: compression level used unless configured otherwise.
+    """
+
+    codec_id: int
+    name: str
+    compress: Callable[[Blob, int], bytes]
+    decompress: Callable[[Blob], bytes]
+    default_level: int
+
+
+def _lz4_compress(data: Blob, level: int) -> bytes:
+    return lz4_frame.compress(data, compression_level=level)
+
+
+def _lz4_decompress(data: Blob) -> bytes:
+    return lz4_frame.decompress(data)
+
+
+def _zstd_compress(data: Blob, level: int) -> bytes:
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def _zstd_decompress(data: Blob) -> bytes:
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+NO_CODEC = Codec(0, "none", lambda data, level: bytes(data), bytes, 0)
+CODECS: Dict[str, Codec] = {
+    codec.name: codec
+    for codec in [
+        NO_CODEC,
+        Codec(1, "zlib", lambda data, level: zlib.compress(data, level), zlib.decompress, 1),
+        Codec(2, "lzma", lambda data, level: lzma.compress(data, preset=level), lzma.decompress, 0),
+        Codec(3, "lz4", _lz4_compress, _lz4_decompress, 0),
+        Codec(4, "zstd", _zstd_compress, _zstd_decompress, 3),
+    ]
+}
+CODECS_BY_ID: Dict[int, Codec] = {codec.codec_id: codec for codec in CODECS.values()}
+
+
+def is_codec_available(name: str) -> bool:
+    if name == "lz4":
+        return lz4_frame is not None
+    if name == "zstd":
+        return zstandard is not None
+    return name in CODECS
+
+
+def available_codecs() -> List[str]:
+    return [name for name in CODECS if is_codec_available(name)]
+
+
+def fastest_available_codec() -> Codec:
+    for name in ["zstd", "lz4", "zlib"]:
+        if is_codec_available(name):
+            return CODECS[name]
+    return NO_CODEC
+
+
+class BlobCodec:
+    """
+    Compresses blobs on the write path and decompresses them on the read path.
+
+    The adaptive policy compresses a sample from the start of each blob first and stores the blob uncompressed if
+    compression does not pay off on the sample, e.g., for arrays of random values or already compressed images.
+    """
+
+    def __init__(
+        self,
+        codec: Codec,
+        level: int,
+        max_ratio: float = DEFAULT_COMPRESSION_MAX_RATIO,
+        sample_size: int = DEFAULT_COMPRESSION_SAMPLE_SIZE,
+    ) -> None:
+        """
+        @param codec: codec to compress with.
+        @param level: compression level of the codec.
+        @param max_ratio: highest compressed-to-original size ratio, estimated on the sample, to still compress at.
+        @param sample_size: number of leading bytes to estimate the compression ratio on.
+        """
+        self.codec = codec
+        self.level = level
+        self.max_ratio = max_ratio
+        self.sample_size = sample_size
+
+    @staticmethod
+    def from_config() -> BlobCodec:
+        name = Config.get("PLANNER", "compression_codec", DEFAULT_CODEC)
+        if name == DEFAULT_CODEC:
+            codec = fastest_available_codec()
+        elif is_codec_available(name):
+            codec = CODECS[name]
+        else:
+            raise ValueError(f"Compression codec {name} is unknown or not installed, available: {available_codecs()}")
+        return BlobCodec(
+            codec,
+            Config.get("PLANNER", "compression_level", codec.default_level),
+            Config.get("PLANNER", "compression_max_ratio", DEFAULT_COMPRESSION_MAX_RATIO),
+            Config.get("PLANNER", "compression_sample_size", DEFAULT_COMPRESSION_SAMPLE_SIZE),
+        )
+
+    def encode(self, data: Blob) -> bytes:
+        codec = self.codec
+        if codec is not NO_CODEC and len(data) > 0:
+            sample = memoryview(data)[: self.sample_size]
+            compressed_sample = codec.compress(sample, self.level)
+            if len(compressed_sample) <= self.max_ratio * len(sample):
+                compressed = compressed_sample if len(sample) == len(data) else codec.compress(data, self.level)
+                return b"".join([BlobCodec._header(codec), compressed])
+        return b"".join([BlobCodec._header(NO_CODEC), data])
+
+    @staticmethod
+    def decode(data: Blob) -> bytes:
+        if bytes(data[: len(CODEC_MAGIC)]) != CODEC_MAGIC:
+            return bytes(data)
+        codec_id = data[len(CODEC_MAGIC)]
+        codec = CODECS_BY_ID.get(codec_id)
+        if codec is None or not is_codec_available(codec.name):
+            name = codec.name if codec is not None else f"with ID {codec_id}"
+            raise ValueError(f"Blob is compressed by codec {name}, which is unknown or not installed")
+        return codec.decompress(memoryview(data)[CODEC_HEADER_SIZE:])
+
+    @staticmethod
+    def _header(codec: Codec) -> bytes:
+        return CODEC_MAGIC + bytes([codec.codec_id])
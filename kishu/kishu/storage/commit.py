@@ -19,6 +19,7 @@
 
 import kishu.planning.plan
 from kishu.exceptions import MissingCommitEntryError
+from kishu.storage.codec import BlobCodec
 
 COMMIT_ENTRY_TABLE = "commit_entry"
 
@@ -114,6 +115,7 @@ def runtime_s(self) -> Optional[float]:
 class KishuCommit:
     def __init__(self, database_path: Path):
         self.database_path = database_path
+        self._codec = BlobCodec.from_config()
 
     def init_database(self):
         con = sqlite3.connect(self.database_path)
@@ -122,14 +124,14 @@ def init_database(self):
         con.commit()
 
     def store_commit(self, commit_entry: CommitEntry) -> None:
-        commit_entry_dill = dill.dumps(commit_entry)
+        commit_entry_dill = self._codec.encode(dill.dumps(commit_entry))
         con = sqlite3.connect(self.database_path)
         cur = con.cursor()
         cur.execute(f"insert into {COMMIT_ENTRY_TABLE} values (?, ?)", (commit_entry.commit_id, memoryview(commit_entry_dill)))
         con.commit()
 
     def update_commit(self, commit_entry: CommitEntry) -> None:
-        commit_entry_dill = dill.dumps(commit_entry)
+        commit_entry_dill = self._codec.encode(dill.dumps(commit_entry))
         con = sqlite3.connect(self.database_path)
         cur = con.cursor()
         cur.execute(
@@ -145,7 +147,7 @@ def get_commit(self, commit_id: str) -> CommitEntry:
         res: tuple = cur.fetchone()
         if not res:
             raise MissingCommitEntryError(commit_id)
-        result = dill.loads(res[0])
+        result = dill.loads(BlobCodec.decode(res[0]))
         con.commit()
         return result
 
@@ -161,7 +163,7 @@ def get_commits(self, commit_ids: List[str]) -> Dict[str, CommitEntry]:
         cur.execute(query, commit_ids)
         res = cur.fetchall()
         for key, data in res:
-            result[key] = dill.loads(data)
+            result[key] = dill.loads(BlobCodec.decode(data))
         con.commit()
         return result
 
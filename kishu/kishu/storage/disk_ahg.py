@@ -5,20 +5,64 @@
 from __future__ import annotations
 
 import sqlite3
+from collections import OrderedDict
 from dataclasses import dataclass
 from pathlib import Path
-from typing import FrozenSet, List
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
 
 from kishu.jupyter.namespace import Namespace
 from kishu.planning.profiler import profile_variable_size
-from kishu.storage.commit_graph import CommitId
+from kishu.storage.commit_graph import ABSOLUTE_PAST, CommitId
 from kishu.storage.config import Config
+from kishu.storage.schema import drop_schema_version, get_schema_version, set_schema_version, table_columns
 
 AHG_VARIABLE_SNAPSHOT_TABLE = "ahg_variable_snapshot"
 AHG_CELL_EXECUTION_TABLE = "ahg_cell_execution"
 AHG_CE_INPUT_TABLE = "ahg_ce_input"
 AHG_CE_OUTPUT_TABLE = "ahg_ce_output"
 AHG_ACTIVE_VSES_TABLE = "ahg_active_vses"
+AHG_ACTIVE_VSES_COMMIT_TABLE = "ahg_active_vses_commit"
+AHG_GENERATION_TABLE = "ahg_generation"
+
+# Every n-th commit along a chain of commits stores its full set of active VSes (keyframe); the others only store the
+# VSes added to or removed from the active set of their parent commit (delta).
+DEFAULT_ACTIVE_VSES_KEYFRAME_INTERVAL = 64
+
+# Number of materialized active VS sets to keep in memory.
+ACTIVE_VSES_CACHE_SIZE = 256
+
+# Maximum number of parameters bound per query, below SQLite's default limit of 999 variables in older versions.
+MAX_QUERY_PARAMETERS = 900
+
+# Layout versions of the AHG tables:
+#   0: full active VS sets in (commit_id, versioned_name) rows.
+#   1: active VS sets as keyframes and deltas, with a chain row per commit.
+#   2: chain rows also store the cell number of the commit's newest CE.
+AHG_SCHEMA_COMPONENT = "ahg"
+AHG_SCHEMA_VERSION = 2
+
+
+TRAVERSE_ACTIVE_VSES_CHAIN_SQL: str = f"""
+    WITH RECURSIVE active_vses_chain(commit_id, parent_commit_id, keyframe_distance, depth) AS (
+        -- Base case: Start from the given commit_id
+        SELECT commit_id, parent_commit_id, keyframe_distance, 0 AS depth
+        FROM {AHG_ACTIVE_VSES_COMMIT_TABLE}
+        WHERE commit_id = ?
+
+        UNION ALL
+
+        -- Recursive case: Follow parents until reaching the nearest keyframe
+        SELECT c.commit_id, c.parent_commit_id, c.keyframe_distance, chain.depth + 1
+        FROM {AHG_ACTIVE_VSES_COMMIT_TABLE} c
+        INNER JOIN active_vses_chain chain ON chain.parent_commit_id = c.commit_id
+        WHERE chain.keyframe_distance > 0
+    )
+
+    -- Select the chain from the keyframe to the given commit.
+    SELECT commit_id, keyframe_distance
+    FROM active_vses_chain
+    ORDER BY depth DESC;
+"""
 
 
 # Aliases
@@ -94,44 +138,114 @@ class AHGUpdateResult:
     output_vss: List[VariableSnapshot]
     newest_ce: CellExecution
     active_vss: List[VariableSnapshot]
+    parent_commit_id: CommitId = ABSOLUTE_PAST
 
 
 class KishuDiskAHG:
     def __init__(self, database_path: Path):
         self.database_path = database_path
 
+        # Materialized active VS sets (as versioned names) of recently read or written commits.
+        self._active_vses_cache: OrderedDict[CommitId, FrozenSet[str]] = OrderedDict()
+
     def init_database(self):
         con = sqlite3.connect(self.database_path)
         cur = con.cursor()
-        cur.execute(
-            f"create table if not exists {AHG_VARIABLE_SNAPSHOT_TABLE} "
-            "(versioned_name text primary key, deleted bool, size float)"
-        )
-        cur.execute(
-            f"create table if not exists {AHG_CELL_EXECUTION_TABLE} "
-            "(cell_num int primary key, cell text, cell_runtime_s float)"
-        )
-        cur.execute(
-            f"create table if not exists {AHG_CE_INPUT_TABLE} "
-            "(cell_num int, versioned_name text, primary key (cell_num, versioned_name))"
-        )
-        cur.execute(
-            f"create table if not exists {AHG_CE_OUTPUT_TABLE} "
-            "(cell_num int, versioned_name text, primary key (cell_num, versioned_name))"
-        )
-        cur.execute(f"create table if not exists {AHG_ACTIVE_VSES_TABLE} (commit_id text, versioned_name text)")
+        try:
+            schema_version = self._detect_schema_version(cur)
+            cur.execute(
+                f"create table if not exists {AHG_VARIABLE_SNAPSHOT_TABLE} "
+                "(versioned_name text primary key, deleted bool, size float)"
+            )
+            cur.execute(
+                f"create table if not exists {AHG_CELL_EXECUTION_TABLE} "
+                "(cell_num int primary key, cell text, cell_runtime_s float)"
+            )
+            cur.execute(
+                f"create table if not exists {AHG_CE_INPUT_TABLE} "
+                "(cell_num int, versioned_name text, primary key (cell_num, versioned_name))"
+            )
+            cur.execute(
+                f"create table if not exists {AHG_CE_OUTPUT_TABLE} "
+                "(cell_num int, versioned_name text, primary key (cell_num, versioned_name))"
+            )
+            cur.execute(
+                f"create table if not exists {AHG_ACTIVE_VSES_TABLE} "
+                "(commit_id text, versioned_name text, is_removed bool, primary key (commit_id, versioned_name))"
+            )
+            cur.execute(
+                f"create table if not exists {AHG_ACTIVE_VSES_COMMIT_TABLE} "
+                "(commit_id text primary key, parent_commit_id text, keyframe_distance int, cell_num int)"
+            )
+            cur.execute(f"create table if not exists {AHG_GENERATION_TABLE} (generation int)")
+            if schema_version < AHG_SCHEMA_VERSION:
+                self._migrate(cur, schema_version)
+            set_schema_version(cur, AHG_SCHEMA_COMPONENT, AHG_SCHEMA_VERSION)
 
-        con.commit()
+            con.commit()
+        finally:
+            con.close()
 
     def drop_database(self):
         con = sqlite3.connect(self.database_path)
         cur = con.cursor()
-        cur.execute(f"drop table if exists {AHG_VARIABLE_SNAPSHOT_TABLE}")
-        cur.execute(f"drop table if exists {AHG_CELL_EXECUTION_TABLE}")
-        cur.execute(f"drop table if exists {AHG_CE_INPUT_TABLE}")
-        cur.execute(f"drop table if exists {AHG_CE_OUTPUT_TABLE}")
-        cur.execute(f"drop table if exists {AHG_ACTIVE_VSES_TABLE}")
-        con.commit()
+        try:
+            cur.execute(f"drop table if exists {AHG_VARIABLE_SNAPSHOT_TABLE}")
+            cur.execute(f"drop table if exists {AHG_CELL_EXECUTION_TABLE}")
+            cur.execute(f"drop table if exists {AHG_CE_INPUT_TABLE}")
+            cur.execute(f"drop table if exists {AHG_CE_OUTPUT_TABLE}")
+            cur.execute(f"drop table if exists {AHG_ACTIVE_VSES_TABLE}")
+            cur.execute(f"drop table if exists {AHG_ACTIVE_VSES_COMMIT_TABLE}")
+            cur.execute(f"drop table if exists {AHG_GENERATION_TABLE}")
+            drop_schema_version(cur, AHG_SCHEMA_COMPONENT)
+            con.commit()
+            self._active_vses_cache.clear()
+        finally:
+            con.close()
+
+    @staticmethod
+    def bump_generation(cur: sqlite3.Cursor) -> None:
+        """
+        Records a change to existing AHG nodes, e.g., their deletion, in the transaction of cur. Appends only add nodes,
+        hence need not bump the generation.
+        """
+        cur.execute(f"create table if not exists {AHG_GENERATION_TABLE} (generation int)")
+        cur.execute(f"update {AHG_GENERATION_TABLE} set generation = generation + 1")
+        if cur.rowcount == 0:
+            cur.execute(f"insert into {AHG_GENERATION_TABLE} values (1)")
+
+    @staticmethod
+    def _detect_schema_version(cur: sqlite3.Cursor) -> int:
+        """
+        Returns the layout version of the existing AHG tables. Databases written before versions were recorded are told
+        apart by their columns.
+        """
+        schema_version = get_schema_version(cur, AHG_SCHEMA_COMPONENT)
+        if schema_version is not None:
+            return schema_version
+        active_vses_columns = table_columns(cur, AHG_ACTIVE_VSES_TABLE)
+        if active_vses_columns is not None and "is_removed" not in active_vses_columns:
+            return 0
+        active_vses_commit_columns = table_columns(cur, AHG_ACTIVE_VSES_COMMIT_TABLE)
+        if active_vses_commit_columns is not None and "cell_num" not in active_vses_commit_columns:
+            return 1
+        return AHG_SCHEMA_VERSION
+
+    @staticmethod
+    def _migrate(cur: sqlite3.Cursor, schema_version: int) -> None:
+        """
+        Upgrades the AHG tables from the given layout version to the current one.
+        """
+        if schema_version < 1:
+            # Each commit's full active VS set becomes a keyframe. Its parent and newest CE were not stored.
+            cur.execute(f"alter table {AHG_ACTIVE_VSES_TABLE} add column is_removed bool not null default 0")
+            cur.execute(
+                f"insert or ignore into {AHG_ACTIVE_VSES_COMMIT_TABLE} (commit_id, parent_commit_id, keyframe_distance) "
+                f"select distinct commit_id, ?, 0 from {AHG_ACTIVE_VSES_TABLE}",
+                (ABSOLUTE_PAST,),
+            )
+        if "cell_num" not in (table_columns(cur, AHG_ACTIVE_VSES_COMMIT_TABLE) or []):
+            cur.execute(f"alter table {AHG_ACTIVE_VSES_COMMIT_TABLE} add column cell_num int")
 
     def store_update_results(self, update_result: AHGUpdateResult):
         # Unpack items
@@ -140,105 +254,260 @@ def store_update_results(self, update_result: AHGUpdateResult):
         output_vss = update_result.output_vss
         newest_ce = update_result.newest_ce
         active_vss = update_result.active_vss
+        parent_commit_id = update_result.parent_commit_id
 
         con = sqlite3.connect(self.database_path)
         cur = con.cursor()
-
-        # Store each output VS.
-        for vs in output_vss:
+        try:
+            # Store each output VS.
+            for vs in output_vss:
+                cur.execute(
+                    f"insert into {AHG_VARIABLE_SNAPSHOT_TABLE} values (?, ?, ?)",
+                    (vs.versioned_name(), vs.deleted, vs.size),
+                )
+
+            # Store the newest CE.
             cur.execute(
-                f"insert into {AHG_VARIABLE_SNAPSHOT_TABLE} values (?, ?, ?)",
-                (vs.versioned_name(), vs.deleted, vs.size),
+                f"insert into {AHG_CELL_EXECUTION_TABLE} values (?, ?, ?)",
+                (newest_ce.cell_num, newest_ce.cell, newest_ce.cell_runtime_s),
             )
 
-        # Store the newest CE.
-        cur.execute(
-            f"insert into {AHG_CELL_EXECUTION_TABLE} values (?, ?, ?)",
-            (newest_ce.cell_num, newest_ce.cell, newest_ce.cell_runtime_s),
-        )
-
-        # Store each VS to CE edge.
-        for vs in accessed_vss:
+            # Store each VS to CE edge.
+            for vs in accessed_vss:
+                cur.execute(
+                    f"insert into {AHG_CE_INPUT_TABLE} values (?, ?)",
+                    (newest_ce.cell_num, vs.versioned_name()),
+                )
+
+            # Store each CE to VS edge.
+            for vs in output_vss:
+                cur.execute(
+                    f"insert into {AHG_CE_OUTPUT_TABLE} values (?, ?)",
+                    (newest_ce.cell_num, vs.versioned_name()),
+                )
+
+            # Store active VSes, either in full (keyframe) or as a delta from the parent commit's active VSes.
+            active_versioned_names = frozenset(vs.versioned_name() for vs in active_vss)
+            keyframe_interval = Config.get("PLANNER", "active_vses_keyframe_interval", DEFAULT_ACTIVE_VSES_KEYFRAME_INTERVAL)
+            parent_keyframe_distance = self._get_keyframe_distance(cur, parent_commit_id)
+            if parent_keyframe_distance is None or parent_keyframe_distance + 1 >= keyframe_interval:
+                keyframe_distance = 0
+                delta_rows = [(commit_id, versioned_name, False) for versioned_name in active_versioned_names]
+            else:
+                keyframe_distance = parent_keyframe_distance + 1
+                parent_versioned_names = self._get_active_versioned_names(cur, parent_commit_id)
+                delta_rows = [
+                    (commit_id, versioned_name, False) for versioned_name in active_versioned_names - parent_versioned_names
+                ] + [(commit_id, versioned_name, True) for versioned_name in parent_versioned_names - active_versioned_names]
             cur.execute(
-                f"insert into {AHG_CE_INPUT_TABLE} values (?, ?)",
-                (newest_ce.cell_num, vs.versioned_name()),
+                f"insert into {AHG_ACTIVE_VSES_COMMIT_TABLE} values (?, ?, ?, ?)",
+                (commit_id, parent_commit_id, keyframe_distance, newest_ce.cell_num),
             )
+            cur.executemany(f"insert into {AHG_ACTIVE_VSES_TABLE} values (?, ?, ?)", delta_rows)
 
-        # Store each CE to VS edge.
-        for vs in output_vss:
-            cur.execute(
-                f"insert into {AHG_CE_OUTPUT_TABLE} values (?, ?)",
-                (newest_ce.cell_num, vs.versioned_name()),
-            )
-
-        # Store active VSes.
-        for vs in active_vss:
-            cur.execute(
-                f"insert into {AHG_ACTIVE_VSES_TABLE} values (?, ?)",
-                (commit_id, vs.versioned_name()),
-            )
-
-        con.commit()
+            con.commit()
+            self._cache_active_versioned_names(commit_id, active_versioned_names)
+        finally:
+            con.close()
 
     def get_all_variable_snapshots(self) -> List[VariableSnapshot]:
         con = sqlite3.connect(self.database_path)
         cur = con.cursor()
-        cur.execute(f"select * from {AHG_VARIABLE_SNAPSHOT_TABLE}")
-        res: List = cur.fetchall()
-        return [VariableSnapshot.from_db_row(versioned_name, deleted, size) for versioned_name, deleted, size in res]
+        try:
+            cur.execute(f"select * from {AHG_VARIABLE_SNAPSHOT_TABLE}")
+            res: List = cur.fetchall()
+            return [VariableSnapshot.from_db_row(versioned_name, deleted, size) for versioned_name, deleted, size in res]
+        finally:
+            con.close()
 
     def get_all_cell_executions(self) -> List[CellExecution]:
         con = sqlite3.connect(self.database_path)
         cur = con.cursor()
-        cur.execute(f"select * from {AHG_CELL_EXECUTION_TABLE}")
-        res: List = cur.fetchall()
-        return [CellExecution(cell_num, cell, cell_runtime_s) for cell_num, cell, cell_runtime_s in res]
+        try:
+            cur.execute(f"select * from {AHG_CELL_EXECUTION_TABLE}")
+            res: List = cur.fetchall()
+            return [CellExecution(cell_num, cell, cell_runtime_s) for cell_num, cell, cell_runtime_s in res]
+        finally:
+            con.close()
+
+    def get_all_cell_execution_runtimes(self) -> List[Tuple[CellExecutionNumber, float]]:
+        """
+        Returns the cell number and runtime of every CE without loading their (potentially large) cell code.
+        """
+        con = sqlite3.connect(self.database_path)
+        cur = con.cursor()
+        try:
+            cur.execute(f"select cell_num, cell_runtime_s from {AHG_CELL_EXECUTION_TABLE} order by cell_num")
+            return cur.fetchall()
+        finally:
+            con.close()
+
+    def get_all_ce_input_edges(self) -> List[Tuple[CellExecutionNumber, str]]:
+        con = sqlite3.connect(self.database_path)
+        cur = con.cursor()
+        try:
+            cur.execute(f"select cell_num, versioned_name from {AHG_CE_INPUT_TABLE}")
+            return cur.fetchall()
+        finally:
+            con.close()
+
+    def get_all_ce_output_edges(self) -> List[Tuple[CellExecutionNumber, str]]:
+        con = sqlite3.connect(self.database_path)
+        cur = con.cursor()
+        try:
+            cur.execute(f"select cell_num, versioned_name from {AHG_CE_OUTPUT_TABLE}")
+            return cur.fetchall()
+        finally:
+            con.close()
+
+    def get_cells_by_cell_nums(self, cell_nums: List[CellExecutionNumber]) -> Dict[CellExecutionNumber, str]:
+        con = sqlite3.connect(self.database_path)
+        cur = con.cursor()
+        try:
+            cells: Dict[CellExecutionNumber, str] = {}
+            for i in range(0, len(cell_nums), MAX_QUERY_PARAMETERS):
+                chunk = cell_nums[i : i + MAX_QUERY_PARAMETERS]
+                cur.execute(
+                    f"select cell_num, cell from {AHG_CELL_EXECUTION_TABLE} WHERE cell_num IN (%s)"
+                    % ",".join("?" * len(chunk)),
+                    chunk,
+                )
+                cells.update(cur.fetchall())
+            return cells
+        finally:
+            con.close()
 
     def get_vs_by_versioned_names(self, versioned_names: List[str]) -> List[VariableSnapshot]:
         con = sqlite3.connect(self.database_path)
         cur = con.cursor()
-        cur.execute(
-            f"select * from {AHG_VARIABLE_SNAPSHOT_TABLE} WHERE versioned_name IN (%s)" % ",".join("?" * len(versioned_names)),
-            versioned_names,
-        )
-        res: List = cur.fetchall()
-        return [VariableSnapshot.from_db_row(versioned_name, deleted, size) for versioned_name, deleted, size in res]
+        try:
+            cur.execute(
+                f"select * from {AHG_VARIABLE_SNAPSHOT_TABLE} WHERE versioned_name IN (%s)"
+                % ",".join("?" * len(versioned_names)),
+                versioned_names,
+            )
+            res: List = cur.fetchall()
+            return [VariableSnapshot.from_db_row(versioned_name, deleted, size) for versioned_name, deleted, size in res]
+        finally:
+            con.close()
 
     def get_ce_by_cell_num(self, cell_num: CellExecutionNumber) -> CellExecution:
         con = sqlite3.connect(self.database_path)
         cur = con.cursor()
-        cur.execute(f"select * from {AHG_CELL_EXECUTION_TABLE} where cell_num = ?", (cell_num,))
-        res: tuple = cur.fetchone()
-        if not res:
-            raise ValueError(f"The CellExecution for cell number = {cell_num} was not found")
-        return CellExecution(res[0], res[1], res[2])
+        try:
+            cur.execute(f"select * from {AHG_CELL_EXECUTION_TABLE} where cell_num = ?", (cell_num,))
+            res: tuple = cur.fetchone()
+            if not res:
+                raise ValueError(f"The CellExecution for cell number = {cell_num} was not found")
+            return CellExecution(res[0], res[1], res[2])
+        finally:
+            con.close()
 
     def get_active_vses(self, commit_id: CommitId) -> List[VariableSnapshot]:
+        return self.get_vs_by_versioned_names(list(self.get_active_versioned_names(commit_id)))
+
+    def get_active_versioned_names(self, commit_id: CommitId) -> FrozenSet[str]:
         con = sqlite3.connect(self.database_path)
         cur = con.cursor()
-        cur.execute(f"select versioned_name from {AHG_ACTIVE_VSES_TABLE} where commit_id = ?", (commit_id,))
-        res: List = cur.fetchall()
-        return self.get_vs_by_versioned_names([i[0] for i in res])
+        try:
+            return self._get_active_versioned_names(cur, commit_id)
+        finally:
+            con.close()
 
     def get_vs_input_ce(self, vs: VariableSnapshot) -> CellExecution:
         con = sqlite3.connect(self.database_path)
         cur = con.cursor()
-        cur.execute(f"select cell_num from {AHG_CE_OUTPUT_TABLE} where versioned_name = ?", (vs.versioned_name(),))
-        res: tuple = cur.fetchone()
-        if not res:
-            raise ValueError(f"The (unique) CE creating VS with version = {vs.version} and name = {vs.name} not found")
-        return self.get_ce_by_cell_num(res[0])
+        try:
+            cur.execute(f"select cell_num from {AHG_CE_OUTPUT_TABLE} where versioned_name = ?", (vs.versioned_name(),))
+            res: tuple = cur.fetchone()
+            if not res:
+                raise ValueError(f"The (unique) CE creating VS with version = {vs.version} and name = {vs.name} not found")
+            return self.get_ce_by_cell_num(res[0])
+        finally:
+            con.close()
 
     def get_ce_input_vses(self, ce: CellExecution) -> List[VariableSnapshot]:
         con = sqlite3.connect(self.database_path)
         cur = con.cursor()
-        cur.execute(f"select versioned_name from {AHG_CE_INPUT_TABLE} where cell_num = ?", (ce.cell_num,))
-        res: List = cur.fetchall()
-        return self.get_vs_by_versioned_names([i[0] for i in res])
+        try:
+            cur.execute(f"select versioned_name from {AHG_CE_INPUT_TABLE} where cell_num = ?", (ce.cell_num,))
+            res: List = cur.fetchall()
+            return self.get_vs_by_versioned_names([i[0] for i in res])
+        finally:
+            con.close()
 
     def get_ce_output_vses(self, ce: CellExecution) -> List[VariableSnapshot]:
         con = sqlite3.connect(self.database_path)
         cur = con.cursor()
-        cur.execute(f"select versioned_name from {AHG_CE_OUTPUT_TABLE} where cell_num = ?", (ce.cell_num,))
-        res: List = cur.fetchall()
-        return self.get_vs_by_versioned_names([i[0] for i in res])
+        try:
+            cur.execute(f"select versioned_name from {AHG_CE_OUTPUT_TABLE} where cell_num = ?", (ce.cell_num,))
+            res: List = cur.fetchall()
+            return self.get_vs_by_versioned_names([i[0] for i in res])
+        finally:
+            con.close()
+
+    def _get_keyframe_distance(self, cur: sqlite3.Cursor, commit_id: CommitId) -> Optional[int]:
+        """
+        Returns the number of deltas between the commit's active VSes and its nearest keyframe, or None if the commit
+        has no stored active VSes.
+        """
+        cur.execute(f"select keyframe_distance from {AHG_ACTIVE_VSES_COMMIT_TABLE} where commit_id = ?", (commit_id,))
+        res: Optional[tuple] = cur.fetchone()
+        return res[0] if res else None
+
+    def _get_active_versioned_names(self, cur: sqlite3.Cursor, commit_id: CommitId) -> FrozenSet[str]:
+        """
+        Materializes the versioned names of the active VSes of a commit by applying the deltas along the chain from its
+        nearest keyframe. Stops early at the most recent commit on the chain with a cached active VS set.
+        """
+        cached = self._active_vses_cache.get(commit_id)
+        if cached is not None:
+            self._active_vses_cache.move_to_end(commit_id)
+            return cached
+
+        cur.execute(TRAVERSE_ACTIVE_VSES_CHAIN_SQL, (commit_id,))
+        chain_rows: List[Tuple[CommitId, int]] = cur.fetchall()
+        if chain_rows and chain_rows[0][1] > 0:
+            raise ValueError(
+                f"The active VSes of commit {commit_id} cannot be rebuilt: commit {chain_rows[0][0]} is stored as a delta"
+                " but its parent commit's active VSes were not found"
+            )
+        chain: List[CommitId] = [row[0] for row in chain_rows]
+
+        # Start from the latest cached commit on the chain, if any.
+        versioned_names: Set[str] = set()
+        for i in reversed(range(len(chain))):
+            if chain[i] in self._active_vses_cache:
+                versioned_names = set(self._active_vses_cache[chain[i]])
+                chain = chain[i + 1 :]
+                break
+
+        # Apply deltas in chain order.
+        delta_rows: List[Tuple[CommitId, str, bool]] = []
+        if chain:
+            cur.execute(
+                f"select commit_id, versioned_name, is_removed from {AHG_ACTIVE_VSES_TABLE} WHERE commit_id IN (%s)"
+                % ",".join("?" * len(chain)),
+                chain,
+            )
+            delta_rows = cur.fetchall()
+        deltas_by_commit_id: Dict[CommitId, Tuple[List[str], List[str]]] = {
+            chain_commit_id: ([], []) for chain_commit_id in chain
+        }
+        for delta_commit_id, versioned_name, is_removed in delta_rows:
+            deltas_by_commit_id[delta_commit_id][1 if is_removed else 0].append(versioned_name)
+        for chain_commit_id in chain:
+            added, removed = deltas_by_commit_id[chain_commit_id]
+            versioned_names.difference_update(removed)
+            versioned_names.update(added)
+
+        result = frozenset(versioned_names)
+        if chain:
+            self._cache_active_versioned_names(commit_id, result)
+        return result
+
+    def _cache_active_versioned_names(self, commit_id: CommitId, versioned_names: FrozenSet[str]) -> None:
+        self._active_vses_cache[commit_id] = versioned_names
+        self._active_vses_cache.move_to_end(commit_id)
+        while len(self._active_vses_cache) > ACTIVE_VSES_CACHE_SIZE:
+            self._active_vses_cache.popitem(last=False)
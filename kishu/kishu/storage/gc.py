@@ -0,0 +1,336 @@
+"""
+Garbage collection of commits unreachable from any branch, tag or HEAD.
+"""
+
+from __future__ import annotations
+
+import os
+import sqlite3
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, List, Set
+
+from dataclasses_json import dataclass_json
+
+from kishu.storage.blob_backend import DEFAULT_PACKFILE_MAX_SIZE, PACK_INDEX_TABLE, PackfileBlobBackend
+from kishu.storage.branch import BRANCH_TABLE, HEAD_BRANCH_TABLE
+from kishu.storage.buffer_store import BUFFER_REF_TABLE, KishuBufferStore
+from kishu.storage.checkpoint import CHECKPOINT_TABLE, PENDING_CHECKPOINT_TABLE, VARIABLE_SNAPSHOT_TABLE
+from kishu.storage.chunk_store import CHUNK_REF_TABLE, KishuChunkStore
+from kishu.storage.commit import COMMIT_ENTRY_TABLE
+from kishu.storage.commit_graph import (
+    ABSOLUTE_PAST,
+    COMMIT_PARENT_TABLE_SUFFIX,
+    HEAD_COMMIT_TABLE_SUFFIX,
+    NOTEBOOK_GRAPH_NAME,
+    VARIABLE_GRAPH_NAME,
+    CommitId,
+)
+from kishu.storage.config import Config
+from kishu.storage.disk_ahg import (
+    AHG_ACTIVE_VSES_COMMIT_TABLE,
+    AHG_ACTIVE_VSES_TABLE,
+    AHG_CE_INPUT_TABLE,
+    AHG_CE_OUTPUT_TABLE,
+    AHG_CELL_EXECUTION_TABLE,
+    AHG_VARIABLE_SNAPSHOT_TABLE,
+    CellExecutionNumber,
+    KishuDiskAHG,
+)
+from kishu.storage.tag import TAG_TABLE
+from kishu.storage.variable_version import COMMIT_VARIABLE_VERSION_TABLE, VARIABLE_VERSION_TABLE
+
+COMMIT_GRAPH_NAMES = [VARIABLE_GRAPH_NAME, NOTEBOOK_GRAPH_NAME]
+
+# Tables holding per-commit rows, and their commit ID column.
+COMMIT_ROW_TABLES = [
+    (COMMIT_ENTRY_TABLE, "commit_id"),
+    (CHECKPOINT_TABLE, "commit_id"),
+    (CHUNK_REF_TABLE, "commit_id"),
+    (BUFFER_REF_TABLE, "commit_id"),
+    (VARIABLE_SNAPSHOT_TABLE, "commit_id"),
+    (COMMIT_VARIABLE_VERSION_TABLE, "commit_id"),
+    (VARIABLE_VERSION_TABLE, "var_commit_id"),
+    (AHG_ACTIVE_VSES_TABLE, "commit_id"),
+    (AHG_ACTIVE_VSES_COMMIT_TABLE, "commit_id"),
+] + [(f"{graph_name}_{COMMIT_PARENT_TABLE_SUFFIX}", "commit_id") for graph_name in COMMIT_GRAPH_NAMES]
+
+# How long garbage collection waits for the kernel's writes to finish before giving up.
+GC_BUSY_TIMEOUT_S = 60.0
+
+# Number of free pages returned to the file system per incremental vacuum step. Each step is a separate write
+# transaction so that an attached kernel can write in between.
+INCREMENTAL_VACUUM_STEP_PAGES = 1024
+
+SQLITE_AUTO_VACUUM_INCREMENTAL = 2
+
+
+@dataclass_json
+@dataclass
+class GarbageCollectionStats:
+    """
+    Outcome of a garbage collection.
+
+    @param num_deleted_commits: number of unreachable commits deleted.
+    @param num_deleted_cell_executions: number of AHG cell executions deleted.
+    @param num_deleted_variable_snapshots: number of AHG variable snapshots deleted.
+    @param num_deleted_buffers: number of out-of-band buffer files deleted.
+    @param deleted_buffer_bytes: total size of the deleted buffer files.
+    @param num_deleted_packfiles: number of packfiles deleted by repacking.
+    @param reclaimed_packfile_bytes: number of bytes by which the packfiles shrank.
+    @param freed_bytes: size of database pages freed by the deletions.
+    @param reclaimed_bytes: number of bytes by which the database file shrank.
+    @param database_size_before: database file size in bytes before garbage collection.
+    @param database_size_after: database file size in bytes after garbage collection.
+    @param runtime_s: runtime of the garbage collection in seconds.
+    """
+
+    num_deleted_commits: int = 0
+    num_deleted_cell_executions: int = 0
+    num_deleted_variable_snapshots: int = 0
+    num_deleted_buffers: int = 0
+    deleted_buffer_bytes: int = 0
+    num_deleted_packfiles: int = 0
+    reclaimed_packfile_bytes: int = 0
+    freed_bytes: int = 0
+    reclaimed_bytes: int = 0
+    database_size_before: int = 0
+    database_size_after: int = 0
+    runtime_s: float = 0.0
+
+
+class KishuGarbageCollector:
+    """
+    Deletes the commits unreachable from branches, tags and HEADs together with their checkpoints, variable snapshots
+    (releasing deduplicated chunks and buffer files no other blob references) and AHG nodes no longer needed for restoring any
+    reachable commit, then repacks mostly dead packfiles and returns the freed space to the file system.
+
+    Deletions happen in a single write transaction, hence are atomic with respect to an attached kernel: any commit
+    made before it is considered for reachability, and any commit made after it only adds new reachable commits.
+    """
+
+    def __init__(self, database_path: Path):
+        self.database_path = database_path
+
+    @staticmethod
+    def init_database(database_path: Path) -> None:
+        """
+        Enables incremental vacuuming. Only takes effect when called on a new database, i.e., before creating tables.
+        """
+        con = sqlite3.connect(database_path)
+        con.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        con.close()
+
+    def collect(self, full_vacuum: bool = False) -> GarbageCollectionStats:
+        """
+        @param full_vacuum: rewrite the whole database with VACUUM instead of incrementally vacuuming. Databases created
+            before incremental vacuuming was enabled only shrink this way. VACUUM blocks writers for its duration.
+        """
+        start_time = time.time()
+        stats = GarbageCollectionStats(database_size_before=os.path.getsize(self.database_path))
+
+        con = sqlite3.connect(self.database_path, timeout=GC_BUSY_TIMEOUT_S, isolation_level=None)
+        try:
+            free_pages_before = self._count_free_pages(con)
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                self._delete_unreachable(con, stats)
+                if BUFFER_REF_TABLE in self._tables(con):
+                    stats.num_deleted_buffers, stats.deleted_buffer_bytes = KishuBufferStore(self.database_path).sweep(
+                        con.cursor()
+                    )
+                con.execute("COMMIT")
+            except BaseException:
+                con.execute("ROLLBACK")
+                raise
+            if PACK_INDEX_TABLE in self._tables(con):
+                self._repack(con, stats)
+            stats.freed_bytes = (self._count_free_pages(con) - free_pages_before) * self._page_size(con)
+
+            if full_vacuum:
+                con.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                con.execute("VACUUM")
+            elif con.execute("PRAGMA auto_vacuum").fetchone()[0] == SQLITE_AUTO_VACUUM_INCREMENTAL:
+                while self._count_free_pages(con) > 0:
+                    # Unlike execute, executescript steps the pragma to completion instead of freeing a single page.
+                    con.executescript(f"PRAGMA incremental_vacuum({INCREMENTAL_VACUUM_STEP_PAGES})")
+        finally:
+            con.close()
+
+        stats.database_size_after = os.path.getsize(self.database_path)
+        stats.reclaimed_bytes = stats.database_size_before - stats.database_size_after
+        stats.runtime_s = time.time() - start_time
+        return stats
+
+    def _delete_unreachable(self, con: sqlite3.Connection, stats: GarbageCollectionStats) -> None:
+        tables = self._tables(con)
+
+        # Find unreachable commits.
+        reachable_commit_ids = self._find_reachable_commit_ids(con, tables)
+        all_commit_ids: Set[CommitId] = set()
+        for table, column in COMMIT_ROW_TABLES:
+            if table in tables:
+                all_commit_ids.update(row[0] for row in con.execute(f"select distinct {column} from {table}"))
+        unreachable_commit_ids = all_commit_ids - reachable_commit_ids
+        if PENDING_CHECKPOINT_TABLE in tables:
+            # Commits whose checkpoints are being written are not stepped to yet.
+            unreachable_commit_ids -= {row[0] for row in con.execute(f"select commit_id from {PENDING_CHECKPOINT_TABLE}")}
+        stats.num_deleted_commits = len(unreachable_commit_ids)
+        if not unreachable_commit_ids:
+            return
+
+        # Delete their rows, remembering the CEs executed for them.
+        con.execute("create temp table if not exists gc_unreachable_commit (commit_id text primary key)")
+        con.execute("delete from temp.gc_unreachable_commit")
+        con.executemany(
+            "insert into temp.gc_unreachable_commit values (?)", [(commit_id,) for commit_id in unreachable_commit_ids]
+        )
+        # Commits migrated from databases predating cell numbers have none; the CEs run for them are kept.
+        unreachable_cell_nums: Set[CellExecutionNumber] = set()
+        if AHG_ACTIVE_VSES_COMMIT_TABLE in tables:
+            unreachable_cell_nums = {
+                row[0]
+                for row in con.execute(
+                    f"select cell_num from {AHG_ACTIVE_VSES_COMMIT_TABLE} "
+                    "where commit_id in (select commit_id from temp.gc_unreachable_commit) and cell_num is not null"
+                )
+            }
+        if CHUNK_REF_TABLE in tables:
+            KishuChunkStore.release(
+                con.cursor(),
+                (
+                    row[0]
+                    for row in con.execute(
+                        f"select digest from {CHUNK_REF_TABLE} "
+                        "where commit_id in (select commit_id from temp.gc_unreachable_commit)"
+                    )
+                ),
+            )
+        for table, column in COMMIT_ROW_TABLES:
+            if table in tables:
+                con.execute(f"delete from {table} where {column} in (select commit_id from temp.gc_unreachable_commit)")
+        con.execute("drop table temp.gc_unreachable_commit")
+
+        if AHG_CELL_EXECUTION_TABLE in tables and unreachable_cell_nums:
+            self._delete_unneeded_ahg_nodes(con, unreachable_cell_nums, stats)
+        # Caches of the AHG in attached kernels would not notice the deletions otherwise.
+        KishuDiskAHG.bump_generation(con.cursor())
+
+    def _repack(self, con: sqlite3.Connection, stats: GarbageCollectionStats) -> None:
+        backend = PackfileBlobBackend(
+            self.database_path, Config.get("PLANNER", "packfile_max_size", DEFAULT_PACKFILE_MAX_SIZE)
+        )
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            repack_stats, packfiles_to_delete = backend.repack(con.cursor())
+            con.execute("COMMIT")
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+        for path in packfiles_to_delete:
+            path.unlink()
+        stats.num_deleted_packfiles = repack_stats.num_deleted_packfiles
+        stats.reclaimed_packfile_bytes = repack_stats.reclaimed_bytes
+
+    def _find_reachable_commit_ids(self, con: sqlite3.Connection, tables: Set[str]) -> Set[CommitId]:
+        """
+        Returns all commits reachable from branches, tags and HEADs by following parent commits, including the parents
+        whose active VSes are delta-encoded against.
+        """
+        root_commit_ids: Set[CommitId] = set()
+        for table in [BRANCH_TABLE, HEAD_BRANCH_TABLE, TAG_TABLE] + [
+            f"{graph_name}_{HEAD_COMMIT_TABLE_SUFFIX}" for graph_name in COMMIT_GRAPH_NAMES
+        ]:
+            if table in tables:
+                root_commit_ids.update(row[0] for row in con.execute(f"select commit_id from {table}"))
+
+        parent_commit_ids: Dict[CommitId, Set[CommitId]] = defaultdict(set)
+        parent_tables = [(f"{graph_name}_{COMMIT_PARENT_TABLE_SUFFIX}", "parent_id") for graph_name in COMMIT_GRAPH_NAMES]
+        parent_tables.append((AHG_ACTIVE_VSES_COMMIT_TABLE, "parent_commit_id"))
+        for table, parent_column in parent_tables:
+            if table in tables:
+                for commit_id, parent_commit_id in con.execute(f"select commit_id, {parent_column} from {table}"):
+                    parent_commit_ids[commit_id].add(parent_commit_id)
+
+        reachable_commit_ids: Set[CommitId] = set()
+        stack: List[CommitId] = [commit_id for commit_id in root_commit_ids if commit_id not in (None, ABSOLUTE_PAST)]
+        while stack:
+            commit_id = stack.pop()
+            if commit_id in reachable_commit_ids:
+                continue
+            reachable_commit_ids.add(commit_id)
+            stack.extend(
+                parent_commit_id
+                for parent_commit_id in parent_commit_ids[commit_id]
+                if parent_commit_id not in (None, ABSOLUTE_PAST) and parent_commit_id not in reachable_commit_ids
+            )
+        return reachable_commit_ids
+
+    def _delete_unneeded_ahg_nodes(
+        self, con: sqlite3.Connection, unreachable_cell_nums: Set[CellExecutionNumber], stats: GarbageCollectionStats
+    ) -> None:
+        """
+        Deletes the CEs executed for deleted commits, and the VSes they created, unless still needed: restoring a
+        remaining commit may rerun the CEs which (transitively) created its active VSes.
+        """
+        all_cell_nums = {row[0] for row in con.execute(f"select cell_num from {AHG_CELL_EXECUTION_TABLE}")}
+        input_versioned_names: Dict[CellExecutionNumber, List[str]] = defaultdict(list)
+        for cell_num, versioned_name in con.execute(f"select cell_num, versioned_name from {AHG_CE_INPUT_TABLE}"):
+            input_versioned_names[cell_num].append(versioned_name)
+        creating_cell_num: Dict[str, CellExecutionNumber] = {
+            versioned_name: cell_num
+            for cell_num, versioned_name in con.execute(f"select cell_num, versioned_name from {AHG_CE_OUTPUT_TABLE}")
+        }
+
+        # Transitively find the CEs creating the VSes needed by the remaining CEs and commits.
+        needed_cell_nums: Set[CellExecutionNumber] = set()
+        stack = list(all_cell_nums - unreachable_cell_nums) + self._creating_cell_nums(
+            (
+                row[0]
+                for row in con.execute(f"select distinct versioned_name from {AHG_ACTIVE_VSES_TABLE} where is_removed = 0")
+            ),
+            creating_cell_num,
+        )
+        while stack:
+            cell_num = stack.pop()
+            if cell_num in needed_cell_nums:
+                continue
+            needed_cell_nums.add(cell_num)
+            stack.extend(self._creating_cell_nums(input_versioned_names[cell_num], creating_cell_num))
+
+        # Delete the unneeded CEs along with the VSes they created.
+        con.execute("create temp table if not exists gc_unneeded_ce (cell_num int primary key)")
+        con.execute("delete from temp.gc_unneeded_ce")
+        con.executemany(
+            "insert into temp.gc_unneeded_ce values (?)", [(cell_num,) for cell_num in all_cell_nums - needed_cell_nums]
+        )
+        stats.num_deleted_cell_executions = con.execute(
+            f"delete from {AHG_CELL_EXECUTION_TABLE} where cell_num in (select cell_num from temp.gc_unneeded_ce)"
+        ).rowcount
+        stats.num_deleted_variable_snapshots = con.execute(
+            f"delete from {AHG_VARIABLE_SNAPSHOT_TABLE} where versioned_name in "
+            f"(select versioned_name from {AHG_CE_OUTPUT_TABLE} where cell_num in (select cell_num from temp.gc_unneeded_ce))"
+        ).rowcount
+        for table in (AHG_CE_INPUT_TABLE, AHG_CE_OUTPUT_TABLE):
+            con.execute(f"delete from {table} where cell_num in (select cell_num from temp.gc_unneeded_ce)")
+        con.execute("drop table temp.gc_unneeded_ce")
+
+    @staticmethod
+    def _creating_cell_nums(
+        versioned_names: Iterable[str], creating_cell_num: Dict[str, CellExecutionNumber]
+    ) -> List[CellExecutionNumber]:
+        return [creating_cell_num[name] for name in versioned_names if name in creating_cell_num]
+
+    @staticmethod
+    def _tables(con: sqlite3.Connection) -> Set[str]:
+        return {row[0] for row in con.execute("select name from sqlite_master where type = 'table'")}
+
+    @staticmethod
+    def _count_free_pages(con: sqlite3.Connection) -> int:
+        return con.execute("PRAGMA freelist_count").fetchone()[0]
+
+    @staticmethod
+    def _page_size(con: sqlite3.Connection) -> int:
+        return con.execute("PRAGMA page_size").fetchone()[0]
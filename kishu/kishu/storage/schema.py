@@ -0,0 +1,40 @@
+"""
+Versions of the table layouts in a Kishu database, for migrating databases written by older Kishu versions.
+"""
+
+from __future__ import annotations
+
+import sqlite3
+from typing import List, Optional
+
+SCHEMA_VERSION_TABLE = "schema_version"
+
+
+def get_schema_version(cur: sqlite3.Cursor, component: str) -> Optional[int]:
+    """
+    Returns the recorded layout version of a component's tables, or None if none is recorded. Databases written before
+    versions were recorded have none.
+    """
+    cur.execute(f"create table if not exists {SCHEMA_VERSION_TABLE} (component text primary key, version int)")
+    cur.execute(f"select version from {SCHEMA_VERSION_TABLE} where component = ?", (component,))
+    res: Optional[tuple] = cur.fetchone()
+    return res[0] if res else None
+
+
+def set_schema_version(cur: sqlite3.Cursor, component: str, version: int) -> None:
+    cur.execute(f"create table if not exists {SCHEMA_VERSION_TABLE} (component text primary key, version int)")
+    cur.execute(f"insert or replace into {SCHEMA_VERSION_TABLE} values (?, ?)", (component, version))
+
+
+def drop_schema_version(cur: sqlite3.Cursor, component: str) -> None:
+    cur.execute(f"create table if not exists {SCHEMA_VERSION_TABLE} (component text primary key, version int)")
+    cur.execute(f"delete from {SCHEMA_VERSION_TABLE} where component = ?", (component,))
+
+
+def table_columns(cur: sqlite3.Cursor, table: str) -> Optional[List[str]]:
+    """
+    Returns the column names of a table, or None if the table does not exist.
+    """
+    cur.execute(f"pragma table_info({table})")
+    columns = [row[1] for row in cur.fetchall()]
+    return columns if columns else None
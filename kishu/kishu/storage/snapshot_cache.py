@@ -0,0 +1,207 @@
+"""
+Process-wide in-memory caches of variable snapshot blobs, shared by all checkpoints reading the same database.
+"""
+
+from __future__ import annotations
+
+import io
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import ClassVar, Optional, Tuple
+
+from kishu.storage.codec import BlobCodec, fastest_available_codec
+from kishu.storage.config import Config
+
+# Default total size in bytes of the cached blobs per database.
+DEFAULT_SNAPSHOT_CACHE_SIZE = 1 << 27
+
+# Maximum number of databases with caches kept alive in a process.
+MAX_CACHED_DATABASES = 16
+
+
+@dataclass
+class SnapshotCacheStats:
+    """
+    Counters of a SnapshotCache.
+
+    @param hits: number of variable snapshots read from the cache.
+    @param misses: number of variable snapshots read from the database.
+    @param evictions: number of blobs evicted to stay within the size bound.
+    @param invalidations: number of times the cache was cleared due to changes made to the database.
+    """
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    invalidations: int = 0
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class SnapshotCache:
+    """
+    A size-bounded LRU cache of the pickles of variable snapshots, keyed by their versioned names, for a database.
+    Blobs are added as they are written or read, optionally compressed by the fastest available codec.
+
+    A versioned name always refers to the same pickle. The cache is cleared if the database file is replaced, and
+    after garbage collection, which may delete the buffer files referenced by the pickles.
+    """
+
+    _caches: ClassVar[OrderedDict[str, SnapshotCache]] = OrderedDict()
+    _caches_lock: ClassVar[threading.Lock] = threading.Lock()
+
+    def __init__(self, max_size: int = DEFAULT_SNAPSHOT_CACHE_SIZE, compress: bool = False) -> None:
+        """
+        @param max_size: total size in bytes of the cached blobs. 0 disables the cache.
+        @param compress: whether to compress the cached blobs, trading decompression time for memory.
+        """
+        self.max_size = max_size
+        self.stats = SnapshotCacheStats()
+
+        self._codec = BlobCodec(fastest_available_codec(), fastest_available_codec().default_level) if compress else None
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, bytes] = OrderedDict()
+        self._size = 0
+        self._file_id: Optional[Tuple[int, int]] = None
+
+    @staticmethod
+    def for_database(database_path: Path) -> SnapshotCache:
+        """
+        Returns the process-wide cache of the database, creating it if needed.
+        """
+        key = str(database_path)
+        with SnapshotCache._caches_lock:
+            cache = SnapshotCache._caches.get(key)
+            if cache is None:
+                cache = SnapshotCache(
+                    Config.get("PLANNER", "snapshot_cache_size", DEFAULT_SNAPSHOT_CACHE_SIZE),
+                    Config.get("PLANNER", "snapshot_cache_compression", False),
+                )
+                SnapshotCache._caches[key] = cache
+                while len(SnapshotCache._caches) > MAX_CACHED_DATABASES:
+                    SnapshotCache._caches.popitem(last=False)
+            SnapshotCache._caches.move_to_end(key)
+        cache._validate(database_path)
+        return cache
+
+    @staticmethod
+    def invalidate(database_path: Path) -> None:
+        """
+        Clears the process-wide cache of the database, if any. Called after destructive changes to the database.
+        """
+        with SnapshotCache._caches_lock:
+            cache = SnapshotCache._caches.get(str(database_path))
+        if cache is not None:
+            cache.clear()
+
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def size(self) -> int:
+        return self._size
+
+    def get(self, versioned_name: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._entries.get(versioned_name)
+            if data is None:
+                self.stats.misses += 1
+                return None
+            self.stats.hits += 1
+            self._entries.move_to_end(versioned_name)
+        return BlobCodec.decode(data) if self._codec is not None else data
+
+    def put(self, versioned_name: str, data: bytes) -> None:
+        if self._codec is not None:
+            data = self._codec.encode(data)
+        if len(data) > self.max_size:
+            return
+        with self._lock:
+            previous_data = self._entries.pop(versioned_name, None)
+            if previous_data is not None:
+                self._size -= len(previous_data)
+            self._entries[versioned_name] = data
+            self._size += len(data)
+            while self._size > self.max_size:
+                _, evicted_data = self._entries.popitem(last=False)
+                self._size -= len(evicted_data)
+                self.stats.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            if self._entries:
+                self.stats.invalidations += 1
+            self._entries.clear()
+            self._size = 0
+
+    def _validate(self, database_path: Path) -> None:
+        try:
+            stat = os.stat(database_path)
+            file_id: Optional[Tuple[int, int]] = (stat.st_dev, stat.st_ino)
+        except FileNotFoundError:
+            file_id = None
+        if file_id != self._file_id:
+            # The database is created after the first checkpoints are constructed.
+            if self._file_id is not None:
+                self.clear()
+            self._file_id = file_id
+
+
+class CachingWriter(io.RawIOBase):
+    """
+    Writes to a file, keeping a copy of the written bytes unless they exceed max_size.
+    """
+
+    def __init__(self, file: io.RawIOBase, max_size: int) -> None:
+        super().__init__()
+        self._file = file
+        self._max_size = max_size
+        self._copy: Optional[bytearray] = bytearray()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:  # type: ignore
+        if self._copy is not None:
+            self._copy += data
+            if len(self._copy) > self._max_size:
+                self._copy = None
+        return self._file.write(data)  # type: ignore
+
+    def data(self) -> Optional[bytes]:
+        return bytes(self._copy) if self._copy is not None else None
+
+
+class CachingReader(io.RawIOBase):
+    """
+    Reads from a file, keeping a copy of the read bytes unless they exceed max_size.
+    """
+
+    def __init__(self, file: io.RawIOBase, max_size: int) -> None:
+        super().__init__()
+        self._file = file
+        self._max_size = max_size
+        self._copy: Optional[bytearray] = bytearray()
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:  # type: ignore
+        num_bytes = self._file.readinto(buffer)
+        if self._copy is not None and num_bytes:
+            self._copy += memoryview(buffer).cast("B")[:num_bytes]
+            if len(self._copy) > self._max_size:
+                self._copy = None
+        return num_bytes  # type: ignore
+
+    def data(self) -> Optional[bytes]:
+        """
+        Returns the whole file, reading what is left of it, unless it exceeds max_size.
+        """
+        while self._copy is not None and self.read(io.DEFAULT_BUFFER_SIZE):
+            pass
+        return bytes(self._copy) if self._copy is not None else None
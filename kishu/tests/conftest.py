@@ -273,6 +273,22 @@ def kishu_jupyter(tmp_kishu_path, notebook_key, set_notebook_path_env) -> Genera
     yield kishu_jupyter
 
 
+@pytest.fixture()
+def kishu_shell(tmp_kishu_path, notebook_key) -> Callable[..., InteractiveShell]:
+    """
+    Returns a function creating a shell with Kishu's hooks installed, after setting the given PLANNER options.
+    """
+
+    def _kishu_shell(**planner_options: Any) -> InteractiveShell:
+        for option, value in planner_options.items():
+            Config.set("PLANNER", option, value)
+        ip = InteractiveShell()
+        KishuForJupyter(notebook_id=NotebookId.from_enclosing_with_key(notebook_key), ip=ip).install_kishu_hooks()
+        return ip
+
+    return _kishu_shell
+
+
 @pytest.fixture()
 def basic_notebook(kishu_jupyter, set_notebook_path_env) -> Generator[str, None, None]:
     yield set_notebook_path_env
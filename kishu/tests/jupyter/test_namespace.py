@@ -1,7 +1,7 @@
 import pytest
 from IPython.core.interactiveshell import InteractiveShell
 
-from kishu.jupyter.namespace import Namespace
+from kishu.jupyter.namespace import LazyVariable, Namespace
 
 
 @pytest.fixture()
@@ -23,6 +23,78 @@ def patched_shell(shell, namespace):
     return shell
 
 
+def test_lazy_variables(namespace, patched_shell):
+    loads = []
+
+    def loader():
+        loads.append(1)
+        return {"x": [1, 2], "y": 3}
+
+    namespace.update(Namespace({"x": LazyVariable("x", loader), "y": LazyVariable("y", loader)}))
+    loaded_callbacks = []
+    namespace.set_load_callback(loaded_callbacks.append)
+    assert namespace.lazy_vars() == {"x", "y"}
+
+    # Accessing a lazy variable loads the variables loaded with it without accessing them.
+    patched_shell.run_cell("z = len(x)")
+    assert namespace["z"] == 2
+    assert namespace.lazy_vars() == set()
+    assert "x" in namespace.accessed_vars() and "y" not in namespace.accessed_vars()
+    assert loaded_callbacks == [{"x": [1, 2], "y": 3}]
+
+    # Functions access lazy variables as globals.
+    namespace.update(Namespace({"y": LazyVariable("y", loader)}))
+    patched_shell.run_cell("def f():\n    return y\nw = f()")
+    assert namespace["w"] == 3
+    assert loads == [1, 1]
+
+
+def test_lazy_variables_reassigned(namespace, patched_shell):
+    def loader():
+        return {"x": 1, "y": 2}
+
+    namespace.update(Namespace({"x": LazyVariable("x", loader), "y": LazyVariable("y", loader)}))
+    patched_shell.run_cell("x = 10")
+    patched_shell.run_cell("z = y")
+    assert namespace["x"] == 10
+    assert namespace["z"] == 2
+
+
+def test_lazy_variables_iterated(namespace, patched_shell):
+    def loader():
+        return {"x": [1, 2], "y": 3}
+
+    for cell in [
+        "values = list(globals().values())",
+        "values = [value for _, value in globals().items()]",
+        "values = list(dict(globals()).values())",
+        "values = list(vars().values())",
+        "values = [globals().pop('x'), globals().pop('y')]",
+    ]:
+        namespace.update(Namespace({"x": LazyVariable("x", loader), "y": LazyVariable("y", loader)}))
+
+        # Listing variables does not load them.
+        assert namespace.keyset() >= {"x", "y"}
+        assert namespace.lazy_vars() == {"x", "y"}
+
+        # Iterating over globals from user code never returns placeholders.
+        patched_shell.run_cell(cell)
+        assert not any(type(value) is LazyVariable for value in namespace["values"])
+        assert [1, 2] in namespace["values"] and 3 in namespace["values"]
+
+
+def test_lazy_variables_to_dict(namespace):
+    def loader():
+        return {"x": [1, 2], "y": 3}
+
+    namespace.update(Namespace({"x": LazyVariable("x", loader), "y": LazyVariable("y", loader)}))
+    assert set(namespace.to_raw_dict().keys()) == {"x", "y"}
+    assert namespace.lazy_vars() == {"x", "y"}
+    assert namespace == Namespace({"x": [1, 2], "y": 3})
+    assert namespace.to_dict() == {"x": [1, 2], "y": 3}
+    assert namespace.lazy_vars() == set()
+
+
 def test_find_input_vars(namespace, patched_shell):
     patched_shell.run_cell("x = 1")
     patched_shell.run_cell("y = x")
@@ -361,3 +361,37 @@ def test_active_vses_different_commits(self, kishu_disk_ahg):
 
         # State of active VSes after 2st cell execution: x and z are active
         assert set(vs.name for vs in ahg.get_active_variable_snapshots("1:2")) == {frozenset("x"), frozenset("z")}
+
+    def test_get_equivalent_ces(self, kishu_disk_ahg):
+        ahg = AHG(kishu_disk_ahg)
+
+        namespace = Namespace({"x": 1})
+        ahg.update_graph(
+            AHGUpdateInfo(
+                parent_commit_id=ABSOLUTE_PAST,
+                commit_id="1:1",
+                user_ns=namespace,
+                cell="x = 1",
+                version=1,
+                current_variables={"x"},
+            )
+        )
+
+        # Cells 2 and 3 run the same code on x from the same commit; cell 4 runs other code.
+        for cell_num, cell in [(2, "y = x + 1"), (3, "y = x + 1"), (4, "y = x + 2")]:
+            namespace["y"] = 2
+            ahg.update_graph(
+                AHGUpdateInfo(
+                    parent_commit_id="1:1",
+                    commit_id=f"1:{cell_num}",
+                    user_ns=namespace,
+                    cell=cell,
+                    version=cell_num,
+                    accessed_variables={"x"},
+                    current_variables={"x", "y"},
+                )
+            )
+
+        assert [ce.cell_num for ce in ahg.get_equivalent_ces(ahg.get_ce_by_cell_num(3))] == [2]
+        assert [ce.cell_num for ce in AHG(kishu_disk_ahg).get_equivalent_ces(ahg.get_ce_by_cell_num(2))] == [3]
+        assert ahg.get_equivalent_ces(ahg.get_ce_by_cell_num(4)) == []
@@ -0,0 +1,148 @@
+import sqlite3
+
+import pytest
+
+from kishu.jupyter.namespace import Namespace
+from kishu.planning.ahg import AHG, AHGUpdateInfo
+from kishu.planning.ahg_cache import AHGCache
+from kishu.storage.disk_ahg import AHG_CELL_EXECUTION_TABLE, AHGUpdateResult, CellExecution, KishuDiskAHG, VariableSnapshot
+from kishu.storage.path import KishuPath
+
+
+class TestAHGCache:
+    @pytest.fixture
+    def db_path_name(self, nb_simple_path):
+        return KishuPath.database_path(nb_simple_path)
+
+    @pytest.fixture
+    def kishu_disk_ahg(self, db_path_name):
+        """Fixture for initializing a KishuDiskAHG instance with 2 cell executions."""
+        kishu_disk_ahg = KishuDiskAHG(db_path_name)
+        kishu_disk_ahg.init_database()
+        vs_x = VariableSnapshot(frozenset("x"), 1)
+        vs_y = VariableSnapshot(frozenset("y"), 2)
+        kishu_disk_ahg.store_update_results(AHGUpdateResult("1:1", [], [vs_x], CellExecution(1, "x = 1"), [vs_x]))
+        kishu_disk_ahg.store_update_results(
+            AHGUpdateResult("1:2", [vs_x], [vs_y], CellExecution(2, "y = x + 1"), [vs_x, vs_y], "1:1")
+        )
+        yield kishu_disk_ahg
+        kishu_disk_ahg.drop_database()
+
+    def test_shared_across_ahgs(self, kishu_disk_ahg):
+        ahg = AHG(kishu_disk_ahg)
+        stats = ahg.get_cache_stats()
+        hits, misses = stats.hits, stats.misses
+
+        assert {vs.version for vs in ahg.get_active_variable_snapshots("1:2")} == {1, 2}
+        assert (stats.hits, stats.misses) == (hits, misses + 1)
+
+        # Another AHG on the same database reuses the results.
+        other_ahg = AHG(KishuDiskAHG(kishu_disk_ahg.database_path))
+        assert other_ahg.get_active_variable_snapshots("1:2") == ahg.get_active_variable_snapshots("1:2")
+        assert other_ahg.get_snapshot() is ahg.get_snapshot()
+        assert (stats.hits, stats.misses) == (hits + 2, misses + 1)
+
+    def test_bounded(self, kishu_disk_ahg):
+        cache = AHGCache(kishu_disk_ahg.database_path, max_size=2)
+        for key in ["a", "b", "c"]:
+            cache.get(key, lambda: key)
+
+        assert cache.stats.evictions == 1
+        assert cache.get("c", lambda: "") == "c"
+        assert cache.get("a", lambda: "recomputed") == "recomputed"
+        assert (cache.stats.hits, cache.stats.misses) == (1, 4)
+
+    def test_unrelated_write_keeps_cache(self, kishu_disk_ahg):
+        ahg = AHG(kishu_disk_ahg)
+        ahg.get_active_variable_snapshots("1:2")
+        snapshot = ahg.get_snapshot()
+
+        # Writes to other tables of the database do not affect the AHG.
+        con = sqlite3.connect(kishu_disk_ahg.database_path)
+        con.execute("create table unrelated (x int)")
+        con.execute("insert into unrelated values (1)")
+        con.commit()
+        con.close()
+
+        hits = ahg.get_cache_stats().hits
+        ahg.get_active_variable_snapshots("1:2")
+        assert ahg.get_cache_stats().hits == hits + 1
+        assert ahg.get_snapshot() is snapshot
+
+    def test_update_graph_keeps_cache(self, kishu_disk_ahg):
+        ahg = AHG(kishu_disk_ahg)
+        ahg.get_active_variable_snapshots("1:2")
+        invalidations = ahg.get_cache_stats().invalidations
+
+        ahg.update_graph(
+            AHGUpdateInfo(
+                parent_commit_id="1:2",
+                commit_id="1:3",
+                user_ns=Namespace({"x": 1, "y": 2, "z": 3}),
+                version=3,
+                accessed_variables={"y"},
+                current_variables={"x", "y", "z"},
+            )
+        )
+
+        # The new cell execution is applied to the cached snapshot in place.
+        assert ahg.get_cache_stats().invalidations == invalidations
+        assert {vs.version for vs in ahg.get_active_variable_snapshots("1:3")} == {1, 2, 3}
+        assert {ce.cell_num for ce in ahg.get_all_cell_executions()} == {1, 2, 3}
+
+    def test_invalidated_by_other_connection(self, kishu_disk_ahg):
+        ahg = AHG(kishu_disk_ahg)
+        assert len(ahg.get_all_cell_executions()) == 2
+
+        # Another connection deletes a cell execution.
+        con = sqlite3.connect(kishu_disk_ahg.database_path)
+        con.execute(f"delete from {AHG_CELL_EXECUTION_TABLE} where cell_num = 2")
+        con.commit()
+        con.close()
+
+        invalidations = ahg.get_cache_stats().invalidations
+        assert {ce.cell_num for ce in ahg.get_all_cell_executions()} == {1}
+        assert ahg.get_cache_stats().invalidations == invalidations + 1
+
+    def test_invalidated_by_generation(self, kishu_disk_ahg):
+        ahg = AHG(kishu_disk_ahg)
+        assert len(ahg.get_all_cell_executions()) == 2
+
+        # Deleting other than the latest nodes, e.g., by garbage collection, bumps the generation.
+        con = sqlite3.connect(kishu_disk_ahg.database_path)
+        con.execute(f"delete from {AHG_CELL_EXECUTION_TABLE} where cell_num = 1")
+        KishuDiskAHG.bump_generation(con.cursor())
+        con.commit()
+        con.close()
+
+        assert {ce.cell_num for ce in ahg.get_all_cell_executions()} == {2}
+
+    def test_note_append_after_other_append(self, kishu_disk_ahg):
+        cache = AHGCache(kishu_disk_ahg.database_path)
+        cache.get_snapshot()
+
+        # Another writer appends between validating the cache and this append.
+        vs_z = VariableSnapshot(frozenset("z"), 3)
+        vs_w = VariableSnapshot(frozenset("w"), 4)
+        KishuDiskAHG(kishu_disk_ahg.database_path).store_update_results(
+            AHGUpdateResult("2:3", [], [vs_z], CellExecution(3, "z = 3"), [vs_z])
+        )
+        kishu_disk_ahg.store_update_results(AHGUpdateResult("1:4", [], [vs_w], CellExecution(4, "w = 4"), [vs_w]))
+        cache.note_append()
+
+        assert cache.stats.invalidations == 1
+        assert cache.get_snapshot().num_ces() == 4
+
+    def test_validate_once_per_lookup(self, kishu_disk_ahg, monkeypatch):
+        cache = AHGCache(kishu_disk_ahg.database_path)
+        num_validations = 0
+        validate = cache._validate
+
+        def counting_validate():
+            nonlocal num_validations
+            num_validations += 1
+            validate()
+
+        monkeypatch.setattr(cache, "_validate", counting_validate)
+        assert cache.get("outer", lambda: cache.get("inner", lambda: cache.get_snapshot().num_ces())) == 2
+        assert num_validations == 1
@@ -0,0 +1,88 @@
+from unittest.mock import patch
+
+import pytest
+
+from kishu.planning.ahg_snapshot import AHGSnapshot
+from kishu.storage.disk_ahg import AHGUpdateResult, CellExecution, KishuDiskAHG, VariableSnapshot
+from kishu.storage.path import KishuPath
+
+
+class TestAHGSnapshot:
+    @pytest.fixture
+    def db_path_name(self, nb_simple_path):
+        return KishuPath.database_path(nb_simple_path)
+
+    @pytest.fixture
+    def kishu_disk_ahg(self, db_path_name):
+        """Fixture for initializing a KishuDiskAHG instance."""
+        kishu_disk_ahg = KishuDiskAHG(db_path_name)
+        kishu_disk_ahg.init_database()
+        yield kishu_disk_ahg
+        kishu_disk_ahg.drop_database()
+
+    @pytest.fixture
+    def update_results(self):
+        vs_x = VariableSnapshot(frozenset("x"), 1)
+        vs_y = VariableSnapshot(frozenset("y"), 2)
+        vs_z = VariableSnapshot(frozenset("z"), 3)
+        vs_x_deleted = VariableSnapshot(frozenset("x"), 3, deleted=True)
+        return [
+            AHGUpdateResult("1:1", [], [vs_x], CellExecution(1, "x = 1", 3.0), [vs_x]),
+            AHGUpdateResult("1:2", [vs_x], [vs_y], CellExecution(2, "y = x + 1", 0.1), [vs_x, vs_y], "1:1"),
+            AHGUpdateResult(
+                "1:3", [vs_x, vs_y], [vs_x_deleted, vs_z], CellExecution(3, "z = x + y\ndel x", 0.2), [vs_y, vs_z], "1:2"
+            ),
+        ]
+
+    def assert_snapshot_matches(self, snapshot, update_results):
+        assert snapshot.num_ces() == len(update_results)
+        for update_result in update_results:
+            ce_idx = snapshot.ce_index_by_cell_num(update_result.newest_ce.cell_num)
+            assert snapshot.get_ce(ce_idx) == update_result.newest_ce
+            assert {snapshot.vss[vs_idx] for vs_idx in snapshot.input_vses_of(ce_idx)} == set(update_result.accessed_vss)
+            assert {snapshot.vss[vs_idx] for vs_idx in snapshot.output_vses_of(ce_idx)} == set(update_result.output_vss)
+            for vs in update_result.output_vss:
+                assert snapshot.input_ce_of(snapshot.vs_index[vs.versioned_name()]) == ce_idx
+
+    def test_from_db(self, kishu_disk_ahg, update_results):
+        for update_result in update_results:
+            kishu_disk_ahg.store_update_results(update_result)
+
+        self.assert_snapshot_matches(AHGSnapshot.from_db(kishu_disk_ahg), update_results)
+
+    def test_update(self, kishu_disk_ahg, update_results):
+        kishu_disk_ahg.store_update_results(update_results[0])
+        snapshot = AHGSnapshot.from_db(kishu_disk_ahg)
+
+        # The snapshot is appended to without reading back from the database.
+        with patch.object(KishuDiskAHG, "get_cells_by_cell_nums") as get_cells_by_cell_nums:
+            for update_result in update_results[1:]:
+                kishu_disk_ahg.store_update_results(update_result)
+                snapshot.update(update_result)
+            assert snapshot.get_ces(range(1, 3)) == [update_results[1].newest_ce, update_results[2].newest_ce]
+            get_cells_by_cell_nums.assert_not_called()
+
+        self.assert_snapshot_matches(snapshot, update_results)
+
+    def test_lazy_cell_code(self, kishu_disk_ahg, update_results):
+        for update_result in update_results:
+            kishu_disk_ahg.store_update_results(update_result)
+        snapshot = AHGSnapshot.from_db(kishu_disk_ahg)
+
+        # Cell code is loaded in one query for only the requested CEs, then reused.
+        with patch.object(
+            KishuDiskAHG, "get_cells_by_cell_nums", wraps=kishu_disk_ahg.get_cells_by_cell_nums
+        ) as get_cells_by_cell_nums:
+            assert [ce.cell for ce in snapshot.get_ces([0, 2])] == ["x = 1", "z = x + y\ndel x"]
+            get_cells_by_cell_nums.assert_called_once()
+            assert set(get_cells_by_cell_nums.call_args.args[0]) == {1, 3}
+
+            snapshot.get_ces([0, 2])
+            get_cells_by_cell_nums.assert_called_once()
+
+    def test_missing_nodes(self, kishu_disk_ahg):
+        snapshot = AHGSnapshot.from_db(kishu_disk_ahg)
+
+        with pytest.raises(ValueError):
+            snapshot.ce_index_by_cell_num(1)
+        assert snapshot.vs_indices(["1,x"]) == []
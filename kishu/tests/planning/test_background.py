@@ -0,0 +1,167 @@
+import os
+import time
+from pathlib import Path
+
+import pytest
+
+from kishu.exceptions import CheckpointPendingError
+from kishu.jupyter.namespace import Namespace
+from kishu.planning.background import BackgroundCheckpointer, BackgroundCheckpointStatus
+from kishu.storage.checkpoint import KishuCheckpoint
+from kishu.storage.config import Config
+
+
+class WriteFileCheckpointPlan:
+    """
+    Writes the namespace's x to a file after a delay, standing in for a checkpoint plan.
+    """
+
+    def __init__(self, path: Path, delay_s: float = 0.0, fail: bool = False) -> None:
+        self.path = path
+        self.delay_s = delay_s
+        self.fail = fail
+
+    def run(self, user_ns: Namespace) -> None:
+        time.sleep(self.delay_s)
+        if self.fail:
+            raise ValueError("Failed to checkpoint")
+        self.path.write_text(str(user_ns["x"]))
+
+
+class TestBackgroundCheckpointer:
+    def test_disabled(self, tmp_path):
+        checkpointer = BackgroundCheckpointer(enabled=False)
+        checkpointer.submit("1", WriteFileCheckpointPlan(tmp_path / "1"), Namespace({"x": 1}))
+        assert (tmp_path / "1").read_text() == "1"
+        assert checkpointer.statuses["1"] == BackgroundCheckpointStatus.done
+
+    def test_bounded_statuses(self, tmp_path, monkeypatch):
+        monkeypatch.setattr("kishu.planning.background.MAX_TRACKED_STATUSES", 2)
+        checkpointer = BackgroundCheckpointer(enabled=False)
+        for commit_id in ["1", "2", "3"]:
+            checkpointer.submit(commit_id, WriteFileCheckpointPlan(tmp_path / commit_id), Namespace({"x": 1}))
+        assert list(checkpointer.statuses) == ["2", "3"]
+
+    def test_snapshot_at_submission(self, tmp_path):
+        checkpointer = BackgroundCheckpointer(enabled=True)
+        user_ns = Namespace({"x": [1]})
+        checkpointer.submit("1", WriteFileCheckpointPlan(tmp_path / "1", delay_s=0.2), user_ns)
+        assert checkpointer.statuses["1"] == BackgroundCheckpointStatus.running
+
+        # The child checkpoints the namespace as of submission.
+        user_ns["x"].append(2)
+        checkpointer.wait()
+        assert (tmp_path / "1").read_text() == "[1]"
+        assert checkpointer.statuses["1"] == BackgroundCheckpointStatus.done
+
+    def test_failed(self, tmp_path):
+        checkpointer = BackgroundCheckpointer(enabled=True)
+        checkpointer.submit("1", WriteFileCheckpointPlan(tmp_path / "1", fail=True), Namespace({"x": 1}))
+        checkpointer.wait()
+        assert checkpointer.statuses["1"] == BackgroundCheckpointStatus.failed
+
+    def test_start_pending(self, tmp_path):
+        checkpointer = BackgroundCheckpointer(enabled=True, coalesce=True)
+        checkpointer.submit("1", WriteFileCheckpointPlan(tmp_path / "1", delay_s=0.2), Namespace({"x": 1}))
+        checkpointer.submit("2", WriteFileCheckpointPlan(tmp_path / "2"), Namespace({"x": 2}))
+        assert checkpointer.statuses["2"] == BackgroundCheckpointStatus.pending
+
+        # Pending checkpoints start once the in-flight one finishes.
+        time.sleep(0.5)
+        checkpointer.start_pending()
+        checkpointer.wait()
+        assert checkpointer.statuses == {"1": BackgroundCheckpointStatus.done, "2": BackgroundCheckpointStatus.done}
+        assert (tmp_path / "2").read_text() == "2"
+
+    def test_coalesce(self, tmp_path):
+        checkpointer = BackgroundCheckpointer(enabled=True, coalesce=True)
+        checkpointer.submit("1", WriteFileCheckpointPlan(tmp_path / "1", delay_s=0.5), Namespace({"x": 1}))
+        checkpointer.submit("2", WriteFileCheckpointPlan(tmp_path / "2"), Namespace({"x": 2}))
+        checkpointer.start_pending()
+        checkpointer.submit("3", WriteFileCheckpointPlan(tmp_path / "3"), Namespace({"x": 3}))
+        checkpointer.submit("4", WriteFileCheckpointPlan(tmp_path / "4"), Namespace({"x": 4}))
+        checkpointer.wait()
+
+        assert checkpointer.statuses == {
+            "1": BackgroundCheckpointStatus.done,
+            "2": BackgroundCheckpointStatus.skipped,
+            "3": BackgroundCheckpointStatus.skipped,
+            "4": BackgroundCheckpointStatus.done,
+        }
+        assert not (tmp_path / "2").exists()
+        assert (tmp_path / "4").read_text() == "4"
+
+    def test_no_coalesce(self, tmp_path):
+        checkpointer = BackgroundCheckpointer(enabled=True, coalesce=False)
+        checkpointer.submit("1", WriteFileCheckpointPlan(tmp_path / "1", delay_s=0.2), Namespace({"x": 1}))
+        checkpointer.submit("2", WriteFileCheckpointPlan(tmp_path / "2"), Namespace({"x": 2}))
+
+        # The second submission waited for the first checkpoint.
+        assert checkpointer.statuses["1"] == BackgroundCheckpointStatus.done
+        checkpointer.wait()
+        assert (tmp_path / "2").read_text() == "2"
+
+    @pytest.mark.parametrize("enabled", [False, True])
+    def test_at_most_one_in_flight(self, tmp_path, enabled):
+        checkpointer = BackgroundCheckpointer(enabled=enabled, coalesce=True)
+        for i in range(5):
+            checkpointer.submit(str(i), WriteFileCheckpointPlan(tmp_path / str(i), delay_s=0.05), Namespace({"x": i}))
+            running = [status for status in checkpointer.statuses.values() if status == BackgroundCheckpointStatus.running]
+            assert len(running) <= 1
+            checkpointer.start_pending()
+        checkpointer.wait()
+        assert set(checkpointer.statuses.values()) <= {BackgroundCheckpointStatus.done, BackgroundCheckpointStatus.skipped}
+        assert (tmp_path / "0").read_text() == "0"
+
+    def test_timeout(self, tmp_path):
+        checkpointer = BackgroundCheckpointer(enabled=True, timeout_s=0.5)
+        checkpointer.submit("1", WriteFileCheckpointPlan(tmp_path / "1", delay_s=60), Namespace({"x": 1}))
+
+        # The stuck child is killed.
+        start_time = time.time()
+        checkpointer.wait()
+        assert time.time() - start_time < 30
+        assert checkpointer.statuses["1"] == BackgroundCheckpointStatus.failed
+        assert not (tmp_path / "1").exists()
+
+    def test_fork_hooks(self, tmp_path):
+        calls = []
+        checkpointer = BackgroundCheckpointer(
+            enabled=True, before_fork=lambda: calls.append("before"), after_fork=lambda: calls.append("after")
+        )
+        checkpointer.submit("1", WriteFileCheckpointPlan(tmp_path / "1"), Namespace({"x": 1}))
+        checkpointer.wait()
+        assert calls == ["before", "after"]
+
+    def test_pending_mark(self, tmp_path):
+        kishu_checkpoint = KishuCheckpoint(tmp_path / "kishu.db")
+        kishu_checkpoint.init_database()
+        checkpointer = BackgroundCheckpointer(enabled=True, coalesce=True, kishu_checkpoint=kishu_checkpoint)
+        checkpointer.submit("1", WriteFileCheckpointPlan(tmp_path / "1", delay_s=0.5), Namespace({"x": 1}))
+        checkpointer.submit("2", WriteFileCheckpointPlan(tmp_path / "2"), Namespace({"x": 2}))
+        checkpointer.submit("3", WriteFileCheckpointPlan(tmp_path / "3"), Namespace({"x": 3}))
+
+        # Readers wait for the checkpoint being written; they time out if it takes too long. Skipped checkpoints are
+        # no longer pending.
+        Config.set("PLANNER", "async_checkpoint_timeout_s", 0.1)
+        assert checkpointer.statuses["2"] == BackgroundCheckpointStatus.skipped
+        kishu_checkpoint.wait_until_written("2")
+        with pytest.raises(CheckpointPendingError):
+            kishu_checkpoint.wait_until_written("1")
+        Config.set("PLANNER", "async_checkpoint_timeout_s", 30)
+        kishu_checkpoint.wait_until_written("1")
+        assert (tmp_path / "1").read_text() == "1"
+        checkpointer.wait()
+        kishu_checkpoint.wait_until_written("3")
+
+    def test_pending_mark_of_dead_writer(self, tmp_path):
+        kishu_checkpoint = KishuCheckpoint(tmp_path / "kishu.db")
+        kishu_checkpoint.init_database()
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        # The writer died, e.g., with its kernel, without finishing the checkpoint.
+        kishu_checkpoint.mark_pending("1", pid)
+        kishu_checkpoint.wait_until_written("1")
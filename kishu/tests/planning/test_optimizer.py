@@ -1,3 +1,4 @@
+import time
 from typing import Generator
 
 import pytest
@@ -168,3 +169,43 @@ def test_incremental_load_optimizer_mixed(self, test_ahg, enable_slow_network_ba
         # Assert the correct fallback recomputations for VS x exists (to rerun cell 1).
         assert len(opt_result.fallback_recomputation) == 1
         assert set(ce.cell_num for ce in opt_result.fallback_recomputation[vs_x]) == {1}
+
+    @pytest.mark.benchmark
+    def test_optimizer_benchmark(self, kishu_disk_ahg, disable_always_migrate, enable_slow_network_bandwidth):
+        """
+        Plans checkpoints and restores for a 2,000-cell session with 200 variables. Each cell updates one variable from
+        the previous cell's output, with every 20th cell starting a new chain.
+        """
+        num_cells, num_variables = 2000, 200
+        active_vses = {}
+        for cell_num in range(1, num_cells + 1):
+            accessed_vss = [active_vses[(cell_num - 1) % num_variables]] if cell_num % 20 != 1 else []
+            vs = VariableSnapshot(frozenset({f"x{cell_num % num_variables}"}), cell_num, size=cell_num)
+            active_vses[cell_num % num_variables] = vs
+            kishu_disk_ahg.store_update_results(
+                AHGUpdateResult(
+                    commit_id=f"1:{cell_num}",
+                    accessed_vss=accessed_vss,
+                    output_vss=[vs],
+                    newest_ce=CellExecution(cell_num, f"x{cell_num % num_variables} = {cell_num}\n" + "#" * 1000),
+                    active_vss=list(active_vses.values()),
+                    parent_commit_id=f"1:{cell_num - 1}",
+                )
+            )
+
+        start_time = time.time()
+        ahg = AHG(kishu_disk_ahg)
+        target_active_vss = ahg.get_active_variable_snapshots(f"1:{num_cells}")
+        vss_to_migrate, ces_to_recompute = Optimizer(ahg, target_active_vss).compute_plan()
+        optimizer_time_s = time.time() - start_time
+        assert len(vss_to_migrate) + len(ces_to_recompute) > 0
+
+        start_time = time.time()
+        ahg = AHG(kishu_disk_ahg)
+        target_active_vss = ahg.get_active_variable_snapshots(f"1:{num_cells}")
+        useful_stored_vss = ahg.get_active_variable_snapshots(f"1:{num_cells // 2}")
+        opt_result = IncrementalLoadOptimizer(ahg, target_active_vss, set(), useful_stored_vss).compute_plan()
+        incremental_optimizer_time_s = time.time() - start_time
+        assert len(opt_result.ces_to_rerun) > 0
+
+        print(f"Optimizer: {optimizer_time_s:.3f} s, IncrementalLoadOptimizer: {incremental_optimizer_time_s:.3f} s")
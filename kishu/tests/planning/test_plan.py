@@ -1,10 +1,24 @@
+import os
+import threading
+import time
+
 import psutil
 import pytest
 from IPython.core.interactiveshell import InteractiveShell
 
 from kishu.exceptions import CommitIdNotExistError
-from kishu.jupyter.namespace import Namespace
-from kishu.planning.plan import CheckpointPlan, IncrementalCheckpointPlan, RestorePlan
+from kishu.jupyter.namespace import LazyVariable, Namespace
+from kishu.planning.plan import (
+    SIDE_EFFECT_MARKER,
+    CheckpointPlan,
+    IncrementalCheckpointPlan,
+    InteractiveShellPool,
+    LazyVariablePrefetcher,
+    PausableThreadPoolExecutor,
+    RerunCellRestoreAction,
+    RestorePlan,
+    StepOrder,
+)
 from kishu.storage.checkpoint import KishuCheckpoint
 from kishu.storage.disk_ahg import VariableSnapshot
 from kishu.storage.path import KishuPath
@@ -180,13 +194,282 @@ def test_fallback_recomputation(self, db_path_name, kishu_checkpoint):
         restore_plan.add_load_variable_restore_action(2, ["foo"], [(2, "foo = UndeserializableClass()")])
         result_ns = restore_plan.run(db_path_name, exec_id)
 
-        # Both load variable restored actions should have failed.
-        assert len(restore_plan.fallbacked_actions) == 2
+        # Only the load of foo should have failed, as the class is loaded without it.
+        assert len(restore_plan.fallbacked_actions) == 1
 
         # Compare keys in this case as modules are not directly comparable
         assert result_ns.keyset() == user_ns.keyset()
         assert result_ns["foo"] == user_ns["foo"]
 
+    def test_fallback_recomputation_resumes(self, db_path_name, kishu_checkpoint, monkeypatch):
+        shell = InteractiveShell()
+        shell.run_cell(UNDESERIALIZABLE_CLASS)
+        shell.run_cell("foo = UndeserializableClass()\nb = 1")
+        shell.run_cell("b = UndeserializableClass()")
+        user_ns = Namespace(shell.user_ns)
+        CheckpointPlan.create(user_ns, db_path_name, 1).run(user_ns)
+
+        reruns = []
+        rerun = RerunCellRestoreAction.run
+        monkeypatch.setattr(RerunCellRestoreAction, "run", lambda self, ctx: reruns.append(self) or rerun(self, ctx))
+
+        # Failed loads rerun only their fallback cells. Those of foo do not overwrite b recomputed by later cells.
+        restore_plan = RestorePlan()
+        restore_plan.add_rerun_cell_restore_action(1, UNDESERIALIZABLE_CLASS)
+        restore_plan.add_load_variable_restore_action(
+            4, ["b"], [(3, "b = 2")], fallback_names={3: (frozenset(), frozenset({"b"}))}
+        )
+        restore_plan.add_load_variable_restore_action(
+            5,
+            ["foo"],
+            [(2, "foo = UndeserializableClass()\nb = 1")],
+            fallback_names={2: (frozenset({"UndeserializableClass"}), frozenset({"foo", "b"}))},
+        )
+        restore_plan.add_rerun_cell_restore_action(6, "c = b + 1")
+        result_ns = restore_plan.run(db_path_name, 1)
+
+        assert len(restore_plan.fallbacked_actions) == 2
+        assert [action.step_order.cell_num for action in reruns] == [1, 3, 2, 6]
+        assert result_ns["foo"] == user_ns["foo"]
+        assert result_ns["b"] == 2
+        assert result_ns["c"] == 3
+
+    def test_fallback_recomputation_restarts(self, db_path_name, kishu_checkpoint, monkeypatch):
+        shell = InteractiveShell()
+        shell.run_cell(UNDESERIALIZABLE_CLASS + "\na = []")
+        shell.run_cell("foo = UndeserializableClass()\nn = len(a)")
+        shell.run_cell("a.append(1)")
+        user_ns = Namespace(shell.user_ns)
+        CheckpointPlan.create(user_ns, db_path_name, 1).run(user_ns)
+
+        reruns = []
+        rerun = RerunCellRestoreAction.run
+        monkeypatch.setattr(RerunCellRestoreAction, "run", lambda self, ctx: reruns.append(self) or rerun(self, ctx))
+
+        # Cell 3 already modified a in place when the load fails, so the plan restarts with the fallback cell in place.
+        restore_plan = RestorePlan()
+        restore_plan.add_rerun_cell_restore_action(
+            1, UNDESERIALIZABLE_CLASS + "\na = []", frozenset(), frozenset({"UndeserializableClass", "a"})
+        )
+        restore_plan.add_rerun_cell_restore_action(3, "a.append(1)", frozenset({"a"}), frozenset({"a"}))
+        restore_plan.add_load_variable_restore_action(
+            4,
+            ["foo", "n"],
+            [(2, "foo = UndeserializableClass()\nn = len(a)")],
+            fallback_names={2: (frozenset({"UndeserializableClass", "a"}), frozenset({"foo", "n"}))},
+        )
+        result_ns = restore_plan.run(db_path_name, 1)
+
+        assert len(restore_plan.fallbacked_actions) == 1
+        assert [action.step_order.cell_num for action in reruns] == [1, 3, 1, 2, 3]
+        assert result_ns["foo"] == user_ns["foo"]
+        assert result_ns["n"] == 0
+        assert result_ns["a"] == [1]
+
+    @pytest.mark.benchmark
+    def test_fallback_recomputation_benchmark(self, db_path_name, kishu_checkpoint):
+        """
+        Measures the time to restore 10 variables failing to load, each recomputed by a fallback cell.
+        """
+        shell = InteractiveShell()
+        shell.run_cell(UNDESERIALIZABLE_CLASS)
+        shell.run_cell("\n".join(f"foo{i} = UndeserializableClass()" for i in range(10)))
+        user_ns = Namespace(shell.user_ns)
+        CheckpointPlan.create(user_ns, db_path_name, 1).run(user_ns)
+
+        restore_plan = RestorePlan()
+        restore_plan.add_rerun_cell_restore_action(1, UNDESERIALIZABLE_CLASS)
+        for i in range(10):
+            restore_plan.add_load_variable_restore_action(
+                2 * i + 3, [f"foo{i}"], [(2 * i + 2, f"foo{i} = UndeserializableClass()")]
+            )
+        start_time = time.time()
+        result_ns = restore_plan.run(db_path_name, 1)
+        restore_time_s = time.time() - start_time
+        assert len(restore_plan.fallbacked_actions) == 10
+        assert result_ns["foo9"] == user_ns["foo9"]
+        print(f"restored 10 variables by fallback recomputation in {restore_time_s:.3f}s")
+
+    def test_shell_pool(self):
+        pool = InteractiveShellPool(max_size=1)
+        shell = pool.get()
+        shell.run_cell("x = 1\nx")
+        pool.put(shell)
+
+        # Recycled shells start with a clean namespace.
+        assert pool.get() is shell
+        assert "x" not in shell.user_ns
+        assert shell.user_ns["Out"] == {}
+        assert pool.get() is not shell
+
+    def test_shared_checkpoint_loads(self, db_path_name, kishu_checkpoint, monkeypatch):
+        shared = [1]
+        user_ns = Namespace({"a": shared, "b": [shared], "c": 3})
+        CheckpointPlan.create(user_ns, db_path_name, 1).run(user_ns)
+
+        loads = []
+        load_checkpoint = KishuCheckpoint.load_checkpoint
+        monkeypatch.setattr(
+            KishuCheckpoint,
+            "load_checkpoint",
+            lambda self, commit_id, variable_names=None: loads.append(frozenset(variable_names))
+            or load_checkpoint(self, commit_id, variable_names),
+        )
+
+        # Loads with no cells rerun between them share one load of their variables; later loads load again.
+        restore_plan = RestorePlan()
+        restore_plan.add_load_variable_restore_action(1, ["a"], [])
+        restore_plan.add_load_variable_restore_action(2, ["b"], [])
+        restore_plan.add_rerun_cell_restore_action(3, "a.append(2)")
+        restore_plan.add_load_variable_restore_action(4, ["c"], [])
+        result_ns = restore_plan.run(db_path_name, 1)
+
+        assert sorted(loads, key=len) == [{"c"}, {"a", "b"}]
+        assert result_ns["b"][0] is result_ns["a"]
+        assert result_ns["a"] == [1, 2]
+
+    @pytest.mark.benchmark
+    @pytest.mark.parametrize("rerun_between_loads", [False, True])
+    def test_shared_checkpoint_loads_benchmark(self, db_path_name, kishu_checkpoint, rerun_between_loads):
+        """
+        Measures the time to restore 30 medium-sized variables of a checkpoint, each by its own action.
+        """
+        user_ns = Namespace({f"x{i}": {j: str(j) for j in range(i, i + 20_000)} for i in range(30)})
+        CheckpointPlan.create(user_ns, db_path_name, 1).run(user_ns)
+
+        restore_plan = RestorePlan()
+        for i in range(30):
+            restore_plan.add_load_variable_restore_action(2 * i + 1, [f"x{i}"], [])
+            if rerun_between_loads:
+                restore_plan.add_rerun_cell_restore_action(2 * i + 2, "pass")
+        start_time = time.time()
+        result_ns = restore_plan.run(db_path_name, 1)
+        restore_time_s = time.time() - start_time
+        assert result_ns.to_dict() == user_ns.to_dict()
+        print(f"rerun_between_loads={rerun_between_loads}: restored 30 variables in {restore_time_s:.3f}s")
+
+    def test_parallel_reruns(self, db_path_name, kishu_checkpoint):
+        user_ns = Namespace({"data": [1, 2, 3]})
+        CheckpointPlan.create(user_ns, db_path_name, 1).run(user_ns)
+
+        # Cells 2 and 4 form a chain independent of cell 3.
+        restore_plan = RestorePlan()
+        restore_plan.add_load_variable_restore_action(1, ["data"], [])
+        restore_plan.add_rerun_cell_restore_action(
+            2, "a = sum(data)\na_pid = __import__('os').getpid()", frozenset({"data"}), frozenset({"a", "a_pid"})
+        )
+        restore_plan.add_rerun_cell_restore_action(
+            3, "b = len(data)\nb_pid = __import__('os').getpid()", frozenset({"data"}), frozenset({"b", "b_pid"})
+        )
+        restore_plan.add_rerun_cell_restore_action(4, "a2 = 2 * a\ndel a", frozenset({"a"}), frozenset({"a2"}))
+        result_ns = restore_plan.run(db_path_name, 1, rerun_workers=2)
+
+        assert result_ns["a_pid"] != os.getpid() and result_ns["b_pid"] != os.getpid()
+        assert {k: v for k, v in result_ns.to_dict().items() if not k.endswith("_pid")} == {
+            "data": [1, 2, 3],
+            "a2": 12,
+            "b": 3,
+        }
+
+    def test_parallel_reruns_conflict(self, db_path_name, kishu_checkpoint):
+        user_ns = Namespace({"data": [1, 2, 3]})
+        CheckpointPlan.create(user_ns, db_path_name, 1).run(user_ns)
+
+        # Cell 4 reads data loaded after the first cell to rerun, so it is rerun in the shell.
+        restore_plan = RestorePlan()
+        restore_plan.add_rerun_cell_restore_action(
+            2, "a = 1\na_pid = __import__('os').getpid()", frozenset(), frozenset({"a", "a_pid"})
+        )
+        restore_plan.add_load_variable_restore_action(3, ["data"], [])
+        restore_plan.add_rerun_cell_restore_action(
+            4, "b = len(data)\nb_pid = __import__('os').getpid()", frozenset({"data"}), frozenset({"b", "b_pid"})
+        )
+        result_ns = restore_plan.run(db_path_name, 1, rerun_workers=2)
+
+        assert result_ns["a_pid"] != os.getpid() and result_ns["b_pid"] == os.getpid()
+        assert result_ns["a"] == 1 and result_ns["b"] == 3
+
+    @pytest.mark.parametrize(
+        "cell_code",
+        [
+            f"{SIDE_EFFECT_MARKER}\na = 1\na_pid = __import__('os').getpid()",
+            "a = (i for i in range(3))\na_pid = __import__('os').getpid()",  # Unpicklable
+        ],
+    )
+    def test_parallel_reruns_serial(self, db_path_name, kishu_checkpoint, cell_code):
+        user_ns = Namespace({})
+        CheckpointPlan.create(user_ns, db_path_name, 1).run(user_ns)
+
+        # Cells marked as having side effects are rerun in the shell, as are those whose variables can't be shipped.
+        restore_plan = RestorePlan()
+        restore_plan.add_rerun_cell_restore_action(1, cell_code, frozenset(), frozenset({"a", "a_pid"}))
+        restore_plan.add_rerun_cell_restore_action(2, "b = 2", frozenset(), frozenset({"b"}))
+        result_ns = restore_plan.run(db_path_name, 1, rerun_workers=2)
+
+        assert result_ns["a_pid"] == os.getpid()
+        assert result_ns["b"] == 2
+
+    def test_parallel_reruns_stuck_worker(self, db_path_name, kishu_checkpoint, monkeypatch):
+        user_ns = Namespace({})
+        CheckpointPlan.create(user_ns, db_path_name, 1).run(user_ns)
+        monkeypatch.setattr("kishu.planning.plan.RERUN_TIMEOUT_GRACE_S", 1.0)
+
+        # The worker rerunning cell 1 is stuck, so the cell is rerun in the shell once the worker times out.
+        restore_plan = RestorePlan()
+        restore_plan.add_rerun_cell_restore_action(
+            1,
+            f"import os, time\na_pid = os.getpid()\nif a_pid != {os.getpid()}:\n    time.sleep(600)",
+            frozenset(),
+            frozenset({"os", "time", "a_pid"}),
+        )
+        restore_plan.add_rerun_cell_restore_action(2, "b = 2", frozenset(), frozenset({"b"}))
+        start_time = time.time()
+        result_ns = restore_plan.run(db_path_name, 1, rerun_workers=2)
+
+        assert time.time() - start_time < 30
+        assert result_ns["a_pid"] == os.getpid()
+        assert result_ns["b"] == 2
+
+    def test_pausable_thread_pool(self):
+        executor = PausableThreadPoolExecutor(2)
+        started, release = threading.Event(), threading.Event()
+        running = executor.submit(lambda: started.set() or release.wait(10))
+        started.wait()
+        threading.Timer(0.1, release.set).start()
+
+        # Pausing waits for the running task. Tasks submitted while paused start once unpaused.
+        with executor.paused():
+            assert running.done()
+            submitted = executor.submit(time.time)
+            time.sleep(0.1)
+            assert not submitted.done()
+            unpaused_time = time.time()
+        assert submitted.result() >= unpaused_time
+        executor.shutdown()
+
+    @pytest.mark.benchmark
+    @pytest.mark.parametrize("rerun_workers", [1, 4])
+    def test_parallel_reruns_benchmark(self, db_path_name, kishu_checkpoint, rerun_workers):
+        """
+        Measures the time to restore 4 independent models, each trained by a cell taking 1s.
+        """
+        user_ns = Namespace({})
+        CheckpointPlan.create(user_ns, db_path_name, 1).run(user_ns)
+
+        restore_plan = RestorePlan()
+        for i in range(4):
+            restore_plan.add_rerun_cell_restore_action(
+                i + 1,
+                f"__import__('time').sleep(1)\nmodel{i} = list(range({i}))",
+                frozenset(),
+                frozenset({f"model{i}"}),
+            )
+        start_time = time.time()
+        result_ns = restore_plan.run(db_path_name, 1, rerun_workers=rerun_workers)
+        restore_time_s = time.time() - start_time
+        assert result_ns["model3"] == [0, 1, 2]
+        print(f"rerun_workers={rerun_workers}: restored 4 models in {restore_time_s:.3f}s")
+
     def test_store_versioned_names(self, db_path_name, kishu_incremental_checkpoint):
         """
         Tests that the VARIABLE_SNAPSHOT table are populated correctly for incremental storage.
@@ -229,6 +512,117 @@ def test_incremental_restore(self, db_path_name, kishu_incremental_checkpoint):
 
         assert result_ns["b"] == 2
 
+    @pytest.mark.parametrize("num_workers", [1, 4])
+    def test_memoized_rerun(self, db_path_name, kishu_incremental_checkpoint, num_workers):
+        user_ns = Namespace({"b": 2})
+        IncrementalCheckpointPlan.create(user_ns, db_path_name, 1, [VariableSnapshot(frozenset("b"), 1)]).run(user_ns)
+
+        # The stored output of cell 1 is loaded instead of rerunning cell 2; cell 3's is missing, so it is rerun.
+        restore_plan = RestorePlan()
+        restore_plan.add_rerun_cell_restore_action(
+            2, "b = 'rerun'", memoized_outputs={VariableSnapshot(frozenset("b"), 1)}, cell_runtime_s=2.0
+        )
+        restore_plan.add_rerun_cell_restore_action(
+            3, "c = 3", memoized_outputs={VariableSnapshot(frozenset("c"), 1)}, cell_runtime_s=4.0
+        )
+        result_ns = restore_plan.run(db_path_name, 1, num_workers=num_workers)
+
+        assert result_ns["b"] == 2 and result_ns["c"] == 3
+        assert restore_plan.memoized_actions == [restore_plan.actions[StepOrder.new_rerun_cell(2)]]
+        assert restore_plan.memoized_runtime_s() == 2.0
+
+    @pytest.mark.benchmark
+    @pytest.mark.parametrize("memoized", [False, True])
+    def test_memoized_rerun_benchmark(self, db_path_name, kishu_incremental_checkpoint, memoized):
+        """
+        Measures the time to restore a model trained by a cell taking 1s, whose output was stored by an earlier run.
+        """
+        user_ns = Namespace({"model": list(range(100_000))})
+        vs_model = VariableSnapshot(frozenset({"model"}), 1)
+        IncrementalCheckpointPlan.create(user_ns, db_path_name, 1, [vs_model]).run(user_ns)
+
+        restore_plan = RestorePlan()
+        restore_plan.add_rerun_cell_restore_action(
+            2,
+            "__import__('time').sleep(1)\nmodel = list(range(100_000))",
+            memoized_outputs={vs_model} if memoized else None,
+            cell_runtime_s=1.0,
+        )
+        start_time = time.time()
+        result_ns = restore_plan.run(db_path_name, 1)
+        restore_time_s = time.time() - start_time
+        assert result_ns["model"] == user_ns["model"]
+        print(f"memoized={memoized}: restored model in {restore_time_s:.3f}s, saved {restore_plan.memoized_runtime_s()}s")
+
+    def test_lazy_incremental_restore(self, db_path_name, kishu_incremental_checkpoint):
+        user_ns = Namespace({"a": [1], "b": 2, "c": 3})
+        vs_ab, vs_c = VariableSnapshot(frozenset({"a", "b"}), 1), VariableSnapshot(frozenset("c"), 1)
+        IncrementalCheckpointPlan.create(user_ns, db_path_name, 1, [vs_ab, vs_c]).run(user_ns)
+
+        # Lazily restored variables are loaded with their variable snapshot on first access.
+        restore_plan = RestorePlan()
+        restore_plan.add_incremental_load_restore_action(1, {vs_ab, vs_c}, [(1, "a = [1]; b = 2; c = 3")])
+        result_ns = restore_plan.run(db_path_name, 1, lazy=True)
+        assert isinstance(result_ns.to_raw_dict()["a"], LazyVariable)
+        assert result_ns.lazy_vars() == {"a", "b", "c"}
+        assert result_ns["a"] == [1]
+        assert result_ns.lazy_vars() == {"c"}
+
+        # Prefetched variable snapshots are installed on first access.
+        prefetcher = LazyVariablePrefetcher()
+        prefetcher.start(result_ns)
+        prefetcher.stop()
+        assert result_ns.lazy_vars() == {"c"}
+        assert result_ns["c"] == 3
+
+    def test_lazy_restore_before_rerun(self, db_path_name, kishu_incremental_checkpoint):
+        user_ns = Namespace({"a": 1})
+        vs_a = VariableSnapshot(frozenset("a"), 1)
+        IncrementalCheckpointPlan.create(user_ns, db_path_name, 1, [vs_a]).run(user_ns)
+
+        # Variables loaded before cells are rerun are not lazy, as the cells may access them.
+        restore_plan = RestorePlan()
+        restore_plan.add_incremental_load_restore_action(1, {vs_a}, [(1, "a = 1")])
+        restore_plan.add_rerun_cell_restore_action(2, "b = a + 1")
+        result_ns = restore_plan.run(db_path_name, 1, lazy=True)
+        assert result_ns.lazy_vars() == set()
+        assert result_ns["b"] == 2
+
+    @pytest.mark.parametrize("num_workers", [1, 4])
+    def test_prefetched_incremental_restore(self, db_path_name, kishu_incremental_checkpoint, num_workers):
+        user_ns = Namespace({"a": [1], "b": [2]})
+        vs_a = VariableSnapshot(frozenset("a"), 1)
+        vs_b = VariableSnapshot(frozenset("b"), 1)
+        IncrementalCheckpointPlan.create(user_ns, db_path_name, 1, [vs_a, vs_b]).run(user_ns)
+
+        # Loads started before the rerun cell are still installed after it, overwriting its changes.
+        restore_plan = RestorePlan()
+        restore_plan.add_incremental_load_restore_action(1, {vs_a}, [(1, "a = [1]")])
+        restore_plan.add_rerun_cell_restore_action(2, "a.append(3)\nb = a")
+        restore_plan.add_incremental_load_restore_action(3, {vs_b}, [(1, "b = [2]")])
+        result_ns = restore_plan.run(db_path_name, 1, num_workers=num_workers)
+        assert result_ns.to_dict() == {"a": [1, 3], "b": [2]}
+
+    @pytest.mark.benchmark
+    @pytest.mark.parametrize("num_workers", [1, 4])
+    def test_prefetched_restore_benchmark(self, db_path_name, kishu_incremental_checkpoint, num_workers):
+        """
+        Measures the time to restore 100 medium-sized variables loaded around a rerun cell.
+        """
+        user_ns = Namespace({f"x{i}": {j: str(j) for j in range(i, i + 20_000)} for i in range(100)})
+        vses = [VariableSnapshot(frozenset({name}), 1) for name in user_ns.keyset()]
+        IncrementalCheckpointPlan.create(user_ns, db_path_name, 1, vses).run(user_ns)
+
+        restore_plan = RestorePlan()
+        restore_plan.add_incremental_load_restore_action(1, set(vses[:50]), [])
+        restore_plan.add_rerun_cell_restore_action(2, "import time\ntime.sleep(0.5)")
+        restore_plan.add_incremental_load_restore_action(3, set(vses[50:]), [])
+        start_time = time.time()
+        result_ns = restore_plan.run(db_path_name, 1, num_workers=num_workers)
+        restore_time_s = time.time() - start_time
+        assert len(result_ns.keyset()) == 101
+        print(f"num_workers={num_workers}: restored 100 variables in {restore_time_s:.3f}s")
+
     def test_move_variable(self, db_path_name, kishu_incremental_checkpoint):
         user_ns = Namespace({"a": 1, "b": 2, "c": 3})
 
@@ -145,7 +145,7 @@ def test_checkpoint_restore_planner(self, nb_simple_path, enable_always_migrate,
         # Assert the restore plan has correct fields.
         version = min([ce.cell_num for ce in planner.get_ahg().get_all_cell_executions()])  # Get timestamp from stored CE
         assert restore_plan.actions[StepOrder.new_load_variable(version)].fallback_recomputation == [
-            RerunCellRestoreAction(StepOrder.new_rerun_cell(version), "x = 1\n")
+            RerunCellRestoreAction(StepOrder.new_rerun_cell(version), "x = 1\n", frozenset(), frozenset({"x"}))
         ]
 
     def test_checkpoint_restore_planner_with_existing_items(
@@ -313,11 +313,11 @@ def test_checkpoint_restore_planner_incremental_restore_undo(
         # Generate the incremental restore plan for undoing to cell 1.
         restore_plan = planner_manager.planner.generate_incremental_restore_plan(db_path_name, "1:1")
 
-        # The restore plan consists of moving X and loading Y.
+        # The restore plan consists of loading Y; X is unchanged and stays in place.
         version = min([ce.cell_num for ce in planner.get_ahg().get_all_cell_executions()])  # Get timestamp from stored CE
-        assert len(restore_plan.actions) == 2
+        assert len(restore_plan.actions) == 1
         assert len(restore_plan.actions[StepOrder.new_incremental_load(version)].variable_snapshots) == 1
-        assert restore_plan.actions[StepOrder.new_move_variable(version)].vars_to_move.keyset() == {"x"}
+        assert planner.get_unchanged_variables("1:1") == {"x"}
 
     def test_checkpoint_restore_planner_incremental_restore_branch(
         self, db_path_name, enable_always_migrate, kishu_disk_ahg, kishu_graph, kishu_incremental_checkpoint
@@ -359,13 +359,97 @@ def test_checkpoint_restore_planner_incremental_restore_branch(
         version_1 = min([ce.cell_num for ce in planner.get_ahg().get_all_cell_executions()])  # Get timestamp from stored CE
         version_2 = max([ce.cell_num for ce in planner.get_ahg().get_all_cell_executions()])
 
-        # The restore plan consists of moving X, loading Y, then rerunning cell 1
-        # to modify x (to the version in cell 1) and recompute z.
-        assert len(restore_plan.actions) == 3
+        # The restore plan consists of loading Y, then rerunning cell 2 to modify y and recompute z. X stays in place as
+        # cell 2 does not read it.
+        assert len(restore_plan.actions) == 2
         assert len(restore_plan.actions[StepOrder.new_incremental_load(version_1)].variable_snapshots) == 1
-        assert restore_plan.actions[StepOrder.new_move_variable(version_1)].vars_to_move.keyset() == {"x"}
         assert restore_plan.actions[StepOrder.new_rerun_cell(version_2)].cell_code == cell2_code
 
+        # The rerun carries the variables cell 2 reads and writes, for rerunning independent cells in parallel.
+        assert restore_plan.actions[StepOrder.new_rerun_cell(version_2)].input_names == {"y"}
+        assert restore_plan.actions[StepOrder.new_rerun_cell(version_2)].output_names == {"y", "z"}
+
+    def test_checkpoint_restore_planner_incremental_restore_move_rerun_inputs(
+        self, db_path_name, enable_always_migrate, kishu_disk_ahg, kishu_graph, kishu_incremental_checkpoint
+    ):
+        """
+        Test that unchanged variables read by cells to rerun are moved into the restore shell.
+        """
+        planner = CheckpointRestorePlanner(kishu_disk_ahg, kishu_graph, Namespace({}), incremental_cr=True)
+        planner_manager = PlannerManager(planner)
+
+        # Run cell 1.
+        planner_manager.run_cell("1:1", {}, {"x": 1, "y": 2}, "x = 1\ny = 2")
+
+        # Create and run checkpoint plan for cell 1.
+        planner_manager.checkpoint_session(db_path_name, "1:1", [])
+
+        # Run cell 2, which reads x.
+        cell2_code = "y += x\nz = 4\n"
+        planner_manager.run_cell("1:2", {"x", "y"}, {"y": 3, "z": 4}, cell2_code)
+
+        # Create and run checkpoint plan for cell 2.
+        planner_manager.checkpoint_session(db_path_name, "1:2", ["1:1"])
+
+        # Generate the incremental restore plan for checking out from 1:2 to the same state as 1:2 branched from 1:1.
+        restore_plan = planner_manager.planner._generate_incremental_restore_plan(
+            db_path_name,
+            planner.get_ahg().get_active_variable_snapshots("1:2"),
+            planner.get_ahg().get_active_variable_snapshots("1:1"),
+            ["1:1"],
+        )
+
+        # X is moved for rerunning cell 2.
+        version_1 = min([ce.cell_num for ce in planner.get_ahg().get_all_cell_executions()])  # Get timestamp from stored CE
+        assert len(restore_plan.actions) == 3
+        assert restore_plan.actions[StepOrder.new_move_variable(version_1)].vars_to_move.keyset() == {"x"}
+
+    @pytest.mark.parametrize("cell_code,memoized", [("y = x + 1", True), ("y = x + 1  # kishu: nondeterministic", False)])
+    def test_checkpoint_restore_planner_incremental_restore_memoized_rerun(
+        self,
+        db_path_name,
+        enable_always_migrate,
+        kishu_disk_ahg,
+        kishu_graph,
+        kishu_incremental_checkpoint,
+        cell_code,
+        memoized,
+    ):
+        """
+        Test that rerunning a cell run before on the same inputs loads the stored outputs of its earlier execution.
+        """
+        planner = CheckpointRestorePlanner(kishu_disk_ahg, kishu_graph, Namespace({}), incremental_cr=True)
+        planner_manager = PlannerManager(planner)
+
+        # Run cells 1 and 2, storing both.
+        planner_manager.run_cell("1:1", {}, {"x": 1}, "x = 1")
+        planner_manager.checkpoint_session(db_path_name, "1:1", [])
+        planner_manager.run_cell("1:2", {"x"}, {"y": 2}, cell_code)
+        planner_manager.checkpoint_session(db_path_name, "1:2", ["1:1"])
+
+        # Check out cell 1 and run cell 2 again as cell 3 without storing it.
+        planner.replace_state("1:1", Namespace({"x": 1}))
+        kishu_graph.jump("1:1")
+        planner_manager.run_cell("1:3", {"x"}, {"y": 2}, cell_code)
+
+        # Restoring cell 3 reruns it, loading the outputs of cell 2 instead if the cell is deterministic.
+        restore_plan = planner._generate_incremental_restore_plan(
+            db_path_name, planner.get_ahg().get_active_variable_snapshots("1:3"), set(), ["1:1"]
+        )
+        version_3 = max(ce.cell_num for ce in planner.get_ahg().get_all_cell_executions())
+        rerun_action = restore_plan.actions[StepOrder.new_rerun_cell(version_3)]
+        if memoized:
+            assert rerun_action.memoized_outputs == planner.get_ahg().get_active_variable_snapshots("1:2") - (
+                planner.get_ahg().get_active_variable_snapshots("1:1")
+            )
+        else:
+            assert rerun_action.memoized_outputs is None
+
+        result_ns = restore_plan.run(db_path_name, "1:3")
+        assert result_ns["y"] == 2
+        assert len(restore_plan.memoized_actions) == (1 if memoized else 0)
+        assert restore_plan.memoized_runtime_s() == (1.0 if memoized else 0.0)
+
     def test_get_differing_vars_post_checkout(
         self, db_path_name, enable_always_migrate, kishu_disk_ahg, kishu_graph, kishu_incremental_checkpoint
     ):
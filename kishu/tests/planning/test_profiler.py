@@ -66,6 +66,15 @@ def test_pandas_dataframe():
     assert profile_variable_size(df) < np.inf
 
 
+def test_dataframes_and_modules(tmp_path: Path):
+    Config.set("PROFILER", "auto_add_unpicklable_object", True)
+
+    # dill fails to compare DataFrames after unpickling them; stored variable snapshots may also hold modules.
+    df = pd.DataFrame(np.array([[1, 2, 3], [4, 5, 6], [7, 8, 9]]), columns=["a", "b", "c"])
+    assert profile_variable_size([df, np, pd]) < np.inf
+    assert Config.get("PROFILER", "excluded_classes", []) == []
+
+
 def test_generator():
     gen = (i for i in range(10))
     assert profile_variable_size(gen) == np.inf
@@ -83,3 +92,12 @@ def test_add_unserializable_variable_to_config(tmp_path: Path):
     # The generator has no module, so it is only added to the class list.
     assert Config.get("PROFILER", "excluded_modules", []) == []
     assert Config.get("PROFILER", "excluded_classes", []) == ["<class 'generator'>"]
+
+
+def test_unserializable_container_not_added_to_config(tmp_path: Path):
+    Config.set("PROFILER", "auto_add_unpicklable_object", True)
+
+    # The variables of a snapshot are profiled as a list; other lists are still picklable.
+    assert profile_variable_size([1, (i for i in range(10))]) == np.inf
+    assert Config.get("PROFILER", "excluded_classes", []) == []
+    assert profile_variable_size([1, 2]) < np.inf
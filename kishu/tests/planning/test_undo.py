@@ -0,0 +1,89 @@
+from kishu.jupyter.namespace import Namespace
+from kishu.planning.undo import UndoBuffer
+from kishu.storage.disk_ahg import VariableSnapshot
+
+
+class TestUndoBuffer:
+    def test_undo(self):
+        undo_buffer = UndoBuffer(max_cells=2)
+        vs_xy1, vs_z1 = VariableSnapshot(frozenset({"x", "y"}), 1), VariableSnapshot(frozenset("z"), 1)
+        user_ns = Namespace({"x": [1]})
+        user_ns["y"] = user_ns["x"]
+        undo_buffer.record("1", None, set(), {vs_xy1}, user_ns)
+
+        # x is modified in place and z is assigned.
+        vs_xy2 = VariableSnapshot(frozenset({"x", "y"}), 2)
+        user_ns["x"].append(2)
+        user_ns["z"] = 3
+        undo_buffer.record("2", "1", {vs_xy1}, {vs_xy2, vs_z1}, user_ns)
+
+        # Undoing restores x and y, still sharing the list, and deletes z.
+        assert undo_buffer.undo("2", "1", user_ns)
+        assert user_ns["x"] == [1] and user_ns["y"] is user_ns["x"]
+        assert "z" not in user_ns
+
+        # The undone cell can no longer be undone; the cell before it still can.
+        assert not undo_buffer.undo("2", "1", user_ns)
+        assert not undo_buffer.undo("1", "0", user_ns)
+        assert undo_buffer.undo("1", None, user_ns)
+        assert "x" not in user_ns and "y" not in user_ns
+
+    def test_undo_many_cells(self):
+        undo_buffer = UndoBuffer(max_cells=3)
+        user_ns = Namespace({})
+        parent_vses: set = set()
+        for i in range(1, 4):
+            user_ns["x"] = i
+            vses = {VariableSnapshot(frozenset("x"), i)}
+            undo_buffer.record(str(i), str(i - 1), parent_vses, vses, user_ns)
+            parent_vses = vses
+
+        assert undo_buffer.undo("3", "1", user_ns)
+        assert user_ns["x"] == 1
+
+    def test_evicted(self):
+        undo_buffer = UndoBuffer(max_cells=1)
+        user_ns = Namespace({})
+        parent_vses: set = set()
+        for i in range(1, 4):
+            user_ns["x"] = i
+            vses = {VariableSnapshot(frozenset("x"), i)}
+            undo_buffer.record(str(i), str(i - 1), parent_vses, vses, user_ns)
+            parent_vses = vses
+
+        # Only the last cell is kept.
+        assert not undo_buffer.undo("3", "1", user_ns)
+        assert user_ns["x"] == 3
+        assert undo_buffer.undo("3", "2", user_ns)
+        assert user_ns["x"] == 2
+
+    def test_size_limit(self):
+        undo_buffer = UndoBuffer(max_cells=2, max_size=1000)
+        vs_x1, vs_x2 = VariableSnapshot(frozenset("x"), 1), VariableSnapshot(frozenset("x"), 2)
+        user_ns = Namespace({"x": "a" * 2000})
+        undo_buffer.record("1", None, set(), {vs_x1}, user_ns)
+        user_ns["x"] = "b"
+        undo_buffer.record("2", "1", {vs_x1}, {vs_x2}, user_ns)
+
+        # The pickle of x before the cell is too large to keep.
+        assert undo_buffer.size() <= 1000
+        assert not undo_buffer.undo("2", "1", user_ns)
+        assert user_ns["x"] == "b"
+
+    def test_unpicklable(self):
+        undo_buffer = UndoBuffer(max_cells=2)
+        vs_x1, vs_x2 = VariableSnapshot(frozenset("x"), 1), VariableSnapshot(frozenset("x"), 2)
+        user_ns = Namespace({"x": (i for i in range(3))})
+        undo_buffer.record("1", None, set(), {vs_x1}, user_ns)
+        user_ns["x"] = 1
+        undo_buffer.record("2", "1", {vs_x1}, {vs_x2}, user_ns)
+
+        assert not undo_buffer.undo("2", "1", user_ns)
+        assert user_ns["x"] == 1
+
+    def test_disabled(self):
+        undo_buffer = UndoBuffer()
+        undo_buffer.record("1", None, set(), {VariableSnapshot(frozenset("x"), 1)}, Namespace({"x": 1}))
+        assert not undo_buffer.enabled()
+        assert undo_buffer.size() == 0
+        assert not undo_buffer.undo("1", None, Namespace({"x": 1}))
@@ -0,0 +1,165 @@
+import os
+import sqlite3
+import time
+
+import psutil
+import pytest
+
+from kishu.storage.blob_backend import (
+    PACK_INDEX_TABLE,
+    PackfileBlobBackend,
+    SqliteBlobBackend,
+    blob_backends_from_config,
+)
+from kishu.storage.checkpoint import KishuCheckpoint
+from kishu.storage.chunk_store import CHUNK_REF_TABLE, CHUNK_TABLE, KishuChunkStore
+from kishu.storage.config import Config
+from kishu.storage.path import KishuPath
+
+
+class TestPackfileBlobBackend:
+    @pytest.fixture
+    def database_path(self, nb_simple_path):
+        return KishuPath.database_path(nb_simple_path)
+
+    @staticmethod
+    def new_chunk_store(database_path, max_packfile_size=1 << 30):
+        chunk_store = KishuChunkStore(
+            avg_chunk_size=4096, backends=[PackfileBlobBackend(database_path, max_packfile_size), SqliteBlobBackend()]
+        )
+        con = sqlite3.connect(database_path)
+        chunk_store.init_database(con.cursor())
+        con.commit()
+        return chunk_store
+
+    @staticmethod
+    def release_commit(cur, commit_id):
+        KishuChunkStore.release(
+            cur, [row[0] for row in cur.execute(f"select digest from {CHUNK_REF_TABLE} where commit_id = ?", (commit_id,))]
+        )
+        cur.execute(f"delete from {CHUNK_REF_TABLE} where commit_id = ?", (commit_id,))
+
+    def test_store_load(self, database_path):
+        chunk_store = self.new_chunk_store(database_path)
+        con = sqlite3.connect(database_path)
+        cur = con.cursor()
+        data = os.urandom(100000)
+
+        chunk_store.store(cur, "1", "", data)
+        chunk_store.store(cur, "2", "", data + b"tail")
+        assert chunk_store.load(cur, "1", "") == data
+        assert chunk_store.load(cur, "2", "") == data + b"tail"
+
+        # Chunk data is only stored in the packfile.
+        assert cur.execute(f"select count(*) from {CHUNK_TABLE} where data is not null").fetchone()[0] == 0
+        assert list(PackfileBlobBackend.packfile_directory(database_path).iterdir()) != []
+        assert sum(path.stat().st_size for path in PackfileBlobBackend.packfile_directory(database_path).iterdir()) < 110000
+
+    def test_new_packfile_when_full(self, database_path):
+        chunk_store = self.new_chunk_store(database_path, max_packfile_size=50000)
+        con = sqlite3.connect(database_path)
+        cur = con.cursor()
+        blobs = [os.urandom(30000) for _ in range(4)]
+
+        for i, data in enumerate(blobs):
+            chunk_store.store(cur, str(i), "", data)
+        assert len(list(PackfileBlobBackend.packfile_directory(database_path).iterdir())) == 2
+        for i, data in enumerate(blobs):
+            assert chunk_store.load(cur, str(i), "") == data
+
+    def test_repack(self, database_path):
+        chunk_store = self.new_chunk_store(database_path, max_packfile_size=50000)
+        backend = PackfileBlobBackend(database_path, max_packfile_size=50000)
+        con = sqlite3.connect(database_path)
+        cur = con.cursor()
+        blobs = [os.urandom(30000) for _ in range(6)]
+        for i, data in enumerate(blobs):
+            chunk_store.store(cur, str(i), "", data)
+        assert len(list(backend.directory.iterdir())) == 3
+
+        # The first packfile holds blobs 0 and 1, the second blobs 2 and 3.
+        self.release_commit(cur, "0")
+        self.release_commit(cur, "1")
+        self.release_commit(cur, "2")
+        repacked_size = sum(path.stat().st_size for path in sorted(backend.directory.iterdir())[:2])
+        stats, packfiles_to_delete = backend.repack(cur, min_live_ratio=0.6)
+        con.commit()
+        for path in packfiles_to_delete:
+            path.unlink()
+
+        assert stats.num_deleted_packfiles == 2
+        assert 30000 < stats.moved_bytes < 31000
+        assert stats.moved_bytes + stats.reclaimed_bytes == repacked_size
+        assert cur.execute(f"select count(*) from {PACK_INDEX_TABLE} where pack_id < 2").fetchone()[0] == 0
+        for i in [3, 4, 5]:
+            assert chunk_store.load(cur, str(i), "") == blobs[i]
+
+    def test_read_other_backend(self, database_path):
+        # Chunks stored before switching backends remain readable.
+        sqlite_chunk_store = KishuChunkStore(avg_chunk_size=4096)
+        packfile_chunk_store = self.new_chunk_store(database_path)
+        con = sqlite3.connect(database_path)
+        cur = con.cursor()
+        data = os.urandom(100000)
+
+        sqlite_chunk_store.store(cur, "1", "", data)
+        packfile_chunk_store.store(cur, "2", "", data + os.urandom(100000))
+        assert packfile_chunk_store.load(cur, "1", "") == data
+        with pytest.raises(ValueError):
+            sqlite_chunk_store.load(cur, "2", "")
+
+    def test_from_config(self, database_path):
+        assert isinstance(blob_backends_from_config(database_path)[0], SqliteBlobBackend)
+
+        Config.set("PLANNER", "blob_backend", "packfile")
+        Config.set("PLANNER", "packfile_max_size", 1000)
+        backends = blob_backends_from_config(database_path)
+        assert isinstance(backends[0], PackfileBlobBackend)
+        assert backends[0].max_packfile_size == 1000
+        assert isinstance(backends[1], SqliteBlobBackend)
+
+        Config.set("PLANNER", "blob_backend", "unknown")
+        with pytest.raises(ValueError):
+            blob_backends_from_config(database_path)
+
+    @pytest.mark.benchmark
+    @pytest.mark.parametrize("blob_backend", ["sqlite", "packfile"])
+    @pytest.mark.parametrize("blob_size", [1_000_000, 100_000_000, 1_000_000_000, 5_000_000_000])
+    def test_throughput_benchmark(self, database_path, blob_backend, blob_size):
+        """
+        Measures the write and read throughput of checkpoints stored in each backend.
+        """
+        if psutil.virtual_memory().available < 3 * blob_size:
+            pytest.skip(f"Not enough memory for {blob_size / 1e9:.1f} GB blobs")
+        Config.set("PLANNER", "blob_backend", blob_backend)
+        Config.set("PLANNER", "compression_codec", "none")
+        checkpoint = KishuCheckpoint(database_path)
+        checkpoint.init_database()
+        data = os.urandom(blob_size)
+
+        start_time = time.time()
+        checkpoint.store_checkpoint("1", data)
+        write_time_s = time.time() - start_time
+        start_time = time.time()
+        assert checkpoint.get_checkpoint("1") == data
+        read_time_s = time.time() - start_time
+        database_size = os.path.getsize(database_path)
+
+        # Backend alone, without chunking and digesting.
+        backend = blob_backends_from_config(database_path)[0]
+        con = sqlite3.connect(database_path)
+        cur = con.cursor()
+        pieces = [(i.to_bytes(16, "big"), 1, data[i : i + 65536]) for i in range(0, blob_size, 65536)]
+        start_time = time.time()
+        backend.insert(cur, pieces)
+        con.commit()
+        backend_write_time_s = time.time() - start_time
+        start_time = time.time()
+        assert len(backend.load(cur, [digest for digest, _, _ in pieces])) == len(pieces)
+        backend_read_time_s = time.time() - start_time
+        print(
+            f"{blob_backend}, {blob_size / 1e6:.0f} MB: write {blob_size / 1e6 / write_time_s:.1f} MB/s, "
+            f"read {blob_size / 1e6 / read_time_s:.1f} MB/s, database {database_size / 1e6:.1f} MB; "
+            f"backend alone: write {blob_size / 1e6 / backend_write_time_s:.1f} MB/s, "
+            f"read {blob_size / 1e6 / backend_read_time_s:.1f} MB/s"
+        )
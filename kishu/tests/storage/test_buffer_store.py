@@ -0,0 +1,651 @@
+import io
+import mmap
+import os
+import sqlite3
+import time
+
+import dill
+import numpy
+import pandas
+import pytest
+from sklearn.neural_network import MLPRegressor
+
+from kishu.jupyter.namespace import Namespace
+from kishu.storage.blob_backend import CHUNK_TABLE
+from kishu.storage.buffer_store import (
+    BUFFER_FILE_SUFFIX,
+    BUFFER_MAGIC,
+    BUFFER_REF_TABLE,
+    BUFFER_REF_TABLE_NAMES_IDX,
+    DELTA_FILE_SUFFIX,
+    SHARED_MAGIC,
+    KishuBufferStore,
+)
+from kishu.storage.checkpoint import KishuCheckpoint
+from kishu.storage.config import Config
+from kishu.storage.disk_ahg import VariableSnapshot
+from kishu.storage.path import KishuPath
+
+REGISTRY: dict = {}
+
+
+class Registered:
+    """
+    Pickles as a tuple holding a registered list, which the garbage collector does not find reachable from it.
+    """
+
+    def __init__(self, key: str) -> None:
+        self.key = key
+
+    def __reduce__(self):
+        return (tuple, ([REGISTRY[self.key]],))
+
+
+class Unloadable:
+    """
+    Pickles as a call failing on unpickling.
+    """
+
+    def __reduce__(self):
+        return (int, ("not a number",))
+
+
+class TestKishuBufferStore:
+    @pytest.fixture
+    def database_path(self, nb_simple_path):
+        database_path = KishuPath.database_path(nb_simple_path)
+        con = sqlite3.connect(database_path)
+        KishuBufferStore.init_database(con.cursor())
+        con.commit()
+        return database_path
+
+    @staticmethod
+    def num_buffer_files(buffer_store):
+        return len(list(buffer_store.directory.iterdir())) if buffer_store.directory.exists() else 0
+
+    @staticmethod
+    def buffer_file_sizes(buffer_store, suffix):
+        return [path.stat().st_size for path in buffer_store.directory.iterdir() if path.name.endswith(suffix)]
+
+    def test_round_trip(self, database_path):
+        buffer_store = KishuBufferStore(database_path, min_size=1000)
+        array = numpy.random.rand(1000, 100)
+        df = pandas.DataFrame({"a": numpy.random.rand(10000), "b": numpy.arange(10000)})
+
+        data = buffer_store.dumps({"array": array, "df": df, "small": numpy.arange(10), "list": [1, 2]})
+        assert data.startswith(BUFFER_MAGIC)
+        assert len(data) < 10000
+        assert self.num_buffer_files(buffer_store) == 3
+
+        loaded = buffer_store.loads(data)
+        assert numpy.array_equal(loaded["array"], array)
+        assert loaded["df"].equals(df)
+        assert numpy.array_equal(loaded["small"], numpy.arange(10))
+        assert loaded["list"] == [1, 2]
+
+    def test_load_memory_mapped(self, database_path):
+        buffer_store = KishuBufferStore(database_path, min_size=1000)
+        array = numpy.random.rand(100000)
+        data = buffer_store.dumps(array)
+
+        loaded = buffer_store.loads(data)
+        base = loaded
+        while isinstance(base, numpy.ndarray):
+            base = base.base
+        assert isinstance(base.obj, mmap.mmap)
+
+        # Restored arrays are writable without modifying the stored buffer.
+        loaded[0] = -1.0
+        assert buffer_store.loads(data)[0] == array[0]
+
+    def test_small_buffers_in_band(self, database_path):
+        buffer_store = KishuBufferStore(database_path, min_size=1 << 20)
+        array = numpy.random.rand(1000)
+
+        data = buffer_store.dumps(array)
+        assert not data.startswith(BUFFER_MAGIC)
+        assert self.num_buffer_files(buffer_store) == 0
+        assert numpy.array_equal(dill.loads(data), array)
+
+    def test_empty_buffers(self, database_path):
+        buffer_store = KishuBufferStore(database_path)
+        variables = {"x": numpy.zeros(0), "y": numpy.zeros(0), "z": numpy.zeros((0, 3))}
+
+        loaded = buffer_store.loads(buffer_store.dumps(variables))
+        assert loaded["x"].shape == loaded["y"].shape == (0,)
+        assert loaded["z"].shape == (0, 3)
+
+    def test_load_plain_pickle(self, database_path):
+        buffer_store = KishuBufferStore(database_path)
+        assert buffer_store.loads(dill.dumps({"x": 1})) == {"x": 1}
+
+    def test_dedup_buffers(self, database_path):
+        buffer_store = KishuBufferStore(database_path, min_size=1000)
+        array = numpy.random.rand(10000)
+
+        buffer_store.dumps({"x": array})
+        buffer_store.dumps({"y": array, "z": array + 1})
+        assert self.num_buffer_files(buffer_store) == 2
+
+    def test_sweep(self, database_path):
+        buffer_store = KishuBufferStore(database_path, min_size=1000)
+        con = sqlite3.connect(database_path)
+        cur = con.cursor()
+        kept_data = buffer_store.dumps(numpy.random.rand(10000))
+        KishuBufferStore.store_refs(cur, "1", "", kept_data)
+        buffer_store.dumps(numpy.random.rand(10000))
+        assert cur.execute(f"select count(*) from {BUFFER_REF_TABLE}").fetchone()[0] == 1
+
+        # Recently written buffers may not be referenced yet.
+        assert buffer_store.sweep(cur) == (0, 0)
+
+        assert buffer_store.sweep(cur, grace_period_s=0) == (1, 80000)
+        assert self.num_buffer_files(buffer_store) == 1
+        assert buffer_store.loads(kept_data).shape == (10000,)
+
+    def test_dataframe_columns(self, database_path):
+        buffer_store = KishuBufferStore(database_path, min_size=1000)
+        df = pandas.DataFrame(
+            {"a": numpy.random.rand(10000), "b": numpy.random.rand(10000), "c": numpy.arange(10000), "d": ["x"] * 10000}
+        )
+        df.attrs = {"source": "test"}
+        data = buffer_store.dumps(df)
+        assert self.num_buffer_files(buffer_store) == 3
+
+        # Modifying or adding a column stores only that column.
+        a = df["a"].copy()
+        df["a"] = df["a"] + 1
+        df["e"] = numpy.random.rand(10000)
+        edited_data = buffer_store.dumps(df)
+        assert self.num_buffer_files(buffer_store) == 5
+
+        loaded = buffer_store.loads(edited_data)
+        pandas.testing.assert_frame_equal(loaded, df)
+        assert loaded.attrs == {"source": "test"}
+        base = loaded["b"].to_numpy()
+        while isinstance(base, numpy.ndarray):
+            base = base.base
+        assert isinstance(base.obj, mmap.mmap)
+        assert buffer_store.loads(data)["a"].equals(a)
+
+    @pytest.mark.parametrize(
+        "df",
+        [
+            pandas.DataFrame(numpy.random.rand(1000, 3), columns=["a", "a", "b"]),
+            pandas.DataFrame(
+                numpy.random.rand(1000, 2),
+                columns=pandas.MultiIndex.from_tuples([("x", 1), ("y", 2)]),
+                index=pandas.date_range("2024-01-01", periods=1000),
+            ),
+            pandas.DataFrame(
+                {
+                    "category": pandas.Categorical(["p", "q"] * 500),
+                    "time": pandas.date_range("2024-01-01", periods=1000, tz="UTC"),
+                    "nullable": pandas.array([1, None] * 500, dtype="Int64"),
+                }
+            ),
+            pandas.DataFrame(),
+        ],
+    )
+    def test_dataframe_round_trip(self, database_path, df):
+        buffer_store = KishuBufferStore(database_path, min_size=1000)
+        pandas.testing.assert_frame_equal(buffer_store.loads(buffer_store.dumps(df)), df)
+
+    @pytest.mark.filterwarnings("ignore::sklearn.exceptions.ConvergenceWarning")
+    def test_sklearn_params(self, database_path):
+        buffer_store = KishuBufferStore(database_path, min_size=1 << 20, model_param_min_size=1000)
+        x, y = numpy.random.rand(100, 20), numpy.random.rand(100, 10)
+        model = MLPRegressor(hidden_layer_sizes=(50, 30), max_iter=5).fit(x, y)
+        data = buffer_store.dumps({"model": model, "array": numpy.random.rand(1000)})
+
+        # Only the fitted weights are parameters stored out of band.
+        assert self.num_buffer_files(buffer_store) == 3
+
+        # Fine-tuning the last layer stores only its weights.
+        model.coefs_[-1] = model.coefs_[-1] + 1.0
+        edited_data = buffer_store.dumps({"model": model})
+        assert self.num_buffer_files(buffer_store) == 4
+
+        assert numpy.array_equal(buffer_store.loads(edited_data)["model"].predict(x), model.predict(x))
+        assert not numpy.array_equal(buffer_store.loads(data)["model"].predict(x), model.predict(x))
+
+    def test_torch_params(self, database_path):
+        torch = pytest.importorskip("torch")
+        buffer_store = KishuBufferStore(database_path, min_size=1 << 20, model_param_min_size=1000)
+        model = torch.nn.Sequential(torch.nn.Linear(100, 50), torch.nn.ReLU(), torch.nn.Linear(50, 20))
+        tensors = {"bfloat16": torch.rand(1000).to(torch.bfloat16), "frozen": torch.rand(1000)}
+        data = buffer_store.dumps({"model": model, "tensors": tensors})
+        assert self.num_buffer_files(buffer_store) == 4
+
+        # Fine-tuning the last layer stores only its weights.
+        with torch.no_grad():
+            model[2].weight += 1.0
+        edited_data = buffer_store.dumps({"model": model})
+        assert self.num_buffer_files(buffer_store) == 5
+
+        loaded = buffer_store.loads(data)
+        assert loaded["tensors"]["bfloat16"].dtype == torch.bfloat16
+        assert torch.equal(loaded["tensors"]["bfloat16"], tensors["bfloat16"])
+        loaded_model = buffer_store.loads(edited_data)["model"]
+        assert isinstance(loaded_model[2].weight, torch.nn.Parameter)
+        assert loaded_model[2].weight.requires_grad
+        for name, tensor in model.state_dict().items():
+            assert torch.equal(loaded_model.state_dict()[name], tensor)
+
+    def test_split_shared(self, database_path):
+        buffer_store = KishuBufferStore(database_path, min_size=1000)
+        cache = [str(i) for i in range(1000)]
+        config = {"cache": cache, "lr": 0.1}
+        array = numpy.random.rand(10000)
+        variables = {"cache": cache, "config": config, "model": [cache, array], "array": array, "alias": config}
+
+        data = buffer_store.dumps(variables, split_shared=True)
+        assert KishuBufferStore.parse_header(data)[0]
+        f = io.BytesIO()
+        buffer_store.dump(variables, f, split_shared=True)
+        assert f.getvalue().startswith(SHARED_MAGIC)
+
+        # Objects remain shared after loading.
+        for loaded in [buffer_store.loads(data), buffer_store.load(io.BufferedReader(io.BytesIO(f.getvalue())))]:
+            assert loaded["cache"] == cache
+            assert loaded["config"]["cache"] is loaded["cache"]
+            assert loaded["model"][0] is loaded["cache"]
+            assert loaded["model"][1] is loaded["array"]
+            assert loaded["alias"] is loaded["config"]
+            assert numpy.array_equal(loaded["array"], array)
+
+    def test_split_shared_found_by_pickling(self, database_path):
+        buffer_store = KishuBufferStore(database_path)
+        REGISTRY["shared"] = [1, 2, 3]
+        variables = {"a": Registered("shared"), "b": [Registered("shared")]}
+
+        # Objects first found shared while pickling become parts of their own.
+        data = buffer_store.dumps(variables, split_shared=True)
+        assert data.startswith(SHARED_MAGIC)
+        loaded = buffer_store.loads(data)
+        assert loaded["a"][0] == [1, 2, 3]
+        assert loaded["b"][0][0] is loaded["a"][0]
+
+    def test_split_shared_cycle(self, database_path):
+        buffer_store = KishuBufferStore(database_path)
+        x: list = []
+        y = [x]
+        x.append(y)
+
+        # Variables referencing each other are pickled together.
+        data = buffer_store.dumps({"x": x, "y": y}, split_shared=True)
+        assert not data.startswith(SHARED_MAGIC)
+        loaded = buffer_store.loads(data)
+        assert loaded["x"][0] is loaded["y"]
+        assert loaded["y"][0] is loaded["x"]
+
+    def test_split_shared_select(self, database_path):
+        buffer_store = KishuBufferStore(database_path)
+        cache = [str(i) for i in range(1000)]
+        variables = {"cache": cache, "config": {"cache": cache}, "unloadable": Unloadable()}
+        data = buffer_store.dumps(variables, split_shared=True)
+        assert data.startswith(SHARED_MAGIC)
+
+        # Loading some variables unpickles only their parts and the parts they reference.
+        loaded = buffer_store.loads(data, {"config"})
+        assert loaded.keys() == {"config"}
+        assert loaded["config"]["cache"] == cache
+        with pytest.raises(ValueError):
+            buffer_store.loads(data)
+
+    def test_delta(self, database_path):
+        buffer_store = KishuBufferStore(database_path, min_size=1000, delta_block_size=1000)
+        array = numpy.random.rand(100000)
+        data = buffer_store.dumps(array)
+        base_digests, _ = KishuBufferStore.parse_header(data)
+
+        # Modifying a row stores the block containing it.
+        edited_array = array.copy()
+        edited_array[50000] = -1.0
+        edited_data = buffer_store.dumps(edited_array, base_digests)
+        assert self.buffer_file_sizes(buffer_store, DELTA_FILE_SUFFIX) == [pytest.approx(1000, abs=100)]
+
+        # Appending stores the appended blocks.
+        appended_array = numpy.append(edited_array, numpy.random.rand(1000))
+        appended_data = buffer_store.dumps(appended_array, KishuBufferStore.parse_header(edited_data)[0])
+        assert sorted(self.buffer_file_sizes(buffer_store, DELTA_FILE_SUFFIX))[1] == pytest.approx(8000, abs=200)
+
+        # Buffers differing in most blocks are stored whole.
+        buffer_store.dumps(array + 1, base_digests)
+        assert len(self.buffer_file_sizes(buffer_store, DELTA_FILE_SUFFIX)) == 2
+        assert len(self.buffer_file_sizes(buffer_store, BUFFER_FILE_SUFFIX)) == 2
+
+        assert numpy.array_equal(buffer_store.loads(data), array)
+        assert numpy.array_equal(buffer_store.loads(edited_data), edited_array)
+        assert numpy.array_equal(buffer_store.loads(appended_data), appended_array)
+
+        # Restored deltas are writable without modifying the stored buffers.
+        loaded = buffer_store.loads(edited_data)
+        loaded[0] = -1.0
+        assert buffer_store.loads(data)[0] == array[0]
+
+    def test_delta_keyframes(self, database_path):
+        buffer_store = KishuBufferStore(database_path, min_size=1000, delta_block_size=1000, keyframe_interval=3)
+        array = numpy.random.rand(100000)
+        versions = []
+        base_digests = []
+        for i in range(7):
+            array = array.copy()
+            array[i] = -1.0
+            data = buffer_store.dumps(array, base_digests)
+            base_digests, _ = KishuBufferStore.parse_header(data)
+            versions.append((array, data))
+
+        # Versions 0, 3 and 6 are stored whole, each followed by two deltas.
+        assert len(self.buffer_file_sizes(buffer_store, BUFFER_FILE_SUFFIX)) == 3
+        assert len(self.buffer_file_sizes(buffer_store, DELTA_FILE_SUFFIX)) == 4
+        for array, data in versions:
+            assert numpy.array_equal(buffer_store.loads(data), array)
+
+    def test_sweep_delta_bases(self, database_path):
+        buffer_store = KishuBufferStore(database_path, min_size=1000, delta_block_size=1000)
+        con = sqlite3.connect(database_path)
+        cur = con.cursor()
+        array = numpy.random.rand(100000)
+        data = buffer_store.dumps(array)
+        array[0] = -1.0
+        edited_data = buffer_store.dumps(array, KishuBufferStore.parse_header(data)[0])
+        KishuBufferStore.store_refs(cur, "2", "", edited_data)
+
+        # The unreferenced base of the referenced delta is kept.
+        assert buffer_store.sweep(cur, grace_period_s=0) == (0, 0)
+        assert numpy.array_equal(buffer_store.loads(edited_data), array)
+
+    def test_latest_digests(self, database_path):
+        con = sqlite3.connect(database_path)
+        cur = con.cursor()
+        KishuBufferStore.store_digest_refs(cur, "1", "1,x,y", [b"a"])
+        KishuBufferStore.store_digest_refs(cur, "2", "2,x,y", [b"b", b"c"])
+        KishuBufferStore.store_digest_refs(cur, "3", "3,x", [b"d"])
+        assert sorted(KishuBufferStore.latest_digests(cur, "4,x,y")) == [b"b", b"c"]
+        assert KishuBufferStore.latest_digests(cur, "4,y") == []
+
+        # The latest blob is found through the index on variable names.
+        plan = cur.execute(
+            f"explain query plan select commit_id, blob_key from {BUFFER_REF_TABLE} where names = ? order by rowid desc",
+            ("x,y",),
+        ).fetchall()
+        assert len(plan) == 1 and f"USING INDEX {BUFFER_REF_TABLE_NAMES_IDX}" in plan[0][-1]
+
+    def test_migrate_refs_without_names(self, nb_simple_path):
+        # Buffer references stored without variable names by older versions.
+        con = sqlite3.connect(KishuPath.database_path(nb_simple_path))
+        cur = con.cursor()
+        cur.execute(f"create table {BUFFER_REF_TABLE} (commit_id text, blob_key text, digest blob)")
+        cur.executemany(f"insert into {BUFFER_REF_TABLE} values (?, ?, ?)", [("1", "1,x", b"a"), ("1", "", b"b")])
+
+        KishuBufferStore.init_database(cur)
+        KishuBufferStore.init_database(cur)
+        assert cur.execute(f"select blob_key, names from {BUFFER_REF_TABLE} order by blob_key").fetchall() == [
+            ("", ""),
+            ("1,x", "x"),
+        ]
+        assert KishuBufferStore.latest_digests(cur, "2,x") == [b"a"]
+
+
+class TestCheckpointBuffers:
+    @pytest.fixture
+    def kishu_checkpoint(self, nb_simple_path):
+        Config.set("PLANNER", "out_of_band_min_size", 1000)
+        kishu_checkpoint = KishuCheckpoint(KishuPath.database_path(nb_simple_path))
+        kishu_checkpoint.init_database()
+        return kishu_checkpoint
+
+    def test_store_checkpoint(self, kishu_checkpoint):
+        array = numpy.random.rand(10000)
+        kishu_checkpoint.store_checkpoint("1", kishu_checkpoint.dumps({"array": array}))
+
+        con = sqlite3.connect(kishu_checkpoint.database_path)
+        assert con.execute(f"select commit_id from {BUFFER_REF_TABLE}").fetchall() == [("1",)]
+        assert numpy.array_equal(kishu_checkpoint.loads(kishu_checkpoint.get_checkpoint("1"))["array"], array)
+
+    @pytest.mark.parametrize("chunk_dedup", [False, True])
+    def test_load_checkpoint_variables(self, kishu_checkpoint, chunk_dedup):
+        Config.set("PLANNER", "chunk_dedup", chunk_dedup)
+        kishu_checkpoint = KishuCheckpoint(kishu_checkpoint.database_path)
+        array = numpy.random.rand(10000)
+        kishu_checkpoint.dump_checkpoint("1", {"array": array, "arrays": [array], "unloadable": Unloadable()})
+
+        loaded = kishu_checkpoint.load_checkpoint("1", {"array", "arrays"})
+        assert loaded.keys() == {"array", "arrays"}
+        assert loaded["arrays"][0] is loaded["array"]
+        assert numpy.array_equal(loaded["array"], array)
+
+    def test_delta_variable_snapshots(self, kishu_checkpoint):
+        Config.set("PLANNER", "delta_block_size", 1000)
+        kishu_checkpoint = KishuCheckpoint(kishu_checkpoint.database_path, incremental_cr=True)
+        kishu_checkpoint.init_database()
+        array = numpy.random.rand(100000)
+        vs_1, vs_2 = VariableSnapshot(frozenset({"array"}), 1), VariableSnapshot(frozenset({"array"}), 2)
+        kishu_checkpoint.store_variable_snapshots("1", [vs_1], Namespace({"array": array}))
+        edited_array = array.copy()
+        edited_array[:10] = -1.0
+        kishu_checkpoint.store_variable_snapshots("2", [vs_2], Namespace({"array": edited_array}))
+
+        # The second version of the array is stored as a delta from the first.
+        delta_paths = list(kishu_checkpoint._buffer_store.directory.glob(f"*{DELTA_FILE_SUFFIX}"))
+        assert len(delta_paths) == 1
+        assert delta_paths[0].stat().st_size < 2000
+        loaded = kishu_checkpoint.load_variable_snapshots([vs_1, vs_2])
+        assert numpy.array_equal(loaded[0]["array"], array)
+        assert numpy.array_equal(loaded[1]["array"], edited_array)
+
+    def test_split_dataframes_disabled(self, kishu_checkpoint):
+        Config.set("PLANNER", "split_dataframes", False)
+        kishu_checkpoint = KishuCheckpoint(kishu_checkpoint.database_path)
+        df = pandas.DataFrame({"a": numpy.random.rand(10000), "b": numpy.random.rand(10000)})
+        kishu_checkpoint.dumps(df)
+
+        # The float columns are stored as one block.
+        assert len(list(kishu_checkpoint._buffer_store.directory.iterdir())) == 1
+
+    def test_split_shared_variable_snapshots(self, kishu_checkpoint):
+        kishu_checkpoint = KishuCheckpoint(kishu_checkpoint.database_path, incremental_cr=True)
+        kishu_checkpoint.init_database()
+        cache = {i: f"value {i}" for i in range(100000)}
+        variables = {"cache": cache, "a": [cache, 1], "b": {"cache": cache}}
+        vs_1, vs_2 = VariableSnapshot(frozenset(variables), 1), VariableSnapshot(frozenset(variables), 2)
+        kishu_checkpoint.store_variable_snapshots("1", [vs_1], Namespace(variables))
+
+        # Modifying a variable of the snapshot does not store the shared cache again.
+        con = sqlite3.connect(kishu_checkpoint.database_path)
+        size_before = con.execute(f"select sum(length(data)) from {CHUNK_TABLE}").fetchone()[0]
+        variables["a"].append(2)
+        kishu_checkpoint.store_variable_snapshots("2", [vs_2], Namespace(variables))
+        assert con.execute(f"select sum(length(data)) from {CHUNK_TABLE}").fetchone()[0] - size_before < 0.1 * size_before
+
+        loaded = kishu_checkpoint.load_variable_snapshots([vs_2])[0]
+        assert loaded["a"] == [cache, 1, 2]
+        assert loaded["a"][0] is loaded["cache"]
+        assert loaded["b"]["cache"] is loaded["cache"]
+
+    def test_disabled(self, kishu_checkpoint):
+        Config.set("PLANNER", "out_of_band_buffers", False)
+        kishu_checkpoint = KishuCheckpoint(kishu_checkpoint.database_path)
+        data = kishu_checkpoint.dumps(numpy.random.rand(10000))
+        assert not data.startswith(BUFFER_MAGIC)
+
+    @pytest.mark.benchmark
+    @pytest.mark.parametrize("out_of_band_buffers", [False, True])
+    def test_checkout_benchmark(self, kishu_checkpoint, out_of_band_buffers):
+        """
+        Measures the time to store and restore a checkpoint holding a large array.
+        """
+        Config.set("PLANNER", "out_of_band_buffers", out_of_band_buffers)
+        Config.set("PLANNER", "out_of_band_min_size", 1 << 20)
+        kishu_checkpoint = KishuCheckpoint(kishu_checkpoint.database_path)
+        array = numpy.random.rand(50_000_000)
+
+        start_time = time.time()
+        kishu_checkpoint.store_checkpoint("1", kishu_checkpoint.dumps({"array": array}))
+        store_time_s = time.time() - start_time
+
+        start_time = time.time()
+        loaded = kishu_checkpoint.loads(kishu_checkpoint.get_checkpoint("1"))
+        load_time_s = time.time() - start_time
+
+        start_time = time.time()
+        checksum = loaded["array"].sum()
+        access_time_s = time.time() - start_time
+        assert checksum == array.sum()
+        print(
+            f"out_of_band_buffers={out_of_band_buffers}, {array.nbytes / 1e6:.0f} MB array: "
+            f"store {store_time_s:.3f}s, restore {load_time_s:.3f}s, first full scan {access_time_s:.3f}s, "
+            f"database {os.path.getsize(kishu_checkpoint.database_path) / 1e6:.1f} MB"
+        )
+
+    @pytest.mark.benchmark
+    @pytest.mark.parametrize("update", ["row", "slice", "rewrite", "append"])
+    @pytest.mark.parametrize("delta_buffers", [False, True])
+    def test_delta_benchmark(self, kishu_checkpoint, delta_buffers, update):
+        """
+        Measures the size written to store an updated version of a large array and the time to restore it.
+        """
+        Config.set("PLANNER", "delta_buffers", delta_buffers)
+        Config.set("PLANNER", "out_of_band_min_size", 1 << 20)
+        kishu_checkpoint = KishuCheckpoint(kishu_checkpoint.database_path, incremental_cr=True)
+        kishu_checkpoint.init_database()
+        array = numpy.random.rand(25_000, 1_000)
+        vs_1, vs_2 = VariableSnapshot(frozenset({"array"}), 1), VariableSnapshot(frozenset({"array"}), 2)
+        kishu_checkpoint.store_variable_snapshots("1", [vs_1], Namespace({"array": array}))
+
+        if update == "row":
+            array[12_345] = 0.0
+        elif update == "slice":
+            array[10_000:11_000] += 1.0
+        elif update == "rewrite":
+            array = array * 2.0
+        else:
+            array = numpy.append(array, numpy.random.rand(1_000, 1_000), axis=0)
+        directory = kishu_checkpoint._buffer_store.directory
+        size_before = sum(path.stat().st_size for path in directory.iterdir())
+        start_time = time.time()
+        kishu_checkpoint.store_variable_snapshots("2", [vs_2], Namespace({"array": array}))
+        store_time_s = time.time() - start_time
+        written_mb = (sum(path.stat().st_size for path in directory.iterdir()) - size_before) / 1e6
+
+        start_time = time.time()
+        (loaded,) = kishu_checkpoint.load_variable_snapshots([vs_2])
+        checksum = loaded["array"].sum()
+        restore_time_s = time.time() - start_time
+        assert checksum == array.sum()
+        print(
+            f"delta_buffers={delta_buffers}, {update} of a {array.nbytes / 1e6:.0f} MB array: wrote {written_mb:.1f} MB "
+            f"in {store_time_s:.3f}s, restore and full scan {restore_time_s:.3f}s"
+        )
+
+    @pytest.mark.benchmark
+    @pytest.mark.parametrize("update", ["add", "modify"])
+    @pytest.mark.parametrize("split_dataframes", [False, True])
+    def test_split_dataframes_benchmark(self, kishu_checkpoint, split_dataframes, update):
+        """
+        Measures the size written to store a DataFrame after adding or modifying one of its columns.
+        """
+        Config.set("PLANNER", "split_dataframes", split_dataframes)
+        Config.set("PLANNER", "out_of_band_min_size", 1 << 20)
+        kishu_checkpoint = KishuCheckpoint(kishu_checkpoint.database_path, incremental_cr=True)
+        kishu_checkpoint.init_database()
+        df = pandas.DataFrame({f"c{i}": numpy.random.rand(1_000_000) for i in range(20)})
+        vs_1, vs_2 = VariableSnapshot(frozenset({"df"}), 1), VariableSnapshot(frozenset({"df"}), 2)
+        kishu_checkpoint.store_variable_snapshots("1", [vs_1], Namespace({"df": df}))
+
+        if update == "add":
+            df["new"] = df["c0"] * 2.0
+        else:
+            df["c10"] = df["c10"] * 2.0
+        directory = kishu_checkpoint._buffer_store.directory
+        size_before = sum(path.stat().st_size for path in directory.iterdir())
+        start_time = time.time()
+        kishu_checkpoint.store_variable_snapshots("2", [vs_2], Namespace({"df": df}))
+        store_time_s = time.time() - start_time
+        written_mb = (sum(path.stat().st_size for path in directory.iterdir()) - size_before) / 1e6
+
+        start_time = time.time()
+        (loaded,) = kishu_checkpoint.load_variable_snapshots([vs_2])
+        restore_time_s = time.time() - start_time
+        assert loaded["df"].equals(df)
+        print(
+            f"split_dataframes={split_dataframes}, {update} a column of a {df.memory_usage().sum() / 1e6:.0f} MB "
+            f"DataFrame: wrote {written_mb:.1f} MB in {store_time_s:.3f}s, restore {restore_time_s:.3f}s"
+        )
+
+    @pytest.mark.benchmark
+    @pytest.mark.filterwarnings("ignore::sklearn.exceptions.ConvergenceWarning")
+    @pytest.mark.parametrize("model_param_min_size", [1 << 20, 1 << 16])
+    def test_model_params_benchmark(self, kishu_checkpoint, model_param_min_size):
+        """
+        Measures the size written to store a model of many small layers after fine-tuning its last layer, and the
+        time to restore it.
+        """
+        Config.set("PLANNER", "model_param_min_size", model_param_min_size)
+        kishu_checkpoint = KishuCheckpoint(kishu_checkpoint.database_path, incremental_cr=True)
+        kishu_checkpoint.init_database()
+        x, y = numpy.random.rand(1000, 300), numpy.random.rand(1000, 100)
+        model = MLPRegressor(hidden_layer_sizes=(300,) * 100, max_iter=1).fit(x, y)
+        vs_1, vs_2 = VariableSnapshot(frozenset({"model"}), 1), VariableSnapshot(frozenset({"model"}), 2)
+        kishu_checkpoint.store_variable_snapshots("1", [vs_1], Namespace({"model": model}))
+
+        model.coefs_[-1] = model.coefs_[-1] + 1.0
+        con = sqlite3.connect(kishu_checkpoint.database_path)
+        directory = kishu_checkpoint._buffer_store.directory
+
+        def stored_mb():
+            chunk_mb = con.execute(f"select sum(length(data)) from {CHUNK_TABLE}").fetchone()[0] / 1e6
+            return chunk_mb + sum(path.stat().st_size for path in directory.iterdir()) / 1e6
+
+        size_before = stored_mb()
+        start_time = time.time()
+        kishu_checkpoint.store_variable_snapshots("2", [vs_2], Namespace({"model": model}))
+        store_time_s = time.time() - start_time
+        written_mb = stored_mb() - size_before
+
+        start_time = time.time()
+        (loaded,) = kishu_checkpoint.load_variable_snapshots([vs_2])
+        restore_time_s = time.time() - start_time
+        assert numpy.array_equal(loaded["model"].predict(x), model.predict(x))
+        print(
+            f"model_param_min_size={model_param_min_size}, fine-tuned last layer: wrote {written_mb:.1f} MB "
+            f"in {store_time_s:.3f}s, restore {restore_time_s:.3f}s"
+        )
+
+    @pytest.mark.benchmark
+    @pytest.mark.parametrize("split_shared_objects", [False, True])
+    def test_split_shared_benchmark(self, kishu_checkpoint, split_shared_objects):
+        """
+        Measures the size written to store a variable snapshot of variables sharing a large cache after modifying one.
+        """
+        Config.set("PLANNER", "split_shared_objects", split_shared_objects)
+        kishu_checkpoint = KishuCheckpoint(kishu_checkpoint.database_path, incremental_cr=True)
+        kishu_checkpoint.init_database()
+        # Cached entries reference shared objects, i.e., the pickle references them by their indices in its memo.
+        units = [{"unit": "ms"}, {"unit": "s"}]
+        cache = {f"key {i}": [i, units[i % 2]] for i in range(500_000)}
+        config = {"cache": cache, "seed": 0}
+        variables = {f"x{i}": {"results": [[j, units[j % 2]] for j in range(10_000)], "config": config} for i in range(10)}
+        variables["config"] = config
+        vs_1, vs_2 = VariableSnapshot(frozenset(variables), 1), VariableSnapshot(frozenset(variables), 2)
+        kishu_checkpoint.store_variable_snapshots("1", [vs_1], Namespace(variables))
+
+        # Modify the variable pickled first, shifting the memo indices of the objects pickled after it.
+        first = next(name for name in Namespace(variables).subset(set(vs_1.name)).to_dict() if name != "config")
+        variables[first]["results"].insert(0, "new")
+        con = sqlite3.connect(kishu_checkpoint.database_path)
+        size_before = con.execute(f"select sum(length(data)) from {CHUNK_TABLE}").fetchone()[0]
+        start_time = time.time()
+        kishu_checkpoint.store_variable_snapshots("2", [vs_2], Namespace(variables))
+        store_time_s = time.time() - start_time
+        written_mb = (con.execute(f"select sum(length(data)) from {CHUNK_TABLE}").fetchone()[0] - size_before) / 1e6
+
+        start_time = time.time()
+        (loaded,) = kishu_checkpoint.load_variable_snapshots([vs_2])
+        restore_time_s = time.time() - start_time
+        assert loaded[first]["config"] is loaded["config"]
+        print(
+            f"split_shared_objects={split_shared_objects}: first version {size_before / 1e6:.1f} MB, modified one of 11 "
+            f"variables: wrote {written_mb:.1f} MB in {store_time_s:.3f}s, restore {restore_time_s:.3f}s"
+        )
@@ -1,12 +1,20 @@
+import os
 import pickle
+import resource
 import sqlite3
+import time
+from typing import Any, Callable
 
+import numpy
 import pytest
 
 from kishu.jupyter.namespace import Namespace
 from kishu.planning.ahg import VariableSnapshot
 from kishu.storage.checkpoint import CHECKPOINT_TABLE, VARIABLE_SNAPSHOT_TABLE, KishuCheckpoint
+from kishu.storage.chunk_store import CHUNK_TABLE
+from kishu.storage.config import Config
 from kishu.storage.path import KishuPath
+from kishu.storage.snapshot_cache import DEFAULT_SNAPSHOT_CACHE_SIZE
 
 
 class TestKishuCheckpoint:
@@ -14,6 +22,15 @@ class TestKishuCheckpoint:
     def db_path_name(self, nb_simple_path):
         return KishuPath.database_path(nb_simple_path)
 
+    @pytest.fixture
+    def store_raw_blobs(self, tmp_kishu_path):
+        """Fixture for storing blobs without deduplication and compression."""
+        Config.set("PLANNER", "chunk_dedup", False)
+        Config.set("PLANNER", "compression_codec", "none")
+        yield
+        Config.set("PLANNER", "chunk_dedup", True)
+        Config.set("PLANNER", "compression_codec", "auto")
+
     @pytest.fixture
     def kishu_checkpoint(self, db_path_name):
         """Fixture for initializing a KishuBranch instance."""
@@ -108,7 +125,7 @@ def test_get_variable_snapshots(self, kishu_incremental_checkpoint):
         assert unpickled_data_list[0] == {"c": "strc"}
         assert unpickled_data_list[1] == {"b": "strb"}
 
-    def test_chunking(self, kishu_checkpoint):
+    def test_chunking(self, store_raw_blobs, kishu_checkpoint):
         test_str = b"A" * 1500  # 1.5KB, expect 2 chunks
         kishu_checkpoint.store_checkpoint("1", test_str)
 
@@ -120,7 +137,7 @@ def test_chunking(self, kishu_checkpoint):
 
         assert kishu_checkpoint.get_checkpoint("1") == test_str
 
-    def test_chunking_single(self, kishu_incremental_checkpoint):
+    def test_chunking_single(self, store_raw_blobs, kishu_incremental_checkpoint):
         vs_a = VariableSnapshot(frozenset({"a"}), 1)
 
         test_str = "A" * 1500  # 1.5KB, expect 2 chunks
@@ -141,7 +158,7 @@ def test_chunking_single(self, kishu_incremental_checkpoint):
         unpickled_data_list = [pickle.loads(i) for i in data_list]
         assert unpickled_data_list[0] == {"a": test_str}
 
-    def test_chunking_multiple(self, kishu_incremental_checkpoint):
+    def test_chunking_multiple(self, store_raw_blobs, kishu_incremental_checkpoint):
         vs_a = VariableSnapshot(frozenset({"a"}), 1)
         vs_b = VariableSnapshot(frozenset({"b"}), 1)
 
@@ -181,3 +198,223 @@ def test_skip_unserializable(self, kishu_incremental_checkpoint):
         # Only vs_string would be returned (as vs_gen was skipped due to not being serializable).
         nameset = kishu_incremental_checkpoint.get_stored_versioned_names(["1"])
         assert nameset == {vs_string.versioned_name()}
+
+    def test_dedup_checkpoints(self, kishu_checkpoint):
+        data = os.urandom(1000000)
+        edited_data = data[:500000] + b"edit" + data[500000:]
+        kishu_checkpoint.store_checkpoint("1", data)
+        kishu_checkpoint.store_checkpoint("2", edited_data)
+
+        # Only the chunks around the edit are stored again.
+        con = sqlite3.connect(kishu_checkpoint.database_path)
+        cur = con.cursor()
+        cur.execute(f"SELECT sum(length(data)) FROM {CHUNK_TABLE};")
+        assert cur.fetchone()[0] < 1200000
+
+        assert kishu_checkpoint.get_checkpoint("1") == data
+        assert kishu_checkpoint.get_checkpoint("2") == edited_data
+
+    def test_dedup_variable_snapshots(self, kishu_incremental_checkpoint):
+        vs_a1 = VariableSnapshot(frozenset({"a"}), 1)
+        vs_a2 = VariableSnapshot(frozenset({"a"}), 2)
+        vs_b = VariableSnapshot(frozenset({"b"}), 2)
+        a = list(range(100000))
+
+        kishu_incremental_checkpoint.store_variable_snapshots("1", [vs_a1], Namespace({"a": a}))
+        a.append(-1)
+        kishu_incremental_checkpoint.store_variable_snapshots("2", [vs_a2, vs_b], Namespace({"a": a, "b": "strb"}))
+
+        # The appended list shares all but its last chunks with its previous version.
+        con = sqlite3.connect(kishu_incremental_checkpoint.database_path)
+        cur = con.cursor()
+        cur.execute(f"SELECT count(*), sum(refcount) FROM {CHUNK_TABLE};")
+        num_chunks, num_refs = cur.fetchone()
+        assert num_refs - num_chunks > 0
+
+        assert kishu_incremental_checkpoint.get_stored_versioned_names(["2"]) == {
+            vs_a2.versioned_name(),
+            vs_b.versioned_name(),
+        }
+        data_list = kishu_incremental_checkpoint.get_variable_snapshots([vs_a1, vs_a2, vs_b])
+        unpickled_data_list = [pickle.loads(i) for i in data_list]
+        assert unpickled_data_list == [{"a": a[:-1]}, {"a": a}, {"b": "strb"}]
+
+    def test_stream_checkpoint(self, kishu_checkpoint):
+        Config.set("PLANNER", "out_of_band_min_size", 1000)
+        namespace = {"array": numpy.arange(10000), "list": list(range(100000)), "str": "a"}
+        kishu_checkpoint.dump_checkpoint("1", namespace)
+
+        loaded_namespace = kishu_checkpoint.load_checkpoint("1")
+        assert numpy.array_equal(loaded_namespace.pop("array"), namespace["array"])
+        assert loaded_namespace == {"list": namespace["list"], "str": "a"}
+
+    def test_load_dumped_checkpoint(self, kishu_checkpoint):
+        Config.set("PLANNER", "out_of_band_min_size", 1000)
+        kishu_checkpoint = KishuCheckpoint(kishu_checkpoint.database_path)
+        namespace = {"array": numpy.arange(10000)}
+        kishu_checkpoint.store_checkpoint("1", kishu_checkpoint.dumps(namespace))
+
+        # Checkpoints dumped with their buffers' digests up front load as well.
+        assert numpy.array_equal(kishu_checkpoint.load_checkpoint("1")["array"], namespace["array"])
+
+    def test_load_variable_snapshots(self, kishu_incremental_checkpoint):
+        vs_a = VariableSnapshot(frozenset({"a"}), 1)
+        vs_gen = VariableSnapshot(frozenset({"gen"}), 1)
+        vs_b = VariableSnapshot(frozenset({"b"}), 1)
+        a = list(range(100000))
+        kishu_incremental_checkpoint.store_variable_snapshots(
+            "1", [vs_a, vs_gen, vs_b], Namespace({"a": a, "gen": (i for i in range(10)), "b": "strb"})
+        )
+
+        assert kishu_incremental_checkpoint.get_stored_versioned_names(["1"]) == {
+            vs_a.versioned_name(),
+            vs_b.versioned_name(),
+        }
+        assert kishu_incremental_checkpoint.load_variable_snapshots([vs_b, vs_a]) == [{"b": "strb"}, {"a": a}]
+        with pytest.raises(ValueError):
+            kishu_incremental_checkpoint.load_variable_snapshots([vs_gen])
+
+    @pytest.mark.parametrize("chunk_dedup", [False, True])
+    def test_snapshot_cache(self, db_path_name, chunk_dedup):
+        Config.set("PLANNER", "chunk_dedup", chunk_dedup)
+        kishu_checkpoint = KishuCheckpoint(db_path_name, incremental_cr=True)
+        kishu_checkpoint.init_database()
+        vs_a, vs_b = VariableSnapshot(frozenset({"a"}), 1), VariableSnapshot(frozenset({"b"}), 1)
+        kishu_checkpoint.store_variable_snapshots("1", [vs_a], Namespace({"a": list(range(1000))}))
+
+        # Written variable snapshots are read from memory, even by other checkpoints of the same database.
+        other_checkpoint = KishuCheckpoint(db_path_name, incremental_cr=True)
+        stats = other_checkpoint.get_snapshot_cache_stats()
+        assert other_checkpoint.load_variable_snapshots([vs_a]) == [{"a": list(range(1000))}]
+        assert (stats.hits, stats.misses) == (1, 0)
+
+        # Those read from the database are then cached.
+        kishu_checkpoint._snapshot_cache.clear()
+        kishu_checkpoint.store_variable_snapshots("2", [vs_b], Namespace({"b": "strb"}))
+        kishu_checkpoint._snapshot_cache.clear()
+        assert other_checkpoint.load_variable_snapshots([vs_a, vs_b]) == [{"a": list(range(1000))}, {"b": "strb"}]
+        assert other_checkpoint.get_variable_snapshots([vs_b]) == other_checkpoint.get_variable_snapshots([vs_b])
+        assert (stats.hits, stats.misses) == (3, 2)
+        assert stats.hit_rate() == 0.6
+
+        kishu_checkpoint.drop_database()
+        assert other_checkpoint._snapshot_cache.size() == 0
+
+    @pytest.mark.parametrize("serialization_executor", ["process", "thread"])
+    def test_parallel_serialization(self, db_path_name, serialization_executor):
+        Config.set("PLANNER", "serialization_workers", 4)
+        Config.set("PLANNER", "serialization_executor", serialization_executor)
+        Config.set("PLANNER", "out_of_band_min_size", 1000)
+        kishu_checkpoint = KishuCheckpoint(db_path_name, incremental_cr=True)
+        kishu_checkpoint.init_database()
+        variables = {f"x{i}": list(range(i * 1000)) for i in range(8)}
+        variables["array"] = numpy.arange(10000)
+        variables["gen"] = (i for i in range(10))
+        vses = [VariableSnapshot(frozenset({name}), 1) for name in variables]
+
+        kishu_checkpoint.store_variable_snapshots("1", vses, Namespace(variables))
+
+        # All but the unserializable generator are stored.
+        stored_vses = [vs for vs in vses if vs.name != frozenset({"gen"})]
+        assert kishu_checkpoint.get_stored_versioned_names(["1"]) == {vs.versioned_name() for vs in stored_vses}
+        data_list = kishu_checkpoint.get_variable_snapshots(stored_vses)
+        for vs, data in zip(stored_vses, data_list):
+            (name,) = vs.name
+            if name == "array":
+                assert numpy.array_equal(kishu_checkpoint.loads(data)["array"], variables["array"])
+            else:
+                assert kishu_checkpoint.loads(data) == {name: variables[name]}
+
+    def test_unknown_serialization_executor(self, db_path_name):
+        Config.set("PLANNER", "serialization_executor", "unknown")
+        with pytest.raises(ValueError):
+            KishuCheckpoint(db_path_name)
+
+    @pytest.mark.benchmark
+    @pytest.mark.parametrize("variable_kind", ["objects", "arrays"])
+    @pytest.mark.parametrize(
+        ("serialization_executor", "serialization_workers"), [("process", 1), ("process", 4), ("thread", 4)]
+    )
+    def test_parallel_serialization_benchmark(
+        self, db_path_name, variable_kind, serialization_executor, serialization_workers
+    ):
+        """
+        Measures the time to store 20 large independent variables.
+        """
+        Config.set("PLANNER", "serialization_workers", serialization_workers)
+        Config.set("PLANNER", "serialization_executor", serialization_executor)
+        kishu_checkpoint = KishuCheckpoint(db_path_name, incremental_cr=True)
+        kishu_checkpoint.init_database()
+        if variable_kind == "objects":
+            variables = {f"x{i}": [str(j) for j in range(i, i + 300_000)] for i in range(20)}
+        else:
+            variables = {f"x{i}": numpy.random.rand(3_000_000) for i in range(20)}
+        vses = [VariableSnapshot(frozenset({name}), 1) for name in variables]
+
+        start_time = time.time()
+        kishu_checkpoint.store_variable_snapshots("1", vses, Namespace(variables))
+        store_time_s = time.time() - start_time
+        assert len(kishu_checkpoint.get_stored_versioned_names(["1"])) == 20
+        print(
+            f"{variable_kind}, {serialization_executor} x{serialization_workers}: "
+            f"stored 20 variables in {store_time_s:.3f}s ({os.cpu_count()} CPUs)"
+        )
+
+    @pytest.mark.benchmark
+    @pytest.mark.parametrize("snapshot_cache_size", [0, DEFAULT_SNAPSHOT_CACHE_SIZE])
+    def test_snapshot_cache_benchmark(self, db_path_name, snapshot_cache_size):
+        """
+        Measures the time to load the variable snapshots of two branches in turn, 10 times each.
+        """
+        Config.set("PLANNER", "snapshot_cache_size", snapshot_cache_size)
+        kishu_checkpoint = KishuCheckpoint(db_path_name, incremental_cr=True)
+        kishu_checkpoint.init_database()
+        branch_vses = []
+        for version in [1, 2]:
+            vses = [VariableSnapshot(frozenset({f"x{i}"}), version) for i in range(10)]
+            variables = {f"x{i}": {j: str(j + version) for j in range(20_000)} for i in range(10)}
+            kishu_checkpoint.store_variable_snapshots(str(version), vses, Namespace(variables))
+            branch_vses.append(vses)
+
+        start_time = time.time()
+        for _ in range(10):
+            for vses in branch_vses:
+                kishu_checkpoint.load_variable_snapshots(vses)
+        load_time_s = time.time() - start_time
+        hit_rate = kishu_checkpoint.get_snapshot_cache_stats().hit_rate()
+        print(f"snapshot_cache_size={snapshot_cache_size}: loaded in {load_time_s:.3f}s, hit rate {hit_rate:.2f}")
+
+    @pytest.mark.benchmark
+    @pytest.mark.parametrize("streaming", [False, True])
+    def test_stream_checkpoint_benchmark(self, db_path_name, streaming):
+        """
+        Measures the peak memory to store and load a checkpoint of a large namespace without out-of-band buffers.
+        """
+        kishu_checkpoint = KishuCheckpoint(db_path_name)
+        kishu_checkpoint.init_database()
+
+        def max_rss_delta_mb(run: Callable[[], Any]) -> float:
+            # Measure in a child process, whose peak memory is not raised by earlier tests.
+            read_fd, write_fd = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(read_fd)
+                start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                run()
+                delta_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss
+                os.write(write_fd, str(delta_kb / 1024).encode())
+                os._exit(0)
+            os.close(write_fd)
+            with os.fdopen(read_fd) as f:
+                delta_mb = float(f.read())
+            os.waitpid(pid, 0)
+            return delta_mb
+
+        namespace = {i: os.urandom(1000) for i in range(200_000)}
+        if streaming:
+            store_mb = max_rss_delta_mb(lambda: kishu_checkpoint.dump_checkpoint("1", namespace))
+            load_mb = max_rss_delta_mb(lambda: kishu_checkpoint.load_checkpoint("1"))
+        else:
+            store_mb = max_rss_delta_mb(lambda: kishu_checkpoint.store_checkpoint("1", kishu_checkpoint.dumps(namespace)))
+            load_mb = max_rss_delta_mb(lambda: kishu_checkpoint.loads(kishu_checkpoint.get_checkpoint("1")))
+        print(f"streaming={streaming}: peak RSS grows by {store_mb:.1f}MB to store, {load_mb:.1f}MB to load")
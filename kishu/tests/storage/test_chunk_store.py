@@ -0,0 +1,241 @@
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict
+from unittest.mock import patch
+
+import dill
+import nbformat
+import numpy
+import pandas
+import pytest
+from IPython.core.interactiveshell import InteractiveShell
+
+from kishu.jupyter.namespace import Namespace
+from kishu.storage.chunk_store import CHUNK_REF_TABLE, CHUNK_TABLE, FastCDCChunker, KishuChunkStore
+from kishu.storage.path import KishuPath
+
+
+class TestFastCDCChunker:
+    @pytest.fixture
+    def chunker(self):
+        return FastCDCChunker(avg_size=4096)
+
+    def test_small_blob(self, chunker):
+        assert chunker.chunk_boundaries(b"") == []
+        assert chunker.chunk_boundaries(b"abc") == [3]
+
+    def test_chunk_sizes(self, chunker):
+        data = os.urandom(1000000)
+        boundaries = chunker.chunk_boundaries(data)
+
+        assert boundaries[-1] == len(data)
+        sizes = [end - start for start, end in zip([0] + boundaries, boundaries)]
+        assert all(chunker.min_size < size <= chunker.max_size for size in sizes[:-1])
+        assert 2048 < len(data) / len(boundaries) < 8192
+        assert b"".join(chunker.split(data)) == data
+
+    def test_low_entropy_blob(self, chunker):
+        # Without content-defined boundaries, chunks are cut at the maximum size.
+        data = b"A" * 100000
+        assert chunker.chunk_boundaries(data) == list(range(chunker.max_size, len(data), chunker.max_size)) + [len(data)]
+
+    def test_boundaries_shift_with_insertion(self, chunker):
+        data = os.urandom(1000000)
+        boundaries = chunker.chunk_boundaries(data)
+        shifted_boundaries = [end - 5 for end in chunker.chunk_boundaries(b"12345" + data)]
+
+        # Only the chunks near the insertion change.
+        assert len(set(boundaries) - set(shifted_boundaries)) <= 1
+
+    def test_invalid_avg_size(self):
+        with pytest.raises(ValueError):
+            FastCDCChunker(avg_size=16)
+
+
+class TestKishuChunkStore:
+    @pytest.fixture
+    def db_path_name(self, nb_simple_path):
+        database_path = KishuPath.database_path(nb_simple_path)
+        con = sqlite3.connect(database_path)
+        KishuChunkStore().init_database(con.cursor())
+        con.commit()
+        yield database_path
+        os.remove(database_path)
+
+    def test_store_load_release(self, db_path_name):
+        chunk_store = KishuChunkStore(avg_chunk_size=4096)
+        data = os.urandom(100000)
+        con = sqlite3.connect(db_path_name)
+        cur = con.cursor()
+
+        chunk_store.store(cur, "1", "", data)
+        chunk_store.store(cur, "2", "", data + b"tail")
+        assert chunk_store.load(cur, "1", "") == data
+        assert chunk_store.load(cur, "2", "") == data + b"tail"
+        assert chunk_store.load(cur, "3", "") is None
+
+        # Chunks shared by both blobs outlive either of them.
+        KishuChunkStore.release(
+            cur, [row[0] for row in cur.execute(f"select digest from {CHUNK_REF_TABLE} where commit_id = '1'")]
+        )
+        cur.execute(f"delete from {CHUNK_REF_TABLE} where commit_id = '1'")
+        assert chunk_store.load(cur, "2", "") == data + b"tail"
+
+        KishuChunkStore.release(
+            cur, [row[0] for row in cur.execute(f"select digest from {CHUNK_REF_TABLE} where commit_id = '2'")]
+        )
+        assert cur.execute(f"select count(*) from {CHUNK_TABLE}").fetchone()[0] == 0
+
+    def test_load_by_blob_keys(self, db_path_name):
+        chunk_store = KishuChunkStore()
+        con = sqlite3.connect(db_path_name)
+        cur = con.cursor()
+        chunk_store.store(cur, "1", "1,a", b"a")
+        chunk_store.store(cur, "2", "2,b", b"b")
+
+        assert chunk_store.load_by_blob_keys(cur, ["1,a", "2,b", "3,c"]) == {"1,a": b"a", "2,b": b"b"}
+        assert KishuChunkStore.stored_blob_keys(cur, ["2"]) == {"2,b"}
+
+    def test_writer(self, db_path_name):
+        chunk_store = KishuChunkStore(avg_chunk_size=4096)
+        con = sqlite3.connect(db_path_name)
+        cur = con.cursor()
+        data = numpy.random.default_rng(0).bytes(10_000_000)
+
+        chunk_store.store(cur, "1", "", data)
+        with chunk_store.writer(cur, "2", "") as writer:
+            for i in range(0, len(data), 100_003):
+                writer.write(data[i : i + 100_003])
+
+        # Streaming finds the same chunks as chunking the whole blob.
+        def digests(commit_id):
+            return [row[0] for row in cur.execute(f"select digest from {CHUNK_REF_TABLE} where commit_id = ?", (commit_id,))]
+
+        assert digests("2") == digests("1")
+        assert chunk_store.load(cur, "2", "") == data
+
+    def test_writer_abort(self, db_path_name):
+        chunk_store = KishuChunkStore(avg_chunk_size=4096)
+        con = sqlite3.connect(db_path_name)
+        cur = con.cursor()
+        writer = chunk_store.writer(cur, "1", "")
+        writer.write(os.urandom(100000))
+        writer.abort()
+        con.commit()
+        assert chunk_store.load(cur, "1", "") is None
+
+    @pytest.mark.parametrize("read_size", [1, 1000, 1 << 20, -1])
+    def test_reader(self, db_path_name, read_size):
+        chunk_store = KishuChunkStore(avg_chunk_size=4096)
+        con = sqlite3.connect(db_path_name)
+        cur = con.cursor()
+        data = bytes(range(256)) * 2000
+        chunk_store.store(cur, "1", "a", data)
+        assert chunk_store.reader(cur, "2", "a") is None
+
+        reader = chunk_store.reader(cur, "1", "a")
+        read_data = b""
+        while True:
+            piece = reader.read(read_size)
+            if not piece:
+                break
+            read_data += piece
+        assert read_data == data
+        assert chunk_store.readers_by_blob_keys(cur, ["a"])["a"].readall() == data
+
+    @staticmethod
+    def run_notebook_snapshots(notebook_path: Path):
+        """
+        Runs the notebook's cells, yielding the pickled variables changed by each cell as incremental checkpointing
+        would store them.
+        """
+        os.environ["MPLBACKEND"] = "Agg"
+        notebook = nbformat.read(notebook_path, nbformat.NO_CONVERT)
+        shell = InteractiveShell()
+        cwd = os.getcwd()
+        os.chdir(notebook_path.parent)
+        try:
+            with patch.object(shell, "enable_gui", lambda gui=None: None):  # For %matplotlib inline.
+                prev_dumps: Dict[str, bytes] = {}
+                for cell in notebook.cells:
+                    if cell.cell_type != "code":
+                        continue
+                    result = shell.run_cell(cell.source, silent=True)
+                    if not result.success:
+                        pytest.skip(
+                            f"Cannot run {notebook_path.name} here: {result.error_in_exec or result.error_before_exec}"
+                        )
+                    user_ns = Namespace(shell.user_ns)
+                    dumps = {}
+                    for name in user_ns.keyset():
+                        try:
+                            dumps[name] = dill.dumps(user_ns[name])
+                        except Exception:
+                            continue
+                    yield [(name, data) for name, data in dumps.items() if prev_dumps.get(name) != data]
+                    prev_dumps = dumps
+        finally:
+            os.chdir(cwd)
+
+    @staticmethod
+    def growing_variable_snapshots(num_cells: int):
+        """
+        Yields the pickled variables changed by cells each appending a column to a DataFrame and an element to a list.
+        """
+        df = pandas.DataFrame({"c0": numpy.random.rand(100000)})
+        values = list(numpy.random.rand(100000))
+        for cell_num in range(1, num_cells + 1):
+            df[f"c{cell_num}"] = numpy.random.rand(len(df))
+            values.append(cell_num)
+            yield [("df", dill.dumps(df)), ("values", dill.dumps(values))]
+
+    def store_and_report(self, db_path_name, workload_name, snapshots):
+        raw_bytes = sum(len(data) for cell_snapshots in snapshots for _, data in cell_snapshots)
+
+        # Store with deduplication.
+        chunk_store = KishuChunkStore()
+        con = sqlite3.connect(db_path_name)
+        cur = con.cursor()
+        start_time = time.time()
+        for commit_idx, cell_snapshots in enumerate(snapshots):
+            for name, data in cell_snapshots:
+                chunk_store.store(cur, str(commit_idx), f"{commit_idx},{name}", data)
+            con.commit()
+        dedup_time_s = time.time() - start_time
+        stored_bytes = cur.execute(f"select sum(length(data)) from {CHUNK_TABLE}").fetchone()[0] or 0
+
+        # Store whole blobs.
+        cur.execute("create table raw_blob (commit_id text, versioned_name text, data blob)")
+        start_time = time.time()
+        for commit_idx, cell_snapshots in enumerate(snapshots):
+            for name, data in cell_snapshots:
+                cur.execute("insert into raw_blob values (?, ?, ?)", (str(commit_idx), f"{commit_idx},{name}", data))
+            con.commit()
+        raw_time_s = time.time() - start_time
+        con.close()
+
+        print(
+            f"{workload_name}: {raw_bytes / 1e6:.2f} MB of snapshots, {stored_bytes / 1e6:.2f} MB stored, "
+            f"dedup ratio {raw_bytes / max(stored_bytes, 1):.2f}x, "
+            f"write {raw_bytes / 1e6 / dedup_time_s:.1f} MB/s (whole blobs: {raw_bytes / 1e6 / raw_time_s:.1f} MB/s)"
+        )
+
+    @pytest.mark.benchmark
+    @pytest.mark.parametrize(
+        "notebook_name",
+        [
+            "04_training_linear_models.ipynb",
+            "ml-ex3.ipynb",
+            "nbexec_test_case_3.ipynb",
+            "numpy.ipynb",
+            "sklearn_tweet_classification.ipynb",
+        ],
+    )
+    def test_dedup_benchmark(self, db_path_name, tmp_nb_path, notebook_name):
+        self.store_and_report(db_path_name, notebook_name, list(self.run_notebook_snapshots(tmp_nb_path(notebook_name))))
+
+    @pytest.mark.benchmark
+    def test_dedup_benchmark_growing_variables(self, db_path_name):
+        self.store_and_report(db_path_name, "growing variables", list(self.growing_variable_snapshots(20)))
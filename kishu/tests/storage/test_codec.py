@@ -0,0 +1,125 @@
+import base64
+import json
+import os
+import sqlite3
+import time
+
+import dill
+import numpy
+import pandas
+import pytest
+
+from kishu.storage.codec import CODEC_MAGIC, CODECS, NO_CODEC, BlobCodec, available_codecs
+from kishu.storage.commit import COMMIT_ENTRY_TABLE, CommitEntry, KishuCommit
+from kishu.storage.config import Config
+from kishu.storage.path import KishuPath
+
+
+class TestBlobCodec:
+    @pytest.mark.parametrize("codec_name", available_codecs())
+    @pytest.mark.parametrize("data", [b"", b"A" * 5000, bytes(range(256)) * 20, bytearray(b"xy" * 1000000)])
+    def test_round_trip(self, codec_name, data):
+        codec = BlobCodec(CODECS[codec_name], CODECS[codec_name].default_level)
+        assert BlobCodec.decode(codec.encode(data)) == data
+        assert BlobCodec.decode(memoryview(codec.encode(data))) == data
+
+    def test_skip_incompressible(self):
+        codec = BlobCodec(CODECS["zlib"], 1)
+
+        compressible = codec.encode(b"A" * 5000)
+        assert compressible[: len(CODEC_MAGIC) + 1] == CODEC_MAGIC + bytes([CODECS["zlib"].codec_id])
+        assert len(compressible) < 100
+
+        incompressible = codec.encode(os.urandom(5000))
+        assert incompressible[: len(CODEC_MAGIC) + 1] == CODEC_MAGIC + bytes([NO_CODEC.codec_id])
+        assert len(incompressible) == 5000 + len(CODEC_MAGIC) + 1
+
+    def test_estimate_on_sample(self):
+        codec = BlobCodec(CODECS["zlib"], 1, sample_size=1000)
+
+        # Only the leading sample decides whether to compress.
+        data = os.urandom(1000) + b"A" * 100000
+        encoded = codec.encode(data)
+        assert encoded[len(CODEC_MAGIC)] == NO_CODEC.codec_id
+        assert BlobCodec.decode(encoded) == data
+
+    def test_decode_unencoded_blob(self):
+        data = dill.dumps([1, 2, 3])
+        assert BlobCodec.decode(data) == data
+
+    def test_decode_unknown_codec(self):
+        with pytest.raises(ValueError):
+            BlobCodec.decode(CODEC_MAGIC + bytes([255]) + b"data")
+
+    def test_from_config(self, tmp_kishu_path):
+        Config.set("PLANNER", "compression_codec", "lzma")
+        Config.set("PLANNER", "compression_level", 3)
+        codec = BlobCodec.from_config()
+        assert codec.codec.name == "lzma"
+        assert codec.level == 3
+
+        Config.set("PLANNER", "compression_codec", "unknown")
+        with pytest.raises(ValueError):
+            BlobCodec.from_config()
+
+    @pytest.mark.benchmark
+    def test_codec_benchmark(self):
+        """
+        Measures compression throughput and ratio of each codec and level on typical checkpoint blobs.
+        """
+        payloads = {
+            "random floats df": dill.dumps(pandas.DataFrame({f"c{i}": numpy.random.rand(200000) for i in range(10)})),
+            "int list": dill.dumps(list(range(1000000))),
+            "categorical df": dill.dumps(pandas.DataFrame({"c": numpy.random.choice(["a", "bb", "ccc"], 1000000)})),
+            "notebook json": json.dumps(
+                {
+                    "cells": [
+                        {"source": "x = 1\n" * 100, "png": base64.b64encode(os.urandom(200000)).decode()} for _ in range(10)
+                    ]
+                }
+            ).encode(),
+        }
+        for payload_name, payload in payloads.items():
+            for codec_name in available_codecs():
+                for level in [0] if codec_name == NO_CODEC.name else sorted({CODECS[codec_name].default_level, 6}):
+                    codec = BlobCodec(CODECS[codec_name], level)
+                    start_time = time.time()
+                    encoded = codec.encode(payload)
+                    encode_time_s = time.time() - start_time
+                    start_time = time.time()
+                    BlobCodec.decode(encoded)
+                    decode_time_s = time.time() - start_time
+                    print(
+                        f"{payload_name} ({len(payload) / 1e6:.1f} MB), {codec_name}-{level}: "
+                        f"ratio {len(payload) / len(encoded):.2f}x, "
+                        f"compress {len(payload) / 1e6 / encode_time_s:.0f} MB/s, "
+                        f"decompress {len(payload) / 1e6 / decode_time_s:.0f} MB/s"
+                    )
+
+
+class TestCompressedCommitEntry:
+    @pytest.fixture
+    def kishu_commit(self, nb_simple_path):
+        kishu_commit = KishuCommit(KishuPath.database_path(nb_simple_path))
+        kishu_commit.init_database()
+        yield kishu_commit
+        os.remove(kishu_commit.database_path)
+
+    def test_store_compressed(self, kishu_commit):
+        commit_entry = CommitEntry(commit_id="1", raw_nb=json.dumps({"cells": [{"source": "x = 1"}] * 1000}))
+        kishu_commit.store_commit(commit_entry)
+
+        con = sqlite3.connect(kishu_commit.database_path)
+        stored_size = con.execute(f"select length(data) from {COMMIT_ENTRY_TABLE}").fetchone()[0]
+        assert stored_size < len(dill.dumps(commit_entry)) / 10
+        assert kishu_commit.get_commit("1") == commit_entry
+        assert kishu_commit.get_commits(["1"]) == {"1": commit_entry}
+
+    def test_read_uncompressed(self, kishu_commit):
+        # Commit entries stored before compression are read as is.
+        commit_entry = CommitEntry(commit_id="1", message="uncompressed")
+        con = sqlite3.connect(kishu_commit.database_path)
+        con.execute(f"insert into {COMMIT_ENTRY_TABLE} values (?, ?)", ("1", dill.dumps(commit_entry)))
+        con.commit()
+
+        assert kishu_commit.get_commit("1") == commit_entry
@@ -1,4 +1,6 @@
+import os
 import sqlite3
+import time
 from typing import Generator
 
 import pytest
@@ -6,6 +8,7 @@
 from kishu.jupyter.namespace import Namespace
 from kishu.storage.config import Config
 from kishu.storage.disk_ahg import (
+    AHG_ACTIVE_VSES_COMMIT_TABLE,
     AHG_ACTIVE_VSES_TABLE,
     AHG_CE_INPUT_TABLE,
     AHG_CE_OUTPUT_TABLE,
@@ -52,6 +55,9 @@ def test_create_tables(self, kishu_disk_ahg):
         cur.execute(f"SELECT count(*) FROM sqlite_master WHERE type='table' AND name='{AHG_ACTIVE_VSES_TABLE}';")
         assert cur.fetchone()[0] == 1
 
+        cur.execute(f"SELECT count(*) FROM sqlite_master WHERE type='table' AND name='{AHG_ACTIVE_VSES_COMMIT_TABLE}';")
+        assert cur.fetchone()[0] == 1
+
     def test_disk_ahg(self, kishu_disk_ahg):
         """
         Store a few commits corresponding to this test graph.
@@ -112,6 +118,198 @@ def test_disk_ahg(self, kishu_disk_ahg):
         # Active VSes.
         assert set(kishu_disk_ahg.get_active_vses("1:3")) == {vs2, vs3}
 
+    def test_active_vses_delta(self, kishu_disk_ahg):
+        Config.set("PLANNER", "active_vses_keyframe_interval", 3)
+        vses = [VariableSnapshot(frozenset({f"x{i}"}), i) for i in range(6)]
+
+        # Each cell creates a new VS and deletes the second latest VS; commit 5 branches off from commit 3.
+        parents = ["", "1:0", "1:1", "1:2", "1:3", "1:2"]
+        expected_active_vses = [{vses[0]}, {vses[0], vses[1]}, {vses[1], vses[2]}]
+        expected_active_vses += [{vses[2], vses[3]}, {vses[3], vses[4]}, {vses[1], vses[5]}]
+        for i in range(6):
+            kishu_disk_ahg.store_update_results(
+                AHGUpdateResult(
+                    commit_id=f"1:{i}",
+                    accessed_vss=[],
+                    output_vss=[vses[i]],
+                    newest_ce=CellExecution(i, f"x{i} = {i}"),
+                    active_vss=list(expected_active_vses[i]),
+                    parent_commit_id=parents[i],
+                )
+            )
+
+        # Commits 1:0, 1:3 and 1:5 are keyframes; the others only store their changes.
+        con = sqlite3.connect(kishu_disk_ahg.database_path)
+        cur = con.cursor()
+        cur.execute(f"SELECT commit_id FROM {AHG_ACTIVE_VSES_COMMIT_TABLE} WHERE keyframe_distance = 0")
+        assert {row[0] for row in cur.fetchall()} == {"1:0", "1:3", "1:5"}
+        cur.execute(f"SELECT is_removed FROM {AHG_ACTIVE_VSES_TABLE} WHERE commit_id = '1:2'")
+        assert sorted(row[0] for row in cur.fetchall()) == [False, True]  # x2 is added, x0 is removed.
+
+        # Active VSes are correctly materialized, with and without cached results.
+        fresh_disk_ahg = KishuDiskAHG(kishu_disk_ahg.database_path)
+        for i in range(6):
+            assert set(kishu_disk_ahg.get_active_vses(f"1:{i}")) == expected_active_vses[i]
+            assert set(fresh_disk_ahg.get_active_vses(f"1:{i}")) == expected_active_vses[i]
+
+    def test_active_vses_missing_commit(self, kishu_disk_ahg):
+        assert kishu_disk_ahg.get_active_vses("1:1") == []
+
+    def test_active_vses_missing_parent(self, kishu_disk_ahg):
+        Config.set("PLANNER", "active_vses_keyframe_interval", 3)
+        vses = [VariableSnapshot(frozenset({f"x{i}"}), i) for i in range(2)]
+        for i in range(2):
+            kishu_disk_ahg.store_update_results(
+                AHGUpdateResult(
+                    commit_id=f"1:{i}",
+                    accessed_vss=[],
+                    output_vss=[vses[i]],
+                    newest_ce=CellExecution(i, f"x{i} = {i}"),
+                    active_vss=vses[: i + 1],
+                    parent_commit_id=f"1:{i - 1}" if i else "",
+                )
+            )
+
+        # Commit 1:1 is stored as a delta of 1:0; without 1:0 its active VSes cannot be rebuilt.
+        con = sqlite3.connect(kishu_disk_ahg.database_path)
+        con.execute(f"DELETE FROM {AHG_ACTIVE_VSES_COMMIT_TABLE} WHERE commit_id = '1:0'")
+        con.commit()
+        with pytest.raises(ValueError):
+            KishuDiskAHG(kishu_disk_ahg.database_path).get_active_vses("1:1")
+
+    def test_get_many_cells(self, kishu_disk_ahg):
+        # More cells than SQLite's default limit of 999 variables in older versions.
+        num_cells = 2000
+        con = sqlite3.connect(kishu_disk_ahg.database_path)
+        con.executemany(
+            f"INSERT INTO {AHG_CELL_EXECUTION_TABLE} VALUES (?, ?, ?)", [(i, f"x = {i}", 1.0) for i in range(num_cells)]
+        )
+        con.commit()
+        con.close()
+
+        cells = kishu_disk_ahg.get_cells_by_cell_nums(list(range(num_cells + 1)))
+        assert cells == {i: f"x = {i}" for i in range(num_cells)}
+
+    def test_migrate_full_active_vses(self, db_path_name):
+        # Active VSes stored in full by older versions, whose table had no primary key.
+        con = sqlite3.connect(db_path_name)
+        con.execute(f"CREATE TABLE {AHG_VARIABLE_SNAPSHOT_TABLE} (versioned_name text primary key, deleted bool, size float)")
+        con.execute(f"CREATE TABLE {AHG_CELL_EXECUTION_TABLE} (cell_num int primary key, cell text, cell_runtime_s float)")
+        con.execute(
+            f"CREATE TABLE {AHG_CE_INPUT_TABLE} (cell_num int, versioned_name text, primary key (cell_num, versioned_name))"
+        )
+        con.execute(
+            f"CREATE TABLE {AHG_CE_OUTPUT_TABLE} (cell_num int, versioned_name text, primary key (cell_num, versioned_name))"
+        )
+        con.execute(f"CREATE TABLE {AHG_ACTIVE_VSES_TABLE} (commit_id text, versioned_name text)")
+        con.executemany(
+            f"INSERT INTO {AHG_VARIABLE_SNAPSHOT_TABLE} VALUES (?, ?, ?)", [("0,x", False, 1.0), ("1,y", False, 1.0)]
+        )
+        con.executemany(
+            f"INSERT INTO {AHG_ACTIVE_VSES_TABLE} VALUES (?, ?)",
+            [("1:0", "0,x"), ("1:1", "0,x"), ("1:1", "1,y"), ("1:1", "0,x")],
+        )
+        con.commit()
+
+        kishu_disk_ahg = KishuDiskAHG(db_path_name)
+        kishu_disk_ahg.init_database()
+        kishu_disk_ahg.init_database()
+        vs_x, vs_y = VariableSnapshot(frozenset({"x"}), 0), VariableSnapshot(frozenset({"y"}), 1)
+        assert set(kishu_disk_ahg.get_active_vses("1:0")) == {vs_x}
+        assert set(kishu_disk_ahg.get_active_vses("1:1")) == {vs_x, vs_y}
+
+        # Migrated commits are keyframes, which new commits can be stored as deltas of.
+        Config.set("PLANNER", "active_vses_keyframe_interval", 3)
+        vs_z = VariableSnapshot(frozenset({"z"}), 2)
+        kishu_disk_ahg.store_update_results(
+            AHGUpdateResult(
+                commit_id="1:2",
+                accessed_vss=[],
+                output_vss=[vs_z],
+                newest_ce=CellExecution(2, "z = 2"),
+                active_vss=[vs_x, vs_y, vs_z],
+                parent_commit_id="1:1",
+            )
+        )
+        cur = con.cursor()
+        cur.execute(f"SELECT commit_id, keyframe_distance, cell_num FROM {AHG_ACTIVE_VSES_COMMIT_TABLE} ORDER BY commit_id")
+        assert cur.fetchall() == [("1:0", 0, None), ("1:1", 0, None), ("1:2", 1, 2)]
+        assert set(KishuDiskAHG(db_path_name).get_active_vses("1:2")) == {vs_x, vs_y, vs_z}
+        kishu_disk_ahg.drop_database()
+
+    def test_migrate_chain_without_cell_num(self, db_path_name):
+        # Chain rows stored without the commit's cell number by older versions.
+        con = sqlite3.connect(db_path_name)
+        con.execute(
+            f"CREATE TABLE {AHG_ACTIVE_VSES_TABLE} "
+            "(commit_id text, versioned_name text, is_removed bool, primary key (commit_id, versioned_name))"
+        )
+        con.execute(
+            f"CREATE TABLE {AHG_ACTIVE_VSES_COMMIT_TABLE} "
+            "(commit_id text primary key, parent_commit_id text, keyframe_distance int)"
+        )
+        con.execute(f"INSERT INTO {AHG_ACTIVE_VSES_COMMIT_TABLE} VALUES ('1:0', '', 0)")
+        con.commit()
+
+        kishu_disk_ahg = KishuDiskAHG(db_path_name)
+        kishu_disk_ahg.init_database()
+        cur = con.cursor()
+        cur.execute(f"SELECT * FROM {AHG_ACTIVE_VSES_COMMIT_TABLE}")
+        assert cur.fetchall() == [("1:0", "", 0, None)]
+        kishu_disk_ahg.drop_database()
+
+    @pytest.mark.benchmark
+    @pytest.mark.parametrize("keyframe_interval", [1, 64])
+    def test_active_vses_delta_benchmark(self, kishu_disk_ahg, keyframe_interval):
+        """
+        Stores the active VSes of a 2,000-cell session with 300 variables in which each cell modifies one variable.
+        A keyframe interval of 1 stores every active VS set in full.
+        """
+        Config.set("PLANNER", "active_vses_keyframe_interval", keyframe_interval)
+        num_cells, num_variables = 2000, 300
+        active_vses = {f"x{i}": VariableSnapshot(frozenset({f"x{i}"}), 0) for i in range(num_variables)}
+
+        start_time = time.time()
+        kishu_disk_ahg.store_update_results(
+            AHGUpdateResult(
+                commit_id="1:0",
+                accessed_vss=[],
+                output_vss=list(active_vses.values()),
+                newest_ce=CellExecution(0, "x = 1"),
+                active_vss=list(active_vses.values()),
+            )
+        )
+        for cell_num in range(1, num_cells + 1):
+            vs = VariableSnapshot(frozenset({f"x{cell_num % num_variables}"}), cell_num)
+            active_vses[f"x{cell_num % num_variables}"] = vs
+            kishu_disk_ahg.store_update_results(
+                AHGUpdateResult(
+                    commit_id=f"1:{cell_num}",
+                    accessed_vss=[],
+                    output_vss=[vs],
+                    newest_ce=CellExecution(cell_num, "x = 1"),
+                    active_vss=list(active_vses.values()),
+                    parent_commit_id=f"1:{cell_num - 1}",
+                )
+            )
+        write_time_s = time.time() - start_time
+
+        start_time = time.time()
+        fresh_disk_ahg = KishuDiskAHG(kishu_disk_ahg.database_path)
+        for cell_num in range(1, num_cells + 1, 97):
+            assert len(fresh_disk_ahg.get_active_vses(f"1:{cell_num}")) == num_variables
+        read_time_s = time.time() - start_time
+
+        con = sqlite3.connect(kishu_disk_ahg.database_path)
+        num_rows = con.execute(f"SELECT count(*) FROM {AHG_ACTIVE_VSES_TABLE}").fetchone()[0]
+        con.execute("VACUUM")
+        con.close()
+        db_size = os.path.getsize(kishu_disk_ahg.database_path)
+        print(
+            f"keyframe_interval={keyframe_interval}: {num_rows} active VS rows, {db_size / 1e6:.2f} MB, "
+            f"write {write_time_s:.2f} s, read {read_time_s:.3f} s"
+        )
+
 
 class TestProfiling:
     @pytest.fixture()
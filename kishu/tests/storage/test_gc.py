@@ -0,0 +1,316 @@
+import os
+import sqlite3
+import time
+
+import numpy
+import pytest
+
+from kishu.exceptions import CommitIdNotExistError
+from kishu.planning.ahg_cache import AHGCache
+from kishu.storage.blob_backend import PackfileBlobBackend
+from kishu.storage.branch import KishuBranch
+from kishu.storage.buffer_store import KishuBufferStore
+from kishu.storage.checkpoint import KishuCheckpoint
+from kishu.storage.chunk_store import CHUNK_TABLE
+from kishu.storage.commit import KishuCommit
+from kishu.storage.commit_graph import KishuCommitGraph
+from kishu.storage.config import Config
+from kishu.storage.disk_ahg import (
+    AHG_CELL_EXECUTION_TABLE,
+    AHG_VARIABLE_SNAPSHOT_TABLE,
+    AHGUpdateResult,
+    CellExecution,
+    KishuDiskAHG,
+    VariableSnapshot,
+)
+from kishu.storage.gc import KishuGarbageCollector
+from kishu.storage.path import KishuPath
+from kishu.storage.tag import KishuTag, TagRow
+
+
+class TestGarbageCollector:
+    @pytest.fixture
+    def db_path_name(self, nb_simple_path):
+        database_path = KishuPath.database_path(nb_simple_path)
+        KishuGarbageCollector.init_database(database_path)
+        KishuBranch(database_path).init_database()
+        KishuCheckpoint(database_path).init_database()
+        KishuCommitGraph.new_var_graph(database_path).init_database()
+        KishuTag(database_path).init_database()
+        KishuDiskAHG(database_path).init_database()
+        yield database_path
+        os.remove(database_path)
+
+    def commit(self, database_path, parent_commit_id, update_result, checkpoint_size=100, checkpoint_obj=None):
+        """Stores a commit the same way KishuForJupyter does."""
+        graph = KishuCommitGraph.new_var_graph(database_path)
+        if parent_commit_id is None:
+            graph.reset()
+        else:
+            graph.jump(parent_commit_id)
+        graph.step(update_result.commit_id)
+        KishuDiskAHG(database_path).store_update_results(update_result)
+        checkpoint = KishuCheckpoint(database_path)
+        data = os.urandom(checkpoint_size) if checkpoint_obj is None else checkpoint.dumps(checkpoint_obj)
+        checkpoint.store_checkpoint(update_result.commit_id, data)
+
+    @pytest.fixture
+    def two_branches(self, db_path_name):
+        """
+        Commits 1:1 <- 1:2 <- 1:3 on branch main and 1:2 <- 1:4 on branch dev, with main checked out.
+        """
+        vs_x = VariableSnapshot(frozenset("x"), 1)
+        vs_y = VariableSnapshot(frozenset("y"), 2)
+        vs_z = VariableSnapshot(frozenset("z"), 3)
+        vs_w = VariableSnapshot(frozenset("w"), 4)
+        self.commit(db_path_name, None, AHGUpdateResult("1:1", [], [vs_x], CellExecution(1, "x = 1"), [vs_x]))
+        self.commit(
+            db_path_name, "1:1", AHGUpdateResult("1:2", [vs_x], [vs_y], CellExecution(2, "y = x"), [vs_x, vs_y], "1:1")
+        )
+        self.commit(
+            db_path_name,
+            "1:2",
+            AHGUpdateResult("1:3", [vs_y], [vs_z], CellExecution(3, "z = y"), [vs_x, vs_y, vs_z], "1:2"),
+        )
+        self.commit(
+            db_path_name,
+            "1:2",
+            AHGUpdateResult("1:4", [vs_x], [vs_w], CellExecution(4, "w = x"), [vs_x, vs_y, vs_w], "1:2"),
+            checkpoint_size=100000,
+        )
+
+        branch = KishuBranch(db_path_name)
+        branch.upsert_branch("main", "1:3")
+        branch.upsert_branch("dev", "1:4")
+        branch.update_head("main", "1:3")
+        KishuCommitGraph.new_var_graph(db_path_name).jump("1:3")
+        return db_path_name
+
+    def test_nothing_to_collect(self, two_branches):
+        stats = KishuGarbageCollector(two_branches).collect()
+
+        assert stats.num_deleted_commits == 0
+        assert stats.freed_bytes == 0
+        assert len(KishuCommitGraph.new_var_graph(two_branches).list_all_history()) == 4
+
+    def test_collect_deleted_branch(self, two_branches):
+        KishuBranch(two_branches).delete_branch("dev")
+
+        stats = KishuGarbageCollector(two_branches).collect()
+
+        assert stats.num_deleted_commits == 1
+        assert stats.num_deleted_cell_executions == 1
+        assert stats.num_deleted_variable_snapshots == 1
+        assert stats.freed_bytes > 0
+        assert stats.reclaimed_bytes > 0
+        assert stats.database_size_after == os.path.getsize(two_branches)
+
+        assert {node.commit_id for node in KishuCommitGraph.new_var_graph(two_branches).list_all_history()} == {
+            "1:1",
+            "1:2",
+            "1:3",
+        }
+        with pytest.raises(CommitIdNotExistError):
+            KishuCheckpoint(two_branches).get_checkpoint("1:4")
+        assert len(KishuCheckpoint(two_branches).get_checkpoint("1:3")) == 100
+        con = sqlite3.connect(two_branches)
+        assert con.execute(f"select count(*) from {CHUNK_TABLE}").fetchone()[0] == 3
+        con.close()
+
+        disk_ahg = KishuDiskAHG(two_branches)
+        assert {ce.cell_num for ce in disk_ahg.get_all_cell_executions()} == {1, 2, 3}
+        assert {vs.version for vs in disk_ahg.get_all_variable_snapshots()} == {1, 2, 3}
+        assert {vs.version for vs in disk_ahg.get_active_vses("1:3")} == {1, 2, 3}
+
+    def test_invalidate_attached_ahg_cache(self, two_branches):
+        # Commit 1:5 after 1:4 so that collecting 1:4 does not delete the latest AHG nodes.
+        vs_v = VariableSnapshot(frozenset("v"), 5)
+        self.commit(two_branches, "1:3", AHGUpdateResult("1:5", [], [vs_v], CellExecution(5, "v = 5"), [vs_v], "1:3"))
+        KishuBranch(two_branches).upsert_branch("main", "1:5")
+        KishuBranch(two_branches).update_head("main", "1:5")
+        cache = AHGCache(two_branches)
+        assert cache.get_snapshot().num_ces() == 5
+        KishuBranch(two_branches).delete_branch("dev")
+
+        KishuGarbageCollector(two_branches).collect()
+
+        assert {ce.cell_num for ce in cache.get_snapshot().get_ces(range(cache.get_snapshot().num_ces()))} == {1, 2, 3, 5}
+
+    def test_tag_keeps_commit(self, two_branches):
+        KishuTag(two_branches).upsert_tag(TagRow("keep", "1:4", ""))
+        KishuBranch(two_branches).delete_branch("dev")
+
+        stats = KishuGarbageCollector(two_branches).collect()
+
+        assert stats.num_deleted_commits == 0
+        assert {ce.cell_num for ce in KishuDiskAHG(two_branches).get_all_cell_executions()} == {1, 2, 3, 4}
+
+    def test_keep_restore_sources(self, two_branches):
+        """
+        Commits after the deleted ones may still need their CEs to recompute their active VSes.
+        """
+        con = sqlite3.connect(two_branches)
+        con.execute("delete from var_commit_parent where commit_id = '1:3'")
+        con.execute("insert into var_commit_parent values ('1:3', '')")
+        con.execute("update ahg_active_vses_commit set parent_commit_id = '', keyframe_distance = 0 where commit_id = '1:3'")
+        con.execute("insert into ahg_active_vses values ('1:3', '1,x', 0), ('1:3', '2,y', 0)")
+        con.commit()
+        con.close()
+        KishuBranch(two_branches).delete_branch("dev")
+
+        stats = KishuGarbageCollector(two_branches).collect()
+
+        # 1:1 and 1:2 are unreachable, but restoring 1:3 may rerun their CEs.
+        assert stats.num_deleted_commits == 3
+        assert stats.num_deleted_cell_executions == 1
+        assert {ce.cell_num for ce in KishuDiskAHG(two_branches).get_all_cell_executions()} == {1, 2, 3}
+        assert {vs.version for vs in KishuDiskAHG(two_branches).get_active_vses("1:3")} == {1, 2, 3}
+
+    def test_delete_unreferenced_buffers(self, two_branches):
+        Config.set("PLANNER", "out_of_band_min_size", 1000)
+        shared_array = numpy.random.rand(10000)
+        vs_a = VariableSnapshot(frozenset("a"), 5)
+        vs_b = VariableSnapshot(frozenset("b"), 6)
+        self.commit(
+            two_branches,
+            "1:3",
+            AHGUpdateResult("1:5", [], [vs_a], CellExecution(5, "a = 1"), [vs_a], "1:3"),
+            checkpoint_obj=[shared_array, numpy.random.rand(10000)],
+        )
+        self.commit(
+            two_branches,
+            "1:4",
+            AHGUpdateResult("1:6", [], [vs_b], CellExecution(6, "b = 1"), [vs_b], "1:4"),
+            checkpoint_obj=[shared_array, numpy.random.rand(10000)],
+        )
+        KishuBranch(two_branches).upsert_branch("main", "1:5")
+        KishuBranch(two_branches).update_head("main", "1:5")
+        KishuCommitGraph.new_var_graph(two_branches).jump("1:5")
+        buffer_directory = KishuBufferStore.buffer_directory(two_branches)
+        for path in buffer_directory.iterdir():
+            os.utime(path, (0, 0))
+        KishuBranch(two_branches).delete_branch("dev")
+
+        stats = KishuGarbageCollector(two_branches).collect()
+
+        # Only the buffer of the array not shared with 1:5 is deleted.
+        assert stats.num_deleted_commits == 2
+        assert stats.num_deleted_buffers == 1
+        assert stats.deleted_buffer_bytes == 80000
+        assert len(list(buffer_directory.iterdir())) == 2
+        checkpoint = KishuCheckpoint(two_branches)
+        assert numpy.array_equal(checkpoint.loads(checkpoint.get_checkpoint("1:5"))[0], shared_array)
+
+    def test_repack_packfiles(self, two_branches):
+        Config.set("PLANNER", "blob_backend", "packfile")
+        Config.set("PLANNER", "packfile_max_size", 50000)
+        vs_a = VariableSnapshot(frozenset("a"), 5)
+        vs_b = VariableSnapshot(frozenset("b"), 6)
+        vs_c = VariableSnapshot(frozenset("c"), 7)
+        self.commit(
+            two_branches,
+            "1:3",
+            AHGUpdateResult("1:5", [], [vs_a], CellExecution(5, "a = 1"), [vs_a], "1:3"),
+            checkpoint_size=60000,
+        )
+        self.commit(
+            two_branches,
+            "1:4",
+            AHGUpdateResult("1:6", [], [vs_b], CellExecution(6, "b = 1"), [vs_b], "1:4"),
+            checkpoint_size=60000,
+        )
+        self.commit(
+            two_branches,
+            "1:5",
+            AHGUpdateResult("1:7", [], [vs_c], CellExecution(7, "c = 1"), [vs_c], "1:5"),
+            checkpoint_size=60000,
+        )
+        KishuBranch(two_branches).upsert_branch("main", "1:7")
+        KishuBranch(two_branches).update_head("main", "1:7")
+        KishuCommitGraph.new_var_graph(two_branches).jump("1:7")
+        KishuBranch(two_branches).delete_branch("dev")
+
+        stats = KishuGarbageCollector(two_branches).collect()
+
+        # Only the packfile of 1:6 is dead; the one of 1:7 is still being appended to.
+        assert stats.num_deleted_commits == 2
+        assert stats.num_deleted_packfiles == 1
+        assert stats.reclaimed_packfile_bytes > 60000
+        assert len(list(PackfileBlobBackend.packfile_directory(two_branches).iterdir())) == 2
+        assert len(KishuCheckpoint(two_branches).get_checkpoint("1:5")) == 60000
+
+    def test_full_vacuum(self, two_branches):
+        # Databases created without incremental vacuuming only shrink with a full vacuum.
+        con = sqlite3.connect(two_branches)
+        con.execute("PRAGMA auto_vacuum = NONE")
+        con.execute("VACUUM")
+        con.close()
+        KishuBranch(two_branches).delete_branch("dev")
+
+        stats = KishuGarbageCollector(two_branches).collect(full_vacuum=True)
+
+        assert stats.reclaimed_bytes > 0
+        con = sqlite3.connect(two_branches)
+        assert con.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        assert con.execute(f"select count(*) from {AHG_CELL_EXECUTION_TABLE}").fetchone()[0] == 3
+        assert con.execute(f"select count(*) from {AHG_VARIABLE_SNAPSHOT_TABLE}").fetchone()[0] == 3
+        con.close()
+
+    def test_keep_commit_being_made(self, kishu_shell, set_notebook_path_env, monkeypatch):
+        ip = kishu_shell()
+        ip.run_cell("x = 1")
+        kishu_jupyter = ip.user_ns["_kishu"]
+        database_path = kishu_jupyter.database_path()
+
+        # Collect after the commit's rows are written, but before HEAD steps to it.
+        stats = []
+        step = KishuCommitGraph.step
+
+        def collect_and_step(graph, commit_id):
+            stats.append(KishuGarbageCollector(database_path).collect())
+            step(graph, commit_id)
+
+        monkeypatch.setattr(KishuCommitGraph, "step", collect_and_step)
+        ip.run_cell("y = 2")
+
+        assert [s.num_deleted_commits for s in stats] == [0, 0]
+        head_commit_id = KishuBranch(database_path).get_head().commit_id
+        assert KishuCommit(database_path).get_commit(head_commit_id).raw_cell == "y = 2"
+        assert {vs.name for vs in KishuDiskAHG(database_path).get_active_vses(head_commit_id)} == {
+            frozenset("x"),
+            frozenset("y"),
+        }
+
+    @pytest.mark.benchmark
+    def test_gc_benchmark(self, db_path_name):
+        """
+        Collects an abandoned branch of 1,000 commits with 100 KB checkpoints each, forked off a 1,000-commit history.
+        """
+        num_commits, checkpoint_size = 1000, 100000
+        parent_commit_id = None
+        for cell_num in range(1, 2 * num_commits + 1):
+            commit_id = f"1:{cell_num}"
+            if cell_num == num_commits + 1:
+                KishuBranch(db_path_name).upsert_branch("main", parent_commit_id)
+                parent_commit_id = "1:1"
+            vs = VariableSnapshot(frozenset({f"x{cell_num % 10}"}), cell_num)
+            self.commit(
+                db_path_name,
+                parent_commit_id,
+                AHGUpdateResult(commit_id, [], [vs], CellExecution(cell_num, "x = 1"), [vs], parent_commit_id or ""),
+                checkpoint_size=checkpoint_size,
+            )
+            parent_commit_id = commit_id
+        KishuBranch(db_path_name).update_head("main", f"1:{num_commits}")
+        KishuCommitGraph.new_var_graph(db_path_name).jump(f"1:{num_commits}")
+
+        start_time = time.time()
+        stats = KishuGarbageCollector(db_path_name).collect()
+        runtime_s = time.time() - start_time
+
+        assert stats.num_deleted_commits == num_commits
+        print(
+            f"Deleted {stats.num_deleted_commits} commits: freed {stats.freed_bytes / 1e6:.1f} MB, "
+            f"reclaimed {stats.reclaimed_bytes / 1e6:.1f} MB of {stats.database_size_before / 1e6:.1f} MB "
+            f"in {runtime_s:.2f} s"
+        )
@@ -0,0 +1,47 @@
+from kishu.storage.snapshot_cache import SnapshotCache
+
+
+class TestSnapshotCache:
+    def test_bounded(self):
+        cache = SnapshotCache(max_size=20)
+        cache.put("1,a", b"a" * 10)
+        cache.put("1,b", b"b" * 10)
+        assert cache.get("1,a") == b"a" * 10
+
+        # The least recently used blob is evicted.
+        cache.put("1,c", b"c" * 10)
+        assert cache.size() == 20
+        assert cache.get("1,b") is None
+        assert cache.get("1,a") == b"a" * 10
+        assert cache.get("1,c") == b"c" * 10
+        assert (cache.stats.hits, cache.stats.misses, cache.stats.evictions) == (3, 1, 1)
+
+        # Blobs larger than the cache are not cached.
+        cache.put("1,d", b"d" * 30)
+        assert cache.get("1,d") is None
+        assert cache.get("1,a") == b"a" * 10
+
+    def test_compression(self):
+        cache = SnapshotCache(max_size=1000, compress=True)
+        cache.put("1,a", b"a" * 10000)
+        assert cache.size() < 1000
+        assert cache.get("1,a") == b"a" * 10000
+
+    def test_disabled(self):
+        cache = SnapshotCache(max_size=0)
+        cache.put("1,a", b"a")
+        assert not cache.enabled()
+        assert cache.get("1,a") is None
+
+    def test_database_replaced(self, tmp_path):
+        database_path = tmp_path / "kishu.sqlite"
+        database_path.write_bytes(b"")
+        cache = SnapshotCache.for_database(database_path)
+        cache.put("1,a", b"a")
+        assert SnapshotCache.for_database(database_path).get("1,a") == b"a"
+
+        (tmp_path / "other.sqlite").write_bytes(b"")
+        (tmp_path / "other.sqlite").replace(database_path)
+        assert SnapshotCache.for_database(database_path) is cache
+        assert cache.get("1,a") is None
+        assert cache.stats.invalidations == 1
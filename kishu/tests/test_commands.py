@@ -381,6 +381,38 @@ def test_delete_tag_nonexisting(self, basic_notebook_path, basic_execution_ids):
             message="The provided tag 'NON_EXISTENT_TAG' does not exist.",
         )
 
+    def test_gc(self, kishu_jupyter, basic_notebook_path, basic_execution_ids):
+        # Move everything off the latest commit, leaving it unreachable.
+        database_path = KishuPath.database_path(basic_notebook_path)
+        kishu_branch = KishuBranch(database_path)
+        kishu_branch.update_head(commit_id=basic_execution_ids[1], is_detach=True)
+        for branch in kishu_branch.list_branch():
+            kishu_branch.delete_branch(branch.branch_name)
+        KishuCommitGraph.new_var_graph(database_path).jump(basic_execution_ids[1])
+        KishuCommitGraph.new_nb_graph(database_path).jump(basic_execution_ids[1])
+
+        gc_result = KishuCommand.gc(basic_notebook_path)
+        assert gc_result.status == "ok"
+        assert gc_result.stats.num_deleted_commits == 1
+        log_result = KishuCommand.log_all(basic_notebook_path)
+        assert [commit.commit_id for commit in log_result.commit_graph] == basic_execution_ids[:2]
+
+        # The attached kernel keeps committing.
+        commit_id = kishu_jupyter.commit(CommitEntry(kind=CommitEntryKind.manual, execution_count=4, raw_cell="z = 3"))
+        log_result = KishuCommand.log_all(basic_notebook_path)
+        assert [commit.commit_id for commit in log_result.commit_graph] == basic_execution_ids[:2] + [commit_id]
+
+    def test_gc_keeps_tagged_commit(self, basic_notebook_path, basic_execution_ids):
+        _ = KishuCommand.tag(basic_notebook_path, "tag_1", None, "")
+        kishu_branch = KishuBranch(KishuPath.database_path(basic_notebook_path))
+        kishu_branch.update_head(commit_id=basic_execution_ids[1], is_detach=True)
+        for branch in kishu_branch.list_branch():
+            kishu_branch.delete_branch(branch.branch_name)
+
+        gc_result = KishuCommand.gc(basic_notebook_path)
+        assert gc_result.stats.num_deleted_commits == 0
+        assert len(KishuCommand.log_all(basic_notebook_path).commit_graph) == 3
+
     def test_fe_commit_graph(self, basic_notebook_path, basic_execution_ids):
         fe_commit_graph_result = KishuCommand.fe_commit_graph(basic_notebook_path)
         assert len(fe_commit_graph_result.commits) == 3
@@ -1,11 +1,17 @@
+import shutil
+import time
 from pathlib import Path
-from typing import List
+from typing import Callable, List
 
 import dill
 import nbformat
 import pytest
+from IPython.core.interactiveshell import InteractiveShell
 
+from kishu.jupyter.namespace import LazyVariable
 from kishu.jupyterint import KishuForJupyter
+from kishu.planning.background import BackgroundCheckpointStatus
+from kishu.planning.planner import CheckpointRestorePlanner
 from kishu.storage.commit import KishuCommit, NotebookCommitState
 from tests.helpers.nbexec import NotebookRunner
 
@@ -59,6 +65,320 @@ def test_amend_notebook(
         assert post_latest_entry.nb_record_type == NotebookCommitState.amend_notebook
 
 
+class TestAsyncCheckpoint:
+    def test_checkout(self, kishu_shell, set_notebook_path_env):
+        ip = kishu_shell(async_checkpoint=True)
+        ip.run_cell("x = [1]")
+        ip.run_cell("y = 2")
+        ip.run_cell("x.append(3)")
+
+        # Checkout waits for the checkpoints being written.
+        kishu_jupyter = ip.user_ns["_kishu"]
+        kishu_jupyter.checkout("0:0:1")
+        assert ip.user_ns["x"] == [1]
+        assert "y" not in ip.user_ns
+        assert set(kishu_jupyter._background_checkpointer.statuses.values()) <= {
+            BackgroundCheckpointStatus.done,
+            BackgroundCheckpointStatus.skipped,
+        }
+
+    def test_slow_pickle(self, kishu_shell, set_notebook_path_env, tmp_path):
+        release_path = tmp_path / "release"
+        ip = kishu_shell(async_checkpoint=True)
+        ip.run_cell(
+            "import os, time\n"
+            "kernel_pid = os.getpid()\n"
+            "class SlowPickle:\n"
+            "    def __reduce__(self):\n"
+            "        while os.getpid() != kernel_pid and not os.path.exists({!r}):\n"
+            "            time.sleep(0.01)\n"
+            "        return (SlowPickle, ())".format(str(release_path))
+        )
+        ip.run_cell("x = SlowPickle()")
+
+        # The next cells commit while the child is still pickling x.
+        ip.run_cell("y = 1")
+        ip.run_cell("y += 1")
+        kishu_jupyter = ip.user_ns["_kishu"]
+        assert kishu_jupyter._background_checkpointer.statuses["0:0:2"] == BackgroundCheckpointStatus.running
+        kishu_commit = KishuCommit(kishu_jupyter.database_path())
+        assert [kishu_commit.get_commit(f"0:0:{i}").raw_cell for i in range(3, 5)] == ["y = 1", "y += 1"]
+
+        release_path.touch()
+        kishu_jupyter._background_checkpointer.wait()
+        assert kishu_jupyter._background_checkpointer.statuses["0:0:2"] == BackgroundCheckpointStatus.done
+        assert kishu_commit.get_commit("0:0:2").raw_cell == "x = SlowPickle()"
+
+    @pytest.mark.benchmark
+    @pytest.mark.parametrize("async_checkpoint", [False, True])
+    def test_post_run_cell_benchmark(self, kishu_shell, set_notebook_path_env, async_checkpoint):
+        """
+        Measures the checkpointing time on the critical path of cells modifying a large variable.
+        """
+        ip = kishu_shell(async_checkpoint=async_checkpoint)
+        ip.run_cell("x = {i: str(i) for i in range(200_000)}")
+        start_time = time.time()
+        for i in range(5):
+            ip.run_cell(f"x[-1] = {i}")
+        run_time_s = time.time() - start_time
+        kishu_commit = KishuCommit(ip.user_ns["_kishu"].database_path())
+        checkpoint_time_s = sum(kishu_commit.get_commit(f"0:0:{i}").checkpoint_runtime_s for i in range(2, 7))
+        start_time = time.time()
+        ip.user_ns["_kishu"].checkout("0:0:1")
+        checkout_time_s = time.time() - start_time
+        print(
+            f"async_checkpoint={async_checkpoint}: 5 cells in {run_time_s:.3f}s, "
+            f"checkpointing {checkpoint_time_s:.3f}s, checkout {checkout_time_s:.3f}s"
+        )
+
+
+class TestLazyCheckout:
+    def test_checkout(self, kishu_shell, set_notebook_path_env):
+        ip = kishu_shell(lazy_checkout=True)
+        ip.run_cell("x = [1]")
+        ip.run_cell("y = 2")
+        ip.run_cell("x.append(3)")
+
+        # Checked out variables are loaded on first access.
+        kishu_jupyter = ip.user_ns["_kishu"]
+        kishu_jupyter.checkout("0:0:1")
+        assert "y" not in ip.user_ns
+        kishu_jupyter._lazy_variable_prefetcher.stop()
+        assert type(dict.__getitem__(ip.user_ns, "x")) is LazyVariable
+        ip.run_cell("z = x + [2]")
+        assert ip.user_ns["z"] == [1, 2]
+
+        # Modifications to lazily checked out variables are committed.
+        ip.run_cell("x.append(4)")
+        commit_id = kishu_jupyter._kishu_graph.head()
+        kishu_jupyter.checkout("0:0:1")
+        kishu_jupyter.checkout(commit_id)
+        assert ip.user_ns["x"] == [1, 4]
+
+    @pytest.mark.benchmark
+    @pytest.mark.parametrize("lazy_checkout", [False, True])
+    def test_checkout_benchmark(self, kishu_shell, set_notebook_path_env, lazy_checkout):
+        """
+        Measures the checkout latency, and the time to access one variable after it, for 40 modified variables.
+        """
+        ip = kishu_shell(lazy_checkout=lazy_checkout)
+        ip.run_cell("\n".join(f"x{i} = {{j: str(j) for j in range(50_000)}}" for i in range(40)))
+        ip.run_cell("\n".join(f"x{i}[-1] = 0" for i in range(40)))
+        kishu_jupyter = ip.user_ns["_kishu"]
+        start_time = time.time()
+        kishu_jupyter.checkout("0:0:1")
+        checkout_time_s = time.time() - start_time
+        start_time = time.time()
+        ip.run_cell("y = len(x0)")
+        access_time_s = time.time() - start_time
+        assert ip.user_ns["y"] == 50_000
+        kishu_jupyter._lazy_variable_prefetcher.stop()
+        print(f"lazy_checkout={lazy_checkout}: checkout {checkout_time_s:.3f}s, then accessing x0 {access_time_s:.3f}s")
+
+
+class TestCheckoutNamespace:
+    def test_unchanged_variables_in_place(self, kishu_shell, set_notebook_path_env):
+        ip = kishu_shell()
+        ip.run_cell("x = [1]")
+        ip.run_cell("y = [2]")
+        ip.run_cell("y.append(3)\nz = len(x)")
+        x = ip.user_ns["x"]
+
+        # Only y and z differ; x is neither loaded nor moved.
+        kishu_jupyter = ip.user_ns["_kishu"]
+        commit_id = kishu_jupyter._kishu_graph.head()
+        kishu_jupyter.checkout("0:0:2")
+        assert ip.user_ns["x"] is x and ip.user_ns["y"] == [2]
+        assert "z" not in ip.user_ns
+
+        # Rerunning cell 3 reads x, which is moved to rerun it but also stays in place.
+        kishu_jupyter.checkout(commit_id)
+        assert ip.user_ns["x"] is x and ip.user_ns["y"] == [2, 3] and ip.user_ns["z"] == 1
+
+    @pytest.mark.benchmark
+    def test_checkout_benchmark(self, kishu_shell, set_notebook_path_env):
+        """
+        Measures the latency to check out the parent of a cell modifying 1 of 5000 variables.
+        """
+        ip = kishu_shell()
+        ip.run_cell("\n".join(f"x{i} = [{i}]" for i in range(5000)))
+        ip.run_cell("x0.append(1)")
+        kishu_jupyter = ip.user_ns["_kishu"]
+        start_time = time.time()
+        kishu_jupyter.checkout("0:0:1")
+        checkout_time_s = time.time() - start_time
+        assert ip.user_ns["x0"] == [0]
+        print(f"checkout {checkout_time_s:.3f}s")
+
+
+class TestUndo:
+    def test_undo(self, kishu_shell, set_notebook_path_env):
+        ip = kishu_shell(undo_buffer_cells=2)
+        ip.run_cell("x = [1]")
+        ip.run_cell("y = x")
+        ip.run_cell("x.append(2)\nz = 3")
+        ip.run_cell("del z\nw = 4")
+
+        # The last two cells are undone from memory.
+        kishu_jupyter = ip.user_ns["_kishu"]
+        kishu_jupyter.checkout("0:0:2")
+        assert ip.user_ns["x"] == [1] and ip.user_ns["y"] is ip.user_ns["x"]
+        assert "z" not in ip.user_ns and "w" not in ip.user_ns
+        assert kishu_jupyter._undo_buffer.size() > 0
+
+        # Cells undone from memory can be checked out again from storage.
+        kishu_jupyter.checkout("0:0:4")
+        assert ip.user_ns["x"] == [1, 2] and ip.user_ns["w"] == 4
+        assert "z" not in ip.user_ns
+
+    def test_undo_beyond_buffer(self, kishu_shell, set_notebook_path_env):
+        ip = kishu_shell(undo_buffer_cells=1)
+        ip.run_cell("x = 1")
+        ip.run_cell("x += 1")
+        ip.run_cell("x += 1")
+
+        # Only the last cell is kept, so the checkout restores from storage.
+        kishu_jupyter = ip.user_ns["_kishu"]
+        kishu_jupyter.checkout("0:0:1")
+        assert ip.user_ns["x"] == 1
+        assert kishu_jupyter._undo_buffer.size() == 0
+
+    @pytest.mark.benchmark
+    @pytest.mark.parametrize("undo_buffer_cells", [0, 4])
+    def test_undo_benchmark(self, kishu_shell, set_notebook_path_env, monkeypatch, undo_buffer_cells):
+        """
+        Measures the latency to undo a cell modifying 2 of 40 variables, and the part of it spent updating ID graphs.
+        """
+        ip = kishu_shell(undo_buffer_cells=undo_buffer_cells)
+        ip.run_cell("\n".join(f"x{i} = {{j: str(j) for j in range(50_000)}}" for i in range(40)))
+        start_time = time.time()
+        ip.run_cell("x0[-1] = 0\nx1[-1] = 0")
+        cell_time_s = time.time() - start_time
+
+        replace_state_times_s = []
+        replace_state = CheckpointRestorePlanner.replace_state
+
+        def timed_replace_state(*args):
+            start_time = time.time()
+            replace_state(*args)
+            replace_state_times_s.append(time.time() - start_time)
+
+        monkeypatch.setattr(CheckpointRestorePlanner, "replace_state", timed_replace_state)
+        kishu_jupyter = ip.user_ns["_kishu"]
+        start_time = time.time()
+        kishu_jupyter.checkout("0:0:1")
+        undo_time_s = time.time() - start_time
+        assert -1 not in ip.user_ns["x0"] and -1 not in ip.user_ns["x1"]
+        print(
+            f"undo_buffer_cells={undo_buffer_cells}: cell {cell_time_s:.3f}s, "
+            f"undo {undo_time_s:.3f}s ({replace_state_times_s[0]:.3f}s updating ID graphs)"
+        )
+
+
+class TestResume:
+    @staticmethod
+    def restart(ip: InteractiveShell, kishu_shell: Callable[..., InteractiveShell]) -> InteractiveShell:
+        """
+        Attaches Kishu to a new shell with an empty namespace, as after a kernel restart.
+        """
+        ip.user_ns["_kishu"].uninstall_kishu_hooks()
+        InteractiveShell.clear_instance()
+        return kishu_shell()
+
+    def test_resume(self, kishu_shell, set_notebook_path_env):
+        ip = kishu_shell(resume_lazy_size=10_000)
+        ip.run_cell("x = [1]")
+        ip.run_cell("y = list(range(10_000))")
+        ip.run_cell("x.append(2)")
+        ip.run_cell("z = (i for i in range(len(x)))")
+        head = ip.user_ns["_kishu"]._kishu_graph.head()
+
+        # The generator cannot be stored, so the cell assigning it is rerun.
+        ip = self.restart(ip, kishu_shell)
+        kishu_jupyter = ip.user_ns["_kishu"]
+        kishu_jupyter.resume()
+        kishu_jupyter._lazy_variable_prefetcher.stop()
+        assert kishu_jupyter._kishu_graph.head() == head
+        assert kishu_jupyter._kishu_branch.get_head().commit_id == head
+
+        # Large variable snapshots are loaded and ID graphs are built on first access.
+        assert type(dict.__getitem__(ip.user_ns, "y")) is LazyVariable
+        assert kishu_jupyter._cr_planner.get_id_graph_map().keys() == set()
+        ip.run_cell("x.append(3)")
+        assert ip.user_ns["x"] == [1, 2, 3] and list(ip.user_ns["z"]) == [0, 1]
+        assert "y" not in kishu_jupyter._cr_planner.get_id_graph_map()
+
+        # The modification after resuming is committed.
+        commit_id = kishu_jupyter._kishu_graph.head()
+        kishu_jupyter.checkout(head)
+        assert ip.user_ns["x"] == [1, 2] and ip.user_ns["y"] == list(range(10_000))
+        kishu_jupyter.checkout(commit_id)
+        assert ip.user_ns["x"] == [1, 2, 3]
+
+    def test_resume_twice(self, kishu_shell, set_notebook_path_env):
+        ip = kishu_shell()
+        with pytest.raises(ValueError):
+            ip.user_ns["_kishu"].resume()
+
+        ip.run_cell("x = 1")
+        ip = self.restart(ip, kishu_shell)
+        ip.user_ns["_kishu"].resume()
+        with pytest.raises(ValueError):
+            ip.user_ns["_kishu"].resume()
+        assert ip.user_ns["x"] == 1
+
+    def test_init_kishu_without_head(self, set_notebook_path_env, capsys):
+        ip = InteractiveShell()
+        ip.run_cell("from kishu import init_kishu\ninit_kishu(resume=True)")
+        assert "No earlier head to resume" in capsys.readouterr().out
+
+        # Kishu is attached nonetheless.
+        kishu_jupyter = ip.user_ns["_kishu"]
+        ip.run_cell("x = 1")
+        kishu_jupyter.checkout(kishu_jupyter._kishu_graph.head())
+        assert ip.user_ns["x"] == 1
+
+    @pytest.mark.benchmark
+    def test_resume_benchmark(self, kishu_shell, tmp_path, monkeypatch):
+        """
+        Measures the latency from a kernel restart to running a cell on the restored variables of the Kaggle notebook,
+        checking out the head before the restart or resuming it. Resuming defers loading df_train and building its ID
+        graph to that cell, so it shortens the restore rather than the total.
+        """
+        experiment_dir = Path(__file__).parent / "experiments" / "kaggle-1"
+        for name in ["kaggle-data-exploration.ipynb", "train.csv"]:
+            shutil.copy(experiment_dir / name, tmp_path / name)
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setenv("TEST_NOTEBOOK_PATH", str(tmp_path / "kaggle-data-exploration.ipynb"))
+        notebook = nbformat.read(tmp_path / "kaggle-data-exploration.ipynb", 4)
+
+        ip = kishu_shell()
+        for cell in notebook.cells:
+            if cell.cell_type == "code":
+                ip.run_cell(cell.source.replace("%matplotlib inline", ""))
+        head = ip.user_ns["_kishu"]._kishu_graph.head()
+
+        for session_id, resume in enumerate([False, True], start=1):
+            ip = self.restart(ip, kishu_shell)
+            kishu_jupyter = ip.user_ns["_kishu"]
+            kishu_jupyter.set_session_id(session_id)
+            start_time = time.time()
+            if resume:
+                kishu_jupyter.resume()
+            else:
+                kishu_jupyter.checkout(head)
+            restore_time_s = time.time() - start_time
+            start_time = time.time()
+            ip.run_cell("shape = df_train.shape")
+            cell_time_s = time.time() - start_time
+            assert ip.user_ns["shape"][0] > 0
+            kishu_jupyter._lazy_variable_prefetcher.stop()
+            print(
+                f"{'resume' if resume else 'checkout'}: restore {restore_time_s:.3f}s, then first cell {cell_time_s:.3f}s, "
+                f"total {restore_time_s + cell_time_s:.3f}s"
+            )
+
+
 class TestOnNotebookRunner:
 
     # Modify the test_checkout to use the new fixture.